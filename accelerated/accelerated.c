@@ -98,7 +98,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -123,198 +123,460 @@ PyObject *py_varint_decode(PyObject *self, PyObject *args) {
 }
 
 
+// Determines the lengths of the tag, the length prefix and the data of the
+// field at the start of the buffer. Returns 1 on success, otherwise an
+// exception is set and 0 is returned.
+static int field_lengths(const char *data, Py_ssize_t remaining,
+                         Py_ssize_t *tag_length, Py_ssize_t *prefix_length,
+                         Py_ssize_t *data_length) {
+  unsigned PY_LONG_LONG tag;
+
+  *prefix_length = 0;
+  if (!varint_decode(&tag, data, remaining, tag_length)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid tag");
+    return 0;
+  }
+
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT: {
+      unsigned PY_LONG_LONG value;
+
+      if (!varint_decode(&value, data + *tag_length, remaining - *tag_length,
+                         data_length)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid varint.");
+        return 0;
+      }
+      break;
+    }
+
+    case WIRETYPE_FIXED64:
+      *data_length = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      *data_length = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED: {
+      unsigned PY_LONG_LONG data_size;
+
+      if (!varint_decode(&data_size, data + *tag_length,
+                         remaining - *tag_length, prefix_length)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid length.");
+        return 0;
+      }
+
+      if (data_size > (unsigned PY_LONG_LONG)(remaining - *tag_length -
+                                               *prefix_length)) {
+        PyErr_SetString(
+            PyExc_ValueError, "Length tag exceeds available buffer.");
+        return 0;
+      }
+      *data_length = (Py_ssize_t)data_size;
+      break;
+    }
+
+    default:
+      PyErr_SetString(PyExc_ValueError, "Unexpected Tag");
+      return 0;
+  }
+
+  if (*data_length > remaining - *tag_length - *prefix_length) {
+    PyErr_SetString(PyExc_ValueError, "Field exceeds available buffer.");
+    return 0;
+  }
+
+  return 1;
+}
+
+
+// Splits the next field off the buffer. On success, *entry is set to a new
+// (encoded_tag, encoded_length, data) tuple of strings, buffer and length are
+// advanced past the field and 1 is returned. Otherwise an exception is set and
+// 0 is returned.
+static int split_next(const char **buffer, Py_ssize_t *length,
+                      PyObject **entry) {
+  const char *data = *buffer;
+  Py_ssize_t tag_length = 0;
+  Py_ssize_t prefix_length = 0;
+  Py_ssize_t data_length = 0;
+
+  if (!field_lengths(data, *length, &tag_length, &prefix_length,
+                     &data_length))
+    return 0;
+
+  *entry = Py_BuildValue(
+      "(s#s#s#)", data, tag_length, data + tag_length, prefix_length,
+      data + tag_length + prefix_length, data_length);
+  if (!*entry)
+    return 0;
+
+  *buffer += tag_length + prefix_length + data_length;
+  *length -= tag_length + prefix_length + data_length;
+  return 1;
+}
+
+
+// Positions buffer and length on the part of the buffer we are asked to parse.
+static int select_range(const char **buffer, Py_ssize_t *buffer_len,
+                        Py_ssize_t index, Py_ssize_t length) {
+  if (index < 0 || length < 0 || index > *buffer_len) {
+    PyErr_SetString(
+        PyExc_ValueError, "Invalid parameters.");
+    return 0;
+  }
+
+  // Advance the buffer to the required start index.
+  *buffer += index;
+
+  // Determine the length we will be splitting.
+  if (length == 0 || length > *buffer_len - index) {
+    length = *buffer_len - index;
+  }
+  *buffer_len = length;
+  return 1;
+}
+
+
 PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
-  char *buffer;
+  const char *buffer;
   Py_ssize_t buffer_len = 0;
   Py_ssize_t length = 0;
   Py_ssize_t index = 0;
   static const char *kwlist[] = {"buffer", "index", "length", NULL};
-  PyObject *encoded_tag = NULL;
-
-  PyObject *result = PyList_New(0);
-  if (!result)
-    return NULL;
+  PyObject *result = NULL;
 
   if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|nn", (char **)kwlist,
                                    &buffer, &buffer_len, &index, &length))
     return NULL;
 
-  if (index < 0 || length < 0 || index > buffer_len) {
-    PyErr_SetString(
-        PyExc_ValueError, "Invalid parameters.");
+  if (!select_range(&buffer, &buffer_len, index, length))
     return NULL;
-  }
-
-  // Advance the buffer to the required start index.
-  buffer += index;
 
-  // Determine the length we will be splitting.
-  if (length == 0 || length > buffer_len - index) {
-    length = buffer_len - index;
-  }
+  result = PyList_New(0);
+  if (!result)
+    return NULL;
 
   // We advance the buffer and decrement the length until there is no more
   // buffer space left.
-  while (length > 0) {
-    Py_ssize_t decoded_length = 0;
-    unsigned PY_LONG_LONG tag;
-    int tag_type;
-
-    // Read the tag off the buffer.
-    varint_decode(&tag, buffer, length, &decoded_length);
-
-    // Prepare to pass the encoded tag into the result tuple.
-    encoded_tag = PyString_FromStringAndSize(buffer, decoded_length);
-    buffer += decoded_length;
-    length -= decoded_length;
-
-    // Handle the tag depending on its type.
-    tag_type = tag & TAG_TYPE_MASK;
-    switch (tag_type) {
-      case WIRETYPE_VARINT: {
-        // Decode the varint and position ourselves at the next tag.
-        Py_ssize_t tag_length = 0;
-        PyObject *entry = NULL;
-
-        varint_decode(&tag, buffer, length, &tag_length);
-
-        // Create an entry to add to the result set. Note: We use
-        // PyTuple_SetItem which steals the references here instead of
-        // PyTuple_Pack which does not (meaning its more involved to use).
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
-
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
-
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
-
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
-
-        buffer += tag_length;
-        length -= tag_length;
-
-        break;
-      }
+  while (buffer_len > 0) {
+    PyObject *entry = NULL;
 
-      case WIRETYPE_FIXED64: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 8;
+    if (!split_next(&buffer, &buffer_len, &entry))
+      goto error;
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+    if (PyList_Append(result, entry) < 0) {
+      Py_DECREF(entry);
+      goto error;
+    }
+    Py_DECREF(entry);
+  }
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+  return result;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+error:
+  Py_DECREF(result);
+  return NULL;
+}
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
 
-        buffer += tag_length;
-        length -= tag_length;
+// Appends the start and end offset of a field to a list. Returns 0 on error.
+static int append_offsets(PyObject *offsets, Py_ssize_t start,
+                          Py_ssize_t end) {
+  PyObject *value = NULL;
+  int error = 0;
 
-        break;
-      }
+  value = PyInt_FromSsize_t(start);
+  error = (!value || PyList_Append(offsets, value) < 0);
+  Py_XDECREF(value);
+  if (error)
+    return 0;
 
-      case WIRETYPE_FIXED32: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 4;
+  value = PyInt_FromSsize_t(end);
+  error = (!value || PyList_Append(offsets, value) < 0);
+  Py_XDECREF(value);
+  return !error;
+}
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+// Splits the wire format of a repeated field into its elements without
+// copying them. Returns a flat list of the start and end offset of each
+// element, as kept by LazyWireList.
+PyObject *py_split_offsets(PyObject *self, PyObject *args) {
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t offset = 0;
+  PyObject *result = NULL;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+  if (!PyArg_ParseTuple(args, "s#", &buffer, &buffer_len))
+    return NULL;
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+  result = PyList_New(0);
+  if (!result)
+    return NULL;
 
-        buffer += tag_length;
-        length -= tag_length;
+  while (offset < buffer_len) {
+    Py_ssize_t tag_length = 0;
+    Py_ssize_t prefix_length = 0;
+    Py_ssize_t data_length = 0;
+    Py_ssize_t end;
 
-        break;
-      }
+    if (!field_lengths(buffer + offset, buffer_len - offset, &tag_length,
+                       &prefix_length, &data_length))
+      goto error;
 
-      case WIRETYPE_LENGTH_DELIMITED: {
-        // Decode the length varint and position ourselves at the start of the
-        // data.
-        Py_ssize_t decoded_length = 0;
-        unsigned PY_LONG_LONG data_size;
-        PyObject *entry = NULL;
+    end = offset + tag_length + prefix_length + data_length;
+    if (!append_offsets(result, offset, end))
+      goto error;
 
-        varint_decode(&data_size, buffer, length, &decoded_length);
+    offset = end;
+  }
 
-        // Check that we do not exceed the available buffer here.
-        if (data_size + decoded_length > (unsigned int)length) {
-          PyErr_SetString(
-              PyExc_ValueError, "Length tag exceeds available buffer.");
+  return result;
 
-          goto error;
-        }
+error:
+  Py_DECREF(result);
+  return NULL;
+}
 
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, decoded_length));
+// The bulk of ReadIntoObject(). Splits the buffer and stores the fields in
+// the raw data dict of the object being parsed, keyed by field name. Unknown
+// fields are keyed by a counter. Elements of repeated fields (whose type info
+// is an instance of proto_list_class) are not copied out of the buffer. They
+// are returned in a dict mapping field names to flat lists of the start and
+// end offset of each element in the buffer.
+PyObject *py_read_into_object(PyObject *self, PyObject *args) {
+  const char *base;
+  const char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t index = 0;
+  Py_ssize_t length = 0;
+  PyObject *type_infos = NULL;
+  PyObject *raw_data = NULL;
+  PyObject *proto_list_class = NULL;
+  PyObject *repeated = NULL;
+  long count = 0;
+
+  if (!PyArg_ParseTuple(args, "s#nnO!O!O", &base, &buffer_len, &index,
+                        &length, &PyDict_Type, &type_infos,
+                        &PyDict_Type, &raw_data, &proto_list_class))
+    return NULL;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer + decoded_length, data_size));
+  buffer = base;
+  if (!select_range(&buffer, &buffer_len, index, length))
+    return NULL;
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+  repeated = PyDict_New();
+  if (!repeated)
+    return NULL;
 
-        buffer += decoded_length + data_size;
-        length -= decoded_length + data_size;
+  while (buffer_len > 0) {
+    Py_ssize_t tag_length = 0;
+    Py_ssize_t prefix_length = 0;
+    Py_ssize_t data_length = 0;
+    Py_ssize_t field_length;
+    PyObject *encoded_tag = NULL;
+    PyObject *type_info = NULL;
+    PyObject *entry = NULL;
+    PyObject *name = NULL;
+    PyObject *value = NULL;
+    int error = 0;
+
+    if (!field_lengths(buffer, buffer_len, &tag_length, &prefix_length,
+                       &data_length))
+      goto error;
+
+    field_length = tag_length + prefix_length + data_length;
+    encoded_tag = PyString_FromStringAndSize(buffer, tag_length);
+    if (!encoded_tag)
+      goto error;
+
+    // Borrowed reference.
+    type_info = PyDict_GetItem(type_infos, encoded_tag);
+
+    if (type_info != NULL &&
+        (PyObject *)Py_TYPE(type_info) == proto_list_class) {
+      // Borrowed reference.
+      PyObject *offsets = NULL;
+
+      name = PyObject_GetAttrString(type_info, "name");
+      if (!name) {
+        error = 1;
+      } else {
+        offsets = PyDict_GetItem(repeated, name);
+        if (offsets == NULL) {
+          offsets = PyList_New(0);
+          error = (!offsets || PyDict_SetItem(repeated, name, offsets) < 0);
+          Py_XDECREF(offsets);
+        }
+        error = error || !append_offsets(offsets, buffer - base,
+                                         buffer - base + field_length);
+      }
 
-        break;
+    } else {
+      entry = Py_BuildValue(
+          "(Os#s#)", encoded_tag, buffer + tag_length, prefix_length,
+          buffer + tag_length + prefix_length, data_length);
+
+      if (!entry) {
+        error = 1;
+
+      } else if (type_info == NULL) {
+        // Unknown fields are kept so they are written back when serializing.
+        name = PyInt_FromLong(count++);
+        value = PyTuple_Pack(3, Py_None, entry, Py_None);
+        error = (!name || !value || PyDict_SetItem(raw_data, name, value) < 0);
+
+      } else {
+        // The python format is None so it gets converted lazily on access.
+        name = PyObject_GetAttrString(type_info, "name");
+        value = PyTuple_Pack(3, Py_None, entry, type_info);
+        error = (!name || !value || PyDict_SetItem(raw_data, name, value) < 0);
       }
+    }
 
-      default:
-        PyErr_SetString(
-            PyExc_ValueError, "Unexpected Tag");
+    Py_DECREF(encoded_tag);
+    Py_XDECREF(entry);
+    Py_XDECREF(name);
+    Py_XDECREF(value);
+    if (error)
+      goto error;
 
-        goto error;
-    }
+    buffer += field_length;
+    buffer_len -= field_length;
   }
 
-  return result;
+  return repeated;
 
 error:
-  Py_DECREF(encoded_tag);
+  Py_DECREF(repeated);
   return NULL;
 }
 
+
+// Appends the strings of a wire format tuple to the output list.
+static int extend_output(PyObject *output, PyObject *wire_format) {
+  PyObject *iterator = NULL;
+  PyObject *item = NULL;
+
+  iterator = PyObject_GetIter(wire_format);
+  if (!iterator)
+    return 0;
+
+  while ((item = PyIter_Next(iterator))) {
+    int error = PyList_Append(output, item) < 0;
+    Py_DECREF(item);
+    if (error) {
+      Py_DECREF(iterator);
+      return 0;
+    }
+  }
+
+  Py_DECREF(iterator);
+  return !PyErr_Occurred();
+}
+
+
+// Serializes (python_format, wire_format, type_descriptor) entries. Entries
+// which were parsed and not modified since are copied without calling into
+// python, the others are converted using their type descriptor.
+PyObject *py_serialize_entries(PyObject *self, PyObject *args) {
+  PyObject *entries = NULL;
+  PyObject *iterator = NULL;
+  PyObject *entry = NULL;
+  PyObject *output = NULL;
+  PyObject *separator = NULL;
+  PyObject *result = NULL;
+
+  if (!PyArg_ParseTuple(args, "O", &entries))
+    return NULL;
+
+  iterator = PyObject_GetIter(entries);
+  if (!iterator)
+    return NULL;
+
+  output = PyList_New(0);
+  if (!output)
+    goto end;
+
+  while ((entry = PyIter_Next(iterator))) {
+    PyObject *python_format = NULL;
+    PyObject *wire_format = NULL;
+    PyObject *type_descriptor = NULL;
+    PyObject *converted = NULL;
+    int convert = 0;
+    int error = 0;
+
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 3) {
+      PyErr_SetString(PyExc_TypeError, "Entries must be 3-tuples.");
+      Py_DECREF(entry);
+      goto end;
+    }
+
+    // Borrowed references.
+    python_format = PyTuple_GET_ITEM(entry, 0);
+    wire_format = PyTuple_GET_ITEM(entry, 1);
+    type_descriptor = PyTuple_GET_ITEM(entry, 2);
+
+    if (wire_format == Py_None) {
+      convert = 1;
+    } else {
+      int is_set = PyObject_IsTrue(python_format);
+
+      if (is_set < 0) {
+        error = 1;
+      } else if (is_set) {
+        PyObject *dirty = PyObject_CallMethod(
+            type_descriptor, "IsDirty", "O", python_format);
+
+        if (!dirty) {
+          error = 1;
+        } else {
+          convert = PyObject_IsTrue(dirty);
+          error = convert < 0;
+          Py_DECREF(dirty);
+        }
+      }
+    }
+
+    if (!error && convert > 0) {
+      converted = PyObject_CallMethod(
+          type_descriptor, "ConvertToWireFormat", "O", python_format);
+      error = !converted;
+      wire_format = converted;
+    }
+
+    if (!error)
+      error = !extend_output(output, wire_format);
+
+    Py_XDECREF(converted);
+    Py_DECREF(entry);
+    if (error)
+      goto end;
+  }
+
+  if (PyErr_Occurred())
+    goto end;
+
+  separator = PyString_FromStringAndSize(NULL, 0);
+  if (separator)
+    result = _PyString_Join(separator, output);
+
+end:
+  Py_DECREF(iterator);
+  Py_XDECREF(output);
+  Py_XDECREF(separator);
+  return result;
+}
+
+
 /* Retrieves the semantic protobuf version
  * Returns a Python object if successful or NULL on error
  */
 PyObject *py_semantic_get_version(PyObject *self, PyObject *arguments) {
     const char *errors = NULL;
-    return(PyUnicode_DecodeUTF8("20150518", (Py_ssize_t) 8, errors));
+    return(PyUnicode_DecodeUTF8("20261016", (Py_ssize_t) 8, errors));
 }
 
 static PyMethodDef _semantic_methods[] = {
@@ -340,6 +602,21 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"split_offsets",
+     (PyCFunction)py_split_offsets,
+     METH_VARARGS,
+     "Find the offsets of the elements of a repeated field."},
+
+    {"read_into_object",
+     (PyCFunction)py_read_into_object,
+     METH_VARARGS,
+     "Parse a buffer into the raw data of a struct."},
+
+    {"serialize_entries",
+     (PyCFunction)py_serialize_entries,
+     METH_VARARGS,
+     "Serialize the raw data entries of a struct."},
+
     {NULL}  /* Sentinel */
 };
 
@@ -10,11 +10,11 @@ import shutil
 import stat
 import subprocess
 import unittest
-import zlib
 
 import psutil
 
 from grr_response_client.client_actions import file_finder as client_file_finder
+from grr.lib import compression
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -800,12 +800,7 @@ class MockTransferStore(object):
       raise ValueError("message is not authenticated")
 
     data_blob = message.payload
-    if data_blob.compression == "UNCOMPRESSED":
-      data = data_blob.data
-    elif data_blob.compression == "ZCOMPRESSION":
-      data = zlib.decompress(data_blob.data)
-    else:
-      raise ValueError("unknown blob compression: %s" % data_blob.compression)
+    data = compression.Decompress(data_blob.compression, data_blob.data)
 
     digest = hashlib.sha256(data).digest()
     self.blobs[digest] = data
@@ -2,9 +2,9 @@
 """Utility classes for uploading files to the server."""
 
 import hashlib
-import zlib
 
 from grr_response_client import streaming
+from grr.lib import compression
 from grr.lib import rdfvalue
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import protodict as rdf_protodict
@@ -13,8 +13,9 @@ from grr.lib.rdfvalues import protodict as rdf_protodict
 class TransferStoreUploader(object):
   """An utility class for uploading chunked files to the server.
 
-  Input is divided into chunks, then these chunks are compressed (using zlib)
-  and then they are uploaded to the transfer store (a well-known flow).
+  Input is divided into chunks, then these chunks are compressed (unless they
+  look incompressible) and then they are uploaded to the transfer store (a
+  well-known flow).
   """
 
   DEFAULT_CHUNK_SIZE = 512 * 1024
@@ -77,6 +78,6 @@ class TransferStoreUploader(object):
 
 
 def _CompressedDataBlob(chunk):
-  return rdf_protodict.DataBlob(
-      data=zlib.compress(chunk.data),
-      compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION)
+  data, compression_type = compression.CompressBlob(
+      chunk.data, accepted=compression.ServerCompression())
+  return rdf_protodict.DataBlob(data=data, compression=compression_type)
@@ -10,7 +10,6 @@ import platform
 import socket
 import sys
 import time
-import zlib
 
 
 import psutil
@@ -20,6 +19,7 @@ from grr_response_client import actions
 from grr_response_client import client_utils_common
 from grr_response_client import vfs
 from grr_response_client.client_actions import tempfiles
+from grr.lib import compression
 from grr.lib import constants
 from grr.lib import flags
 from grr.lib import rdfvalue
@@ -76,9 +76,10 @@ class TransferBuffer(actions.ActionPlugin):
         args.offset,
         args.length,
         progress_callback=self.Progress)
+    compressed_data, compression_type = compression.CompressBlob(
+        data, accepted=compression.ServerCompression())
     result = rdf_protodict.DataBlob(
-        data=zlib.compress(data),
-        compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION)
+        data=compressed_data, compression=compression_type)
 
     digest = hashlib.sha256(data).digest()
 
@@ -93,6 +93,7 @@ from grr_response_client import client_stats
 from grr_response_client import client_utils
 from grr_response_client.client_actions import admin
 from grr.lib import communicator
+from grr.lib import compression
 from grr.lib import flags
 from grr.lib import queues
 from grr.lib import rdfvalue
@@ -105,6 +106,7 @@ from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import rekall_types as rdf_rekall_types
+from grr.lib.rdfvalues import structs as rdf_structs
 
 
 class HTTPObject(object):
@@ -117,6 +119,7 @@ class HTTPObject(object):
     self.code = code
     # Contains the decoded data from the 'control' endpoint.
     self.messages = self.source = self.nonce = None
+    self.poll_hint = None
     self.duration = duration
 
   def Success(self):
@@ -124,6 +127,15 @@ class HTTPObject(object):
     return self.code in (200, 406)
 
 
+def _RetryAfter(response):
+  """Returns the seconds a busy frontend asked us to wait, 0 if none."""
+  try:
+    retry_after = int(response.headers["Retry-After"])
+  except (AttributeError, KeyError, TypeError, ValueError):
+    return 0
+  return min(max(0, retry_after), config.CONFIG["Client.poll_max"])
+
+
 class HTTPManager(object):
   """A manager for all HTTP/S connections.
 
@@ -389,6 +401,17 @@ class HTTPManager(object):
 
       # Catch any exceptions that dont have a code (e.g. socket.error).
       except IOError as e:
+        response = getattr(e, "response", None)
+        status_code = getattr(response, "status_code", None)
+        retry_after = _RetryAfter(response)
+        if status_code == 503 and retry_after:
+          # The frontend is reachable but too busy to handle us right now. This
+          # is not a connection error, we just come back when it asked us to.
+          logging.debug("Frontend is busy. Backing off %s seconds.",
+                        retry_after)
+          self.Wait(retry_after)
+          continue
+
         self.consecutive_connection_errors += 1
         # Request failed. If we connected successfully before we attempt a few
         # connections before we determine that it really failed. This might
@@ -397,8 +420,7 @@ class HTTPManager(object):
         if self.active_base_url is not None:
           # Propagate 406 immediately without retrying, as 406 is a valid
           # response that indicates a need for enrollment.
-          response = getattr(e, "response", None)
-          if getattr(response, "status_code", None) == 406:
+          if status_code == 406:
             raise
 
           if self.consecutive_connection_errors >= self.retry_error_limit:
@@ -409,11 +431,13 @@ class HTTPManager(object):
             self.active_base_url = None
             raise e
 
-          # Back off hard to allow the front end to recover.
+          # Back off hard to allow the front end to recover, longer if it
+          # asked us to.
+          backoff = max(self.error_poll_min, retry_after)
           logging.debug(
               "Unable to connect to frontend. Backing off %s seconds.",
-              self.error_poll_min)
-          self.Wait(self.error_poll_min)
+              backoff)
+          self.Wait(backoff)
 
         # We never previously connected, maybe the URL/proxy is wrong? Just fail
         # right away to allow callers to try a different URL.
@@ -457,6 +481,10 @@ class Timer(object):
     """Switch to slow poll mode."""
     self.sleep_time = self.poll_max
 
+  def PollHint(self, sleep_time):
+    """Sleep as long as the server asked for, within our poll limits."""
+    self.sleep_time = min(self.poll_max, max(self.poll_min, sleep_time))
+
   def Wait(self):
     """Wait until the next action is needed."""
     time.sleep(self.sleep_time - int(self.sleep_time))
@@ -572,9 +600,21 @@ class GRRClientWorker(threading.Thread):
     Returns:
        A MessageList protobuf
     """
-    messages = self._out_queue.GetMessages(soft_size_limit=max_size)
+    return self.DrainSerialized(max_size=max_size).ToMessageList()
+
+  def DrainSerialized(self, max_size=1024):
+    """Like Drain() but returns the messages without parsing them.
+
+    Args:
+       max_size: The size (in bytes) of the returned protobuf will be at most
+       one message length over this size.
+
+    Returns:
+       A SerializedMessageList.
+    """
+    messages = self._out_queue.GetSerializedMessages(soft_size_limit=max_size)
     stats.STATS.IncrementCounter(
-        "grr_client_sent_messages", delta=len(messages.job))
+        "grr_client_sent_messages", delta=len(messages))
 
     return messages
 
@@ -851,6 +891,51 @@ class GRRClientWorker(threading.Thread):
       os.kill(os.getpid(), signal.SIGKILL)
 
 
+class SerializedMessageList(object):
+  """A MessageList made of already serialized GrrMessages.
+
+  The queued messages are sent as they are: the wire format of a MessageList
+  is just the concatenation of its framed jobs, so there is no need to parse
+  the messages only to serialize them again.
+  """
+
+  # The tag of MessageList.job, field 1 with a length delimited wire type.
+  _JOB_TAG = rdf_structs.VarintEncode((1 << rdf_structs.TAG_TYPE_BITS) |
+                                      rdf_structs.WIRETYPE_LENGTH_DELIMITED)
+
+  def __init__(self, messages=None, require_fastpoll=False):
+    """Constructor.
+
+    Args:
+      messages: A list of serialized GrrMessages.
+      require_fastpoll: True if any of the messages requires fast poll.
+    """
+    self.messages = messages or []
+    self.require_fastpoll = require_fastpoll
+
+  def __len__(self):
+    return len(self.messages)
+
+  def SerializeToString(self):
+    """Returns the serialized MessageList holding the messages."""
+    tag = self._JOB_TAG
+    encode = rdf_structs.VarintEncode
+    return "".join(
+        "".join((tag, encode(len(message)), message))
+        for message in self.messages)
+
+  @property
+  def job(self):
+    """The parsed messages, a list of GrrMessages."""
+    return [
+        rdf_flows.GrrMessage.FromSerializedString(message)
+        for message in self.messages
+    ]
+
+  def ToMessageList(self):
+    return rdf_flows.MessageList(job=self.job)
+
+
 class SizeLimitedQueue(object):
   """A Queue which limits the total size of its elements.
 
@@ -899,7 +984,8 @@ class SizeLimitedQueue(object):
         timeout is exceeded.
     """
     # We only queue already serialized objects so we know how large they are.
-    message = message.SerializeToString()
+    # They are sent as they are, only whether they need fast poll is kept.
+    message = (message.SerializeToString(), bool(message.require_fastpoll))
 
     if priority >= rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
       pass  # If high priority is set we don't care about the size of the queue.
@@ -919,7 +1005,7 @@ class SizeLimitedQueue(object):
 
     with self._lock:
       self._queues[priority].appendleft(message)
-      self._total_size += len(message)
+      self._total_size += len(message[0])
 
   def _GeneratePriority(self, priority):
     """Yields messages with given priority. Lock should be held by the caller.
@@ -953,15 +1039,33 @@ class SizeLimitedQueue(object):
       earlier in priority order; messages with equivalent priority are returned
       FIFO.
     """
+    return self.GetSerializedMessages(
+        soft_size_limit=soft_size_limit).ToMessageList()
+
+  def GetSerializedMessages(self, soft_size_limit=None):
+    """Like GetMessages() but does not parse the messages.
+
+    Args:
+      soft_size_limit: int If there is more data in the queue than
+        soft_size_limit bytes, the returned list of messages will be
+        approximately this large. If None (default), returns all messages
+        currently on the queue.
+
+    Returns:
+      A SerializedMessageList.
+    """
     with self._lock:
-      ret = rdf_flows.MessageList()
+      ret = SerializedMessageList()
       ret_size = 0
-      for message in self._Generate():
-        ret.job.append(rdf_flows.GrrMessage.FromSerializedString(message))
+      for message, require_fastpoll in self._Generate():
+        ret.messages.append(message)
+        ret.require_fastpoll = ret.require_fastpoll or require_fastpoll
         ret_size += len(message)
         if soft_size_limit is not None and ret_size > soft_size_limit:
           break
 
+      # The messages are no longer held by the queue.
+      self._total_size -= ret_size
       return ret
 
   def Size(self):
@@ -1110,8 +1214,10 @@ class GRRHTTPClient(object):
 
     # Try to decrypt the message into the http_object.
     try:
-      http_object.messages, http_object.source, http_object.nonce = (
-          self.communicator.DecryptMessage(http_object.data))
+      (response_comms, http_object.messages, http_object.source,
+       http_object.nonce) = self.communicator.DecryptResponse(http_object.data)
+      if response_comms.HasField("poll_hint"):
+        http_object.poll_hint = response_comms.poll_hint
 
       return True
 
@@ -1159,16 +1265,14 @@ class GRRHTTPClient(object):
     # back so we don't expire our messages too fast.
     if self.http_manager.consecutive_connection_errors == 0:
       # Grab some messages to send
-      message_list = self.client_worker.Drain(
+      message_list = self.client_worker.DrainSerialized(
           max_size=config.CONFIG["Client.max_post_size"])
     else:
-      message_list = rdf_flows.MessageList()
+      message_list = SerializedMessageList()
 
     # If any outbound messages require fast poll we switch to fast poll mode.
-    for message in message_list.job:
-      if message.require_fastpoll:
-        self.timer.FastPoll()
-        break
+    if message_list.require_fastpoll:
+      self.timer.FastPoll()
 
     # Make new encrypted ClientCommunication rdfvalue.
     payload = rdf_flows.ClientCommunication()
@@ -1201,8 +1305,7 @@ class GRRHTTPClient(object):
       self.server_certificate = None
 
       # Reschedule the tasks back on the queue so they get retried next time.
-      messages = list(message_list.job)
-      for message in messages:
+      for message in message_list.job:
         message.priority = rdf_flows.GrrMessage.Priority.HIGH_PRIORITY
         message.require_fastpoll = False
         message.ttl -= 1
@@ -1228,6 +1331,10 @@ class GRRHTTPClient(object):
       response.code = 500
       return response
 
+    # The server knows best when it will have something for us.
+    if response.poll_hint is not None:
+      self.timer.PollHint(response.poll_hint)
+
     # Check to see if any inbound messages want us to fastpoll. This means we
     # drop to fastpoll immediately on a new request rather than waiting for the
     # next beacon to report results.
@@ -1451,6 +1558,22 @@ class ClientCommunicator(communicator.Communicator):
     # If we still have a cached session key, we need to remove it.
     self._ClearServerCipherCache()
 
+  def SetPeerCompression(self, common_name, accepted_compression):
+    # All frontends share the server's common name, but during an upgrade they
+    # may not all decode the same codecs. Any of them can receive the next
+    # request, so only codecs every one of them advertised are used.
+    known = self.GetPeerCompression(common_name)
+    if known is not None:
+      known = set(int(t) for t in known)
+      accepted_compression = [
+          t for t in accepted_compression if int(t) in known
+      ]
+
+    super(ClientCommunicator, self).SetPeerCompression(common_name,
+                                                       accepted_compression)
+    # Client actions use this to compress the data they upload.
+    compression.SetServerCompression(accepted_compression)
+
   def EncodeMessages(self, message_list, result, **kwargs):
     # Force the right API to be used
     kwargs["api_version"] = config.CONFIG["Network.api"]
@@ -200,6 +200,25 @@ class HTTPManagerTest(test_lib.GRRBaseTest):
     # Make sure that the manager cleared its consecutive_connection_errors.
     self.assertEqual(manager.consecutive_connection_errors, 0)
 
+  def testBusyFrontendIsNotAConnectionError(self):
+    """A 503 with Retry-After makes us wait as asked and try again."""
+    instrumentor = RequestsInstrumentor()
+    busy = _make_http_response(code=503)
+    busy.headers["Retry-After"] = "3"
+    instrumentor.responses = [busy, busy, _make_200("Good")]
+
+    manager = MockHTTPManager()
+    with instrumentor.instrument():
+      result = manager.OpenServerEndpoint("control")
+
+    self.assertEqual(result.data, "Good")
+    # The same URL is retried, every time after the time the frontend asked for.
+    self.assertEqual([(a[0], a[1]["url"]) for a in instrumentor.actions],
+                     [(0, "http://server1/control"),
+                      (3, "http://server1/control"),
+                      (6, "http://server1/control")])
+    self.assertEqual(manager.consecutive_connection_errors, 0)
+
   def test406Errors(self):
     """Ensure that 406 enrollment requests are propagated immediately.
 
@@ -276,6 +295,42 @@ class SizeLimitedQueueTest(test_lib.GRRBaseTest):
     result.job.Extend(queue.GetMessages().job)
     self.assertEqual(list(result.job), [msg_c] * 10 + [msg_a, msg_b] * 10)
 
+  def testSerializedMessagesAreAValidMessageList(self):
+    queue = comms.SizeLimitedQueue(maxsize=10000000, heart_beat_cb=lambda: None)
+
+    msg_a = rdf_flows.GrrMessage(name="A" * 1000, require_fastpoll=False)
+    msg_b = rdf_flows.GrrMessage(name="B", require_fastpoll=True)
+    queue.Put(msg_a, rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+    queue.Put(msg_b, rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+
+    result = queue.GetSerializedMessages()
+    self.assertEqual(len(result), 2)
+    self.assertTrue(result.require_fastpoll)
+
+    message_list = rdf_flows.MessageList.FromSerializedString(
+        result.SerializeToString())
+    self.assertEqual(list(message_list.job), [msg_a, msg_b])
+    expected = rdf_flows.MessageList(job=[msg_a, msg_b])
+    self.assertEqual(result.SerializeToString(), expected.SerializeToString())
+
+  def testSizeIsReducedByRetrievedMessages(self):
+    queue = comms.SizeLimitedQueue(maxsize=10000000, heart_beat_cb=lambda: None)
+
+    msg_a = rdf_flows.GrrMessage(name="A", require_fastpoll=False)
+    msg_size = len(msg_a.SerializeToString())
+    for _ in xrange(10):
+      queue.Put(msg_a, rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+    self.assertEqual(queue.Size(), 10 * msg_size)
+
+    result = queue.GetSerializedMessages(soft_size_limit=3 * msg_size)
+    self.assertEqual(len(result), 4)
+    self.assertFalse(result.require_fastpoll)
+    self.assertEqual(queue.Size(), 6 * msg_size)
+
+    queue.GetMessages()
+    self.assertEqual(queue.Size(), 0)
+    self.assertFalse(queue.Full())
+
   def testSizeLimitedQueueOverflow(self):
 
     msg_a = rdf_flows.GrrMessage(name="A")
@@ -314,6 +369,23 @@ class SizeLimitedQueueTest(test_lib.GRRBaseTest):
     self.assertTrue(heartbeat.called)
 
 
+class TimerTest(test_lib.GRRBaseTest):
+
+  def testPollHintIsKeptWithinPollLimits(self):
+    with test_lib.ConfigOverrider({
+        "Client.poll_min": 1,
+        "Client.poll_max": 100
+    }):
+      timer = comms.Timer()
+
+    timer.PollHint(10)
+    self.assertEqual(timer.sleep_time, 10)
+    timer.PollHint(0.01)
+    self.assertEqual(timer.sleep_time, 1)
+    timer.PollHint(24 * 60 * 60)
+    self.assertEqual(timer.sleep_time, 100)
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -46,6 +46,33 @@ config_lib.DEFINE_string(
     help=("Location of the data store (usually a "
           "filesystem directory)"))
 
+config_lib.DEFINE_integer(
+    "Datastore.mutation_pool_max_pending_batches",
+    default=16,
+    help=("Maximum number of asynchronously flushed mutation batches waiting "
+          "to be written. Further asynchronous flushes block until the "
+          "background writer catches up."))
+
+config_lib.DEFINE_integer(
+    "Datastore.read_cache_size",
+    default=10000,
+    help=("Maximum number of read results held by a single "
+          "DataStore.ReadCache(). Least recently used results are dropped "
+          "first."))
+
+config_lib.DEFINE_integer(
+    "Datastore.collection_index_spacing",
+    default=1024,
+    help=("Number of records between two index points of indexed sequential "
+          "collections. Smaller values make length calculation and random "
+          "access faster at the cost of a larger index."))
+
+config_lib.DEFINE_integer(
+    "Datastore.collection_index_cache_size",
+    default=100,
+    help=("Number of indexed sequential collection indexes kept in memory "
+          "so that reopening a collection does not reread its index."))
+
 # SQLite data store.
 config_lib.DEFINE_integer(
     "SqliteDatastore.vacuum_check",
@@ -137,6 +164,12 @@ config_lib.DEFINE_integer(
     10,
     help="Maximum number of retries (happens in case a query fails).")
 
+config_lib.DEFINE_integer(
+    "Mysql.collection_scan_page_size",
+    1000,
+    help=("Number of collection items fetched per query when scanning "
+          "collections stored in the dedicated collections table."))
+
 # CloudBigTable data store.
 config_lib.DEFINE_string(
     "CloudBigtable.project_id",
@@ -71,6 +71,11 @@ config_lib.DEFINE_bool("AdminUI.use_precompiled_js", False,
                        "If True - use Closure-compiled JS bundle. This flag "
                        "is experimental and is not properly supported yet.")
 
+config_lib.DEFINE_bool("AdminUI.datastore_read_cache", False,
+                       "If True, data store reads are cached for the duration "
+                       "of every API call. Writes from other processes made "
+                       "while a call is handled are not seen by it.")
+
 config_lib.DEFINE_string("AdminUI.export_command", "/usr/bin/grr_api_shell "
                          "'%(AdminUI.url)'",
                          "Command to show in the fileview for downloading the "
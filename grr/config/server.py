@@ -37,9 +37,48 @@ config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_integer("Worker.flow_batch_size", 1,
+                          "Number of flows a worker thread locks, reads and "
+                          "processes together. Batching saves data store "
+                          "round trips when many flows are active. 1 disables "
+                          "batching.")
+
+config_lib.DEFINE_bool("Worker.datastore_read_cache", False,
+                       "If True, data store reads are cached while a flow's "
+                       "messages are processed. Writes from other processes "
+                       "made in the meantime are only seen the next time the "
+                       "flow is processed.")
+
+config_lib.DEFINE_integer("Worker.notification_shards_per_worker", 0,
+                          "If set, each worker leases up to this many "
+                          "notification shards per queue and only processes "
+                          "notifications from those. The value times the "
+                          "number of workers should be at least "
+                          "Worker.queue_shards. 0 makes every worker scan "
+                          "all the shards.")
+
+config_lib.DEFINE_integer("Worker.notification_shard_lease_time", 600,
+                          "Seconds a notification shard lease lasts if it is "
+                          "not renewed. Shards of dead workers are picked up "
+                          "by other workers after this time.")
+
+config_lib.DEFINE_string("Worker.wakeup_channel", "InProcessWakeupChannel",
+                         "The channel used to wake up idle workers when new "
+                         "notifications are queued. InProcessWakeupChannel "
+                         "only reaches workers in the publishing process, "
+                         "UnixSocketWakeupChannel all workers on the same "
+                         "machine and WakeupChannel disables wakeups. Workers "
+                         "always keep polling as a fallback.")
+
+config_lib.DEFINE_string("Worker.wakeup_socket_dir",
+                         "%(Config.prefix)/var/grr-worker-wakeup",
+                         "Directory holding the sockets of "
+                         "UnixSocketWakeupChannel.")
+
 config_lib.DEFINE_list("Frontend.well_known_flows", ["TransferStore", "Stats"],
                        "Allow these well known flows to run directly on the "
-                       "frontend. Other flows are scheduled as normal.")
+                       "frontend, on the thread handling the poll. Other flows "
+                       "are queued and processed by the workers.")
 
 config_lib.DEFINE_list("Frontend.DEBUG_well_known_flows_blacklist", [],
                        "Drop these well known flows requests without "
@@ -112,6 +151,109 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer(
+    "Frontend.client_ping_flush_interval", 5,
+    "Client ping times, clocks and IP addresses are buffered in memory and "
+    "written to the data store every this many seconds. A frontend crash "
+    "loses at most this many seconds of pings. 0 writes every ping "
+    "immediately.")
+
+config_lib.DEFINE_integer(
+    "Frontend.client_ping_max_pending", 10000,
+    "Number of clients with buffered pings that triggers an immediate write "
+    "to the data store.")
+
+config_lib.DEFINE_bool(
+    "Frontend.event_loop", False,
+    "If set, the frontend serves all connections from a single event loop "
+    "and keeps them open between requests, instead of using a thread per "
+    "connection.")
+
+config_lib.DEFINE_integer(
+    "Frontend.event_loop_worker_threads", 50,
+    "Number of threads processing client messages in the event loop "
+    "frontend. When all threads are busy and as many requests are queued, "
+    "clients are asked to retry later.")
+
+config_lib.DEFINE_integer(
+    "Frontend.keep_alive_timeout", 60,
+    "Seconds after which the event loop frontend closes idle client "
+    "connections.")
+
+config_lib.DEFINE_integer(
+    "Frontend.processes", 1,
+    "Number of frontend processes to run. If more than one, a parent process "
+    "binds the port and forks the frontend processes, restarting them when "
+    "they exit. Each process runs its monitoring server on "
+    "Monitoring.http_port plus its index.")
+
+config_lib.DEFINE_integer(
+    "Frontend.shared_cache_size", 50000,
+    "Number of verified client ciphers and public keys each that frontend "
+    "processes forked by the same parent share in memory.")
+
+config_lib.DEFINE_float(
+    "Frontend.idle_poll_hint", 0,
+    "Seconds that clients which neither sent nor received messages are asked "
+    "to wait before polling again. 0 leaves this to the clients.")
+
+config_lib.DEFINE_integer(
+    "Frontend.session_lifetime", 60 * 60,
+    "Seconds the frontend keeps using the same session key for messages to a "
+    "client. Clients cache the session keys they have seen, so only the first "
+    "message of a session costs RSA operations on either side. 0 uses a new "
+    "session key for every message.")
+
+config_lib.DEFINE_integer(
+    "Frontend.receive_batch_size", 10 * 1024 * 1024,
+    "Messages in a client bundle are decoded and stored in batches of about "
+    "this many bytes, which bounds the memory the frontend needs for large "
+    "bundles.")
+
+config_lib.DEFINE_float(
+    "Frontend.drain_batch_delay", 0.005,
+    "Seconds the frontend waits for other clients to poll before draining "
+    "client queues, so the queues of clients polling at about the same time "
+    "are drained with a single data store query.")
+
+config_lib.DEFINE_integer(
+    "Frontend.max_concurrent_bundles", 0,
+    "Number of client message bundles the frontend handles concurrently "
+    "before it considers itself overloaded. While overloaded, idle clients "
+    "are asked to wait as long as they allow before polling again. 0 never "
+    "considers the frontend overloaded.")
+
+config_lib.DEFINE_float(
+    "Frontend.client_poll_rate", 0,
+    "Polls per second a single client may make on average. Polls above this "
+    "rate are rejected before they are decrypted. 0 does not limit clients.")
+
+config_lib.DEFINE_integer(
+    "Frontend.client_poll_burst", 10,
+    "Number of polls a client may make in a burst above "
+    "Frontend.client_poll_rate.")
+
+config_lib.DEFINE_float(
+    "Frontend.global_poll_rate", 0,
+    "Polls per second the frontend accepts from clients without outstanding "
+    "messages. 0 does not limit the rate.")
+
+config_lib.DEFINE_integer(
+    "Frontend.global_poll_burst", 1000,
+    "Number of polls the frontend accepts in a burst above "
+    "Frontend.global_poll_rate.")
+
+config_lib.DEFINE_integer(
+    "Frontend.max_concurrent_polls", 0,
+    "Maximum number of polls the frontend handles concurrently. The actual "
+    "limit adapts to Frontend.target_poll_latency. 0 does not limit "
+    "concurrency.")
+
+config_lib.DEFINE_float(
+    "Frontend.target_poll_latency", 2.0,
+    "Seconds a poll may take before the frontend lowers its concurrency "
+    "limit.")
+
 config_lib.DEFINE_string("Frontend.upload_store", "FileUploadFileStore",
                          "The implementation of the upload file store.")
 
@@ -206,6 +348,23 @@ config_lib.DEFINE_integer(
     help="The number of bytes allowed for unbounded "
     "reads from a file object")
 
+config_lib.DEFINE_integer(
+    "Server.aff4_object_cache_size",
+    1000,
+    help="The number of AFF4 objects of classes which opt in to caching "
+    "that are kept in memory between reads. 0 disables the cache.")
+
+config_lib.DEFINE_integer(
+    "Server.aff4_object_cache_age",
+    600,
+    help="The number of seconds an AFF4 object is kept in the object cache.")
+
+config_lib.DEFINE_integer(
+    "Server.aff4_read_ahead_threads",
+    10,
+    help="The number of threads which read chunks of AFF4 images ahead of a "
+    "sequential reader. 0 reads all chunks in the reading thread.")
+
 # Data retention policies.
 config_lib.DEFINE_semantic_value(
     rdfvalue.Duration,
@@ -931,8 +931,7 @@ class ApiGetClientLoadStatsHandler(api_call_handler_base.ApiCallHandler):
     # possible).
     points.sort(key=lambda x: x[1])
 
-    ts = timeseries.Timeseries()
-    ts.MultiAppend(points)
+    ts = timeseries.Timeseries.FromPairs(points)
 
     if args.metric not in self.GAUGE_METRICS:
       ts.MakeIncreasing()
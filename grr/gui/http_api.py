@@ -376,6 +376,14 @@ class HttpRequestHandler(object):
 
   def HandleRequest(self, request):
     """Handles given HTTP request."""
+    if config.CONFIG["AdminUI.datastore_read_cache"]:
+      with data_store.DB.ReadCache():
+        return self._HandleRequest(request)
+
+    return self._HandleRequest(request)
+
+  def _HandleRequest(self, request):
+    """Handles given HTTP request, see HandleRequest."""
     impersonated_username = config.CONFIG["AdminUI.debug_impersonate_user"]
     if impersonated_username:
       logging.info("Overriding user as %s", impersonated_username)
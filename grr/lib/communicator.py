@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 """Abstracts encryption and authentication."""
 
+import collections
+import hashlib
 import struct
 import time
-import zlib
 
 
+from grr.lib import compression
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -14,6 +16,7 @@ from grr.lib import utils
 
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import structs as rdf_structs
 
 
 class CommunicatorInit(registry.InitHook):
@@ -30,6 +33,8 @@ class CommunicatorInit(registry.InitHook):
 
     stats.STATS.RegisterCounterMetric(
         "grr_encrypted_cipher_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric(
+        "grr_session_cipher_cache", fields=[("type", str)])
 
 
 class Error(stats.CountingExceptionMixin, Exception):
@@ -52,6 +57,217 @@ class UnknownClientCert(DecodingError):
   counter = "grr_client_unknown"
 
 
+def _ReadVarint(buf, pos):
+  """Reads a varint, returns (value, new_pos) or None if buf ends first."""
+  result = 0
+  shift = 0
+  while pos < len(buf):
+    b = ord(buf[pos])
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+    if shift >= 64:
+      raise DecodingError("Too many bytes when decoding varint.")
+  return None
+
+
+def _ReadField(buf, pos):
+  """Reads the header of the protobuf field starting at pos.
+
+  Args:
+    buf: A string holding serialized fields.
+    pos: The position of the field in buf.
+
+  Returns:
+    A tuple (field_number, wire_type, start, end) giving the position of the
+    field's value in buf, or None if buf ends within the header. The value may
+    extend past the end of buf.
+
+  Raises:
+    DecodingError: If the wire type is not supported.
+  """
+  tag = _ReadVarint(buf, pos)
+  if tag is None:
+    return None
+
+  tag, start = tag
+  wire_type = tag & rdf_structs.TAG_TYPE_MASK
+  if wire_type == rdf_structs.WIRETYPE_LENGTH_DELIMITED:
+    length = _ReadVarint(buf, start)
+    if length is None:
+      return None
+    length, start = length
+    end = start + length
+  elif wire_type == rdf_structs.WIRETYPE_VARINT:
+    value = _ReadVarint(buf, start)
+    if value is None:
+      return None
+    end = value[1]
+  elif wire_type == rdf_structs.WIRETYPE_FIXED64:
+    end = start + 8
+  elif wire_type == rdf_structs.WIRETYPE_FIXED32:
+    end = start + 4
+  else:
+    raise DecodingError("Unexpected wire type %d." % wire_type)
+
+  return tag >> rdf_structs.TAG_TYPE_BITS, wire_type, start, end
+
+
+class MessageStream(object):
+  """The messages of a received PackedMessageList.
+
+  The message list is decompressed incrementally and messages are parsed as
+  their data becomes available, so the decompressed message list is never held
+  in memory as a whole.
+  """
+
+  # The size of the decompressed chunks messages are parsed from.
+  chunk_size = 64 * 1024
+
+  # The field number of MessageList.job.
+  _JOB_FIELD = 1
+
+  def __init__(self, packed_message_list, auth_state, source):
+    """Constructor.
+
+    Args:
+      packed_message_list: The decrypted PackedMessageList.
+      auth_state: The GrrMessage.AuthorizationState of the messages.
+      source: Where the messages came from.
+    """
+    self.packed_message_list = packed_message_list
+    self.auth_state = auth_state
+    self.source = source
+    self.timestamp = packed_message_list.timestamp
+
+  def __iter__(self):
+    for serialized in self._SplitMessages():
+      yield self._ParseMessage(serialized)
+
+  def Batches(self, max_size):
+    """Yields the messages in lists.
+
+    The whole message list is decoded before the first list is yielded, so a
+    corrupt message list raises before any of its messages were handled and
+    handling the retransmitted bundle does not duplicate them. Message lists
+    that fit into a single list are decoded once, larger ones twice.
+
+    Args:
+      max_size: The serialized size of the messages in a list does not exceed
+        this, unless the list holds a single message larger than that.
+
+    Yields:
+      Lists of GrrMessages.
+
+    Raises:
+      DecodingError: If the message list is corrupt.
+    """
+    # Keep the messages as long as they fit into a single list.
+    batch = []
+    batch_size = 0
+    for serialized in self._SplitMessages():
+      msg = self._ParseMessage(serialized)
+      batch_size += len(serialized)
+      if batch is None:
+        continue
+
+      if batch and batch_size > max_size:
+        batch = None
+      else:
+        batch.append(msg)
+
+    if batch is None:
+      for batch in self._DecodeBatches(max_size):
+        yield batch
+    elif batch:
+      yield batch
+
+  def _DecodeBatches(self, max_size):
+    """Like Batches() but yields lists as soon as they are decoded."""
+    batch = []
+    batch_size = 0
+    for serialized in self._SplitMessages():
+      if batch and batch_size + len(serialized) > max_size:
+        yield batch
+        batch = []
+        batch_size = 0
+
+      batch.append(self._ParseMessage(serialized))
+      batch_size += len(serialized)
+
+    if batch:
+      yield batch
+
+  def _ParseMessage(self, serialized):
+    try:
+      msg = rdf_flows.GrrMessage.FromSerializedString(serialized)
+    except rdfvalue.DecodeError:
+      raise DecodingError("RDFValue parsing failed.")
+
+    # Mark messages as authenticated and where they came from.
+    msg.auth_state = self.auth_state
+    msg.source = self.source
+    return msg
+
+  def _SplitMessages(self):
+    """Yields the serialized GrrMessages in the message list."""
+    try:
+      chunks = compression.DecompressChunks(
+          self.packed_message_list.compression,
+          self.packed_message_list.message_list, self.chunk_size)
+
+      # Data which was not parsed yet and the size it has to reach before we
+      # try again, if known.
+      pending = []
+      pending_size = 0
+      needed_size = 0
+      for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < needed_size:
+          continue
+
+        buf = "".join(pending)
+        pos = 0
+        needed_size = 0
+        while pos < len(buf):
+          field = _ReadField(buf, pos)
+          if field is None:
+            break
+
+          field_number, wire_type, start, end = field
+          if end > len(buf):
+            needed_size = end - pos
+            break
+
+          if (field_number == self._JOB_FIELD and
+              wire_type == rdf_structs.WIRETYPE_LENGTH_DELIMITED):
+            yield buf[start:end]
+          pos = end
+
+        pending = [buf[pos:]]
+        pending_size = len(buf) - pos
+
+    except compression.Error as e:
+      raise DecodingError(str(e))
+
+    if pending_size:
+      raise DecodingError("Message list is truncated.")
+
+
+# The cipher of a received ClientCommunication and what we know about its
+# sender, before the payload is decrypted.
+ReceivedSession = collections.namedtuple(
+    "ReceivedSession", ["source", "cipher", "cipher_verified",
+                        "remote_public_key"])
+
+
+def _KeyFingerprint(public_key):
+  return hashlib.sha1(str(public_key.GetN())).digest()
+
+
 class Cipher(object):
   """Holds keying information."""
   cipher_name = "aes_128_cbc"
@@ -67,6 +283,9 @@ class Cipher(object):
 
   def __init__(self, source, private_key, remote_public_key):
     self.private_key = private_key
+    self.created = time.time()
+    # Identifies the key the session key is encrypted with.
+    self.remote_key_fingerprint = _KeyFingerprint(remote_public_key)
 
     # The CipherProperties() protocol buffer specifying the session keys, that
     # we send to the other end point. It will be encrypted using the RSA private
@@ -114,6 +333,24 @@ class Cipher(object):
     return rdf_crypto.HMAC(self.cipher.hmac_key).HMAC("".join(data))
 
 
+class RestoredCipher(Cipher):
+  """A cipher we created earlier, restored from a cache of sessions.
+
+  This allows sharing sessions outside of this process without repeating the
+  RSA operations it took to create them.
+  """
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, serialized_cipher, encrypted_cipher,
+               encrypted_cipher_metadata, remote_key_fingerprint, created):
+    self.cipher = rdf_flows.CipherProperties.FromSerializedString(
+        serialized_cipher)
+    self.encrypted_cipher = encrypted_cipher
+    self.encrypted_cipher_metadata = encrypted_cipher_metadata
+    self.remote_key_fingerprint = remote_key_fingerprint
+    self.created = created
+
+
 class ReceivedCipher(Cipher):
   """A cipher which we received from our peer."""
 
@@ -256,10 +493,33 @@ class ReceivedCipher(Cipher):
       return True
 
 
+class VerifiedCipher(ReceivedCipher):
+  """A received cipher restored after its signature was verified.
+
+  This allows caching verified ciphers outside of this process without
+  repeating the RSA operations when they are read back.
+  """
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, serialized_cipher, cipher_metadata):
+    self.serialized_cipher = serialized_cipher
+    self.cipher = rdf_flows.CipherProperties.FromSerializedString(
+        serialized_cipher)
+    self.cipher_metadata = cipher_metadata
+
+
 class Communicator(object):
   """A class responsible for encoding and decoding comms."""
   server_name = None
 
+  # The number of seconds a cipher is used for messages to the same
+  # destination. Creating a cipher takes an RSA signature and an RSA
+  # encryption and receiving one takes an RSA decryption and an RSA signature
+  # verification. The receiver caches ciphers it has seen, so while the cipher
+  # is reused both sides only need symmetric crypto. 0 creates a new cipher
+  # for every message.
+  session_lifetime = 0
+
   def __init__(self, certificate=None, private_key=None):
     """Creates a communicator.
 
@@ -274,21 +534,54 @@ class Communicator(object):
     # A cache for encrypted ciphers
     self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
 
+    # The ciphers used for messages to our peers, keyed by common name.
+    self.session_ciphers = utils.FastStore(max_size=50000)
+
+    # The compression types our peers accept, keyed by common name.
+    self.peer_compression = utils.FastStore(max_size=50000)
+
   @classmethod
-  def EncodeMessageList(cls, message_list, packed_message_list):
-    """Encode the MessageList into the packed_message_list rdfvalue."""
+  def EncodeMessageList(cls,
+                        message_list,
+                        packed_message_list,
+                        accepted_compression=None):
+    """Encode the MessageList into the packed_message_list rdfvalue.
+
+    Args:
+      message_list: A MessageList rdfvalue.
+      packed_message_list: The PackedMessageList rdfvalue to fill in.
+      accepted_compression: The compression types the receiver accepts. If
+        None, zlib is used.
+    """
+    packed_message_list.accepted_compression = (
+        compression.SupportedCompression())
+
     # By default uncompress
     uncompressed_data = message_list.SerializeToString()
     packed_message_list.message_list = uncompressed_data
 
-    compressed_data = zlib.compress(uncompressed_data)
+    codec = compression.ChooseCodec(accepted_compression)
+    compressed_data = codec.Compress(uncompressed_data)
 
     # Only compress if it buys us something.
     if len(compressed_data) < len(uncompressed_data):
-      packed_message_list.compression = (
-          rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
+      packed_message_list.compression = codec.compression_type
       packed_message_list.message_list = compressed_data
 
+  def _PeerKey(self, common_name):
+    return utils.SmartStr(rdfvalue.RDFURN(common_name))
+
+  def GetPeerCompression(self, common_name):
+    """Returns the compression types the peer advertised or None."""
+    try:
+      return self.peer_compression.Get(self._PeerKey(common_name))
+    except KeyError:
+      return None
+
+  def SetPeerCompression(self, common_name, accepted_compression):
+    self.peer_compression.Put(
+        self._PeerKey(common_name), list(accepted_compression))
+
   def _ClearServerCipherCache(self):
     self.server_cipher = None
     self.server_cipher_age = rdfvalue.RDFDatetime.FromSecondsSinceEpoch(0)
@@ -307,6 +600,40 @@ class Communicator(object):
     self.server_cipher_age = rdfvalue.RDFDatetime.Now()
     return self.server_cipher
 
+  def _GetSessionCipher(self, destination):
+    """Returns the cipher to encrypt messages to destination with.
+
+    Args:
+      destination: The CN of the remote system.
+
+    Returns:
+      A Cipher, reused for self.session_lifetime seconds.
+
+    Raises:
+      UnknownClientCert: If we do not have a key for the destination.
+    """
+    remote_public_key = self._GetRemotePublicKey(destination)
+    if not self.session_lifetime:
+      return Cipher(self.common_name, self.private_key, remote_public_key)
+
+    key = self._PeerKey(destination)
+    try:
+      cipher = self.session_ciphers.Get(key)
+      # A new session is needed when the peer's key changes, e.g. because it
+      # enrolled again.
+      if (cipher.created + self.session_lifetime > time.time() and
+          cipher.remote_key_fingerprint == _KeyFingerprint(remote_public_key)):
+        stats.STATS.IncrementCounter(
+            "grr_session_cipher_cache", fields=["hits"])
+        return cipher
+    except KeyError:
+      pass
+
+    stats.STATS.IncrementCounter("grr_session_cipher_cache", fields=["misses"])
+    cipher = Cipher(self.common_name, self.private_key, remote_public_key)
+    self.session_ciphers.Put(key, cipher)
+    return cipher
+
   def EncodeMessages(self,
                      message_list,
                      result,
@@ -319,7 +646,7 @@ class Communicator(object):
 
     Args:
        message_list: A MessageList rdfvalue containing a list of
-       GrrMessages.
+       GrrMessages. Any object serializing to a MessageList works.
 
        result: A ClientCommunication rdfvalue which will be filled in.
 
@@ -351,15 +678,17 @@ class Communicator(object):
       # it's the only cipher it ever uses.
       cipher = self._GetServerCipher()
     else:
-      remote_public_key = self._GetRemotePublicKey(destination)
-      cipher = Cipher(self.common_name, self.private_key, remote_public_key)
+      cipher = self._GetSessionCipher(destination)
 
     # Make a nonce for this transaction
     if timestamp is None:
       self.timestamp = timestamp = long(time.time() * 1000000)
 
     packed_message_list = rdf_flows.PackedMessageList(timestamp=timestamp)
-    self.EncodeMessageList(message_list, packed_message_list)
+    self.EncodeMessageList(
+        message_list,
+        packed_message_list,
+        accepted_compression=self.GetPeerCompression(destination))
 
     result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
 
@@ -400,10 +729,25 @@ class Communicator(object):
     Returns:
        a Packed_Message_List rdfvalue
     """
+    return self.DecryptResponse(encrypted_response)[1:]
+
+  def DecryptResponse(self, encrypted_response):
+    """Like DecryptMessage() but also returns the ClientCommunication.
+
+    Args:
+       encrypted_response: A serialized and encrypted string.
+
+    Returns:
+       A tuple of the ClientCommunication rdfvalue followed by the messages,
+       their source and timestamp as returned by DecodeMessages().
+
+    Raises:
+       DecodingError: If the response can not be decoded.
+    """
     try:
       response_comms = rdf_flows.ClientCommunication.FromSerializedString(
           encrypted_response)
-      return self.DecodeMessages(response_comms)
+      return (response_comms,) + self.DecodeMessages(response_comms)
     except (rdfvalue.DecodeError, type_info.TypeValueError, ValueError,
             AttributeError) as e:
       raise DecodingError("Error while decrypting messages: %s" % e)
@@ -421,18 +765,11 @@ class Communicator(object):
     Raises:
       DecodingError: If decompression fails.
     """
-    compression = packed_message_list.compression
-    if compression == rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED:
-      data = packed_message_list.message_list
-
-    elif (compression ==
-          rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION):
-      try:
-        data = zlib.decompress(packed_message_list.message_list)
-      except zlib.error as e:
-        raise DecodingError("Failed to decompress: %s" % e)
-    else:
-      raise DecodingError("Compression scheme not supported")
+    try:
+      data = compression.Decompress(packed_message_list.compression,
+                                    packed_message_list.message_list)
+    except compression.Error as e:
+      raise DecodingError(str(e))
 
     try:
       result = rdf_flows.MessageList.FromSerializedString(data)
@@ -453,6 +790,25 @@ class Communicator(object):
     Raises:
        DecryptionError: If the message failed to decrypt properly.
     """
+    stream = self.DecodeMessageStream(response_comms)
+    return list(stream), stream.source, stream.timestamp
+
+  def ReadCipher(self, response_comms):
+    """Reads the cipher of a message and finds out who sent it.
+
+    This is cheap for ciphers seen recently, which are cached. The payload is
+    not decrypted, so callers can decide whether to handle the message at all
+    before spending any more work on it.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+
+    Returns:
+       A ReceivedSession to pass to DecodeMessageStream().
+
+    Raises:
+       DecryptionError: If the cipher failed to decrypt properly.
+    """
     # Have we seen this cipher before?
     cipher_verified = False
     try:
@@ -487,6 +843,27 @@ class Communicator(object):
         # We don't know who we are talking to.
         remote_public_key = None
 
+    return ReceivedSession(source, cipher, cipher_verified, remote_public_key)
+
+  def DecodeMessageStream(self, response_comms, session=None):
+    """Like DecodeMessages() but parses the messages as they are read.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+        session: The ReceivedSession returned by ReadCipher() for these
+          comms. If not given, the cipher is read first.
+
+    Returns:
+       A MessageStream. Iterating over it raises DecodingError if the message
+       list is corrupt.
+
+    Raises:
+       DecryptionError: If the message failed to decrypt properly.
+    """
+    if session is None:
+      session = self.ReadCipher(response_comms)
+    cipher = session.cipher
+
     # Decrypt the message with the per packet IV.
     plain = cipher.Decrypt(response_comms.encrypted, response_comms.packet_iv)
     try:
@@ -495,7 +872,9 @@ class Communicator(object):
     except rdfvalue.DecodeError as e:
       raise DecryptionError(str(e))
 
-    message_list = self.DecompressMessageList(packed_message_list)
+    # The decrypted data is no longer needed, the message list is decompressed
+    # from the parsed PackedMessageList.
+    del plain
 
     # Are these messages authenticated?
     # pyformat: disable
@@ -503,18 +882,18 @@ class Communicator(object):
         response_comms,
         packed_message_list,
         cipher,
-        cipher_verified,
+        session.cipher_verified,
         response_comms.api_version,
-        remote_public_key)
+        session.remote_public_key)
     # pyformat: enable
 
-    # Mark messages as authenticated and where they came from.
-    for msg in message_list.job:
-      msg.auth_state = auth_state
-      msg.source = cipher.cipher_metadata.source
+    # Only trust authenticated peers to tell us what they can decode.
+    if auth_state == rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED:
+      self.SetPeerCompression(cipher.cipher_metadata.source,
+                              packed_message_list.accepted_compression)
 
-    return (message_list.job, cipher.cipher_metadata.source,
-            packed_message_list.timestamp)
+    return MessageStream(packed_message_list, auth_state,
+                         cipher.cipher_metadata.source)
 
   def VerifyMessageSignature(self, unused_response_comms, packed_message_list,
                              cipher, cipher_verified, api_version,
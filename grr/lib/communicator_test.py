@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Tests for the communicator."""
+
+import zlib
+
+
+from grr.lib import communicator
+from grr.lib import flags
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.test_lib import test_lib
+
+
+class MessageStreamTest(test_lib.GRRBaseTest):
+  """Tests decoding message lists as a stream."""
+
+  def _MakeMessages(self, count, size=100):
+    return [
+        rdf_flows.GrrMessage(
+            session_id="aff4:/flows/W:1234",
+            request_id=1,
+            response_id=i + 1,
+            payload=rdf_protodict.DataBlob(string="x" * size))
+        for i in xrange(count)
+    ]
+
+  def _MakeStream(self, messages, compress=True):
+    data = rdf_flows.MessageList(job=messages).SerializeToString()
+    compression = rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED
+    if compress:
+      data = zlib.compress(data)
+      compression = rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION
+
+    packed_message_list = rdf_flows.PackedMessageList(
+        message_list=data, compression=compression, timestamp=1234)
+    stream = communicator.MessageStream(
+        packed_message_list,
+        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED,
+        "C.1000000000000000")
+    # Make sure messages span several chunks.
+    stream.chunk_size = 64
+    return stream
+
+  def testMessagesAreDecoded(self):
+    messages = self._MakeMessages(20, size=500)
+    for compress in [True, False]:
+      stream = self._MakeStream(messages, compress=compress)
+      self.assertEqual(stream.timestamp, 1234)
+
+      decoded = list(stream)
+      self.assertEqual([m.response_id for m in decoded], range(1, 21))
+      for msg in decoded:
+        self.assertEqual(msg.payload.string, "x" * 500)
+        self.assertEqual(msg.auth_state,
+                         rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+        self.assertEqual(msg.source, "C.1000000000000000")
+
+  def testBatchesAreLimitedInSize(self):
+    messages = self._MakeMessages(10)
+    size = len(messages[0].SerializeToString())
+    batches = list(self._MakeStream(messages).Batches(3 * size))
+    self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+
+    # Messages larger than the limit still make it through on their own.
+    batches = list(self._MakeStream(messages).Batches(1))
+    self.assertEqual([len(batch) for batch in batches], [1] * 10)
+
+  def testBatchesAreOnlyYieldedForValidMessageLists(self):
+    messages = self._MakeMessages(10)
+    size = len(messages[0].SerializeToString())
+    data = rdf_flows.MessageList(job=messages).SerializeToString()
+    packed_message_list = rdf_flows.PackedMessageList(message_list=data[:-10])
+    stream = communicator.MessageStream(packed_message_list, None, None)
+
+    batches = []
+    with self.assertRaises(communicator.DecodingError):
+      for batch in stream.Batches(3 * size):
+        batches.append(batch)
+    self.assertEqual(batches, [])
+
+  def testEmptyMessageList(self):
+    self.assertEqual(list(self._MakeStream([])), [])
+
+  def testTruncatedMessageListRaises(self):
+    data = rdf_flows.MessageList(
+        job=self._MakeMessages(3)).SerializeToString()
+    packed_message_list = rdf_flows.PackedMessageList(message_list=data[:-10])
+    stream = communicator.MessageStream(packed_message_list, None, None)
+    with self.assertRaises(communicator.DecodingError):
+      list(stream)
+
+  def testCorruptMessageListRaises(self):
+    packed_message_list = rdf_flows.PackedMessageList(
+        message_list="not compressed",
+        compression=rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
+    stream = communicator.MessageStream(packed_message_list, None, None)
+    with self.assertRaises(communicator.DecodingError):
+      list(stream)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""Compression codecs for data exchanged between clients and servers.
+
+Each codec is identified by its value in PackedMessageList.CompressionType,
+DataBlob.CompressionType uses the same values. Senders advertise the codecs
+they can decode in every PackedMessageList, so a peer only ever uses a codec
+the other side understands. Everybody understands zlib, which is used as long
+as nothing else was negotiated.
+"""
+
+import zlib
+
+
+from grr.lib import registry
+from grr.lib.rdfvalues import flows as rdf_flows
+
+try:
+  from lz4 import frame as lz4_frame  # pylint: disable=g-import-not-at-top
+except ImportError:
+  lz4_frame = None
+
+UNCOMPRESSED = rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED
+ZCOMPRESSION = rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION
+LZ4COMPRESSION = rdf_flows.PackedMessageList.CompressionType.LZ4COMPRESSION
+
+# Decompressing to more than this many bytes fails, so that a small message can
+# not make the receiver run out of memory.
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+
+# Data is sampled to decide if it is worth compressing.
+_SAMPLE_SIZE = 4096
+# Compressing the sample has to save at least this fraction of its size.
+_MIN_SAVINGS = 0.1
+
+# Magic numbers of common formats which are compressed already: gzip, zip,
+# bzip2, xz, 7z, zstd, lz4, png, jpeg and rar.
+_COMPRESSED_MAGIC = ("\x1f\x8b", "PK\x03\x04", "BZh", "\xfd7zXZ\x00",
+                     "7z\xbc\xaf\x27\x1c", "\x28\xb5\x2f\xfd",
+                     "\x04\x22\x4d\x18", "\x89PNG", "\xff\xd8\xff", "Rar!")
+
+
+class Error(Exception):
+  """Raised when data can not be compressed or decompressed."""
+
+
+class Codec(object):
+  """The base class for compression codecs."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # The compression type this codec implements.
+  compression_type = None
+
+  # If several codecs can be used, the one with the highest preference wins.
+  preference = 0
+
+  @classmethod
+  def IsAvailable(cls):
+    """Returns True if this codec can be used in this process."""
+    return True
+
+  def Compress(self, data):
+    """Compresses data.
+
+    Args:
+      data: The string to compress.
+
+    Returns:
+      The compressed string.
+    """
+    raise NotImplementedError()
+
+  def Decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+    """Decompresses data.
+
+    Args:
+      data: A string compressed with Compress().
+      max_size: The maximum size of the decompressed data.
+
+    Returns:
+      The decompressed string.
+
+    Raises:
+      Error: If the data is corrupt or decompresses to more than max_size
+        bytes.
+    """
+    raise NotImplementedError()
+
+  def DecompressChunks(self, data, chunk_size):
+    """Decompresses data incrementally.
+
+    Args:
+      data: A string compressed with Compress().
+      chunk_size: The approximate size of the chunks to produce.
+
+    Yields:
+      The decompressed data in chunks.
+
+    Raises:
+      Error: If the data is corrupt.
+    """
+    _ = chunk_size
+    yield self.Decompress(data)
+
+
+class ZlibCodec(Codec):
+  """Compresses using zlib, which every client and server supports."""
+
+  compression_type = ZCOMPRESSION
+  preference = 1
+
+  def Compress(self, data):
+    return zlib.compress(data)
+
+  def Decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+    decompressor = zlib.decompressobj()
+    try:
+      result = decompressor.decompress(data, max_size + 1)
+      if len(result) <= max_size:
+        result += decompressor.flush()
+    except zlib.error as e:
+      raise Error("Failed to decompress: %s" % e)
+
+    if len(result) > max_size:
+      raise Error("Decompressed data exceeds %d bytes." % max_size)
+    return result
+
+  def DecompressChunks(self, data, chunk_size):
+    decompressor = zlib.decompressobj()
+    try:
+      chunk = decompressor.decompress(data, chunk_size)
+      while chunk:
+        yield chunk
+        chunk = decompressor.decompress(decompressor.unconsumed_tail,
+                                        chunk_size)
+
+      chunk = decompressor.flush()
+    except zlib.error as e:
+      raise Error("Failed to decompress: %s" % e)
+
+    if chunk:
+      yield chunk
+
+
+class LZ4Codec(Codec):
+  """Compresses using lz4 frames, several times faster than zlib."""
+
+  compression_type = LZ4COMPRESSION
+  preference = 2
+
+  @classmethod
+  def IsAvailable(cls):
+    return lz4_frame is not None
+
+  def Compress(self, data):
+    return lz4_frame.compress(data)
+
+  def Decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    try:
+      result = decompressor.decompress(data, max_size + 1)
+    except (RuntimeError, ValueError) as e:
+      raise Error("Failed to decompress: %s" % e)
+
+    if len(result) > max_size:
+      raise Error("Decompressed data exceeds %d bytes." % max_size)
+    if not decompressor.eof:
+      raise Error("Failed to decompress: truncated lz4 frame.")
+    return result
+
+  def DecompressChunks(self, data, chunk_size):
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    try:
+      chunk = decompressor.decompress(data, chunk_size)
+      while True:
+        if chunk:
+          yield chunk
+
+        if decompressor.eof or decompressor.needs_input:
+          break
+
+        chunk = decompressor.decompress("", chunk_size)
+    except (RuntimeError, ValueError) as e:
+      raise Error("Failed to decompress: %s" % e)
+
+    if not decompressor.eof:
+      raise Error("Failed to decompress: truncated lz4 frame.")
+
+
+def _AvailableCodecs():
+  for cls in Codec.classes.itervalues():
+    if cls.compression_type is not None and cls.IsAvailable():
+      yield cls
+
+
+def SupportedCompression():
+  """Returns the compression types this process is able to decode."""
+  return sorted([UNCOMPRESSED] +
+                [cls.compression_type for cls in _AvailableCodecs()])
+
+
+def GetCodec(compression_type):
+  """Returns a codec for the compression type.
+
+  Args:
+    compression_type: A PackedMessageList.CompressionType or
+      DataBlob.CompressionType value.
+
+  Returns:
+    A Codec instance.
+
+  Raises:
+    Error: If this compression type is not supported.
+  """
+  for cls in _AvailableCodecs():
+    if cls.compression_type == compression_type:
+      return cls()
+
+  raise Error("Compression scheme %s not supported" % compression_type)
+
+
+def ChooseCodec(accepted=None):
+  """Returns the best codec the receiver accepts.
+
+  Args:
+    accepted: The compression types advertised by the receiver. If None, the
+      receiver is only assumed to accept zlib.
+
+  Returns:
+    A Codec instance.
+  """
+  accepted = set(int(t) for t in accepted or []) | set([int(ZCOMPRESSION)])
+  best = max(
+      (cls for cls in _AvailableCodecs()
+       if int(cls.compression_type) in accepted),
+      key=lambda cls: cls.preference)
+  return best()
+
+
+def Decompress(compression_type, data, max_size=MAX_DECOMPRESSED_SIZE):
+  """Decompresses data compressed with the given compression type.
+
+  Args:
+    compression_type: The compression type data was compressed with.
+    data: The compressed string.
+    max_size: The maximum size of the decompressed data.
+
+  Returns:
+    The decompressed string.
+
+  Raises:
+    Error: If this compression type is not supported, the data is corrupt or
+      decompresses to more than max_size bytes.
+  """
+  if compression_type == UNCOMPRESSED:
+    return data
+  return GetCodec(compression_type).Decompress(data, max_size=max_size)
+
+
+def DecompressChunks(compression_type, data, chunk_size=64 * 1024):
+  """Like Decompress() but produces the result incrementally.
+
+  Args:
+    compression_type: The compression type data was compressed with.
+    data: The compressed string.
+    chunk_size: The approximate size of the chunks to produce.
+
+  Returns:
+    An iterator over the decompressed data in chunks.
+
+  Raises:
+    Error: If this compression type is not supported. Corrupt data raises
+      Error while iterating.
+  """
+  if compression_type == UNCOMPRESSED:
+    return (data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size))
+  return GetCodec(compression_type).DecompressChunks(data, chunk_size)
+
+
+def LooksIncompressible(data):
+  """Guesses if compressing data would be a waste of time.
+
+  Args:
+    data: A string.
+
+  Returns:
+    True if data starts like a compressed file format, or a sample of it does
+    not compress well.
+  """
+  if data.startswith(_COMPRESSED_MAGIC):
+    return True
+
+  if len(data) <= _SAMPLE_SIZE:
+    return False
+
+  sample = data[:_SAMPLE_SIZE]
+  return len(zlib.compress(sample, 1)) > len(sample) * (1 - _MIN_SAVINGS)
+
+
+def CompressBlob(data, accepted=None):
+  """Compresses a chunk of data for upload.
+
+  Args:
+    data: The string to compress.
+    accepted: The compression types advertised by the receiver, see
+      ChooseCodec().
+
+  Returns:
+    A tuple of the (possibly) compressed data and its compression type.
+  """
+  if LooksIncompressible(data):
+    return data, UNCOMPRESSED
+
+  codec = ChooseCodec(accepted)
+  return codec.Compress(data), codec.compression_type
+
+
+# The compression types all frontends of the server accept. Clients talk to a
+# single server and learn these from its messages, see
+# ClientCommunicator.SetPeerCompression().
+_server_compression = []
+
+
+def SetServerCompression(accepted):
+  global _server_compression
+  _server_compression = list(accepted)
+
+
+def ServerCompression():
+  """Returns the compression types the server advertised, if any."""
+  return _server_compression
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Tests for the compression codecs."""
+
+import gzip
+import os
+import StringIO
+import unittest
+import zlib
+
+
+from grr.lib import compression
+from grr.lib import flags
+from grr.test_lib import test_lib
+
+
+class CompressionTest(test_lib.GRRBaseTest):
+  """Tests the compression codecs."""
+
+  TEXT = "".join("line %d of some log file\n" % i for i in xrange(1000))
+
+  def testZlibIsUsedByDefault(self):
+    codec = compression.ChooseCodec()
+    self.assertEqual(codec.compression_type, compression.ZCOMPRESSION)
+    self.assertEqual(codec.Compress(self.TEXT), zlib.compress(self.TEXT))
+
+  def testUnacceptedCodecsAreNotChosen(self):
+    codec = compression.ChooseCodec([compression.UNCOMPRESSED])
+    self.assertEqual(codec.compression_type, compression.ZCOMPRESSION)
+
+  def testRoundTrip(self):
+    for compression_type in compression.SupportedCompression():
+      if compression_type == compression.UNCOMPRESSED:
+        data = self.TEXT
+      else:
+        data = compression.GetCodec(compression_type).Compress(self.TEXT)
+      self.assertEqual(
+          compression.Decompress(compression_type, data), self.TEXT)
+
+  def testDecompressChunks(self):
+    for compression_type in compression.SupportedCompression():
+      if compression_type == compression.UNCOMPRESSED:
+        data = self.TEXT
+      else:
+        data = compression.GetCodec(compression_type).Compress(self.TEXT)
+
+      chunks = list(
+          compression.DecompressChunks(compression_type, data, chunk_size=1000))
+      self.assertGreater(len(chunks), 1)
+      self.assertEqual("".join(chunks), self.TEXT)
+
+  def testCorruptDataRaises(self):
+    with self.assertRaises(compression.Error):
+      compression.Decompress(compression.ZCOMPRESSION, "not compressed")
+
+  def testDecompressedSizeIsLimited(self):
+    for compression_type in compression.SupportedCompression():
+      if compression_type == compression.UNCOMPRESSED:
+        continue
+
+      data = compression.GetCodec(compression_type).Compress(self.TEXT)
+      self.assertEqual(
+          compression.Decompress(
+              compression_type, data, max_size=len(self.TEXT)), self.TEXT)
+      with self.assertRaises(compression.Error):
+        compression.Decompress(
+            compression_type, data, max_size=len(self.TEXT) - 1)
+
+  @unittest.skipUnless(compression.lz4_frame, "requires lz4")
+  def testTruncatedLZ4FrameRaises(self):
+    data = compression.GetCodec(compression.LZ4COMPRESSION).Compress(self.TEXT)
+    with self.assertRaises(compression.Error):
+      compression.Decompress(compression.LZ4COMPRESSION, data[:-10])
+
+  def testUnsupportedCompressionRaises(self):
+    with self.assertRaises(compression.Error):
+      compression.Decompress(1000, self.TEXT)
+
+  @unittest.skipUnless(compression.lz4_frame, "requires lz4")
+  def testLZ4IsPreferredWhenAccepted(self):
+    codec = compression.ChooseCodec(compression.SupportedCompression())
+    self.assertEqual(codec.compression_type, compression.LZ4COMPRESSION)
+
+  def testIncompressibleDataIsNotCompressed(self):
+    random_data = os.urandom(64 * 1024)
+    self.assertEqual(
+        compression.CompressBlob(random_data),
+        (random_data, compression.UNCOMPRESSED))
+
+    fd = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=fd, mode="wb") as gzip_fd:
+      gzip_fd.write("x")
+    self.assertTrue(compression.LooksIncompressible(fd.getvalue()))
+
+  def testCompressibleDataIsCompressed(self):
+    data, compression_type = compression.CompressBlob(self.TEXT)
+    self.assertEqual(compression_type, compression.ZCOMPRESSION)
+    self.assertLess(len(data), len(self.TEXT))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
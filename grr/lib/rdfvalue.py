@@ -32,6 +32,17 @@ MICROSECONDS = 1000000
 # Somewhere to keep all the late binding placeholders.
 _LATE_BINDING_STORE = {}
 
+# The instance attributes every RDFValue has. Classes which are created in large
+# numbers declare these as __slots__ so their instances carry no __dict__, and
+# fill them in their constructors. Other classes use the class level defaults.
+_RDFVALUE_SLOTS = ("_age", "dirty", "attribute_instance")
+
+# Normalized paths of recently parsed URNs. The same clients, flows and
+# directories are referred to over and over again so URNs parsed from the same
+# string share a single normalized path instead of each holding a copy.
+_URN_PATHS = {}
+_URN_PATHS_MAX_SIZE = 10000
+
 
 def RegisterLateBindingCallback(target_name, callback, **kwargs):
   """Registers a callback to be invoked when the RDFValue named is declared."""
@@ -72,6 +83,9 @@ class RDFValue(object):
   """
   __metaclass__ = RDFValueMetaclass
 
+  # Subclasses which do not declare their own __slots__ get a __dict__ as usual.
+  __slots__ = ()
+
   # This is how the attribute will be serialized to the data store. It must
   # indicate both the type emitted by SerializeToDataStore() and expected by
   # FromDatastoreValue()
@@ -101,9 +115,10 @@ class RDFValue(object):
     Raises:
       InitializeError: if we can not be initialized from this parameter.
     """
-    # Default timestamp is now.
+    # The default age is 0. It is only converted to an RDFDatetime when the age
+    # property is accessed so values do not each carry a timestamp object.
     if age is None:
-      age = RDFDatetime(age=0)
+      age = 0
 
     self._age = age
 
@@ -125,6 +140,40 @@ class RDFValue(object):
   def __copy__(self):
     return self.Copy()
 
+  def _SlotNames(self):
+    """Returns the names of all __slots__ declared by this class and bases."""
+    names = set()
+    for cls in self.__class__.__mro__:
+      names.update(cls.__dict__.get("__slots__", ()))
+    return names
+
+  def __getstate__(self):
+    """Returns the instance attributes kept in __dict__ and in __slots__."""
+    state = dict(getattr(self, "__dict__", ()))
+    for name in self._SlotNames():
+      try:
+        state[name] = object.__getattribute__(self, name)
+      except AttributeError:
+        pass
+
+    return state
+
+  def __setstate__(self, state):
+    """Restores the state returned by __getstate__.
+
+    Values pickled before their class used __slots__ only stored the
+    attributes that were set on the instance, so any slot missing from the
+    state is first initialized by the constructor.
+
+    Args:
+      state: A dict of attribute names and values.
+    """
+    if not self._SlotNames().issubset(state):
+      self.__init__()
+
+    for name, value in state.iteritems():
+      object.__setattr__(self, name, value)
+
   @property
   def age(self):
     if self._age.__class__ is not RDFDatetime:
@@ -212,9 +261,12 @@ class RDFBytes(RDFValue):
   """An attribute which holds bytes."""
   data_store_type = "bytes"
 
-  _value = ""
+  __slots__ = _RDFVALUE_SLOTS + ("_value",)
 
   def __init__(self, initializer=None, age=None):
+    self._value = ""
+    self.dirty = False
+    self.attribute_instance = None
     super(RDFBytes, self).__init__(initializer=initializer, age=age)
     if not self._value and initializer is not None:
       self.ParseFromString(initializer)
@@ -258,6 +310,8 @@ class RDFBytes(RDFValue):
 class RDFZippedBytes(RDFBytes):
   """Zipped bytes sequence."""
 
+  __slots__ = ()
+
   def Uncompress(self):
     if self:
       return zlib.decompress(self._value)
@@ -270,7 +324,12 @@ class RDFString(RDFBytes):
 
   data_store_type = "string"
 
-  _value = u""
+  __slots__ = ()
+
+  def __init__(self, initializer=None, age=None):
+    super(RDFString, self).__init__(initializer=initializer, age=age)
+    if initializer is None:
+      self._value = u""
 
   def format(self, *args, **kwargs):  # pylint: disable=invalid-name
     return self._value.format(*args, **kwargs)
@@ -300,6 +359,8 @@ class HashDigest(RDFBytes):
 
   data_store_type = "bytes"
 
+  __slots__ = ()
+
   def HexDigest(self):
     return self._value.encode("hex")
 
@@ -320,11 +381,16 @@ class RDFInteger(RDFValue):
 
   data_store_type = "integer"
 
+  __slots__ = _RDFVALUE_SLOTS + ("_value",)
+
   @staticmethod
   def IsNumeric(value):
     return isinstance(value, (int, long, float, RDFInteger))
 
   def __init__(self, initializer=None, age=None):
+    self._value = None
+    self.dirty = False
+    self.attribute_instance = None
     super(RDFInteger, self).__init__(initializer=initializer, age=age)
     if self._value is None:
       if initializer is None:
@@ -432,14 +498,15 @@ class RDFBool(RDFInteger):
   """Boolean value."""
   data_store_type = "unsigned_integer"
 
+  __slots__ = ()
+
 
 class RDFDatetime(RDFInteger):
   """A date and time internally stored in MICROSECONDS."""
   converter = MICROSECONDS
   data_store_type = "unsigned_integer"
 
-  # A value of 0 means this object is not initialized.
-  _value = 0
+  __slots__ = ()
 
   def __init__(self, initializer=None, age=None):
     super(RDFDatetime, self).__init__(None, age)
@@ -612,11 +679,15 @@ class RDFDatetimeSeconds(RDFDatetime):
   """A DateTime class which is stored in whole seconds."""
   converter = 1
 
+  __slots__ = ()
+
 
 class Duration(RDFInteger):
   """Duration value stored in seconds internally."""
   data_store_type = "unsigned_integer"
 
+  __slots__ = ()
+
   # pyformat: disable
   DIVIDERS = collections.OrderedDict((
       ("w", 60 * 60 * 24 * 7),
@@ -764,6 +835,8 @@ class ByteSize(RDFInteger):
   """
   data_store_type = "unsigned_integer"
 
+  __slots__ = ()
+
   DIVIDERS = dict((
       ("", 1),
       ("k", 1000),
@@ -847,7 +920,7 @@ class RDFURN(RDFValue):
   # class for performance reasons.
   scheme = "aff4"
 
-  _string_urn = ""
+  __slots__ = _RDFVALUE_SLOTS + ("_string_urn",)
 
   def __init__(self, initializer=None, age=None):
     """Constructor.
@@ -856,6 +929,9 @@ class RDFURN(RDFValue):
       initializer: A string or another RDFURN.
       age: The age of this entry.
     """
+    self.dirty = False
+    self.attribute_instance = None
+
     # This is a shortcut that is a bit faster than the standard way of
     # using the RDFValue constructor to make a copy of the class. For
     # RDFURNs that way is a bit slow since it would try to normalize
@@ -867,8 +943,9 @@ class RDFURN(RDFValue):
       super(RDFURN, self).__init__(None, age=age)
       return
 
+    self._string_urn = ""
     super(RDFURN, self).__init__(initializer=initializer, age=age)
-    if self._value is None and initializer is not None:
+    if initializer is not None:
       self.ParseFromString(initializer)
 
   def ParseFromString(self, initializer):
@@ -881,7 +958,15 @@ class RDFURN(RDFValue):
     if initializer.startswith("aff4:/"):
       initializer = initializer[5:]
 
-    self._string_urn = utils.NormalizePath(initializer)
+    path = _URN_PATHS.get(initializer)
+    if path is None:
+      if len(_URN_PATHS) >= _URN_PATHS_MAX_SIZE:
+        _URN_PATHS.clear()
+
+      path = utils.NormalizePath(initializer)
+      _URN_PATHS[initializer] = path
+
+    self._string_urn = path
 
   def SerializeToString(self):
     return str(self)
@@ -1019,6 +1104,8 @@ class RDFURN(RDFValue):
 class Subject(RDFURN):
   """A psuedo attribute representing the subject of an AFF4 object."""
 
+  __slots__ = ()
+
 
 DEFAULT_FLOW_QUEUE = RDFURN("F")
 
@@ -1026,6 +1113,8 @@ DEFAULT_FLOW_QUEUE = RDFURN("F")
 class SessionID(RDFURN):
   """An rdfvalue object that represents a session_id."""
 
+  __slots__ = ()
+
   def __init__(self,
                initializer=None,
                age=None,
@@ -1088,6 +1177,8 @@ class SessionID(RDFURN):
 
 class FlowSessionID(SessionID):
 
+  __slots__ = ()
+
   # TODO(amoser): This is code to fix some legacy issues. Remove this when all
   # clients are built after Dec 2014.
 
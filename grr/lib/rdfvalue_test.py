@@ -3,9 +3,13 @@
 """Tests for utility classes."""
 
 
+import copy
+import pickle
 import unittest
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.test_lib import test_lib
 
 long_string = (
@@ -38,6 +42,81 @@ class RDFValueTest(unittest.TestCase):
         "ipsum dolor sit amet, consectetur adipiscing elit. Morbi luctus ex "
         "sed dictum volutp...')>")
 
+  def testHotValuesHaveNoInstanceDict(self):
+    for value in [
+        rdfvalue.RDFURN("aff4:/foo"),
+        rdfvalue.SessionID("aff4:/flows/W:1234"),
+        rdfvalue.RDFDatetime(1000),
+        rdfvalue.RDFInteger(1),
+        rdfvalue.RDFString("foo")
+    ]:
+      self.assertFalse(hasattr(value, "__dict__"))
+
+      value.attribute_instance = "attribute"
+      value.dirty = True
+      self.assertEqual(value.age, 0)
+
+      copied = copy.deepcopy(value)
+      self.assertEqual(copied, value)
+      self.assertEqual(copied.attribute_instance, "attribute")
+
+  def testPickleRoundTrip(self):
+    for value in [
+        rdf_client.ClientURN("C.1234567812345678"),
+        rdfvalue.RDFDatetime(1000, age=5),
+        rdfvalue.RDFString(u"迎欢迎")
+    ]:
+      value.attribute_instance = "attribute"
+      for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        unpickled = pickle.loads(pickle.dumps(value, protocol))
+        self.assertEqual(unpickled.__class__, value.__class__)
+        self.assertEqual(unpickled, value)
+        self.assertEqual(unpickled.age, value.age)
+        self.assertEqual(unpickled.attribute_instance, "attribute")
+
+  def testUnpicklesValuesPickledWithInstanceDict(self):
+    # Pickled before these classes declared __slots__, so the state is the old
+    # instance __dict__ and lacks attributes which were class defaults.
+    urn = pickle.loads(
+        "\x80\x02cgrr.lib.rdfvalues.client\nClientURN\nq\x00)\x81q\x01}"
+        "q\x02(U\x04_ageq\x03cgrr.lib.rdfvalue\nRDFDatetime\nq\x04)\x81q"
+        "\x05}q\x06h\x03K\x00sbU\x0b_string_urnq\x07X\x13\x00\x00\x00/C."
+        "1234567812345678q\x08ub.")
+    self.assertEqual(urn, rdf_client.ClientURN("C.1234567812345678"))
+    self.assertEqual(urn.age, 0)
+    self.assertFalse(urn.dirty)
+    self.assertIsNone(urn.attribute_instance)
+
+    date = pickle.loads(
+        "ccopy_reg\n_reconstructor\np0\n(cgrr.lib.rdfvalue\nRDFDatetime\n"
+        "p1\nc__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nS'_age'\np6\ng0\n"
+        "(g1\ng2\nNtp7\nRp8\n(dp9\ng6\nI0\nsbsS'_value'\np10\nI1000\nsb.")
+    self.assertEqual(date, rdfvalue.RDFDatetime(1000))
+    self.assertEqual(date.age, rdfvalue.RDFDatetime(0))
+
+    string = pickle.loads(
+        "\x80\x02cgrr.lib.rdfvalue\nRDFString\nq\x00)\x81q\x01}q\x02(U"
+        "\x04_ageq\x03cgrr.lib.rdfvalue\nRDFDatetime\nq\x04)\x81q\x05}q"
+        "\x06h\x03K\x00sbU\x06_valueq\x07U\x03fooq\x08ub.")
+    self.assertEqual(string, rdfvalue.RDFString("foo"))
+
+  def testEmptyStringIsUnicode(self):
+    value = rdfvalue.RDFString()._value  # pylint: disable=protected-access
+    self.assertIsInstance(value, unicode)
+    self.assertEqual(value, u"")
+
+  def testDefaultsAreNotCopiedToInstanceDicts(self):
+    value = rdf_crypto.RSAPublicKey()
+    self.assertFalse(value.dirty)
+    self.assertIsNone(value.attribute_instance)
+    self.assertNotIn("dirty", value.__dict__)
+    self.assertNotIn("attribute_instance", value.__dict__)
+
+  def testURNsParsedFromTheSameStringShareThePath(self):
+    first = rdfvalue.RDFURN("aff4:/C.1234567812345678/fs/os")
+    second = rdfvalue.RDFURN("aff4:/C.1234567812345678/fs/os")
+    self.assertIs(first.Path(), second.Path())
+
 
 class RDFDateTimeTest(unittest.TestCase):
 
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 """This module tests the RDFValue implementation for performance."""
 
+import sys
 
 from grr.lib import flags
+from grr.lib import rdfvalue
 from grr.lib import type_info
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr_response_proto import jobs_pb2
 from grr_response_proto import knowledge_base_pb2
@@ -54,6 +58,25 @@ class FastGrrMessageList(rdf_structs.RDFProtoStruct):
               name="job", field_number=1, nested=StructGrrMessage)))
 
 
+class DictURN(rdfvalue.RDFURN):
+  """An RDFURN which keeps its attributes in an instance __dict__."""
+
+  # Class attributes hide the slots so instances store these in __dict__.
+  _age = 0
+  _string_urn = ""
+  dirty = False
+  attribute_instance = None
+
+
+class DictDatetime(rdfvalue.RDFDatetime):
+  """An RDFDatetime which keeps its attributes in an instance __dict__."""
+
+  _age = 0
+  _value = 0
+  dirty = False
+  attribute_instance = None
+
+
 class RDFValueBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
   """Microbenchmark tests for RDFProtos."""
 
@@ -339,6 +362,177 @@ class RDFValueBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
 
+  def _StatEntry(self, i):
+    return rdf_client.StatEntry(
+        pathspec=rdf_paths.PathSpec(
+            path="/usr/lib/file_%d" % i,
+            pathtype=rdf_paths.PathSpec.PathType.OS),
+        st_mode=33188,
+        st_ino=1063090 + i,
+        st_dev=64512,
+        st_nlink=1,
+        st_uid=139592,
+        st_gid=5000,
+        st_size=i,
+        st_atime=1336469177,
+        st_mtime=1336129892,
+        st_ctime=1336129892)
+
+  def _GrrMessage(self, i):
+    return rdf_flows.GrrMessage(
+        session_id="aff4:/C.1234567812345678/flows/W:ABCDEF",
+        name="ListDirectory",
+        request_id=1,
+        response_id=i,
+        task_id=12345 + i,
+        payload=self._StatEntry(i))
+
+  def testStatEntryRoundTrip(self):
+    """Decode and encode a StatEntry, as done for every file we collect."""
+    data = self._StatEntry(1).SerializeToString()
+
+    def DecodeEncode():
+      s = rdf_client.StatEntry.FromSerializedString(data)
+      self.assertEqual(s.SerializeToString(), data)
+
+    def DecodeReadEncode():
+      s = rdf_client.StatEntry.FromSerializedString(data)
+      self.assertEqual(s.pathspec.path, "/usr/lib/file_1")
+      self.assertEqual(s.SerializeToString(), data)
+
+    self.TimeIt(DecodeEncode, "StatEntry decode/encode")
+    self.TimeIt(DecodeReadEncode, "StatEntry decode/read/encode")
+
+  def testGrrMessageRoundTrip(self):
+    """Decode and encode a GrrMessage carrying a StatEntry."""
+    data = self._GrrMessage(1).SerializeToString()
+
+    def DecodeEncode():
+      s = rdf_flows.GrrMessage.FromSerializedString(data)
+      self.assertEqual(s.SerializeToString(), data)
+
+    def DecodeModifyEncode():
+      s = rdf_flows.GrrMessage.FromSerializedString(data)
+      s.task_id = 1
+      s.SerializeToString()
+
+    def DecodePayload():
+      s = rdf_flows.GrrMessage.FromSerializedString(data)
+      self.assertEqual(s.payload.st_size, 1)
+
+    self.TimeIt(DecodeEncode, "GrrMessage decode/encode")
+    self.TimeIt(DecodeModifyEncode, "GrrMessage decode/modify/encode")
+    self.TimeIt(DecodePayload, "GrrMessage decode payload")
+
+  def testMessageListRoundTrip(self):
+    """Decode and encode a MessageList as sent by clients."""
+    repeats = self.REPEATS / 50
+    message_list = rdf_flows.MessageList()
+    for i in xrange(100):
+      message_list.job.Append(self._GrrMessage(i))
+
+    data = message_list.SerializeToString()
+
+    def DecodeEncode():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      self.assertEqual(s.SerializeToString(), data)
+
+    def DecodeIterate():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      for i, message in enumerate(s.job):
+        self.assertEqual(message.response_id, i)
+
+    self.TimeIt(
+        DecodeEncode, "MessageList decode/encode", repetitions=repeats)
+    self.TimeIt(
+        DecodeIterate, "MessageList decode/iterate", repetitions=repeats)
+
+  def testLazyRepeatedFields(self):
+    """Parse a bundle of 10k messages and forward or read it."""
+    repeats = self.REPEATS / 200
+    message_list = rdf_flows.MessageList()
+    for i in xrange(10000):
+      message_list.job.Append(self._GrrMessage(i))
+
+    data = message_list.SerializeToString()
+
+    def Forward():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      return len(s.SerializeToString())
+
+    def ReadOne():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      return s.job[5000].response_id
+
+    def ReadAll():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      for message in s.job:
+        message.response_id  # pylint: disable=pointless-statement
+
+    def ProtoForward():
+      s = jobs_pb2.MessageList()
+      s.ParseFromString(data)
+      return len(s.SerializeToString())
+
+    def LazySize():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      elements = s.job.wrapped_list
+      return sys.getsizeof(elements.buff) + sys.getsizeof(elements.offsets)
+
+    def MaterializedSize():
+      s = rdf_flows.MessageList.FromSerializedString(data)
+      elements = list(s.job.wrapped_list)
+      size = sys.getsizeof(elements)
+      for entry in elements:
+        size += sys.getsizeof(entry) + sys.getsizeof(entry[1])
+        size += sum(sys.getsizeof(x) for x in entry[1])
+
+      return size
+
+    self.TimeIt(Forward, "SProto decode/encode", repetitions=repeats)
+    self.TimeIt(ReadOne, "SProto decode/read one", repetitions=repeats)
+    self.TimeIt(ReadAll, "SProto decode/read all", repetitions=repeats)
+    self.TimeIt(ProtoForward, "Protobuf decode/encode", repetitions=repeats)
+    # The value column shows the memory held by the parsed elements.
+    self.TimeIt(LazySize, "Bytes held by the lazy list", repetitions=1)
+    self.TimeIt(
+        MaterializedSize, "Bytes held by wire format tuples", repetitions=1)
+
+  def _InstanceSize(self, value):
+    """Returns the bytes held by an RDFValue, its __dict__ and its age."""
+    size = sys.getsizeof(value)
+    if hasattr(value, "__dict__"):
+      size += sys.getsizeof(value.__dict__)
+
+    age = value._age  # pylint: disable=protected-access
+    if isinstance(age, rdfvalue.RDFValue):
+      size += self._InstanceSize(age)
+
+    return size
+
+  def testMemoryFootprint(self):
+    """Compare the bytes per value with a __dict__ and with __slots__."""
+    path = "aff4:/C.1234567812345678/fs/os/usr/lib"
+
+    def DictURNSize():
+      return self._InstanceSize(DictURN(path, age=DictDatetime(age=0)))
+
+    def URNSize():
+      return self._InstanceSize(rdfvalue.RDFURN(path))
+
+    def DictDatetimeSize():
+      return self._InstanceSize(
+          DictDatetime(1336129892000000, age=DictDatetime(age=0)))
+
+    def DatetimeSize():
+      return self._InstanceSize(rdfvalue.RDFDatetime(1336129892000000))
+
+    # The value column shows the bytes held by each object.
+    self.TimeIt(DictURNSize, "RDFURN with __dict__", repetitions=1)
+    self.TimeIt(URNSize, "RDFURN with __slots__", repetitions=1)
+    self.TimeIt(DictDatetimeSize, "RDFDatetime with __dict__", repetitions=1)
+    self.TimeIt(DatetimeSize, "RDFDatetime with __slots__", repetitions=1)
+
 
 def main(argv):
   # Run the full test suite
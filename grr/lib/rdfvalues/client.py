@@ -46,6 +46,8 @@ except ImportError:
 class ClientURN(rdfvalue.RDFURN):
   """A client urn has to have a specific form."""
 
+  __slots__ = ()
+
   # Valid client urns must match this expression.
   CLIENT_ID_RE = re.compile(r"^(aff4:)?/?(?P<clientid>(c|C)\.[0-9a-fA-F]{16})$")
 
@@ -74,8 +76,10 @@ class ClientURN(rdfvalue.RDFURN):
     clientid = match.group("clientid")
     clientid_correctcase = "".join((clientid[0].upper(), clientid[1:].lower()))
 
-    self._string_urn = self._string_urn.replace(clientid, clientid_correctcase,
-                                                1)
+    # Only replace the path when needed so it stays shared with other URNs.
+    if clientid != clientid_correctcase:
+      self._string_urn = self._string_urn.replace(clientid,
+                                                  clientid_correctcase, 1)
 
   @classmethod
   def Validate(cls, value):
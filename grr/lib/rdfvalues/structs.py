@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """Semantic Protobufs are serialization agnostic, rich data types."""
 
+import array
 import base64
 import copy
 import struct
@@ -8,7 +9,7 @@ import struct
 
 # pylint: disable=g-import-not-at-top
 try:
-  from grr.accelerated import _semantic
+  from grr import _semantic
 except ImportError:
   _semantic = None
 
@@ -192,6 +193,26 @@ def SplitBuffer(buff, index=0, length=None):
       raise rdfvalue.DecodeError("Unexpected Tag.")
 
 
+def SplitOffsets(buff):
+  """Splits the wire format of a repeated field into its elements.
+
+  Args:
+    buff: The packed wire format of the repeated field.
+
+  Returns:
+    A flat list of the start and end offset of each element in the buffer, as
+    kept by LazyWireList.
+  """
+  offsets = []
+  end = 0
+  for encoded_tag, encoded_length, encoded_field in SplitBuffer(buff):
+    offsets.append(end)
+    end += len(encoded_tag) + len(encoded_length) + len(encoded_field)
+    offsets.append(end)
+
+  return offsets
+
+
 def SerializeEntries(entries):
   """Serializes given triplets of python and wire values and a descriptor."""
   output = []
@@ -206,11 +227,44 @@ def SerializeEntries(entries):
   return "".join(output)
 
 
+def OrderedEntries(raw_data):
+  """Returns the entries of a raw data dict in field number order.
+
+  The raw data dict iterates in an order which depends on how the object was
+  built, so serializing it directly gives different bytes for a constructed
+  and a parsed copy of the same protobuf. Known fields are emitted in field
+  number order, like the protobuf library does, followed by unknown fields in
+  the order they were read.
+
+  Args:
+    raw_data: The raw data dict of an RDFProtoStruct.
+
+  Returns:
+    A list of (python_format, wire_format, type_descriptor) triplets.
+  """
+  known = []
+  unknown = []
+  for key, entry in raw_data.iteritems():
+    type_descriptor = entry[2]
+    if type_descriptor is None:
+      unknown.append((key, entry))
+    else:
+      known.append((type_descriptor.field_number, entry))
+
+  known.sort(key=lambda item: item[0])
+  unknown.sort(key=lambda item: item[0])
+  return [entry for _, entry in known] + [entry for _, entry in unknown]
+
+
 def ReadIntoObject(buff, index, value_obj, length=0):
   """Reads all tags until the next end group and store in the value_obj."""
   raw_data = value_obj.GetRawData()
   count = 0
 
+  # The offsets of the elements of repeated fields in the buffer, by name.
+  repeated = {}
+  end = index
+
   # Split the buffer into tags and wire_format representations, then collect
   # these into the raw data cache.
   for (encoded_tag, encoded_length, encoded_field) in SplitBuffer(
@@ -218,6 +272,9 @@ def ReadIntoObject(buff, index, value_obj, length=0):
 
     type_info_obj = value_obj.type_infos_by_encoded_tag.get(encoded_tag)
 
+    start = end
+    end += len(encoded_tag) + len(encoded_length) + len(encoded_field)
+
     # Internal format to store parsed fields.
     wire_format = (encoded_tag, encoded_length, encoded_field)
 
@@ -240,14 +297,42 @@ def ReadIntoObject(buff, index, value_obj, length=0):
 
       count += 1
 
-    # Repeated fields are handled especially.
+    # Repeated fields are handled especially: their elements are left in the
+    # buffer until they are accessed.
     elif type_info_obj.__class__ is ProtoList:
-      value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
+      repeated.setdefault(type_info_obj.name, []).extend((start, end))
 
     else:
       # Set the python_format as None so it gets converted lazily on access.
       raw_data[type_info_obj.name] = (None, wire_format, type_info_obj)
 
+  for name, offsets in repeated.iteritems():
+    value_obj.Get(name).ExtendFromBuffer(buff, offsets)
+
+  value_obj.SetRawData(raw_data)
+
+
+def _AcceleratedSplitOffsets(buff):
+  try:
+    return _semantic.split_offsets(buff)
+  except ValueError as e:
+    raise rdfvalue.DecodeError(e)
+
+
+def _AcceleratedReadIntoObject(buff, index, value_obj, length=0):
+  """ReadIntoObject() which splits and stores the fields in c."""
+  raw_data = value_obj.GetRawData()
+
+  try:
+    repeated = _semantic.read_into_object(
+        buff, index, length, value_obj.type_infos_by_encoded_tag, raw_data,
+        ProtoList)
+  except ValueError as e:
+    raise rdfvalue.DecodeError(e)
+
+  for name, offsets in repeated.iteritems():
+    value_obj.Get(name).ExtendFromBuffer(buff, offsets)
+
   value_obj.SetRawData(raw_data)
 
 
@@ -256,6 +341,12 @@ if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+
+  # Older builds of the accelerator only provide the functions above.
+  if hasattr(_semantic, "split_offsets"):
+    SplitOffsets = _AcceleratedSplitOffsets
+    SerializeEntries = _semantic.serialize_entries
+    ReadIntoObject = _AcceleratedReadIntoObject
 # pylint: enable=invalid-name
 
 
@@ -857,7 +948,7 @@ class ProtoEmbedded(ProtoType):
 
   def ConvertToWireFormat(self, value):
     """Encode the nested protobuf into wire format."""
-    output = SerializeEntries(value.GetRawData().itervalues())
+    output = SerializeEntries(OrderedEntries(value.GetRawData()))
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
   def LateBind(self, target=None):
@@ -1041,11 +1132,134 @@ class ProtoDynamicAnyValueEmbedded(ProtoDynamicEmbedded):
           "Can't convert value %s to an protobuf.Any value." % value)
 
     any_value = AnyValue(type_url=type_name, value=data)
-    output = SerializeEntries(any_value.GetRawData().itervalues())
+    output = SerializeEntries(OrderedEntries(any_value.GetRawData()))
 
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
 
+class LazyWireList(object):
+  """A list of (python_format, wire_format) tuples backed by a buffer.
+
+  RepeatedFieldHelper keeps its elements in a list of such tuples. Building
+  the list for a parsed repeated field means copying every element out of the
+  buffer, even though most of them might never be accessed - e.g. when a
+  message list is only forwarded. This list instead keeps the buffer the
+  elements were parsed from and their offsets in it. Elements are split off
+  the buffer when they are accessed and untouched elements are serialized by
+  copying the buffer.
+
+  Only the operations RepeatedFieldHelper needs are supported.
+  """
+
+  def __init__(self, buff, offsets):
+    self.buff = buff
+
+    # The start and end offset of each element in the buffer.
+    self.offsets = array.array("L", offsets)
+    self.parsed_count = len(self.offsets) // 2
+
+    # Parsed elements which were accessed, by index.
+    self.accessed = {}
+
+    # Elements appended after parsing.
+    self.appended = []
+
+  def _Index(self, item):
+    if item < 0:
+      item += len(self)
+
+    if not 0 <= item < len(self):
+      raise IndexError("list index out of range")
+
+    return item
+
+  def __len__(self):
+    return self.parsed_count + len(self.appended)
+
+  def __getitem__(self, item):
+    if item.__class__ is slice:
+      return [self[i] for i in xrange(*item.indices(len(self)))]
+
+    item = self._Index(item)
+    if item >= self.parsed_count:
+      return self.appended[item - self.parsed_count]
+
+    try:
+      return self.accessed[item]
+    except KeyError:
+      start, end = self.offsets[2 * item], self.offsets[2 * item + 1]
+      for wire_format in SplitBuffer(self.buff[start:end]):
+        return (None, wire_format)
+
+  def __setitem__(self, item, value):
+    item = self._Index(item)
+    if item >= self.parsed_count:
+      self.appended[item - self.parsed_count] = value
+    else:
+      self.accessed[item] = value
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+  def __copy__(self):
+    result = LazyWireList(self.buff, self.offsets)
+    result.accessed = self.accessed.copy()
+    result.appended = self.appended[:]
+    return result
+
+  def append(self, value):  # pylint: disable=invalid-name
+    self.appended.append(value)
+
+  def extend(self, values):  # pylint: disable=invalid-name
+    self.appended.extend(values)
+
+  def IterAccessed(self):
+    """Yields the elements which were accessed or appended."""
+    for value in self.accessed.itervalues():
+      yield value
+
+    for value in self.appended:
+      yield value
+
+  def _CopyElements(self, output, first, last):
+    """Copies the elements in [first, last) from the buffer to the output."""
+    if first >= last:
+      return
+
+    offsets = self.offsets
+
+    # Elements parsed from the same buffer are usually adjacent, in which case
+    # they are copied at once.
+    if (offsets[2 * first + 1:2 * last - 1:2] ==
+        offsets[2 * first + 2:2 * last:2]):
+      output.append(self.buff[offsets[2 * first]:offsets[2 * last - 1]])
+    else:
+      for i in xrange(first, last):
+        output.append(self.buff[offsets[2 * i]:offsets[2 * i + 1]])
+
+  def Serialize(self, type_descriptor):
+    """Serializes the elements, copying untouched ones from the buffer."""
+    output = []
+
+    dirty = sorted(
+        i for i, (python_format, _) in self.accessed.iteritems()
+        if python_format and type_descriptor.IsDirty(python_format))
+
+    first = 0
+    for i in dirty:
+      self._CopyElements(output, first, i)
+      output.extend(type_descriptor.ConvertToWireFormat(self.accessed[i][0]))
+      first = i + 1
+
+    self._CopyElements(output, first, self.parsed_count)
+    output.append(
+        SerializeEntries((python_format, wire_format, type_descriptor)
+                         for python_format, wire_format in self.appended))
+
+    return "".join(output)
+
+
 class RepeatedFieldHelper(object):
   """A helper for the RDFProto to handle repeated fields.
 
@@ -1094,8 +1308,14 @@ class RepeatedFieldHelper(object):
     if self.dirty:
       return True
 
-    # If any of the items is dirty we are also dirty.
-    for item in self.wrapped_list:
+    # If any of the items is dirty we are also dirty. Elements of a
+    # LazyWireList can only be dirty if they were accessed.
+    if self.wrapped_list.__class__ is LazyWireList:
+      items = self.wrapped_list.IterAccessed()
+    else:
+      items = self.wrapped_list
+
+    for item in items:
       if self.type_descriptor.IsDirty(item[0]):
         self.dirty = True
         return True
@@ -1104,7 +1324,8 @@ class RepeatedFieldHelper(object):
 
   def Copy(self):
     return RepeatedFieldHelper(
-        wrapped_list=self.wrapped_list[:], type_descriptor=self.type_descriptor)
+        wrapped_list=copy.copy(self.wrapped_list),
+        type_descriptor=self.type_descriptor)
 
   def Append(self, rdf_value=utils.NotAValue, wire_format=None, **kwargs):
     """Append the value to our internal list."""
@@ -1130,6 +1351,9 @@ class RepeatedFieldHelper(object):
 
   def Pop(self, item):
     result = self[item]
+    if self.wrapped_list.__class__ is LazyWireList:
+      self.wrapped_list = list(self.wrapped_list)
+
     self.wrapped_list.pop(item)
     return result
 
@@ -1137,6 +1361,20 @@ class RepeatedFieldHelper(object):
     for i in iterable:
       self.Append(rdf_value=i)
 
+  def ExtendFromBuffer(self, buff, offsets):
+    """Appends elements which are still serialized in a buffer.
+
+    Args:
+      buff: The buffer the elements were parsed from.
+      offsets: A flat sequence of the start and end offset of each element in
+        the buffer.
+    """
+    elements = LazyWireList(buff, offsets)
+    if self.wrapped_list:
+      self.wrapped_list.extend(elements)
+    else:
+      self.wrapped_list = elements
+
   append = utils.Proxy("Append")
   remove = utils.Proxy("Remove")
 
@@ -1248,8 +1486,7 @@ class ProtoList(ProtoType):
 
   def ConvertFromWireFormat(self, value, container=None):
     result = RepeatedFieldHelper(type_descriptor=self.delegate)
-    for wire_format in SplitBuffer(value[2]):
-      result.wrapped_list.append((None, wire_format))
+    result.ExtendFromBuffer(value[2], SplitOffsets(value[2]))
 
     return result
 
@@ -1262,9 +1499,12 @@ class ProtoList(ProtoType):
     Returns:
       A wire format representation of the value.
     """
-    output = SerializeEntries(
-        (python_format, wire_format, value.type_descriptor)
-        for python_format, wire_format in value.wrapped_list)
+    if value.wrapped_list.__class__ is LazyWireList:
+      output = value.wrapped_list.Serialize(value.type_descriptor)
+    else:
+      output = SerializeEntries(
+          (python_format, wire_format, value.type_descriptor)
+          for python_format, wire_format in value.wrapped_list)
     return ("", "", output)
 
   def Format(self, value):
@@ -1675,7 +1915,7 @@ class RDFStruct(rdfvalue.RDFValue):
     self.dirty = True
 
   def SerializeToString(self):
-    return SerializeEntries(self._data.itervalues())
+    return SerializeEntries(OrderedEntries(self._data))
 
   def ParseFromString(self, string):
     ReadIntoObject(string, 0, self)
@@ -339,6 +339,39 @@ class RDFStructsTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
     self.assertEqual(len(sliced), 2)
     self.assertEqual(sliced[0].foobar, "Nest3")
 
+  def testRepeatedMemberIsParsedLazily(self):
+    tested = TestStruct()
+    for i in range(10):
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+
+    data = tested.SerializeToString()
+    new_tested = TestStruct.FromSerializedString(data)
+    elements = new_tested.repeat_nested.wrapped_list
+    self.assertIsInstance(elements, structs.LazyWireList)
+
+    # Elements which were not accessed are written back as they were read.
+    self.assertEqual(new_tested.SerializeToString(), data)
+
+    new_tested.repeat_nested[3].foobar = "Changed"
+    self.assertEqual(new_tested.repeat_nested[-1].foobar, "Nest9")
+    new_tested.repeat_nested.Append(foobar="Appended")
+    self.assertEqual(len(new_tested.repeat_nested), 11)
+    self.assertEqual(len(elements.accessed), 2)
+
+    decoded = TestStruct.FromSerializedString(new_tested.SerializeToString())
+    expected = ["Nest%s" % i for i in range(10)] + ["Appended"]
+    expected[3] = "Changed"
+    self.assertEqual([x.foobar for x in decoded.repeat_nested], expected)
+
+    copied = decoded.repeat_nested.Copy()
+    copied.Append(foobar="Copy")
+    self.assertEqual(len(copied), 12)
+    self.assertEqual(len(decoded.repeat_nested), 11)
+
+    self.assertEqual(decoded.repeat_nested.Pop(0).foobar, "Nest0")
+    self.assertEqual(decoded.repeat_nested[0].foobar, "Nest1")
+    self.assertEqual(len(decoded.repeat_nested), 10)
+
   def testUnknownFields(self):
     """Test that unknown fields are preserved across decode/encode cycle."""
     tested = TestStruct(foobar="hello", int=5)
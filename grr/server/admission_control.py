@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Admission control for client polls on the frontend.
+
+A burst of clients reconnecting after an outage can overload the data store.
+The frontend therefore decides whether to handle a poll before it spends any
+work on it and asks rejected clients to retry later:
+
+  - Token buckets limit the rate of polls per client and in total.
+  - The number of polls handled concurrently is limited. The limit adapts to
+    the time polls take, which is dominated by the data store: it grows
+    slowly while polls are fast and shrinks quickly once they are slow, at
+    most once per generation of polls.
+  - Clients we recently sent messages to are likely to have flows waiting on
+    their answers. They bypass the global rate limit and may use the whole
+    concurrency limit, other clients only part of it.
+"""
+
+import random
+import threading
+import time
+
+from grr import config
+from grr.lib import stats
+from grr.lib import utils
+
+
+class Overloaded(Exception):
+  """Raised when a poll is rejected."""
+
+  def __init__(self, message, retry_after):
+    super(Overloaded, self).__init__(message)
+    # The number of seconds after which the client should retry.
+    self.retry_after = retry_after
+
+
+class TokenBucket(object):
+  """Allows a number of events per second with bursts up to a maximum."""
+
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = burst
+    self.tokens = float(burst)
+    self.last_update = time.time()
+
+  def Take(self, now=None):
+    """Takes a token from the bucket.
+
+    Args:
+      now: The current time, defaults to time.time().
+
+    Returns:
+      0 if a token was taken, otherwise the number of seconds until the next
+      token is available.
+    """
+    now = now or time.time()
+    self.tokens = min(self.burst,
+                      self.tokens + (now - self.last_update) * self.rate)
+    self.last_update = now
+
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0
+
+    return (1 - self.tokens) / self.rate
+
+
+class Ticket(object):
+  """An admitted poll, released once it is handled."""
+
+  def __init__(self, controller, key):
+    self.controller = controller
+    self.key = key
+    self.start = time.time()
+
+  def Release(self, sent_messages=False):
+    """Releases the ticket.
+
+    Args:
+      sent_messages: True if messages were sent to the client, which gives it
+        priority for a while.
+    """
+    self.controller.Release(self, sent_messages=sent_messages)
+
+
+class AdmissionController(object):
+  """Decides which client polls the frontend handles."""
+
+  # The concurrency limit never drops below this.
+  MIN_CONCURRENCY = 4
+
+  # The share of the concurrency limit clients without priority may use.
+  NORMAL_SHARE = 0.8
+
+  # Clients have priority for this many seconds after we sent them messages.
+  PRIORITY_TIME = 10 * 60
+
+  # Clients are asked to retry at least this many seconds later when the
+  # frontend is busy, plus some jitter so they do not all come back at once.
+  BUSY_RETRY_AFTER = 10
+
+  def __init__(self):
+    self.lock = threading.Lock()
+
+    self.client_rate = config.CONFIG["Frontend.client_poll_rate"]
+    self.client_burst = config.CONFIG["Frontend.client_poll_burst"]
+    if self.client_rate:
+      self.client_buckets = utils.FastStore(max_size=100000)
+    else:
+      self.client_buckets = None
+
+    global_rate = config.CONFIG["Frontend.global_poll_rate"]
+    if global_rate:
+      self.global_bucket = TokenBucket(
+          global_rate, config.CONFIG["Frontend.global_poll_burst"])
+    else:
+      self.global_bucket = None
+
+    self.max_concurrency = config.CONFIG["Frontend.max_concurrent_polls"]
+    self.target_latency = config.CONFIG["Frontend.target_poll_latency"]
+    self.concurrency_limit = float(self.max_concurrency)
+    # When the concurrency limit was last decreased. Polls admitted before
+    # that ran under the old limit and do not decrease it again.
+    self.last_decrease = 0
+
+    # The time until which clients have priority, by key.
+    self.priority_clients = utils.FastStore(max_size=100000)
+
+    # The number of polls being handled right now.
+    self.in_flight = 0
+
+  def _ClientBucket(self, key):
+    try:
+      return self.client_buckets.Get(key)
+    except KeyError:
+      bucket = TokenBucket(self.client_rate, self.client_burst)
+      self.client_buckets.Put(key, bucket)
+      return bucket
+
+  def _HasPriority(self, key, now):
+    try:
+      return self.priority_clients.Get(key) > now
+    except KeyError:
+      return False
+
+  def _Reject(self, reason, retry_after):
+    stats.STATS.IncrementCounter("frontend_admission", fields=[reason])
+    raise Overloaded("Poll rejected: %s." % reason,
+                     int(retry_after + random.uniform(0, retry_after)) + 1)
+
+  def Admit(self, key):
+    """Admits a poll or raises.
+
+    Args:
+      key: A string identifying the client, e.g. its client id.
+
+    Returns:
+      A Ticket which has to be released once the poll is handled.
+
+    Raises:
+      Overloaded: If the poll is rejected.
+    """
+    now = time.time()
+    with self.lock:
+      if self.client_buckets is not None:
+        wait = self._ClientBucket(key).Take(now)
+        if wait:
+          self._Reject("client_rate", wait)
+
+      priority = self._HasPriority(key, now)
+
+      if self.global_bucket is not None and not priority:
+        wait = self.global_bucket.Take(now)
+        if wait:
+          self._Reject("global_rate", max(wait, self.BUSY_RETRY_AFTER))
+
+      if self.max_concurrency:
+        limit = self.concurrency_limit
+        if not priority:
+          limit *= self.NORMAL_SHARE
+        if self.in_flight >= max(limit, 1):
+          self._Reject("concurrency", self.BUSY_RETRY_AFTER)
+
+      self.in_flight += 1
+
+    stats.STATS.IncrementCounter(
+        "frontend_admission",
+        fields=["admitted_priority" if priority else "admitted"])
+    return Ticket(self, key)
+
+  def Release(self, ticket, sent_messages=False):
+    """Releases an admitted poll, see Ticket.Release()."""
+    now = time.time()
+    latency = now - ticket.start
+
+    with self.lock:
+      self.in_flight -= 1
+
+      if sent_messages:
+        self.priority_clients.Put(ticket.key, now + self.PRIORITY_TIME)
+
+      if self.max_concurrency:
+        # Additive increase, multiplicative decrease.
+        if latency > self.target_latency:
+          if ticket.start > self.last_decrease:
+            self.last_decrease = now
+            self.concurrency_limit = max(
+                min(self.MIN_CONCURRENCY, self.max_concurrency),
+                self.concurrency_limit * 0.9)
+        else:
+          self.concurrency_limit = min(
+              self.max_concurrency,
+              self.concurrency_limit + 1 / self.concurrency_limit)
+
+        stats.STATS.SetGaugeValue("frontend_concurrency_limit",
+                                  int(self.concurrency_limit))
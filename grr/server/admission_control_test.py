@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Tests for the admission control of client polls."""
+
+
+from grr.lib import flags
+from grr.server import admission_control
+# pylint: disable=unused-import
+# Registers the frontend metrics.
+from grr.server import front_end
+# pylint: enable=unused-import
+from grr.test_lib import test_lib
+
+
+class TokenBucketTest(test_lib.GRRBaseTest):
+
+  def testBurstThenRate(self):
+    bucket = admission_control.TokenBucket(2, 3)
+    now = bucket.last_update
+    for _ in xrange(3):
+      self.assertEqual(bucket.Take(now), 0)
+
+    self.assertAlmostEqual(bucket.Take(now), 0.5)
+    self.assertEqual(bucket.Take(now + 0.5), 0)
+    self.assertGreater(bucket.Take(now + 0.5), 0)
+
+
+class AdmissionControllerTest(test_lib.GRRBaseTest):
+
+  def _Controller(self, **overrides):
+    options = {
+        "Frontend.client_poll_rate": 0,
+        "Frontend.global_poll_rate": 0,
+        "Frontend.max_concurrent_polls": 0,
+    }
+    options.update(overrides)
+    with test_lib.ConfigOverrider(options):
+      return admission_control.AdmissionController()
+
+  def testEverythingIsAdmittedByDefault(self):
+    controller = self._Controller()
+    tickets = [controller.Admit("client_%d" % i) for i in xrange(100)]
+    self.assertEqual(controller.in_flight, 100)
+
+    for ticket in tickets:
+      ticket.Release()
+    self.assertEqual(controller.in_flight, 0)
+
+  def testClientRateLimit(self):
+    controller = self._Controller(**{
+        "Frontend.client_poll_rate": 0.001,
+        "Frontend.client_poll_burst": 2
+    })
+    controller.Admit("client").Release()
+    controller.Admit("client").Release()
+
+    with self.assertRaises(admission_control.Overloaded) as e:
+      controller.Admit("client")
+    self.assertGreater(e.exception.retry_after, 0)
+
+    # Other clients have their own budget.
+    controller.Admit("other client").Release()
+
+  def testGlobalRateLimitSkipsPriorityClients(self):
+    controller = self._Controller(**{
+        "Frontend.global_poll_rate": 0.001,
+        "Frontend.global_poll_burst": 1
+    })
+    controller.Admit("busy client").Release(sent_messages=True)
+
+    with self.assertRaises(admission_control.Overloaded):
+      controller.Admit("idle client")
+
+    controller.Admit("busy client").Release()
+
+  def testConcurrencyLimit(self):
+    controller = self._Controller(**{"Frontend.max_concurrent_polls": 10})
+    controller.Admit("busy client").Release(sent_messages=True)
+
+    # Clients without priority only get part of the limit.
+    tickets = [controller.Admit("client_%d" % i) for i in xrange(8)]
+    with self.assertRaises(admission_control.Overloaded):
+      controller.Admit("client_8")
+
+    tickets.append(controller.Admit("busy client"))
+    for ticket in tickets:
+      ticket.Release()
+    controller.Admit("client_8").Release()
+
+  def testConcurrencyLimitShrinksWhenPollsAreSlow(self):
+    controller = self._Controller(**{
+        "Frontend.max_concurrent_polls": 10,
+        "Frontend.target_poll_latency": 1.0
+    })
+    ticket = controller.Admit("client")
+    ticket.start -= 5
+    ticket.Release()
+    self.assertLess(controller.concurrency_limit, 10)
+
+    limit = controller.concurrency_limit
+    controller.Admit("client").Release()
+    self.assertGreater(controller.concurrency_limit, limit)
+
+  def testConcurrencyLimitShrinksOncePerGeneration(self):
+    controller = self._Controller(**{
+        "Frontend.max_concurrent_polls": 10,
+        "Frontend.target_poll_latency": 1.0
+    })
+    tickets = [controller.Admit("client_%d" % i) for i in xrange(5)]
+    for ticket in tickets:
+      ticket.start -= 5
+      ticket.Release()
+    self.assertAlmostEqual(controller.concurrency_limit, 9)
+
+    # Slow polls admitted after the decrease shrink the limit again.
+    ticket = controller.Admit("client")
+    ticket.start = controller.last_decrease + 0.1
+    with test_lib.FakeTime(ticket.start + 5):
+      ticket.Release()
+    self.assertAlmostEqual(controller.concurrency_limit, 8.1)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -17,6 +17,7 @@ from grr import config
 from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import stats
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import aff4_rdfvalues
@@ -25,6 +26,7 @@ from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.server import access_control
 from grr.server import data_store
+from grr.server import threadpool
 
 # Factor to convert from seconds to microseconds
 MICROSECONDS = 1000000
@@ -38,6 +40,12 @@ EMPTY_DATA = "X"
 
 AFF4_PREFIXES = set(["aff4:", "metadata:"])
 
+_READ_AHEAD_POOL_LOCK = threading.Lock()
+
+# Every write to an AFF4 object updates at least one of these attributes so they
+# tell whether a cached copy of the object is still current.
+VERSION_ATTRIBUTES = ["aff4:type", "metadata:last"]
+
 
 class Error(Exception):
   pass
@@ -279,6 +287,14 @@ class Factory(object):
         max_size=self.intermediate_cache_max_size,
         max_age=self.intermediate_cache_age)
 
+    # Attributes of objects whose schema sets CACHE_READS, shared by all the
+    # callers in this process.
+    self.object_cache = None
+    if config.CONFIG["Server.aff4_object_cache_size"]:
+      self.object_cache = utils.AgeBasedCache(
+          max_size=config.CONFIG["Server.aff4_object_cache_size"],
+          max_age=config.CONFIG["Server.aff4_object_cache_age"])
+
     # Create a token for system level actions. This token is used by other
     # classes such as HashFileStore and NSRLFilestore to create entries under
     # aff4:/files, as well as to create top level paths like aff4:/foreman
@@ -310,6 +326,12 @@ class Factory(object):
     urns = set([utils.SmartUnicode(u) for u in urns])
     to_read = {urn: self._MakeCacheInvariant(urn, age) for urn in urns}
 
+    use_object_cache = self.object_cache is not None and age == NEWEST_TIME
+    if use_object_cache:
+      for urn, values in self._GetCachedAttributes(to_read):
+        del to_read[urn]
+        yield urn, values
+
     # Urns not present in the cache we need to get from the database.
     if to_read:
       for subject, values in data_store.DB.MultiResolvePrefix(
@@ -321,7 +343,73 @@ class Factory(object):
         # Ensure the values are sorted.
         values.sort(key=lambda x: x[-1], reverse=True)
 
-        yield utils.SmartUnicode(subject), values
+        subject = utils.SmartUnicode(subject)
+        if use_object_cache and subject in to_read:
+          self._CacheAttributes(to_read[subject], values)
+
+        yield subject, values
+
+  def _ObjectVersion(self, values):
+    """Returns the newest values of the VERSION_ATTRIBUTES in values."""
+    version = {}
+    for attribute, value, ts in values:
+      if attribute in VERSION_ATTRIBUTES:
+        # The values are sorted so the first one is the newest.
+        version.setdefault(attribute, (value, ts))
+
+    return sorted(version.items())
+
+  def _CacheAttributes(self, key, values):
+    """Puts an object's attributes into the object cache if it opts in."""
+    version = self._ObjectVersion(values)
+    aff4_type = dict(version).get(AFF4Object.SchemaCls.TYPE.predicate)
+    if aff4_type is None:
+      return
+
+    aff4_cls = AFF4Object.classes.get(aff4_type[0])
+    if aff4_cls is not None and aff4_cls.SchemaCls.CACHE_READS:
+      # Keep our own copy since callers are allowed to modify the values.
+      self.object_cache.Put(key, (version, list(values)))
+
+  def _GetCachedAttributes(self, to_read):
+    """Returns the cached attributes of objects which did not change since.
+
+    Args:
+      to_read: A dict mapping urns to their cache keys.
+
+    Returns:
+      A list of (urn, values) tuples for the objects that can be served from
+      the object cache.
+    """
+    cached = {}
+    for urn, key in to_read.iteritems():
+      try:
+        cached[urn] = self.object_cache.Get(key)
+      except KeyError:
+        pass
+
+    if not cached:
+      return []
+
+    # Other processes might have written to the objects so we check the
+    # VERSION_ATTRIBUTES, which is a lot cheaper than reading the objects.
+    current = {}
+    for subject, values in data_store.DB.MultiResolvePrefix(
+        cached,
+        VERSION_ATTRIBUTES,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP):
+      values.sort(key=lambda x: x[-1], reverse=True)
+      current[utils.SmartUnicode(subject)] = self._ObjectVersion(values)
+
+    result = []
+    for urn, (version, values) in cached.iteritems():
+      if current.get(urn) == version:
+        # Callers are allowed to modify the returned list.
+        result.append((urn, list(values)))
+      else:
+        self.object_cache.ExpireObject(to_read[urn])
+
+    return result
 
   def SetAttributes(self,
                     urn,
@@ -330,6 +418,8 @@ class Factory(object):
                     add_child_index=True,
                     mutation_pool=None):
     """Sets the attributes in the data store."""
+    if self.object_cache is not None:
+      self.object_cache.ExpireObject(self._MakeCacheInvariant(urn, NEWEST_TIME))
 
     attributes[AFF4Object.SchemaCls.LAST] = [
         rdfvalue.RDFDatetime.Now().SerializeToDataStore()
@@ -555,6 +645,93 @@ class Factory(object):
         follow_symlinks=False,
         transaction=transaction)
 
+  def MultiOpenWithLock(self,
+                        urns,
+                        aff4_type=None,
+                        token=None,
+                        age=NEWEST_TIME,
+                        blocking=True,
+                        blocking_lock_timeout=10,
+                        blocking_sleep_interval=1,
+                        lease_time=100):
+    """Opens and locks a number of urns.
+
+    Locks are taken one subject at a time but the attributes of all the locked
+    objects are then read with a single data store query. Urns that can not be
+    locked are skipped, the caller can tell which ones by comparing the urns
+    of the returned objects with the ones it asked for.
+
+    Just like objects returned by OpenWithLock, the returned objects have to be
+    closed by the caller in order to release the locks.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If set, urns that do not hold an object of this type are
+          skipped.
+      token: The Security Token to use for opening these items.
+      age: The age policy used to build these objects.
+      blocking: When True, wait and repeatedly try to grab each lock.
+      blocking_lock_timeout: Maximum wait time per lock when blocking is True.
+      blocking_sleep_interval: Sleep time between lock grabbing attempts. Used
+          when blocking is True.
+      lease_time: Maximum time the objects stay locked.
+
+    Returns:
+      A list of locked AFF4 objects.
+    """
+    transactions = {}
+    for urn in urns:
+      try:
+        transaction = self._AcquireLock(
+            urn,
+            blocking=blocking,
+            blocking_lock_timeout=blocking_lock_timeout,
+            blocking_sleep_interval=blocking_sleep_interval,
+            lease_time=lease_time)
+      except LockError:
+        continue
+
+      transactions[utils.SmartUnicode(urn)] = transaction
+
+    if not transactions:
+      return []
+
+    result = []
+    done = False
+    try:
+      local_cache = dict(self.GetAttributes(transactions, age=age))
+      for urn in transactions:
+        # Objects that do not exist yet should not be read again one by one.
+        local_cache.setdefault(urn, [])
+
+      for urn in list(transactions):
+        try:
+          result.append(
+              self.Open(
+                  urn,
+                  aff4_type=aff4_type,
+                  mode="rw",
+                  token=token,
+                  local_cache=local_cache,
+                  age=age,
+                  follow_symlinks=False,
+                  transaction=transactions[urn]))
+        except IOError:
+          continue
+
+        del transactions[urn]
+
+      done = True
+    finally:
+      # Whatever is not returned to the caller must not stay locked.
+      for transaction in transactions.itervalues():
+        transaction.Release()
+      if not done:
+        for obj in result:
+          obj.transaction.Release()
+
+    return result
+
   def _AcquireLock(self,
                    urn,
                    blocking=None,
@@ -1081,6 +1258,10 @@ class Factory(object):
       except KeyError:
         pass
 
+      if self.object_cache is not None:
+        self.object_cache.ExpireObject(
+            self._MakeCacheInvariant(urn_to_delete, NEWEST_TIME))
+
     pool.DeleteSubjects(marked_urns)
     pool.Flush()
 
@@ -1192,6 +1373,8 @@ class Factory(object):
 
   def Flush(self):
     self.intermediate_cache.Flush()
+    if self.object_cache is not None:
+      self.object_cache.Flush()
 
   # Well known AFF4 paths.
   def _InitWellKnownPaths(self):
@@ -1551,6 +1734,11 @@ class AFF4Object(object):
     # be possible to find all the children of the parent object.
     ADD_CHILD_INDEX = True
 
+    # Objects which are read far more often than they are written can be kept
+    # in the factory's object cache. They are still checked against the data
+    # store on each read, but only their type and last write time are read.
+    CACHE_READS = False
+
     TYPE = Attribute("aff4:type", rdfvalue.RDFString,
                      "The name of the AFF4Object derived class.", "type")
 
@@ -2734,8 +2922,15 @@ class AFF4ImageBase(AFF4Stream):
   # Subclasses should set the name of the type of stream to use for chunks.
   STREAM_TYPE = None
 
-  # How many chunks should be cached.
+  # How many chunks are read ahead on a cache miss. While a read only stream is
+  # read sequentially the read ahead doubles on every miss, up to the limits
+  # below, and the next chunks are fetched in the background.
   LOOK_AHEAD = 10
+  MAX_READ_AHEAD_BYTES = 4 * 1024 * 1024
+  MAX_READ_AHEAD_CHUNKS = 1000
+
+  # Read aheads are fetched from the data store in batches of this many chunks.
+  READ_AHEAD_BATCH_SIZE = 10
 
   class SchemaCls(AFF4Stream.SchemaCls):
     """The schema for AFF4ImageBase."""
@@ -2813,8 +3008,6 @@ class AFF4ImageBase(AFF4Stream):
     """Build a cache for our chunks."""
     super(AFF4ImageBase, self).Initialize()
     self.offset = 0
-    # A cache for segments.
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -2826,6 +3019,18 @@ class AFF4ImageBase(AFF4Stream):
       self.size = 0
       self.content_last = None
 
+    # A cache for segments. It holds the chunks being read and the ones read
+    # ahead in the background.
+    self.chunk_cache = ChunkCache(self._WriteChunk,
+                                  max(100, 2 * self._MaxReadAhead()))
+
+    # The current read ahead and the chunk it ends before.
+    self._read_ahead = self.LOOK_AHEAD
+    self._read_ahead_end = None
+    # Chunk keys which are being read in the background, mapped to an event
+    # which is set once they are in the chunk cache.
+    self._pending_reads = {}
+
   def SetChunksize(self, chunksize):
     # pylint: disable=protected-access
     self.Set(self.Schema._CHUNKSIZE(chunksize))
@@ -2904,28 +3109,161 @@ class AFF4ImageBase(AFF4Stream):
     self.chunk_cache.Put(chunk, fd)
     return fd
 
-  def _GetChunkForReading(self, chunk):
-    """Returns the relevant chunk from the datastore and reads ahead."""
+  def _ChunkKey(self, chunk):
+    """Returns the key of the given chunk in the chunk cache."""
+    return chunk
+
+  def _ChunkCount(self):
+    return (self.size + self.chunksize - 1) // self.chunksize
+
+  def _MaxReadAhead(self):
+    # Streams open for writing keep the chunk cache small so dirty chunks get
+    # written out regularly.
+    if "w" in self.mode:
+      return self.LOOK_AHEAD
+
+    return max(self.LOOK_AHEAD,
+               min(self.MAX_READ_AHEAD_BYTES // self.chunksize,
+                   self.MAX_READ_AHEAD_CHUNKS))
+
+  def _GetCachedChunk(self, key):
+    """Returns a cached chunk, waiting for it if it is being read."""
     try:
-      return self.chunk_cache.Get(chunk)
+      return self.chunk_cache.Get(key)
     except KeyError:
       pass
 
+    pending = self._pending_reads.get(key)
+    if pending is None:
+      return None
+
+    pending.wait()
+    try:
+      return self.chunk_cache.Get(key)
+    except KeyError:
+      return None
+
+  def _ReadChunksInBackground(self, keys, done):
+    try:
+      self._ReadChunks(keys)
+    finally:
+      done.set()
+      for key in keys:
+        self._pending_reads.pop(key, None)
+
+  def _FetchChunks(self, chunks, background=False):
+    """Reads the given chunks into the chunk cache.
+
+    The chunks are split into batches which are read in parallel on the read
+    ahead thread pool. Unless background is set, the first batch is read in
+    this thread and the call returns once it is in the cache.
+
+    Args:
+      chunks: The numbers of the chunks to read.
+      background: If set, all batches are read by the thread pool and batches
+        which do not fit into its queue are dropped.
+    """
+    keys = []
+    for chunk in chunks:
+      key = self._ChunkKey(chunk)
+      if (key is not None and key not in self.chunk_cache and
+          key not in self._pending_reads and key not in keys):
+        keys.append(key)
+
+    # Chunks of streams open for writing may be dirty so they are never evicted
+    # from the cache by another thread.
+    pool = None
+    if "w" not in self.mode:
+      pool = _GetReadAheadPool()
+
+    if pool is None:
+      if not background:
+        self._ReadChunks(keys)
+      return
+
+    # Use at most one batch per thread so the pool's queue does not overflow.
+    batch_size = max(self.READ_AHEAD_BATCH_SIZE,
+                     -(-len(keys) // pool.max_threads))
+    batches = [keys[i:i + batch_size] for i in xrange(0, len(keys), batch_size)]
+
+    if not background and batches:
+      first_batch = batches.pop(0)
+    else:
+      first_batch = []
+
+    for batch in batches:
+      done = threading.Event()
+      for key in batch:
+        self._pending_reads[key] = done
+      try:
+        pool.AddTask(
+            self._ReadChunksInBackground, (batch, done),
+            name="Read ahead %s" % self.urn,
+            blocking=False,
+            inline=not background)
+      except threadpool.Full:
+        done.set()
+        for key in batch:
+          self._pending_reads.pop(key, None)
+
+    if first_batch:
+      self._ReadChunks(first_batch)
+
+  def _GetChunkForReading(self, chunk):
+    """Returns the relevant chunk from the datastore and reads ahead."""
+    key = self._ChunkKey(chunk)
+    result = self._GetCachedChunk(key)
+    if result is not None:
+      stats.STATS.IncrementCounter("aff4_image_chunk_cache_hits")
+      self._ReadAheadInBackground(chunk)
+      return result
+
+    stats.STATS.IncrementCounter("aff4_image_chunk_cache_misses")
+
     # We don't have this chunk already cached. The most common read
     # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
+    # the data store already, we read ahead to reduce round trips. A miss
+    # right after the last read ahead means we did not read far enough.
+    if chunk == self._read_ahead_end:
+      self._read_ahead = min(self._read_ahead * 2, self._MaxReadAhead())
+    else:
+      self._read_ahead = self.LOOK_AHEAD
 
-    missing_chunks = []
-    for chunk_number in range(chunk, chunk + self.LOOK_AHEAD):
-      if chunk_number not in self.chunk_cache:
-        missing_chunks.append(chunk_number)
+    self._read_ahead_end = max(chunk + 1,
+                               min(chunk + self._read_ahead,
+                                   self._ChunkCount()))
+    start = time.time()
+    self._FetchChunks(xrange(chunk, self._read_ahead_end))
+    stats.STATS.RecordEvent("aff4_image_chunk_fetch_latency",
+                            time.time() - start)
 
-    self._ReadChunks(missing_chunks)
     # This should work now - otherwise we just give up.
-    try:
-      return self.chunk_cache.Get(chunk)
-    except KeyError:
+    result = self._GetCachedChunk(key)
+    if result is None:
       raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
+    return result
+
+  def _ReadAheadInBackground(self, chunk):
+    """Reads the next chunks in the background during sequential reads.
+
+    This starts once half of the last read ahead has been consumed, and the
+    read ahead keeps growing as long as the reader keeps up.
+
+    Args:
+      chunk: The chunk which is being read.
+    """
+    if (self._read_ahead <= self.LOOK_AHEAD or self._read_ahead_end is None or
+        self._read_ahead_end - chunk > self._read_ahead // 2):
+      return
+
+    start = self._read_ahead_end
+    if start >= self._ChunkCount():
+      return
+
+    self._read_ahead = min(self._read_ahead * 2, self._MaxReadAhead())
+    self._read_ahead_end = end = min(start + self._read_ahead,
+                                     self._ChunkCount())
+    self._FetchChunks(xrange(start, end), background=True)
 
   def _ReadPartial(self, length):
     """Read as much as possible, but not more than length."""
@@ -2958,7 +3296,7 @@ class AFF4ImageBase(AFF4Stream):
 
   def Read(self, length):
     """Read a block of data from the file."""
-    result = ""
+    result = []
 
     # The total available size in the file
     length = int(length)
@@ -2970,7 +3308,10 @@ class AFF4ImageBase(AFF4Stream):
         break
 
       length -= len(data)
-      result += data
+      result.append(data)
+
+    result = "".join(result)
+    stats.STATS.IncrementCounter("aff4_image_read_bytes", len(result))
     return result
 
   def _WritePartial(self, data):
@@ -3027,12 +3368,17 @@ class AFF4ImageBase(AFF4Stream):
       self.chunk_cache.Flush()
       res = self.__dict__.copy()
       del res["chunk_cache"]
+      res.pop("_pending_reads", None)
       return res
     return self.__dict__
 
   def __setstate__(self, state):
     self.__dict__ = state
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.__dict__.setdefault("_read_ahead", self.LOOK_AHEAD)
+    self.__dict__.setdefault("_read_ahead_end", None)
+    self._pending_reads = {}
+    self.chunk_cache = ChunkCache(self._WriteChunk,
+                                  max(100, 2 * self._MaxReadAhead()))
 
 
 class AFF4Image(AFF4ImageBase):
@@ -3056,6 +3402,25 @@ class AFF4InitHook(registry.InitHook):
 
     FACTORY = Factory()  # pylint: disable=g-bad-name
 
+  def RunOnce(self):
+    """Register the AFF4 image read metrics."""
+    stats.STATS.RegisterCounterMetric("aff4_image_read_bytes")
+    stats.STATS.RegisterCounterMetric("aff4_image_chunk_cache_hits")
+    stats.STATS.RegisterCounterMetric("aff4_image_chunk_cache_misses")
+    stats.STATS.RegisterEventMetric("aff4_image_chunk_fetch_latency")
+
+
+def _GetReadAheadPool():
+  """Returns the thread pool reading AFF4 image chunks ahead, if enabled."""
+  threads = config.CONFIG["Server.aff4_read_ahead_threads"]
+  if threads <= 0:
+    return None
+
+  with _READ_AHEAD_POOL_LOCK:
+    pool = threadpool.ThreadPool.Factory("aff4_read_ahead", threads, threads)
+    pool.Start()
+  return pool
+
 
 class AFF4Filter(object):
   """A simple filtering system to be used with Query()."""
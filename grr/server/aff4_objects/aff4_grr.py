@@ -400,6 +400,9 @@ class GRRForeman(aff4.AFF4Object):
 
   class SchemaCls(aff4.AFF4Object.SchemaCls):
     """Attributes specific to VFSDirectory."""
+    # The rules are checked on every client poll but rarely change.
+    CACHE_READS = True
+
     RULES = aff4.Attribute(
         "aff4:rules",
         rdf_foreman.ForemanRules,
@@ -653,7 +656,7 @@ class VFSBlobImage(VFSFile):
   _HASH_SIZE = 32
 
   # How many chunks we read ahead
-  _READAHEAD = 5
+  LOOK_AHEAD = 5
 
   @classmethod
   def _GenerateChunkIds(cls, fds):
@@ -734,34 +737,10 @@ class VFSBlobImage(VFSFile):
     """Chunks must be added using the AddBlob() method."""
     raise NotImplementedError("Direct writing of BlobImage not allowed.")
 
-  def _GetChunkForReading(self, chunk):
-    """Retrieve the relevant blob from the AFF4 data store or cache."""
-    offset = chunk * self._HASH_SIZE
-    self.index.seek(offset)
-
-    chunk_name = self.index.read(self._HASH_SIZE).encode("hex")
-
-    try:
-      return self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      pass
-
-    # We don't have this chunk already cached. The most common read
-    # access pattern is contiguous reading so since we have to go to
-    # the data store already, we read ahead to reduce round trips.
-    self.index.seek(offset)
-    readahead = []
-
-    for _ in range(self._READAHEAD):
-      name = self.index.read(self._HASH_SIZE).encode("hex")
-      if name and name not in self.chunk_cache:
-        readahead.append(name)
-
-    self._ReadChunks(readahead)
-    try:
-      return self.chunk_cache.Get(chunk_name)
-    except KeyError:
-      raise aff4.ChunkNotFoundError("Cannot open chunk %s" % chunk)
+  def _ChunkKey(self, chunk):
+    """Chunks are cached by the hash of their blob."""
+    self.index.seek(chunk * self._HASH_SIZE)
+    return self.index.read(self._HASH_SIZE).encode("hex") or None
 
   def _ReadChunks(self, chunks):
     res = data_store.DB.ReadBlobs(chunks, token=self.token)
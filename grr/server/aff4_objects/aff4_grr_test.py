@@ -351,6 +351,22 @@ class BlobImageTest(aff4_test_lib.AFF4ObjectTest):
     dest_fd.Seek(0)
     self.assertEqual(dest_fd.Read(5000), src_content + src_content)
 
+  def testSequentialReadsFetchBlobsAhead(self):
+    src_content = "".join("%06d\n" % i for i in xrange(500))
+    with aff4.FACTORY.Create(
+        "aff4:/foo", aff4_type=aff4_grr.VFSBlobImage, token=self.token) as fd:
+      fd.SetChunksize(7)
+      fd.AppendContent(StringIO.StringIO(src_content))
+
+    fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+    with mock.patch.object(
+        data_store.DB, "ReadBlobs", wraps=data_store.DB.ReadBlobs) as read:
+      for i in xrange(500):
+        self.assertEqual(fd.Read(7), "%06d\n" % i)
+
+    # The read ahead grows past LOOK_AHEAD chunks per call to the data store.
+    self.assertLess(read.call_count, 500 / fd.LOOK_AHEAD)
+
   def testMultiStreamStreamsSingleFileWithSingleChunk(self):
     with aff4.FACTORY.Create(
         "aff4:/foo", aff4_type=aff4_grr.VFSBlobImage, token=self.token) as fd:
@@ -242,12 +242,11 @@ class StatsStoreDataQuery(object):
   def _TimeSeriesFromData(self, data, attr=None):
     """Build time series from StatsStore data."""
 
-    series = timeseries.Timeseries()
-
+    pairs = []
     for value, timestamp in data:
       if attr:
         try:
-          series.Append(getattr(value, attr), timestamp)
+          pairs.append((getattr(value, attr), timestamp))
         except AttributeError:
           raise ValueError("Can't find attribute %s in value %s." % (attr,
                                                                      value))
@@ -255,9 +254,9 @@ class StatsStoreDataQuery(object):
         if hasattr(value, "sum") or hasattr(value, "count"):
           raise ValueError(
               "Can't treat complext type as simple value: %s" % value)
-        series.Append(value, timestamp)
+        pairs.append((value, timestamp))
 
-    return series
+    return timeseries.Timeseries.FromPairs(pairs)
 
   @property
   def ts(self):
@@ -164,6 +164,9 @@ class GRRUser(aff4.AFF4Object):
 
   class SchemaCls(aff4.AFF4Object.SchemaCls):
     """Schema for GRRUser."""
+    # Users are read on every API call but are rarely changed.
+    CACHE_READS = True
+
     PENDING_NOTIFICATIONS = aff4.Attribute(
         "aff4:notification/pending",
         rdf_flows.NotificationList,
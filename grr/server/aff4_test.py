@@ -11,6 +11,7 @@ import mock
 
 from grr.lib import flags
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
@@ -1193,6 +1194,52 @@ class AFF4Test(aff4_test_lib.AFF4ObjectTest):
     for i in range(100):
       self.assertEqual(fd.Read(13), "Test%08X\n" % i)
 
+  def _WriteChunks(self, path, num_chunks):
+    with aff4.FACTORY.Create(path, aff4.AFF4Image, token=self.token) as fd:
+      fd.SetChunksize(10)
+      fd.Write("".join("%09d\n" % i for i in xrange(num_chunks)))
+
+  def testSequentialReadsGrowTheReadAhead(self):
+    path = "/C.12345/sequential"
+    self._WriteChunks(path, 1000)
+
+    misses = stats.STATS.GetMetricValue("aff4_image_chunk_cache_misses")
+    read_bytes = stats.STATS.GetMetricValue("aff4_image_read_bytes")
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    for i in xrange(1000):
+      self.assertEqual(fd.Read(10), "%09d\n" % i)
+
+    self.assertGreater(fd._read_ahead, fd.LOOK_AHEAD)
+    # A fixed read ahead would miss every tenth chunk.
+    self.assertLess(
+        stats.STATS.GetMetricValue("aff4_image_chunk_cache_misses") - misses,
+        10)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("aff4_image_read_bytes") - read_bytes,
+        10000)
+
+  def testRandomReadsKeepTheReadAheadSmall(self):
+    path = "/C.12345/random"
+    self._WriteChunks(path, 1000)
+
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    for i in [500, 10, 990, 300, 301, 700]:
+      fd.Seek(i * 10)
+      self.assertEqual(fd.Read(10), "%09d\n" % i)
+      self.assertEqual(fd._read_ahead, fd.LOOK_AHEAD)
+
+    self.assertLessEqual(len(fd.chunk_cache._hash), 6 * fd.LOOK_AHEAD)
+
+  def testReadAheadWithoutThreads(self):
+    path = "/C.12345/nothreads"
+    self._WriteChunks(path, 100)
+
+    with test_lib.ConfigOverrider({"Server.aff4_read_ahead_threads": 0}):
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      self.assertEqual(
+          fd.Read(1000), "".join("%09d\n" % i for i in xrange(100)))
+
   def WriteImage(self,
                  path,
                  prefix="Test",
@@ -1484,6 +1531,34 @@ class AFF4Test(aff4_test_lib.AFF4ObjectTest):
         self.client_id, token=self.token, blocking=False):
       pass
 
+  def testMultiOpenWithLockSkipsLockedObjects(self):
+    urns = [rdfvalue.RDFURN("aff4:/C.%016X" % i) for i in range(1, 4)]
+    for i, urn in enumerate(urns):
+      client = aff4.FACTORY.Create(
+          urn, aff4_grr.VFSGRRClient, mode="w", token=self.token)
+      client.Set(client.Schema.HOSTNAME("client%d" % i))
+      client.Close()
+
+    with aff4.FACTORY.OpenWithLock(urns[0], token=self.token):
+      objs = aff4.FACTORY.MultiOpenWithLock(
+          urns, blocking=False, token=self.token)
+
+      self.assertEqual(sorted(obj.urn for obj in objs), urns[1:])
+      for obj in objs:
+        self.assertTrue(obj.locked)
+        self.assertEqual(
+            obj.Get(obj.Schema.HOSTNAME), "client%d" % urns.index(obj.urn))
+
+        # The returned objects hold their locks until they are closed.
+        with self.assertRaises(aff4.LockError):
+          aff4.FACTORY.OpenWithLock(obj.urn, token=self.token, blocking=False)
+
+        obj.Close()
+
+    for urn in urns:
+      with aff4.FACTORY.OpenWithLock(urn, token=self.token, blocking=False):
+        pass
+
   def testAsynchronousCreateWithLock(self):
     self.client_id = rdfvalue.RDFURN(self.client_id)
 
@@ -1888,6 +1963,82 @@ class AFF4SymlinkTest(aff4_test_lib.AFF4ObjectTest):
       self.assertEqual(symlink_obj.Get(attr), fd.Get(attr))
 
 
+class CachedTestObject(aff4.AFF4Volume):
+  """A test object which is kept in the object cache."""
+
+  class SchemaCls(aff4.AFF4Object.SchemaCls):
+    CACHE_READS = True
+
+    SOME_STRING = aff4.Attribute("aff4:cached_string", rdfvalue.RDFString,
+                                 "SomeString")
+
+
+class AFF4ObjectCacheTest(aff4_test_lib.AFF4ObjectTest):
+  """Tests the factory's object cache."""
+
+  urn = rdfvalue.RDFURN("aff4:/cached")
+
+  def _Write(self, value, aff4_type=CachedTestObject):
+    with aff4.FACTORY.Create(self.urn, aff4_type, token=self.token) as fd:
+      fd.Set(fd.Schema.SOME_STRING, rdfvalue.RDFString(value))
+
+  def _Read(self):
+    fd = aff4.FACTORY.Open(self.urn, token=self.token)
+    return fd.Get(fd.Schema.SOME_STRING)
+
+  def _ReadPrefixes(self):
+    """Reads the object and returns the attribute prefixes read from the db."""
+    with mock.patch.object(
+        data_store.DB,
+        "MultiResolvePrefix",
+        wraps=data_store.DB.MultiResolvePrefix) as resolve:
+      value = self._Read()
+
+    return value, [call[0][1] for call in resolve.call_args_list]
+
+  def testCachedObjectsOnlyHaveTheirVersionRead(self):
+    self._Write("foo")
+    self.assertEqual(self._Read(), "foo")
+
+    value, prefixes = self._ReadPrefixes()
+    self.assertEqual(value, "foo")
+    self.assertEqual(prefixes, [aff4.VERSION_ATTRIBUTES])
+
+  def testObjectsWhichDoNotOptInAreNotCached(self):
+    self._Write("foo", aff4_type=AFF4SymlinkTestSubject)
+    self._Read()
+
+    _, prefixes = self._ReadPrefixes()
+    self.assertEqual(prefixes, [aff4.AFF4_PREFIXES])
+
+  def testWritesAreSeen(self):
+    self._Write("foo")
+    self.assertEqual(self._Read(), "foo")
+
+    self._Write("bar")
+    self.assertEqual(self._Read(), "bar")
+
+  def testWritesFromOtherProcessesAreSeen(self):
+    self._Write("foo")
+    self.assertEqual(self._Read(), "foo")
+
+    # A different factory does not invalidate our cache, just like a factory in
+    # another process.
+    with utils.Stubber(aff4, "FACTORY", aff4.Factory()):
+      self._Write("bar")
+
+    value, prefixes = self._ReadPrefixes()
+    self.assertEqual(value, "bar")
+    self.assertEqual(prefixes, [aff4.VERSION_ATTRIBUTES, aff4.AFF4_PREFIXES])
+
+  def testDeletedObjectsAreNotServed(self):
+    self._Write("foo")
+    self.assertEqual(self._Read(), "foo")
+
+    aff4.FACTORY.Delete(self.urn, token=self.token)
+    self.assertIsNone(self._Read())
+
+
 class ForemanTests(aff4_test_lib.AFF4ObjectTest):
   """Tests the Foreman."""
 
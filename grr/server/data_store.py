@@ -39,9 +39,11 @@ import atexit
 import collections
 import logging
 import os
+import Queue
 import random
 import socket
 import sys
+import threading
 import time
 
 import psutil
@@ -113,6 +115,11 @@ class DBSubjectLockError(Error):
   counter = "grr_commit_failure"
 
 
+class AsyncFlushError(Error):
+  """Raised when mutations flushed earlier with wait=False were not written."""
+  counter = "mutation_pool_async_flush_errors"
+
+
 # This token will be used by default if no token was provided.
 default_token = None
 
@@ -150,6 +157,187 @@ Record = collections.namedtuple(
     "Record", ["queue_id", "timestamp", "suffix", "subpath", "value"])
 
 
+def _CoalesceSetRequests(set_requests):
+  """Merges MultiSet requests that follow each other for the same subject.
+
+  Requests are only merged into the latest request for their subject and only
+  if they use the same timestamp and replace mode, this way the merged
+  requests have the same effect as applying them one by one.
+
+  Args:
+    set_requests: A list of (subject, values, timestamp, replace, to_delete)
+                  tuples as queued by MutationPool.MultiSet.
+
+  Returns:
+    A list of (subject, values, timestamp, replace, to_delete) tuples.
+  """
+  result = []
+  latest_by_subject = {}
+  for subject, values, timestamp, replace, to_delete in set_requests:
+    key = utils.SmartUnicode(subject)
+    index = latest_by_subject.get(key)
+    if index is not None:
+      _, merged_values, merged_timestamp, merged_replace, merged_to_delete = (
+          result[index])
+      # Deleting attributes we already have values for would delete those
+      # values if applied in the same MultiSet call so we can't merge then.
+      if (merged_timestamp == timestamp and merged_replace == replace and
+          not set(to_delete or []).intersection(merged_values)):
+        for attribute, value_list in values.iteritems():
+          if replace:
+            merged_values[attribute] = list(value_list)
+          else:
+            merged_values.setdefault(attribute, []).extend(value_list)
+        merged_to_delete.update(to_delete or [])
+        continue
+
+    latest_by_subject[key] = len(result)
+    result.append((subject, dict((a, list(v)) for a, v in values.iteritems()),
+                   timestamp, replace, set(to_delete or [])))
+
+  return [(subject, values, timestamp, replace, to_delete or None)
+          for subject, values, timestamp, replace, to_delete in result]
+
+
+def _CoalesceDeleteAttributesRequests(delete_attributes_requests,
+                                      deleted_subjects):
+  """Merges DeleteAttributes requests for the same subject and time range.
+
+  Args:
+    delete_attributes_requests: A list of (subject, attributes, start, end)
+                                tuples as queued by
+                                MutationPool.DeleteAttributes.
+    deleted_subjects: A set of subjects (as unicode) that are deleted
+                      entirely. Requests for those are dropped.
+
+  Returns:
+    A list of (subject, attributes, start, end) tuples.
+  """
+  result = []
+  latest_by_subject = {}
+  for subject, attributes, start, end in delete_attributes_requests:
+    key = utils.SmartUnicode(subject)
+    if key in deleted_subjects:
+      continue
+
+    index = latest_by_subject.get(key)
+    if index is not None:
+      _, merged_attributes, merged_start, merged_end = result[index]
+      if merged_start == start and merged_end == end:
+        for attribute in attributes:
+          if attribute not in merged_attributes:
+            merged_attributes.append(attribute)
+        continue
+
+    latest_by_subject[key] = len(result)
+    result.append((subject, list(attributes), start, end))
+
+  return result
+
+
+class MutationBatch(object):
+  """A set of mutations that are applied to the data store together."""
+
+  def __init__(self, store, delete_subject_requests, delete_attributes_requests,
+               set_requests, new_notifications):
+    self.store = store
+    self.delete_subject_requests = delete_subject_requests
+    self.delete_attributes_requests = delete_attributes_requests
+    self.set_requests = set_requests
+    self.new_notifications = new_notifications
+
+    # Set once the batch was applied by the MutationPoolWriter.
+    self.done = threading.Event()
+    self.error = None
+    # Whether the error was raised to a caller already.
+    self.error_raised = False
+
+  def IsEmpty(self):
+    return not (self.delete_subject_requests or
+                self.delete_attributes_requests or self.set_requests or
+                self.new_notifications)
+
+  def Wait(self):
+    """Blocks until the batch is written, raises if writing it failed."""
+    self.done.wait()
+    if self.error is not None and not self.error_raised:
+      self.error_raised = True
+      raise self.error
+
+  def Apply(self):
+    """Writes the mutations to the data store."""
+    self.store.DeleteSubjects(self.delete_subject_requests, sync=False)
+
+    for subject, attributes, start, end in self.delete_attributes_requests:
+      self.store.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=False)
+
+    for subject, values, timestamp, replace, to_delete in self.set_requests:
+      self.store.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete,
+          sync=False)
+
+    if (self.delete_subject_requests or self.delete_attributes_requests or
+        self.set_requests):
+      self.store.Flush()
+
+    for queue, notifications in self.new_notifications:
+      self.store.CreateNotifications(queue, notifications)
+
+
+class MutationPoolWriter(object):
+  """Applies MutationBatches on a background thread.
+
+  Batches are applied one at a time in the order they were submitted.
+  """
+
+  def __init__(self, max_pending_batches):
+    self.queue = Queue.Queue(maxsize=max_pending_batches)
+    self.thread = threading.Thread(
+        name="MutationPool writer thread", target=self._Run)
+    # Do not hold up program exit.
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Submit(self, batch):
+    """Queues a batch, blocks while too many batches are waiting already."""
+    self.queue.put(batch)
+
+  def _Run(self):
+    while True:
+      batch = self.queue.get()
+      try:
+        start_time = time.time()
+        batch.Apply()
+        stats.STATS.RecordEvent("mutation_pool_async_flush_latency",
+                                time.time() - start_time)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error applying mutations: %s", e)
+        batch.error = e
+      finally:
+        batch.done.set()
+
+
+_mutation_pool_writer = None
+_mutation_pool_writer_lock = threading.Lock()
+
+
+def GetMutationPoolWriter():
+  """Returns the global MutationPoolWriter, starting it if needed."""
+  global _mutation_pool_writer  # pylint: disable=global-statement
+
+  with _mutation_pool_writer_lock:
+    if _mutation_pool_writer is None:
+      _mutation_pool_writer = MutationPoolWriter(
+          config.CONFIG["Datastore.mutation_pool_max_pending_batches"])
+
+    return _mutation_pool_writer
+
+
 class MutationPool(object):
   """A mutation pool.
 
@@ -159,15 +347,32 @@ class MutationPool(object):
   before Flush() is called on the pool. If datastore errors occur
   during application, some mutations might be applied while others are
   not.
+
+  Redundant mutations are merged when the pool is flushed: consecutive sets
+  for the same subject end up in a single MultiSet call and attribute
+  deletions for subjects that are deleted entirely are dropped.
+
+  Flush(wait=False) hands the mutations to a background writer thread and
+  returns the MutationBatch, which the caller can Wait() for. A later Flush()
+  (which is also called when the pool is used as a context manager) acts as a
+  barrier and waits until everything flushed from this pool before has been
+  written. Errors of batches nobody waited for are raised as AsyncFlushError
+  by the next Flush of the pool.
   """
 
-  def __init__(self):
+  def __init__(self, store=None):
+    # The data store the mutations are written to.
+    self.store = store if store is not None else DB
+
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
 
     self.new_notifications = []
 
+    # Batches submitted to the writer thread we have not waited for yet.
+    self.pending_batches = []
+
   def DeleteSubjects(self, subjects):
     self.delete_subject_requests.extend(subjects)
 
@@ -189,35 +394,133 @@ class MutationPool(object):
   def DeleteAttributes(self, subject, attributes, start=None, end=None):
     self.delete_attributes_requests.append((subject, attributes, start, end))
 
-  def Flush(self):
-    """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(self.delete_subject_requests, sync=False)
+  def _TakeBatch(self):
+    """Moves all queued mutations into a coalesced MutationBatch."""
+    delete_subject_requests = []
+    deleted_subjects = set()
+    for subject in self.delete_subject_requests:
+      key = utils.SmartUnicode(subject)
+      if key not in deleted_subjects:
+        deleted_subjects.add(key)
+        delete_subject_requests.append(subject)
+
+    delete_attributes_requests = _CoalesceDeleteAttributesRequests(
+        self.delete_attributes_requests, deleted_subjects)
+    set_requests = _CoalesceSetRequests(self.set_requests)
+
+    coalesced = self.Size() - (
+        len(delete_subject_requests) + len(delete_attributes_requests) +
+        len(set_requests))
+    if coalesced:
+      stats.STATS.IncrementCounter("mutation_pool_coalesced_mutations",
+                                   coalesced)
+
+    batch = MutationBatch(self.store, delete_subject_requests,
+                          delete_attributes_requests, set_requests,
+                          self.new_notifications)
 
-    for req in self.delete_attributes_requests:
-      subject, attributes, start, end = req
-      DB.DeleteAttributes(subject, attributes, start=start, end=end, sync=False)
+    self.delete_subject_requests = []
+    self.set_requests = []
+    self.delete_attributes_requests = []
+    self.new_notifications = []
 
-    for req in self.set_requests:
-      subject, values, timestamp, replace, to_delete = req
-      DB.MultiSet(
-          subject,
-          values,
-          timestamp=timestamp,
-          replace=replace,
-          to_delete=to_delete,
-          sync=False)
+    return batch
 
-    if (self.delete_subject_requests or self.delete_attributes_requests or
-        self.set_requests):
-      DB.Flush()
+  def _RaiseAsyncFlushErrors(self, batches, current_batch=None):
+    """Raises the errors of the given batches nobody waited for.
 
-    for queue, notifications in self.new_notifications:
-      DB.CreateNotifications(queue, notifications)
-    self.new_notifications = []
+    Args:
+      batches: Finished batches flushed earlier with wait=False.
+      current_batch: The finished batch of the current Flush(), if any. If
+                     only this batch failed, its error is raised as is.
 
-    self.delete_subject_requests = []
-    self.set_requests = []
-    self.delete_attributes_requests = []
+    Raises:
+      AsyncFlushError: Writing one of the batches failed. The message lists
+                       the errors of all failed batches.
+    """
+    errors = []
+    for batch in batches:
+      if batch.error is not None and not batch.error_raised:
+        batch.error_raised = True
+        errors.append(batch.error)
+
+    current_error = None
+    if current_batch is not None and current_batch.error is not None:
+      current_batch.error_raised = True
+      current_error = current_batch.error
+
+    if not errors:
+      if current_error is not None:
+        raise current_error
+      return
+
+    if current_error is not None:
+      errors.append(current_error)
+    raise AsyncFlushError(
+        "Writing mutations flushed with wait=False failed: %s" %
+        "; ".join(str(error) for error in errors))
+
+  def Flush(self, wait=True):
+    """Flushing actually applies all the operations in the pool.
+
+    Args:
+      wait: If False, the mutations are written by a background thread and
+            this call returns immediately. Otherwise this call returns once
+            all the mutations of this pool, including those flushed earlier
+            with wait=False, have been written.
+
+    Returns:
+      The MutationBatch holding the flushed mutations. Callers of
+      Flush(wait=False) can Wait() for it to find out whether it was written.
+
+    Raises:
+      AsyncFlushError: Writing mutations flushed earlier with wait=False
+                       failed. Mutations which were not flushed yet stay in
+                       the pool in this case.
+    """
+    # Errors of earlier batches are reported before anything else is written.
+    finished = []
+    pending = []
+    for pending_batch in self.pending_batches:
+      if pending_batch.done.is_set():
+        finished.append(pending_batch)
+      else:
+        pending.append(pending_batch)
+    self.pending_batches = pending
+    self._RaiseAsyncFlushErrors(finished)
+
+    batch = self._TakeBatch()
+
+    if not wait:
+      if batch.IsEmpty():
+        batch.done.set()
+      else:
+        GetMutationPoolWriter().Submit(batch)
+        self.pending_batches.append(batch)
+      return batch
+
+    if not self.pending_batches:
+      try:
+        batch.Apply()
+      finally:
+        batch.done.set()
+      return batch
+
+    # Earlier batches are still being written, this batch has to go through
+    # the writer as well so it's applied after them.
+    pending_batches = self.pending_batches
+    self.pending_batches = []
+    if batch.IsEmpty():
+      batch.done.set()
+    else:
+      GetMutationPoolWriter().Submit(batch)
+
+    # Every batch is waited for before raising, so no error is lost.
+    for pending_batch in pending_batches + [batch]:
+      pending_batch.done.wait()
+    self._RaiseAsyncFlushErrors(pending_batches, current_batch=batch)
+
+    return batch
 
   def __enter__(self):
     return self
@@ -229,6 +532,22 @@ class MutationPool(object):
     return (len(self.delete_subject_requests) + len(self.set_requests) +
             len(self.delete_attributes_requests))
 
+  def StoreRequestsAndResponses(self,
+                                new_requests=None,
+                                new_responses=None,
+                                requests_to_delete=None):
+    """Queues new flow requests and responses, see DataStore for details."""
+    to_write, to_delete = self.store.GetRequestsAndResponsesMutations(
+        new_requests=new_requests,
+        new_responses=new_responses,
+        requests_to_delete=requests_to_delete)
+
+    for subject in set(to_write) | set(to_delete):
+      self.MultiSet(
+          subject,
+          to_write.get(subject, {}),
+          to_delete=to_delete.get(subject, []))
+
   # Notification handling
   def CreateNotifications(self, queue, notifications):
     self.new_notifications.append((queue, notifications))
@@ -266,11 +585,11 @@ class MutationPool(object):
         timestamp=0)
 
   def CollectionDelete(self, collection_id):
-    for subject, _, _ in DB.ScanAttribute(
+    for subject, _, _ in self.store.ScanAttribute(
         collection_id.Add("Results"), DataStore.COLLECTION_ATTRIBUTE):
       self.DeleteSubject(subject)
       if self.Size() > 50000:
-        self.Flush()
+        self.Flush(wait=False)
 
   def QueueAddItem(self, queue_id, item, timestamp):
     result_subject, timestamp, _ = DataStore.CollectionMakeURN(
@@ -301,7 +620,7 @@ class MutationPool(object):
 
     filtered_count = 0
 
-    for subject, values in DB.ScanAttributes(
+    for subject, values in self.store.ScanAttributes(
         queue_id.Add("Records"),
         [DataStore.COLLECTION_ATTRIBUTE, DataStore.QUEUE_LOCK_ATTRIBUTE],
         max_records=4 * limit,
@@ -391,7 +710,7 @@ class MutationPool(object):
     """
     # Do the real work in a transaction
     try:
-      lock = DB.LockRetryWrapper(queue, lease_time=lease_seconds)
+      lock = self.store.LockRetryWrapper(queue, lease_time=lease_seconds)
       return self._QueueQueryAndOwn(
           lock.subject,
           lease_seconds=lease_seconds,
@@ -406,23 +725,86 @@ class MutationPool(object):
       logging.warning("Datastore exception: %s", e)
       return []
 
+  def MultiQueueQueryAndOwn(self, limits, lease_seconds, timestamp):
+    """Leases tasks from several queues at once.
+
+    This is the bulk version of QueueQueryAndOwn(): the queues are read with a
+    single data store query and the leases are written by this mutation pool.
+    Queues which are locked by someone else are skipped instead of waiting for
+    the lock.
+
+    Args:
+      limits: A dict mapping queues to the number of tasks to lease from them.
+      lease_seconds: The tasks will be leased for this long.
+      timestamp: Only tasks queued before this time are considered.
+
+    Returns:
+      A dict mapping each queue to a list of GrrMessage() objects leased.
+    """
+    result = {}
+    locks = {}
+    for queue in limits:
+      result[queue] = []
+      try:
+        locks[utils.SmartStr(queue)] = self.store.LockRetryWrapper(
+            queue, lease_time=lease_seconds, blocking=False)
+      except DBSubjectLockError:
+        pass
+
+    if not locks:
+      return result
+
+    try:
+      rows = dict((utils.SmartStr(subject), values)
+                  for subject, values in self.store.MultiResolvePrefix(
+                      list(locks),
+                      DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+                      timestamp=(0, timestamp or rdfvalue.RDFDatetime.Now())))
+    except Error as e:
+      logging.warning("Datastore exception: %s", e)
+      return result
+
+    for queue, limit in limits.iteritems():
+      subject = utils.SmartStr(queue)
+      if subject in locks and subject in rows:
+        result[queue] = self._LeaseTasks(
+            subject, rows[subject], lease_seconds=lease_seconds, limit=limit)
+
+    return result
+
   def _QueueQueryAndOwn(self,
                         subject,
                         lease_seconds=100,
                         limit=1,
                         timestamp=None):
     """Business logic helper for QueueQueryAndOwn()."""
+    # Only grab attributes with timestamps in the past.
+    rows = self.store.ResolvePrefix(
+        subject,
+        DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+        timestamp=(0, timestamp or rdfvalue.RDFDatetime.Now()))
+    return self._LeaseTasks(
+        subject, rows, lease_seconds=lease_seconds, limit=limit)
+
+  def _LeaseTasks(self, subject, rows, lease_seconds, limit):
+    """Leases tasks read from a queue.
+
+    Args:
+      subject: The queue the tasks were read from.
+      rows: (predicate, serialized task, timestamp) tuples read from the queue.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of tasks to lease.
+
+    Returns:
+      A list of GrrMessage() objects leased.
+    """
     tasks = []
 
     lease = long(lease_seconds * 1e6)
 
-    # Only grab attributes with timestamps in the past.
     delete_attrs = set()
     serialized_tasks_dict = {}
-    for predicate, task, timestamp in DB.ResolvePrefix(
-        subject,
-        DataStore.QUEUE_TASK_PREDICATE_PREFIX,
-        timestamp=(0, timestamp or rdfvalue.RDFDatetime.Now())):
+    for predicate, task, timestamp in rows:
       task = rdf_flows.GrrMessage.FromSerializedString(task)
       task.eta = timestamp
       task.last_lease = "%s@%s:%d" % (psutil.Process().name(),
@@ -534,6 +916,108 @@ class MutationPool(object):
         subject, [DataStore.AFF4_INDEX_DIR_TEMPLATE % utils.SmartStr(child)])
 
 
+class DataStoreReadCache(object):
+  """Memoized data store reads for a single unit of work.
+
+  Use DataStore.ReadCache() to get an instance. While the cache is active,
+  reads in the current thread with the same arguments return the same result
+  without going to the data store again. Writes done through the data store
+  object in this process drop cached results for the written subjects, writes
+  from other processes are not seen until the cache is left.
+  """
+
+  def __init__(self, store, max_size=None):
+    self.store = store
+    if max_size is None:
+      max_size = config.CONFIG["Datastore.read_cache_size"]
+    # Keys are read method name and arguments, values are (key, subjects,
+    # result) tuples.
+    self.results = _ReadCacheResults(self, max_size=max_size)
+    # Keys are subjects, values are sets of keys into self.results.
+    self.keys_by_subject = {}
+    # Writes from other threads invalidate entries concurrently.
+    self.lock = threading.Lock()
+    self.depth = 0
+
+  def Get(self, key):
+    """Returns the cached result for key or None."""
+    with self.lock:
+      try:
+        _, _, result = self.results.Get(key)
+      except KeyError:
+        result = None
+
+    if result is None:
+      stats.STATS.IncrementCounter("datastore_read_cache_misses")
+    else:
+      stats.STATS.IncrementCounter("datastore_read_cache_hits")
+    return result
+
+  def Put(self, key, subjects, result):
+    with self.lock:
+      self.results.Put(key, (key, subjects, result))
+      for subject in subjects:
+        self.keys_by_subject.setdefault(subject, set()).add(key)
+
+  def Invalidate(self, subjects):
+    with self.lock:
+      for subject in subjects:
+        for key in self.keys_by_subject.pop(subject, ()):
+          # Also drops the key from the index entries of the other subjects
+          # the result covers.
+          self.results.ExpireObject(key)
+
+  def _Forget(self, key, subjects):
+    """Drops the subject index entries of an expired result."""
+    for subject in subjects:
+      keys = self.keys_by_subject.get(subject)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self.keys_by_subject[subject]
+
+  def __enter__(self):
+    self.depth += 1
+    if self.depth == 1:
+      self.store._ActivateReadCache(self)  # pylint: disable=protected-access
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.depth -= 1
+    if not self.depth:
+      self.store._DeactivateReadCache(self)  # pylint: disable=protected-access
+
+
+class _ReadCacheResults(utils.FastStore):
+  """The results of a DataStoreReadCache, least recently used expire first."""
+
+  def __init__(self, read_cache, max_size=10):
+    super(_ReadCacheResults, self).__init__(max_size=max_size)
+    self.read_cache = read_cache
+
+  def KillObject(self, obj):
+    key, subjects, _ = obj
+    # pylint: disable=protected-access
+    self.read_cache._Forget(key, subjects)
+    # pylint: enable=protected-access
+
+
+def _ReadCacheKey(method_name, subjects, args):
+  """Returns a hashable cache key for a read or None if there is none."""
+  key = [method_name, tuple(subjects)]
+  for arg in args:
+    if isinstance(arg, (list, tuple)):
+      arg = tuple(arg)
+    key.append(arg)
+
+  key = tuple(key)
+  try:
+    hash(key)
+  except TypeError:
+    return None
+  return key
+
+
 class DataStore(object):
   """Abstract database access."""
 
@@ -582,6 +1066,78 @@ class DataStore(object):
       self.flusher_thread.start()
     self.monitor_thread = None
 
+    # The read cache active in the current thread, see ReadCache().
+    self._read_cache_local = threading.local()
+    self._read_caches = set()
+    self._read_caches_lock = threading.Lock()
+
+  def ReadCache(self):
+    """Returns a context manager caching reads done in the current thread.
+
+    This is meant for units of work (an API call, processing a flow) that read
+    the same subjects over and over again. Entries are dropped when the
+    subject is written through this data store object, but writes from other
+    processes are not picked up while the cache is active.
+
+    Nested calls return the cache that is already active.
+
+    Returns:
+      A DataStoreReadCache object to be used in a with statement.
+    """
+    cache = getattr(self._read_cache_local, "cache", None)
+    if cache is None:
+      cache = DataStoreReadCache(self)
+    return cache
+
+  def _GetReadCache(self):
+    return getattr(self._read_cache_local, "cache", None)
+
+  def _ActivateReadCache(self, cache):
+    self._read_cache_local.cache = cache
+    with self._read_caches_lock:
+      self._read_caches.add(cache)
+
+  def _DeactivateReadCache(self, cache):
+    self._read_cache_local.cache = None
+    with self._read_caches_lock:
+      self._read_caches.discard(cache)
+
+  def _InvalidateReadCaches(self, subjects):
+    if not self._read_caches:
+      return
+
+    subjects = [utils.SmartUnicode(s) for s in subjects]
+    with self._read_caches_lock:
+      caches = list(self._read_caches)
+    for cache in caches:
+      cache.Invalidate(subjects)
+
+  def _CachedRead(self, cache, method_name, subjects, args, read):
+    """Returns the result of read() memoized in the given read cache.
+
+    Args:
+      cache: The active DataStoreReadCache.
+      method_name: The name of the read method, part of the cache key.
+      subjects: The subjects read, cached results are dropped when one of them
+          is written.
+      args: The remaining arguments of the read, part of the cache key.
+      read: A function doing the actual read and returning a list.
+
+    Returns:
+      The list returned by read(). The list is shared with the cache and must
+      not be modified.
+    """
+    subjects = [utils.SmartUnicode(s) for s in subjects]
+    key = _ReadCacheKey(method_name, subjects, args)
+    if key is None:
+      return read()
+
+    result = cache.Get(key)
+    if result is None:
+      result = read()
+      cache.Put(key, subjects, result)
+    return result
+
   def InitializeBlobstore(self):
     blobstore_name = config.CONFIG.Get("Blobstore.implementation")
     try:
@@ -619,9 +1175,16 @@ class DataStore(object):
     """Initialization of the datastore."""
     self.InitializeBlobstore()
 
-  @abc.abstractmethod
   def DeleteSubject(self, subject, sync=False):
     """Completely deletes all information about this subject."""
+    try:
+      self._DeleteSubject(subject, sync=sync)
+    finally:
+      self._InvalidateReadCaches([subject])
+
+  @abc.abstractmethod
+  def _DeleteSubject(self, subject, sync=False):
+    """Deletes the subject, the data store specific part of DeleteSubject."""
 
   def DeleteSubjects(self, subjects, sync=False):
     """Delete multiple subjects at once."""
@@ -710,7 +1273,6 @@ class DataStore(object):
         A lock object.
     """
 
-  @abc.abstractmethod
   def MultiSet(self,
                subject,
                values,
@@ -731,6 +1293,26 @@ class DataStore(object):
       sync: If true we block until the operation completes.
       to_delete: An array of attributes to clear prior to setting.
     """
+    try:
+      self._MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync,
+          to_delete=to_delete)
+    finally:
+      self._InvalidateReadCaches([subject])
+
+  @abc.abstractmethod
+  def _MultiSet(self,
+                subject,
+                values,
+                timestamp=None,
+                replace=True,
+                sync=True,
+                to_delete=None):
+    """Writes the values, the data store specific part of MultiSet."""
 
   def MultiDeleteAttributes(self,
                             subjects,
@@ -751,7 +1333,6 @@ class DataStore(object):
       self.DeleteAttributes(
           subject, attributes, start=start, end=end, sync=sync)
 
-  @abc.abstractmethod
   def DeleteAttributes(self,
                        subject,
                        attributes,
@@ -767,6 +1348,20 @@ class DataStore(object):
       end: A timestamp, attributes newer than end will not be deleted.
       sync: If true we block until the operation completes.
     """
+    try:
+      self._DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=sync)
+    finally:
+      self._InvalidateReadCaches([subject])
+
+  @abc.abstractmethod
+  def _DeleteAttributes(self,
+                        subject,
+                        attributes,
+                        start=None,
+                        end=None,
+                        sync=True):
+    """Deletes attributes, the data store specific part of DeleteAttributes."""
 
   def Resolve(self, subject, attribute):
     """Retrieve a value set for a subject's attribute.
@@ -794,7 +1389,6 @@ class DataStore(object):
 
     return (None, 0)
 
-  @abc.abstractmethod
   def MultiResolvePrefix(self,
                          subjects,
                          attribute_prefix,
@@ -802,10 +1396,6 @@ class DataStore(object):
                          limit=None):
     """Generate a set of values matching for subjects' attribute.
 
-    This method provides backwards compatibility for the old method of
-    specifying regexes. Each datastore can move to prefix matching by
-    overriding this method and ResolvePrefix below.
-
     Args:
       subjects: A list of subjects.
       attribute_prefix: The attribute prefix.
@@ -827,6 +1417,30 @@ class DataStore(object):
     Raises:
       AccessError: if anything goes wrong.
     """
+    cache = self._GetReadCache()
+    if cache is None:
+      return self._MultiResolvePrefix(
+          subjects, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    subjects = list(subjects)
+
+    def Read():
+      return [(subject, list(values))
+              for subject, values in self._MultiResolvePrefix(
+                  subjects, attribute_prefix, timestamp=timestamp, limit=limit)]
+
+    result = self._CachedRead(cache, "MultiResolvePrefix", subjects,
+                              [attribute_prefix, timestamp, limit], Read)
+    # Callers are allowed to modify the returned lists.
+    return [(subject, list(values)) for subject, values in result]
+
+  @abc.abstractmethod
+  def _MultiResolvePrefix(self,
+                          subjects,
+                          attribute_prefix,
+                          timestamp=None,
+                          limit=None):
+    """Reads the values, the data store specific part of MultiResolvePrefix."""
 
   def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
                     limit=None):
@@ -852,7 +1466,29 @@ class DataStore(object):
     Raises:
       AccessError: if anything goes wrong.
     """
-    for _, values in self.MultiResolvePrefix(
+    cache = self._GetReadCache()
+    if cache is None:
+      return self._ResolvePrefix(
+          subject, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    def Read():
+      return list(
+          self._ResolvePrefix(
+              subject, attribute_prefix, timestamp=timestamp, limit=limit))
+
+    return list(
+        self._CachedRead(cache, "ResolvePrefix", [subject],
+                         [attribute_prefix, timestamp, limit], Read))
+
+  def _ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                     limit=None):
+    """Reads the values, the data store specific part of ResolvePrefix.
+
+    This method provides backwards compatibility for the old method of
+    specifying regexes. Each datastore can move to prefix matching by
+    overriding this method and _MultiResolvePrefix above.
+    """
+    for _, values in self._MultiResolvePrefix(
         [subject], attribute_prefix, timestamp=timestamp, limit=limit):
       values.sort(key=lambda a: a[0])
       return values
@@ -872,7 +1508,27 @@ class DataStore(object):
           microseconds). Can be a constant such as ALL_TIMESTAMPS or
           NEWEST_TIMESTAMP or a tuple of ints (start, end).
       limit: The maximum total number of results we return.
+
+    Returns:
+       An iterable of (attribute, value string, timestamp).
     """
+    cache = self._GetReadCache()
+    if cache is None:
+      return self._ResolveMulti(
+          subject, attributes, timestamp=timestamp, limit=limit)
+
+    def Read():
+      return list(
+          self._ResolveMulti(
+              subject, attributes, timestamp=timestamp, limit=limit))
+
+    return list(
+        self._CachedRead(cache, "ResolveMulti", [subject],
+                         [attributes, timestamp, limit], Read))
+
+  @abc.abstractmethod
+  def _ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
+    """Reads the values, the data store specific part of ResolveMulti."""
 
   def ResolveRow(self, subject, **kw):
     return self.ResolvePrefix(subject, "", **kw)
@@ -982,7 +1638,7 @@ class DataStore(object):
     return self.blobstore.DeleteBlobs(identifiers, token=token)
 
   def GetMutationPool(self):
-    return self.mutation_pool_cls()
+    return self.mutation_pool_cls(store=self)
 
   def CreateNotifications(self, queue_shard, notifications):
     values = {}
@@ -1071,17 +1727,11 @@ class DataStore(object):
 
       yield (request, sorted(responses, key=lambda msg: msg.response_id))
 
-  def ReadCompletedRequests(self, session_id, timestamp=None, limit=None):
-    """Fetches all the requests with a status message queued for them."""
-    subject = session_id.Add("state")
+  def _ParseCompletedRequests(self, values):
+    """Returns (request, status) tuples for requests which have a status."""
     requests = {}
     status = {}
-
-    for predicate, serialized, _ in self.ResolvePrefix(
-        subject, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
-        limit=limit,
-        timestamp=timestamp):
-
+    for predicate, serialized, _ in values:
       parts = predicate.split(":", 3)
       request_id = parts[2]
       if parts[1] == "status":
@@ -1089,10 +1739,71 @@ class DataStore(object):
       else:
         requests[request_id] = serialized
 
+    completed = []
     for request_id, serialized in sorted(requests.items()):
       if request_id in status:
-        yield (rdf_flows.RequestState.FromSerializedString(serialized),
-               rdf_flows.GrrMessage.FromSerializedString(status[request_id]))
+        completed.append(
+            (rdf_flows.RequestState.FromSerializedString(serialized),
+             rdf_flows.GrrMessage.FromSerializedString(status[request_id])))
+    return completed
+
+  def ReadCompletedRequests(self, session_id, timestamp=None, limit=None):
+    """Fetches all the requests with a status message queued for them."""
+    values = self.ResolvePrefix(
+        session_id.Add("state"),
+        [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
+        limit=limit,
+        timestamp=timestamp)
+
+    for request, status in self._ParseCompletedRequests(values):
+      yield request, status
+
+  def MultiReadCompletedRequests(self, end_timestamps, limit=None):
+    """Fetches the completed requests for a number of flows at once.
+
+    Args:
+      end_timestamps: A dict mapping flow session ids to timestamps. For each
+                      flow, only requests and statuses written up to this
+                      timestamp are returned.
+      limit: The maximum number of requests and statuses read per flow.
+
+    Returns:
+      A dict mapping session ids to lists of (request, status) tuples in
+      ascending order of request ids.
+    """
+    prefixes = [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX]
+    values_by_session_id = {}
+
+    # Flows notified at the same time are read together so the data store
+    # applies the timestamp before the limit.
+    for end, session_ids in utils.GroupBy(end_timestamps,
+                                          end_timestamps.get).iteritems():
+      subjects = {}
+      for session_id in session_ids:
+        subjects[session_id.Add("state")] = session_id
+        values_by_session_id[session_id] = []
+
+      total_limit = limit * len(subjects) if limit else None
+      total = 0
+      for subject, values in self.MultiResolvePrefix(
+          subjects, prefixes, limit=total_limit, timestamp=(0, end)):
+        values = list(values)
+        total += len(values)
+        values_by_session_id[subjects[subject]] = values[:limit]
+
+      if total_limit is None or total < total_limit:
+        continue
+
+      # The limit applies to all flows together so a flow with many requests
+      # may have used it up. Flows which might have been cut short are read
+      # again on their own.
+      for subject, session_id in subjects.iteritems():
+        if len(values_by_session_id[session_id]) < limit:
+          values_by_session_id[session_id] = self.ResolvePrefix(
+              subject, prefixes, limit=limit, timestamp=(0, end))
+
+    return dict((session_id, self._ParseCompletedRequests(values))
+                for session_id, values in values_by_session_id.iteritems())
 
   def ReadResponsesForRequestId(self, session_id, request_id, timestamp=None):
     """Reads responses for one request.
@@ -1153,6 +1864,36 @@ class DataStore(object):
       requests_to_delete: A list of requests that should be deleted from the
                           data store.
     """
+    to_write, to_delete = self.GetRequestsAndResponsesMutations(
+        new_requests=new_requests,
+        new_responses=new_responses,
+        requests_to_delete=requests_to_delete)
+
+    for subject in set(to_write) | set(to_delete):
+      self.MultiSet(
+          subject,
+          to_write.get(subject, {}),
+          to_delete=to_delete.get(subject, []),
+          sync=True)
+
+  def GetRequestsAndResponsesMutations(self,
+                                       new_requests=None,
+                                       new_responses=None,
+                                       requests_to_delete=None):
+    """Computes the writes needed to store flow requests and responses.
+
+    Args:
+      new_requests: A list of tuples (request, timestamp) to store in the
+                    data store.
+      new_responses: A list of tuples (response, timestamp) to store in the
+                     data store.
+      requests_to_delete: A list of requests that should be deleted from the
+                          data store.
+
+    Returns:
+      A tuple (to_write, to_delete). to_write maps subjects to the values to
+      set, to_delete maps subjects to lists of attributes to delete.
+    """
     to_write = {}
     if new_requests is not None:
       for request, timestamp in new_requests:
@@ -1186,12 +1927,7 @@ class DataStore(object):
         queue.append(self.FLOW_REQUEST_TEMPLATE % request.id)
         queue.append(self.FLOW_STATUS_TEMPLATE % request.id)
 
-    for subject in set(to_write) | set(to_delete):
-      self.MultiSet(
-          subject,
-          to_write.get(subject, {}),
-          to_delete=to_delete.get(subject, []),
-          sync=True)
+    return to_write, to_delete
 
   def CheckRequestsForCompletion(self, requests):
     """Checks if there is a status message queued for a number of requests."""
@@ -1712,3 +2448,8 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric("mutation_pool_coalesced_mutations")
+    stats.STATS.RegisterCounterMetric("datastore_read_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_read_cache_misses")
+    stats.STATS.RegisterCounterMetric("mutation_pool_async_flush_errors")
+    stats.STATS.RegisterEventMetric("mutation_pool_async_flush_latency")
@@ -23,6 +23,7 @@ import mock
 import pytest
 
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -1357,6 +1358,7 @@ class DataStoreTestMixin(object):
         "IndexRemoveKeywordsForName",
         "MultiDeleteAttributes",
         "MultiDestroyFlowStates",
+        "MultiReadCompletedRequests",
         "MultiResolvePrefix",
         "MultiSet",
         "ReadBlob",
@@ -1492,6 +1494,258 @@ class DataStoreTestMixin(object):
     stored, _ = data_store.DB.Resolve(self.test_row, predicate)
     self.assertIsNone(stored)
 
+  def testPoolCoalescesSetsForTheSameSubject(self):
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate1", "hello", timestamp=1000)
+    pool.Set(self.test_row, "metadata:predicate1", "world", timestamp=1000)
+    pool.Set(self.test_row, "metadata:predicate2", "foo", timestamp=1000)
+
+    with mock.patch.object(
+        data_store.DB, "MultiSet", wraps=data_store.DB.MultiSet) as multi_set:
+      pool.Flush()
+      self.assertEqual(multi_set.call_count, 1)
+
+    values = data_store.DB.ResolvePrefix(
+        self.test_row,
+        "metadata:",
+        timestamp=data_store.DB.ALL_TIMESTAMPS)
+    self.assertEqual(
+        sorted(values), [("metadata:predicate1", "world", 1000),
+                         ("metadata:predicate2", "foo", 1000)])
+
+  @DeletionTest
+  def testPoolCoalescingPreservesMutationOrder(self):
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate1", "hello", timestamp=1000)
+    # This deletes the value set above, it can't be merged into the same
+    # MultiSet call.
+    pool.MultiSet(
+        self.test_row, {"metadata:predicate2": ["foo"]},
+        timestamp=1000,
+        to_delete=["metadata:predicate1"])
+    pool.Flush()
+
+    values = data_store.DB.ResolvePrefix(
+        self.test_row,
+        "metadata:",
+        timestamp=data_store.DB.ALL_TIMESTAMPS)
+    self.assertEqual(values, [("metadata:predicate2", "foo", 1000)])
+
+  @DeletionTest
+  def testPoolDropsAttributeDeletionsForDeletedSubjects(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+
+    pool = data_store.DB.GetMutationPool()
+    pool.DeleteAttributes(self.test_row, ["metadata:predicate"])
+    pool.DeleteSubject(self.test_row)
+    pool.DeleteSubject(self.test_row)
+
+    with mock.patch.object(
+        data_store.DB, "DeleteAttributes",
+        wraps=data_store.DB.DeleteAttributes) as delete_attributes:
+      pool.Flush()
+      self.assertFalse(delete_attributes.called)
+
+    stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate")
+    self.assertIsNone(stored)
+
+  def testPoolAsyncFlush(self):
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate1", "hello")
+    pool.Flush(wait=False)
+    pool.Set(self.test_row, "metadata:predicate2", "world")
+
+    # Waits for the asynchronously flushed mutations as well.
+    pool.Flush()
+
+    stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate1")
+    self.assertEqual(stored, "hello")
+    stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate2")
+    self.assertEqual(stored, "world")
+    self.assertFalse(pool.pending_batches)
+
+  def testPoolAsyncFlushErrorsAreRaisedOnWait(self):
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate", "hello")
+    with mock.patch.object(
+        data_store.DB, "MultiSet", side_effect=data_store.Error("Boom")):
+      pool.Flush(wait=False)
+      with self.assertRaises(data_store.Error):
+        pool.Flush()
+
+  def testPoolAsyncFlushErrorsAreRaisedByTheBatch(self):
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate", "hello")
+    with mock.patch.object(
+        data_store.DB, "MultiSet", side_effect=data_store.Error("Boom")):
+      batch = pool.Flush(wait=False)
+      with self.assertRaises(data_store.Error):
+        batch.Wait()
+
+    # The error was handled by the caller that queued the batch.
+    pool.Flush()
+
+  def testPoolAsyncFlushErrorsKeepLaterMutations(self):
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate1", "hello")
+    with mock.patch.object(
+        data_store.DB, "MultiSet", side_effect=data_store.Error("Boom")):
+      pool.Flush(wait=False).done.wait()
+
+    pool.Set(self.test_row, "metadata:predicate2", "world")
+    with self.assertRaises(data_store.AsyncFlushError):
+      pool.Flush()
+
+    # The mutations queued after the failed batch are written by the next
+    # Flush.
+    pool.Flush()
+    stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate2")
+    self.assertEqual(stored, "world")
+
+  def testPoolBarrierRaisesErrorsOfAllBatches(self):
+    release = threading.Event()
+    errors = [data_store.Error("Second"), data_store.Error("First")]
+
+    def MultiSet(*unused_args, **unused_kwargs):
+      # Keeps the first batch pending while the barrier Flush() starts.
+      release.wait()
+      raise errors.pop()
+
+    pool = data_store.DB.GetMutationPool()
+    pool.Set(self.test_row, "metadata:predicate1", "hello")
+    with mock.patch.object(data_store.DB, "MultiSet", side_effect=MultiSet):
+      first = pool.Flush(wait=False)
+      pool.Set(self.test_row, "metadata:predicate2", "world")
+
+      timer = threading.Timer(0.1, release.set)
+      timer.start()
+      self.addCleanup(timer.cancel)
+      with self.assertRaises(data_store.AsyncFlushError) as e:
+        pool.Flush()
+
+    self.assertIn("First", str(e.exception))
+    self.assertIn("Second", str(e.exception))
+    self.assertTrue(first.error_raised)
+    self.assertFalse(pool.pending_batches)
+
+  def testPoolUsesItsDataStore(self):
+    store = mock.MagicMock()
+    pool = data_store.MutationPool(store=store)
+    pool.Set(self.test_row, "metadata:predicate", "hello")
+    pool.Flush()
+    self.assertTrue(store.MultiSet.called)
+
+  def testReadCache(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+
+    hits = stats.STATS.GetMetricValue("datastore_read_cache_hits")
+    misses = stats.STATS.GetMetricValue("datastore_read_cache_misses")
+    with data_store.DB.ReadCache():
+      for _ in range(3):
+        stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate")
+        self.assertEqual(stored, "hello")
+
+      self.assertEqual(
+          stats.STATS.GetMetricValue("datastore_read_cache_hits"), hits + 2)
+      self.assertEqual(
+          stats.STATS.GetMetricValue("datastore_read_cache_misses"), misses + 1)
+
+      # Writes through the data store invalidate the cached reads.
+      data_store.DB.Set(self.test_row, "metadata:predicate", "world")
+      stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate")
+      self.assertEqual(stored, "world")
+
+      with data_store.DB.GetMutationPool() as pool:
+        pool.Set(self.test_row, "metadata:predicate", "foo")
+      values = data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+      self.assertEqual([v for _, v, _ in values], ["foo"])
+
+    # Nothing is cached outside of the context.
+    data_store.DB.Set(self.test_row, "metadata:predicate", "bar")
+    hits = stats.STATS.GetMetricValue("datastore_read_cache_hits")
+    stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate")
+    self.assertEqual(stored, "bar")
+    self.assertEqual(
+        stats.STATS.GetMetricValue("datastore_read_cache_hits"), hits)
+
+  def testReadCacheIsPerThread(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+
+    with data_store.DB.ReadCache() as cache:
+      # Nested contexts share the cache.
+      with data_store.DB.ReadCache() as nested_cache:
+        self.assertIs(nested_cache, cache)
+
+      results = []
+      thread = threading.Thread(
+          target=lambda: results.append(data_store.DB.ReadCache()))
+      thread.start()
+      thread.join()
+      self.assertIsNot(results[0], cache)
+
+      # Writes from other threads invalidate cached results as well.
+      data_store.DB.Resolve(self.test_row, "metadata:predicate")
+      thread = threading.Thread(target=lambda: data_store.DB.Set(
+          self.test_row, "metadata:predicate", "world"))
+      thread.start()
+      thread.join()
+      stored, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate")
+      self.assertEqual(stored, "world")
+
+  def testReadCacheIsBounded(self):
+    subjects = ["aff4:/row%d" % i for i in range(3)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject)
+
+    with test_lib.ConfigOverrider({"Datastore.read_cache_size": 2}):
+      with data_store.DB.ReadCache() as cache:
+        for subject in subjects:
+          data_store.DB.Resolve(subject, "metadata:predicate")
+
+        # The least recently used result was dropped.
+        self.assertEqual(len(cache.results), 2)
+        self.assertItemsEqual(cache.keys_by_subject, subjects[1:])
+
+        misses = stats.STATS.GetMetricValue("datastore_read_cache_misses")
+        stored, _ = data_store.DB.Resolve(subjects[0], "metadata:predicate")
+        self.assertEqual(stored, subjects[0])
+        self.assertEqual(
+            stats.STATS.GetMetricValue("datastore_read_cache_misses"),
+            misses + 1)
+
+  def testReadCacheInvalidationForgetsAllSubjectsOfAResult(self):
+    subjects = ["aff4:/row%d" % i for i in range(2)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject)
+
+    with data_store.DB.ReadCache() as cache:
+      list(data_store.DB.MultiResolvePrefix(subjects, "metadata:"))
+      self.assertItemsEqual(cache.keys_by_subject, subjects)
+
+      data_store.DB.Set(subjects[0], "metadata:predicate", "changed")
+      self.assertEqual(len(cache.results), 0)
+      self.assertEqual(cache.keys_by_subject, {})
+
+  @DeletionTest
+  def testReadCacheIsInvalidatedByNotifications(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/W")
+    session_id = rdfvalue.SessionID(flow_name="test")
+    now = rdfvalue.RDFDatetime.Now()
+    end = (now + rdfvalue.Duration("1h")).AsMicrosecondsSinceEpoch()
+    with data_store.DB.ReadCache():
+      self.assertEqual(
+          list(data_store.DB.GetNotifications(queue_shard, end)), [])
+
+      data_store.DB.CreateNotifications(queue_shard, [
+          rdf_flows.GrrNotification(session_id=session_id, timestamp=now)
+      ])
+      notifications = data_store.DB.GetNotifications(queue_shard, end)
+      self.assertEqual([n.session_id for n in notifications], [session_id])
+
+      data_store.DB.DeleteNotifications([queue_shard], [session_id], 0, end)
+      self.assertEqual(
+          list(data_store.DB.GetNotifications(queue_shard, end)), [])
+
   def testQueueManager(self):
     session_id = rdfvalue.SessionID(flow_name="test")
     client_id = test_lib.TEST_CLIENT_ID
@@ -2204,6 +2458,14 @@ class DataStoreBenchmarks(benchmark_test_lib.MicroBenchmarks):
 
   @pytest.mark.benchmark
   def testSimulateFlows(self):
+    self._SimulateFlows(batch_size=1)
+
+  @pytest.mark.benchmark
+  def testSimulateFlowsInBatches(self):
+    """Same as testSimulateFlows but flows are processed in batches."""
+    self._SimulateFlows(batch_size=self.nr_clients)
+
+  def _SimulateFlows(self, batch_size):
     self.flow_ids = []
     self.units = "s"
 
@@ -2227,7 +2489,8 @@ class DataStoreBenchmarks(benchmark_test_lib.MicroBenchmarks):
                    (self.nr_clients,
                     self.nr_dirs * self.files_per_dir), time_used, 1)
 
-    my_worker = worker.GRRWorker(queues=[self.queue], token=self.token)
+    my_worker = worker.GRRWorker(
+        queues=[self.queue], batch_size=batch_size, token=self.token)
 
     start_time = time.time()
 
@@ -2237,7 +2500,8 @@ class DataStoreBenchmarks(benchmark_test_lib.MicroBenchmarks):
 
     time_used = time.time() - start_time
 
-    self.AddResult("Process Messages", time_used, 1)
+    self.AddResult("Process Messages (batch size %d)" % batch_size, time_used,
+                   1)
 
   @pytest.mark.benchmark
   def testMicroBenchmarks(self):
@@ -73,7 +73,7 @@ class FakeDataStore(data_store.DataStore):
         return utils.SmartStr(value)
 
   @utils.Synchronized
-  def DeleteSubject(self, subject, sync=False):
+  def _DeleteSubject(self, subject, sync=False):
     _ = sync
     subject = utils.SmartUnicode(subject)
     try:
@@ -89,13 +89,13 @@ class FakeDataStore(data_store.DataStore):
     return FakeDBSubjectLock(self, subject, lease_time=lease_time)
 
   @utils.Synchronized
-  def Set(self,
-          subject,
-          attribute,
-          value,
-          timestamp=None,
-          replace=True,
-          sync=True):
+  def _SetValue(self,
+                subject,
+                attribute,
+                value,
+                timestamp=None,
+                replace=True,
+                sync=True):
     """Set the value into the data store."""
     subject = utils.SmartUnicode(subject)
 
@@ -116,16 +116,16 @@ class FakeDataStore(data_store.DataStore):
     self.subjects[subject][attribute].sort(key=lambda x: x[1])
 
   @utils.Synchronized
-  def MultiSet(self,
-               subject,
-               values,
-               timestamp=None,
-               replace=True,
-               sync=True,
-               to_delete=None):
+  def _MultiSet(self,
+                subject,
+                values,
+                timestamp=None,
+                replace=True,
+                sync=True,
+                to_delete=None):
     subject = utils.SmartUnicode(subject)
     if to_delete:
-      self.DeleteAttributes(subject, to_delete, sync=sync)
+      self._DeleteAttributes(subject, to_delete, sync=sync)
 
     for k, seq in values.items():
       for v in seq:
@@ -134,7 +134,7 @@ class FakeDataStore(data_store.DataStore):
         else:
           element_timestamp = timestamp
 
-        self.Set(
+        self._SetValue(
             subject,
             k,
             v,
@@ -143,12 +143,12 @@ class FakeDataStore(data_store.DataStore):
             sync=sync)
 
   @utils.Synchronized
-  def DeleteAttributes(self,
-                       subject,
-                       attributes,
-                       start=None,
-                       end=None,
-                       sync=None):
+  def _DeleteAttributes(self,
+                        subject,
+                        attributes,
+                        start=None,
+                        end=None,
+                        sync=None):
     _ = sync  # Unimplemented.
     if isinstance(attributes, basestring):
       raise ValueError(
@@ -214,7 +214,7 @@ class FakeDataStore(data_store.DataStore):
         yield (s, results)
 
   @utils.Synchronized
-  def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
+  def _ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
     subject = utils.SmartUnicode(subject)
 
     # Does timestamp represent a range?
@@ -270,16 +270,16 @@ class FakeDataStore(data_store.DataStore):
         yield (attribute, data, ts)
 
   @utils.Synchronized
-  def MultiResolvePrefix(self,
-                         subjects,
-                         attribute_prefix,
-                         timestamp=None,
-                         limit=None):
+  def _MultiResolvePrefix(self,
+                          subjects,
+                          attribute_prefix,
+                          timestamp=None,
+                          limit=None):
     unicode_to_orig = {utils.SmartUnicode(s): s for s in subjects}
     result = {}
     for unicode_subject, orig_subject in unicode_to_orig.iteritems():
 
-      values = self.ResolvePrefix(
+      values = self._ResolvePrefix(
           unicode_subject, attribute_prefix, timestamp=timestamp, limit=limit)
 
       if not values:
@@ -301,8 +301,8 @@ class FakeDataStore(data_store.DataStore):
     pass
 
   @utils.Synchronized
-  def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
-                    limit=None):
+  def _ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                     limit=None):
     """Resolve all attributes for a subject starting with a prefix."""
     subject = utils.SmartUnicode(subject)
 
@@ -5,6 +5,7 @@
 import logging
 import os
 import Queue
+import re
 import thread
 import threading
 import time
@@ -23,6 +24,11 @@ from grr.server import data_store
 # We use INSERT IGNOREs which generate useless duplicate entry warnings.
 filterwarnings("ignore", category=MySQLdb.Warning, message=r"Duplicate entry.*")
 
+# Subjects of collection items, see DataStore.CollectionMakeURN. These are
+# stored in the `collections` table instead of the generic `aff4` table.
+_COLLECTION_ITEM_RE = re.compile(
+    r"^(.+)/Results/([0-9a-f]{16})\.([0-9a-f]{6})$")
+
 
 # pylint: disable=nonstandard-exception
 class Error(data_store.Error):
@@ -164,6 +170,7 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     self.to_replace = []
     self.to_insert = []
+    self.to_replace_collection_items = []
     self._CalculateAttributeStorageTypes()
     self.buffer_lock = threading.RLock()
     self.lock = threading.RLock()
@@ -171,6 +178,8 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     self.max_query_size = config.CONFIG["Mysql.max_query_size"]
     self.max_values_per_query = config.CONFIG["Mysql.max_values_per_query"]
     self.max_retries = config.CONFIG["Mysql.max_retries"]
+    self.collection_scan_page_size = config.CONFIG[
+        "Mysql.collection_scan_page_size"]
 
     super(MySQLAdvancedDataStore, self).__init__()
 
@@ -182,6 +191,16 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       logging.debug("Recreating Tables")
       self.RecreateTables()
 
+    try:
+      self.ExecuteQuery("desc `collections`")
+    except MySQLdb.Error:
+      # Databases created before collection items got their own table.
+      self._CreateTables()
+      logging.warning("Created the collections table. Items of existing "
+                      "collections are read from the aff4 table until they "
+                      "are moved with `grr_config_updater "
+                      "migrate_collections`.")
+
   @classmethod
   def SetupTestDB(cls):
     super(MySQLAdvancedDataStore, cls).SetupTestDB()
@@ -230,12 +249,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       return -1
     return int(result[0]["size"])
 
-  def DeleteAttributes(self,
-                       subject,
-                       attributes,
-                       start=None,
-                       end=None,
-                       sync=True):
+  def _DeleteAttributes(self,
+                        subject,
+                        attributes,
+                        start=None,
+                        end=None,
+                        sync=True):
     """Remove some attributes from a subject."""
     _ = sync  # Unused
     if not attributes:
@@ -251,12 +270,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       queries = self._BuildDelete(subject, attribute, timestamp)
       self._ExecuteQueries(queries)
 
-  def DeleteSubject(self, subject, sync=False):
+  def _DeleteSubject(self, subject, sync=False):
     _ = sync
     queries = self._BuildDelete(subject)
     self._ExecuteQueries(queries)
 
-  def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
+  def _ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
     """Resolves multiple attributes at once for one subject."""
     for attribute in attributes:
       query, args = self._BuildQuery(subject, attribute, timestamp, limit)
@@ -273,16 +292,16 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if limit is not None and limit <= 0:
         break
 
-  def MultiResolvePrefix(self,
-                         subjects,
-                         attribute_prefix,
-                         timestamp=None,
-                         limit=None):
+  def _MultiResolvePrefix(self,
+                          subjects,
+                          attribute_prefix,
+                          timestamp=None,
+                          limit=None):
     """Result multiple subjects using one or more attribute regexps."""
     result = {}
 
     for subject in subjects:
-      values = self.ResolvePrefix(
+      values = self._ResolvePrefix(
           subject, attribute_prefix, timestamp=timestamp, limit=limit)
 
       if values:
@@ -295,8 +314,8 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return result.iteritems()
 
-  def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
-                    limit=None):
+  def _ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                     limit=None):
     """ResolvePrefix."""
     if isinstance(attribute_prefix, basestring):
       attribute_prefix = [attribute_prefix]
@@ -322,6 +341,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     subject_prefix = utils.SmartStr(rdfvalue.RDFURN(subject_prefix))
     if subject_prefix[-1] != "/":
       subject_prefix += "/"
+
+    collection_items = []
+    if attribute == data_store.DataStore.COLLECTION_ATTRIBUTE:
+      collection_items = self._ScanCollectionItems(
+          subject_prefix, after_urn=after_urn, limit=limit)
+
     subject_prefix += "%"
 
     query = """
@@ -348,6 +373,68 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       args.append(limit)
 
     results, _ = self.ExecuteQuery(query, args)
+    if collection_items:
+      return list(results) + collection_items
+    return results
+
+  def _ScanCollectionItems(self, subject_prefix, after_urn=None, limit=None):
+    """Scans the collections table for items stored below subject_prefix.
+
+    Args:
+      subject_prefix: Subject prefix ending with a "/".
+      after_urn: Only items with a subject greater than this are returned.
+      limit: Maximum number of items to return.
+
+    Returns:
+      A list of rows in the format returned by _ScanAttribute.
+    """
+    # Items are stored as <collection_id>/Results/<timestamp>.<suffix> so they
+    # are below the prefix if their collection is or if the prefix is the
+    # Results directory of their collection. The "/" + 1 upper bound keeps
+    # the collection_id index usable.
+    collection_prefix = subject_prefix[:-1]
+    criteria = [
+        "collection_id=%s", "(collection_id>=%s AND collection_id<%s)"
+    ]
+    args = [
+        collection_prefix, collection_prefix + "/", collection_prefix + "0"
+    ]
+    if subject_prefix.endswith("/Results/"):
+      criteria.append("collection_id=%s")
+      args.append(subject_prefix[:-len("/Results/")])
+
+    query = ("SELECT collection_id, timestamp, suffix, value FROM collections "
+             "WHERE (%s)" % " OR ".join(criteria))
+
+    after_item = None
+    if after_urn:
+      after_item = self._ParseCollectionItemSubject(after_urn)
+    if after_item is not None:
+      query += (" AND (collection_id>%s OR (collection_id=%s AND "
+                "(timestamp>%s OR (timestamp=%s AND suffix>%s))))")
+      after_collection_id, after_timestamp, after_suffix = after_item
+      args.extend([
+          after_collection_id, after_collection_id, after_timestamp,
+          after_timestamp, after_suffix
+      ])
+
+    query += " ORDER BY collection_id, timestamp, suffix"
+    if limit and (after_item is not None or not after_urn):
+      query += " LIMIT %s"
+      args.append(limit)
+
+    rows, _ = self.ExecuteQuery(query, args)
+
+    results = []
+    for row in rows:
+      subject = "%s/Results/%016x.%06x" % (utils.SmartStr(
+          row["collection_id"]), row["timestamp"], row["suffix"])
+      if after_urn and subject <= after_urn:
+        continue
+      results.append(
+          dict(subject=subject, timestamp=row["timestamp"], value=row["value"]))
+      if limit and len(results) >= limit:
+        break
     return results
 
   def ScanAttributes(self,
@@ -385,13 +472,208 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if max_records and result_count >= max_records:
         return
 
-  def MultiSet(self,
-               subject,
-               values,
-               timestamp=None,
-               replace=True,
-               sync=True,
-               to_delete=None):
+  def _ParseCollectionItemSubject(self, subject):
+    """Returns (collection_id, timestamp, suffix) for collection item subjects.
+
+    Args:
+      subject: The subject to parse.
+
+    Returns:
+      The tuple (collection_id, timestamp, suffix) or None if the subject does
+      not belong to an item stored by DataStore.CollectionAddItem.
+    """
+    match = _COLLECTION_ITEM_RE.match(utils.SmartUnicode(subject))
+    if not match:
+      return None
+    return (match.group(1), int(match.group(2), 16), int(match.group(3), 16))
+
+  def CollectionScanItems(self,
+                          collection_id,
+                          rdf_type,
+                          after_timestamp=None,
+                          after_suffix=None,
+                          limit=None):
+    """Scans the collections table one (timestamp, suffix) keyed page at a time.
+
+    Each page continues right after the last item of the previous page, so the
+    cost of a page does not depend on how far into the collection it is.
+
+    Collections with items that were not migrated from the aff4 table yet are
+    scanned through ScanAttribute, which reads both tables.
+    """
+    if self._HasLegacyCollectionItems(collection_id):
+      for result in super(MySQLAdvancedDataStore, self).CollectionScanItems(
+          collection_id,
+          rdf_type,
+          after_timestamp=after_timestamp,
+          after_suffix=after_suffix,
+          limit=limit):
+        yield result
+      return
+
+    collection_id = utils.SmartUnicode(collection_id)
+    last_key = None
+    if after_timestamp:
+      last_key = (int(after_timestamp),
+                  after_suffix or self.COLLECTION_MAX_SUFFIX)
+
+    remaining = limit
+    while remaining is None or remaining > 0:
+      page_size = self.collection_scan_page_size
+      if remaining is not None:
+        page_size = min(page_size, remaining)
+
+      query = ("SELECT timestamp, suffix, value FROM collections "
+               "WHERE collection_hash=unhex(md5(%s))")
+      args = [collection_id]
+      if last_key is not None:
+        query += " AND (timestamp > %s OR (timestamp = %s AND suffix > %s))"
+        args.extend([last_key[0], last_key[0], last_key[1]])
+      query += " ORDER BY timestamp, suffix LIMIT %s"
+      args.append(page_size)
+
+      rows, _ = self.ExecuteQuery(query, args)
+      for row in rows:
+        item = rdf_type.FromSerializedString(
+            self._Decode(self.COLLECTION_ATTRIBUTE, row["value"]))
+        item.age = row["timestamp"]
+        yield (item, row["timestamp"], row["suffix"])
+
+      if len(rows) < page_size:
+        return
+
+      last_key = (rows[-1]["timestamp"], rows[-1]["suffix"])
+      if remaining is not None:
+        remaining -= len(rows)
+
+  def _HasLegacyCollectionItems(self, collection_id):
+    """Checks for items of the collection still stored in the aff4 table."""
+    prefix = utils.SmartUnicode(collection_id) + u"/Results/"
+    # All subjects starting with prefix, "/" + 1 is the first character after
+    # "/". This is a range on the subject index.
+    rows, _ = self.ExecuteQuery(
+        "SELECT 1 FROM subjects WHERE subject>=%s AND subject<%s LIMIT 1",
+        [prefix, prefix[:-1] + u"0"])
+    return bool(rows)
+
+  def CollectionReadItems(self, records):
+    """Reads collection items from the collections table."""
+    other_records = []
+    items = []
+    for record in records:
+      if record.subpath == "Results":
+        items.append(record)
+      else:
+        other_records.append(record)
+
+    for batch in utils.Grouper(items, self.max_values_per_query):
+      query = ("SELECT collection_id, timestamp, suffix, value "
+               "FROM collections WHERE " + " OR ".join([
+                   "(collection_hash=unhex(md5(%s)) AND timestamp=%s AND "
+                   "suffix=%s)"
+               ] * len(batch)))
+      args = []
+      for record in batch:
+        args.extend([
+            utils.SmartUnicode(record.queue_id), record.timestamp, record.suffix
+        ])
+
+      rows, _ = self.ExecuteQuery(query, args)
+      found = set()
+      for row in rows:
+        found.add((utils.SmartUnicode(row["collection_id"]), row["timestamp"],
+                   row["suffix"]))
+        yield (self._Decode(self.COLLECTION_ATTRIBUTE, row["value"]),
+               row["timestamp"])
+
+      # Items that were not migrated from the aff4 table yet.
+      for record in batch:
+        if (utils.SmartUnicode(record.queue_id), record.timestamp,
+            record.suffix) not in found:
+          other_records.append(record)
+
+    if other_records:
+      for result in super(MySQLAdvancedDataStore,
+                          self).CollectionReadItems(other_records):
+        yield result
+
+  def MigrateCollections(self, batch_size=None):
+    """Moves collection items stored in the aff4 table to the collections table.
+
+    Collections written before the collections table existed keep their items
+    in the aff4 table. They can still be read, but scanning them needs the
+    slower aff4 table queries until they are migrated. Migrated rows are
+    removed from the aff4 table in the same transaction, so the migration can
+    be interrupted and restarted at any time.
+
+    Args:
+      batch_size: Number of aff4 rows migrated per transaction. Defaults to
+                  Mysql.max_values_per_query.
+
+    Returns:
+      The number of migrated collection items.
+    """
+    batch_size = batch_size or self.max_values_per_query
+    query = ("SELECT aff4.id, aff4.value, subjects.subject FROM aff4 "
+             "JOIN subjects ON aff4.subject_hash=subjects.hash "
+             "WHERE aff4.attribute_hash=unhex(md5(%s)) AND aff4.id > %s "
+             "ORDER BY aff4.id LIMIT %s")
+
+    last_id = 0
+    migrated_count = 0
+    while True:
+      rows, _ = self.ExecuteQuery(
+          query, [self.COLLECTION_ATTRIBUTE, last_id, batch_size])
+      if not rows:
+        break
+      last_id = rows[-1]["id"]
+
+      ids = []
+      subjects = set()
+      collection_items = []
+      for row in rows:
+        collection_item = self._ParseCollectionItemSubject(row["subject"])
+        # Queue records use the same attribute and stay where they are.
+        if collection_item is None:
+          continue
+
+        ids.append(row["id"])
+        subjects.add(utils.SmartUnicode(row["subject"]))
+        value = self._Decode(self.COLLECTION_ATTRIBUTE, row["value"])
+        collection_items.append(list(collection_item) + [self._Encode(value)])
+
+      if not ids:
+        continue
+
+      transaction = self._BuildCollectionReplaces(collection_items)
+      transaction.append({
+          "query": "DELETE FROM aff4 WHERE id IN (%s)" % ", ".join(
+              ["%s"] * len(ids)),
+          "args": ids
+      })
+      transaction.append({
+          "query": "DELETE subjects FROM subjects LEFT JOIN aff4 ON "
+                   "aff4.subject_hash=subjects.hash "
+                   "WHERE subjects.hash IN (%s) "
+                   "AND aff4.subject_hash IS NULL" % ", ".join(
+                       ["unhex(md5(%s))"] * len(subjects)),
+          "args": list(subjects)
+      })
+      self._ExecuteTransaction(transaction)
+      self._InvalidateReadCaches(subjects)
+
+      migrated_count += len(ids)
+      logging.info("Migrated %d collection items.", migrated_count)
+
+    return migrated_count
+
+  def _MultiSet(self,
+                subject,
+                values,
+                timestamp=None,
+                replace=True,
+                sync=True,
+                to_delete=None):
     """Set multiple attributes' values for this subject in one operation."""
     to_delete = set(to_delete or [])
 
@@ -399,8 +681,19 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     subject = utils.SmartUnicode(subject)
     to_insert = []
     to_replace = []
+    to_replace_collection_items = []
     transaction = []
 
+    collection_item = self._ParseCollectionItemSubject(subject)
+    if (collection_item is not None and
+        data_store.DataStore.COLLECTION_ATTRIBUTE in values):
+      values = dict(values)
+      for value in values.pop(data_store.DataStore.COLLECTION_ATTRIBUTE):
+        if isinstance(value, tuple):
+          value = value[0]
+        to_replace_collection_items.append(
+            list(collection_item) + [self._Encode(value)])
+
     # Build a document for each unique timestamp.
     for attribute, sequence in values.items():
       for value in sequence:
@@ -434,13 +727,16 @@ class MySQLAdvancedDataStore(data_store.DataStore):
           to_insert.append([subject, attribute, data, entry_timestamp])
 
     if to_delete:
-      self.DeleteAttributes(subject, to_delete)
+      self._DeleteAttributes(subject, to_delete)
 
     if sync:
       if to_replace:
         transaction.extend(self._BuildReplaces(to_replace))
       if to_insert:
         transaction.extend(self._BuildInserts(to_insert))
+      if to_replace_collection_items:
+        transaction.extend(
+            self._BuildCollectionReplaces(to_replace_collection_items))
       if transaction:
         self._ExecuteTransaction(transaction)
     else:
@@ -450,6 +746,9 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if to_insert:
         with self.buffer_lock:
           self.to_insert.extend(to_insert)
+      if to_replace_collection_items:
+        with self.buffer_lock:
+          self.to_replace_collection_items.extend(to_replace_collection_items)
 
   def _CountExistingRows(self, subject, attribute):
     query = ("SELECT count(*) AS total FROM aff4 "
@@ -478,14 +777,19 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     with self.buffer_lock:
       to_insert = self.to_insert
       to_replace = self.to_replace
+      to_replace_collection_items = self.to_replace_collection_items
       self.to_replace = []
       self.to_insert = []
+      self.to_replace_collection_items = []
 
     transaction = []
     if to_replace:
       transaction.extend(self._BuildReplaces(to_replace))
     if to_insert:
       transaction.extend(self._BuildInserts(to_insert))
+    if to_replace_collection_items:
+      transaction.extend(
+          self._BuildCollectionReplaces(to_replace_collection_items))
     if transaction:
       self._ExecuteTransaction(transaction)
 
@@ -566,6 +870,36 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     result_queries.extend([attributes_q, subjects_q])
     return result_queries
 
+  def _BuildCollectionReplaceQuery(self, args):
+    return ("REPLACE INTO collections (collection_hash, timestamp, suffix, "
+            "collection_id, value) VALUES") + ", ".join(
+                ["(unhex(md5(%s)), %s, %s, %s, unhex(%s))"] * (len(args) / 5))
+
+  def _BuildCollectionReplaces(self, values):
+    result_queries = []
+    current_args = []
+    total_value_len = 0
+    max_args = self.max_values_per_query * 5
+    for (collection_id, timestamp, suffix, value) in values:
+      current_args.extend([collection_id, timestamp, suffix, collection_id,
+                           value])
+      total_value_len += len(value)
+      if (total_value_len > self.max_query_size or
+          len(current_args) >= max_args):
+        result_queries.append(
+            dict(
+                query=self._BuildCollectionReplaceQuery(current_args),
+                args=current_args))
+        current_args = []
+        total_value_len = 0
+
+    if current_args:
+      result_queries.append(
+          dict(
+              query=self._BuildCollectionReplaceQuery(current_args),
+              args=current_args))
+    return result_queries
+
   def _RetryWrapper(self, action_fn):
     for _ in xrange(self.max_retries):
       # Connectivity issues and deadlocks should not cause threads to die and
@@ -732,6 +1066,22 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         "args": [subject]
     }
 
+    collection_item = self._ParseCollectionItemSubject(subject)
+    collections_q = None
+    if collection_item is not None and (
+        not attribute or attribute == self.COLLECTION_ATTRIBUTE):
+      collection_id, item_timestamp, suffix = collection_item
+      collections_q = {
+          "query": "DELETE collections FROM collections "
+                   "WHERE collection_hash=unhex(md5(%s)) "
+                   "AND timestamp=%s AND suffix=%s",
+          "args": [collection_id, item_timestamp, suffix]
+      }
+      if isinstance(timestamp, (tuple, list)):
+        collections_q["query"] += " AND timestamp >= %s AND timestamp <= %s"
+        collections_q["args"].append(int(timestamp[0]))
+        collections_q["args"].append(int(timestamp[1]))
+
     if attribute:
       aff4_q["query"] += " AND attribute_hash=unhex(md5(%s))"
       aff4_q["args"].append(attribute)
@@ -750,10 +1100,14 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       }
       # If only attribute is being deleted we will not check to clean up
       # subject and lock tables.
+      if collections_q:
+        return [aff4_q, attributes_q, collections_q]
       return [aff4_q, attributes_q]
     # If a subject is being deleted we clean up the locks and subjects table
     # but assume it has attributes that are common to other subjects
 
+    if collections_q:
+      return [aff4_q, locks_q, subjects_q, collections_q]
     return [aff4_q, locks_q, subjects_q]
 
   def _MakeTimestamp(self, start=None, end=None):
@@ -815,6 +1169,19 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     COMMENT ='Table representing locks on subjects';
     """)
 
+    self.ExecuteQuery("""
+    CREATE TABLE IF NOT EXISTS `collections` (
+      collection_hash BINARY(16) NOT NULL,
+      timestamp BIGINT UNSIGNED NOT NULL,
+      suffix INT UNSIGNED NOT NULL,
+      collection_id TEXT CHARACTER SET utf8 NOT NULL,
+      value MEDIUMBLOB NULL,
+      PRIMARY KEY (`collection_hash`,`timestamp`,`suffix`),
+      KEY `collection_id` (`collection_id`(96))
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+    COMMENT ='Table storing the items of sequential collections';
+    """)
+
 
 class MySQLDBSubjectLock(data_store.DBSubjectLock):
   """The Mysql data store lock object.
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 """Benchmark tests for MySQL advanced data store."""
 
+import time
+
+import pytest
 
 from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.server import data_store
 from grr.server import data_store_test
 from grr.server.data_stores import mysql_advanced_data_store_test
+from grr.test_lib import benchmark_test_lib
 from grr.test_lib import test_lib
 
 
@@ -20,6 +26,49 @@ class MysqlAdvancedDataStoreCSVBenchmarks(
   """Benchmark the mysql data store abstraction."""
 
 
+class MysqlAdvancedCollectionBenchmarks(
+    mysql_advanced_data_store_test.MysqlAdvancedTestMixin,
+    benchmark_test_lib.MicroBenchmarks):
+  """Benchmark scanning collections stored in the collections table."""
+
+  units = "s"
+
+  RECORDS = 50000
+  PAGE_SIZE = 1000
+
+  @pytest.mark.benchmark
+  def testCollectionScan(self):
+    urn = rdfvalue.RDFURN("aff4:/test_collection_scan")
+    collection = data_store_test.StringSequentialCollection(urn)
+
+    start_time = time.time()
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(self.RECORDS):
+        collection.Add(
+            rdfvalue.RDFString("%08d" % i), timestamp=i + 1,
+            mutation_pool=pool)
+    elapsed_time = time.time() - start_time
+    self.AddResult("Coll. Add", elapsed_time, self.RECORDS)
+
+    start_time = time.time()
+    for _ in collection.Scan():
+      pass
+    elapsed_time = time.time() - start_time
+    self.AddResult("Coll. full scan", elapsed_time, 1)
+
+    # Page through the collection the way the API pages through hunt results.
+    # With keyset pagination late pages should cost the same as early ones.
+    for offset in [0, self.RECORDS / 2, self.RECORDS - self.PAGE_SIZE]:
+      start_time = time.time()
+      count = len(
+          list(
+              collection.Scan(
+                  after_timestamp=offset, max_records=self.PAGE_SIZE)))
+      elapsed_time = time.time() - start_time
+      self.assertEqual(count, self.PAGE_SIZE)
+      self.AddResult("Coll. page at offset %d" % offset, elapsed_time, 1)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -2,6 +2,8 @@
 """Tests the mysql data store."""
 
 from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.server import data_store
 from grr.server import data_store_test
 from grr.server.data_stores import mysql_advanced_data_store
@@ -35,6 +37,103 @@ class MysqlAdvancedDataStoreTest(data_store_test.DataStoreTestMixin,
         (int(version_major) == 5 and int(version_minor) <= 5)):
       self.fail("GRR needs MySQL >= 5.6")
 
+  def _CountRows(self, table):
+    results, _ = data_store.DB.ExecuteQuery(
+        "SELECT count(*) AS total FROM `%s`" % table)
+    return int(results[0]["total"])
+
+  def testCollectionItemsAreStoredInCollectionsTable(self):
+    urn = rdfvalue.RDFURN("aff4:/test_collection")
+    collection = data_store_test.StringSequentialCollection(urn)
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(10):
+        collection.Add(rdfvalue.RDFString(str(i)), mutation_pool=pool)
+
+    self.assertEqual(self._CountRows("collections"), 10)
+    results, _ = data_store.DB.ExecuteQuery(
+        "SELECT count(*) AS total FROM aff4 "
+        "WHERE attribute_hash=unhex(md5(%s))",
+        [data_store.DataStore.COLLECTION_ATTRIBUTE])
+    self.assertEqual(int(results[0]["total"]), 0)
+
+    # Scanning the attribute still finds the items in the collections table.
+    subjects = [
+        subject
+        for subject, _, _ in data_store.DB.ScanAttribute(
+            urn.Add("Results"), data_store.DataStore.COLLECTION_ATTRIBUTE)
+    ]
+    self.assertEqual(len(subjects), 10)
+    for subject in subjects:
+      self.assertTrue(subject.startswith(utils.SmartStr(urn.Add("Results"))))
+
+    self.assertEqual([str(v) for _, v in collection.Scan()],
+                     [str(i) for i in range(10)])
+
+    collection.Delete()
+    self.assertEqual(self._CountRows("collections"), 0)
+
+  def testCollectionScanItemsPaging(self):
+    urn = rdfvalue.RDFURN("aff4:/test_collection")
+    collection = data_store_test.StringSequentialCollection(urn)
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(25):
+        collection.Add(
+            rdfvalue.RDFString(str(i)), timestamp=i + 1, suffix=1,
+            mutation_pool=pool)
+
+    with test_lib.ConfigOverrider({"Mysql.collection_scan_page_size": 7}):
+      db = mysql_advanced_data_store.MySQLAdvancedDataStore(
+          database_name=data_store.DB.database_name)
+      items = list(
+          db.CollectionScanItems(urn, rdfvalue.RDFString, after_timestamp=5))
+      self.assertEqual([str(item) for item, _, _ in items],
+                       [str(i) for i in range(5, 25)])
+
+      items = list(
+          db.CollectionScanItems(
+              urn, rdfvalue.RDFString, after_timestamp=5, limit=14))
+      self.assertEqual([str(item) for item, _, _ in items],
+                       [str(i) for i in range(5, 19)])
+
+  def testMigrateCollections(self):
+    urn = rdfvalue.RDFURN("aff4:/test_collection")
+    legacy_rows = []
+    records = []
+    for i in range(10):
+      subject, timestamp, _ = data_store.DataStore.CollectionMakeURN(
+          urn, i + 1, suffix=1)
+      records.append(
+          data_store.Record(
+              queue_id=urn,
+              timestamp=timestamp,
+              suffix=1,
+              subpath="Results",
+              value=None))
+      legacy_rows.append([
+          utils.SmartUnicode(subject),
+          data_store.DataStore.COLLECTION_ATTRIBUTE,
+          rdfvalue.RDFString(str(i)).SerializeToString().encode("hex"),
+          timestamp
+      ])
+    # Write the items the way they were stored before the collections table
+    # existed.
+    # pylint: disable=protected-access
+    data_store.DB._ExecuteTransaction(data_store.DB._BuildInserts(legacy_rows))
+    # pylint: enable=protected-access
+
+    # Items are read from the aff4 table until they are migrated.
+    collection = data_store_test.StringSequentialCollection(urn)
+    self.assertEqual([str(v) for _, v in collection.Scan()],
+                     [str(i) for i in range(10)])
+    self.assertEqual(
+        sorted(str(v) for v in collection.MultiResolve(records)),
+        [str(i) for i in range(10)])
+
+    self.assertEqual(data_store.DB.MigrateCollections(batch_size=3), 10)
+    self.assertEqual([str(v) for _, v in collection.Scan()],
+                     [str(i) for i in range(10)])
+    self.assertEqual(data_store.DB.MigrateCollections(), 0)
+
 
 def main(args):
   test_lib.main(args)
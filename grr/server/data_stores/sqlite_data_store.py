@@ -646,13 +646,13 @@ class SqliteDataStore(data_store.DataStore):
     else:
       return value
 
-  def MultiSet(self,
-               subject,
-               values,
-               timestamp=None,
-               replace=True,
-               sync=True,
-               to_delete=None):
+  def _MultiSet(self,
+                subject,
+                values,
+                timestamp=None,
+                replace=True,
+                sync=True,
+                to_delete=None):
     """Set multiple values at once."""
     # All operations are synchronized.
     _ = sync
@@ -683,12 +683,12 @@ class SqliteDataStore(data_store.DataStore):
           sqlite_connection.SetAttribute(subject, attribute, value,
                                          element_timestamp)
 
-  def DeleteAttributes(self,
-                       subject,
-                       attributes,
-                       start=None,
-                       end=None,
-                       sync=True):
+  def _DeleteAttributes(self,
+                        subject,
+                        attributes,
+                        start=None,
+                        end=None,
+                        sync=True):
     """Remove some attributes from a subject."""
     _ = sync
 
@@ -710,23 +710,23 @@ class SqliteDataStore(data_store.DataStore):
         for attribute in list(attributes):
           sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
 
-  def DeleteSubject(self, subject, sync=False):
+  def _DeleteSubject(self, subject, sync=False):
     _ = sync
 
     with self.cache.Get(subject) as sqlite_connection:
       sqlite_connection.DeleteSubject(subject)
 
-  def MultiResolvePrefix(self,
-                         subjects,
-                         attribute_prefix,
-                         timestamp=None,
-                         limit=None):
+  def _MultiResolvePrefix(self,
+                          subjects,
+                          attribute_prefix,
+                          timestamp=None,
+                          limit=None):
     """Result multiple subjects using one or more attribute prefixes."""
     result = {}
 
     remaining_limit = limit
     for subject in subjects:
-      values = self.ResolvePrefix(
+      values = self._ResolvePrefix(
           subject, attribute_prefix, timestamp=timestamp, limit=remaining_limit)
 
       if values:
@@ -753,8 +753,8 @@ class SqliteDataStore(data_store.DataStore):
       except ValueError:
         return timestamp, timestamp
 
-  def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
-                    limit=None):
+  def _ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                     limit=None):
     """Resolve all attributes for a subject matching a prefix."""
     if isinstance(attribute_prefix, str):
       attribute_prefix = [attribute_prefix]
@@ -863,7 +863,7 @@ class SqliteDataStore(data_store.DataStore):
         sorted(raw_results, key=lambda x: x[0]), max_records):
       yield r
 
-  def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
+  def _ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
     """Resolve multiple attributes for a subject."""
     # Holds all the attributes which matched. Keys are attribute names, values
     # are lists of timestamped data.
@@ -10,6 +10,7 @@ import warnings
 import MySQLdb
 
 from grr.lib import rdfvalue
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import objects
@@ -55,7 +56,18 @@ class MysqlDB(object):
   # TODO(user): Inherit from Database (in server/db.py) once the
   # implementation is complete.
 
-  def __init__(self, host=None, port=None, user=None, passwd=None, db=None):
+  # Maximum number of rows written by a single multi-row INSERT.
+  MAX_ROWS_PER_INSERT = 100
+
+  def __init__(self,
+               host=None,
+               port=None,
+               user=None,
+               passwd=None,
+               db=None,
+               max_pool_size=10,
+               max_connection_lifetime=3600,
+               connection_validation_interval=60):
     """Creates a datastore implementation.
 
     Args:
@@ -64,6 +76,11 @@ class MysqlDB(object):
       user: Passed to MySQLdb.Connect when creating a new connection.
       passwd: Passed to MySQLdb.Connect when creating a new connection.
       db: Passed to MySQLdb.Connect when creating a new connection.
+      max_pool_size: The maximum number of simultaneous connections.
+      max_connection_lifetime: Seconds after which pooled connections are
+        replaced by new ones.
+      connection_validation_interval: Connections idle for longer than this
+        many seconds are pinged before they are reused.
     """
 
     # Turn all SQL warnings into exceptions.
@@ -78,7 +95,11 @@ class MysqlDB(object):
           db=db,
           autocommit=False)
 
-    self.pool = mysql_pool.Pool(Connect)
+    self.pool = mysql_pool.Pool(
+        Connect,
+        max_size=max_pool_size,
+        max_lifetime=max_connection_lifetime,
+        validation_interval=connection_validation_interval)
     self._InitializeSchema()
 
   def _InitializeSchema(self):
@@ -222,6 +243,61 @@ class MysqlDB(object):
       con.close()
       client.startup_info = startup_info
 
+  def WriteClientSnapshotHistory(self, clients):
+    """Writes the full history for a particular client."""
+    db_module.ValidateClientSnapshotHistory(clients)
+
+    int_id = _ClientIDToInt(clients[0].client_id)
+    snapshot_rows = []
+    startup_rows = []
+    for client in clients:
+      startup_info = client.startup_info
+      client.startup_info = None
+      try:
+        timestamp = _RDFDatetimeToMysqlString(client.timestamp)
+        snapshot_rows.append((int_id, timestamp, client.SerializeToString()))
+        startup_rows.append((int_id, timestamp,
+                             startup_info.SerializeToString()))
+      finally:
+        client.startup_info = startup_info
+
+    latest = _RDFDatetimeToMysqlString(
+        max(client.timestamp for client in clients))
+    update_query = (
+        "UPDATE clients SET "
+        "last_client_timestamp = IF(last_client_timestamp IS NULL OR "
+        "last_client_timestamp < %s, %s, last_client_timestamp), "
+        "last_startup_timestamp = IF(last_startup_timestamp IS NULL OR "
+        "last_startup_timestamp < %s, %s, last_startup_timestamp) "
+        "WHERE client_id = %s")
+
+    con = self.pool.get()
+    cursor = con.cursor()
+    try:
+      self._MultiRowInsert(cursor, "client_snapshot_history",
+                           ("client_id", "timestamp", "client_snapshot"),
+                           snapshot_rows)
+      self._MultiRowInsert(cursor, "client_startup_history",
+                           ("client_id", "timestamp", "startup_info"),
+                           startup_rows)
+      cursor.execute(update_query, (latest, latest, latest, latest, int_id))
+      con.commit()
+    except MySQLdb.IntegrityError as e:
+      raise db_module.UnknownClientError(str(e))
+    finally:
+      cursor.close()
+      con.close()
+
+  def _MultiRowInsert(self, cursor, table, columns, rows):
+    """Inserts rows using INSERTs of up to MAX_ROWS_PER_INSERT rows each."""
+    for batch in utils.Grouper(rows, self.MAX_ROWS_PER_INSERT):
+      query = "INSERT INTO {table}({cols}) VALUES {rows}".format(
+          table=table,
+          cols=", ".join(columns),
+          rows=", ".join(["(%s)" % ", ".join(["%s"] * len(columns))] *
+                         len(batch)))
+      cursor.execute(query, [value for row in batch for value in row])
+
   # TODO(amoser): Inherit from db.Database instead.
   def ReadClientSnapshot(self, client_id):
     return self.MultiReadClientSnapshot([client_id])[client_id]
@@ -258,6 +334,53 @@ class MysqlDB(object):
       con.close()
     return ret
 
+  def MultiReadClientFullInfo(self, client_ids):
+    """Reads full client information for a list of clients."""
+    int_ids = [_ClientIDToInt(cid) for cid in client_ids]
+    placeholders = ", ".join(["%s"] * len(int_ids))
+    labels_query = ("SELECT client_id, owner, label FROM client_labels "
+                    "WHERE client_id IN ({}) "
+                    "ORDER BY owner, label").format(placeholders)
+    startup_query = (
+        "SELECT s.client_id, s.startup_info, s.timestamp "
+        "FROM clients as c, client_startup_history as s "
+        "WHERE s.client_id = c.client_id "
+        "AND s.timestamp = c.last_startup_timestamp "
+        "AND c.client_id IN ({})").format(placeholders)
+
+    labels = {cid: [] for cid in client_ids}
+    startup_infos = {}
+    con = self.pool.get()
+    cursor = con.cursor()
+    try:
+      cursor.execute(labels_query, int_ids)
+      for cid, owner, label in cursor.fetchall():
+        labels[_IntToClientID(cid)].append(
+            objects.ClientLabel(owner=owner, name=label))
+
+      cursor.execute(startup_query, int_ids)
+      for cid, startup_info, timestamp in cursor.fetchall():
+        startup_info = _StringToRDFProto(rdf_client.StartupInfo, startup_info)
+        startup_info.timestamp = _MysqlToRDFDatetime(timestamp)
+        startup_infos[_IntToClientID(cid)] = startup_info
+    finally:
+      cursor.close()
+      con.close()
+
+    metadatas = self.MultiReadClientMetadata(client_ids)
+    snapshots = self.MultiReadClientSnapshot(client_ids)
+    ret = {}
+    for client_id in client_ids:
+      ret[client_id] = objects.ClientFullInfo(
+          metadata=metadatas.get(client_id),
+          labels=labels[client_id],
+          last_snapshot=snapshots[client_id],
+          last_startup_info=startup_infos.get(client_id))
+    return ret
+
+  def ReadClientFullInfo(self, client_id):
+    return self.MultiReadClientFullInfo([client_id])[client_id]
+
   def ReadClientSnapshotHistory(self, client_id, timerange=None):
     """Reads the full history for a particular client."""
 
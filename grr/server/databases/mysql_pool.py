@@ -3,9 +3,22 @@
 
 import logging
 import threading
+import time
 
 import MySQLdb
 
+from grr.lib import registry
+from grr.lib import stats
+
+
+class _PooledConnection(object):
+  """An idle connection together with its bookkeeping data."""
+
+  def __init__(self, con):
+    self.con = con
+    self.created = time.time()
+    self.last_used = self.created
+
 
 class Pool(object):
   """A Pool of database connections.
@@ -17,9 +30,17 @@ class Pool(object):
   Intends to be thread safe in that multiple connections can be requested and
   used by multiple threads without synchronization, but operations on each
   connection (and its associated cursors) are assumed to be serial.
+
+  Idle connections are checked before they are handed out: connections older
+  than max_lifetime are replaced by new ones and connections that have been
+  idle for longer than validation_interval are pinged first.
   """
 
-  def __init__(self, connect_func, max_size=10):
+  def __init__(self,
+               connect_func,
+               max_size=10,
+               max_lifetime=None,
+               validation_interval=None):
     """Creates a ConnectionPool.
 
     Args:
@@ -27,8 +48,14 @@ class Pool(object):
        database, i.e. a MySQLdb.Connection. Should raise or block if the
        database is unavailable.
      max_size: The maximum number of simultaneous connections.
+     max_lifetime: If set, the number of seconds after which a connection is
+       closed and replaced instead of being reused.
+     validation_interval: If set, connections that have been idle for more
+       than this many seconds are pinged before they are reused.
     """
     self.connect_func = connect_func
+    self.max_lifetime = max_lifetime
+    self.validation_interval = validation_interval
     self.limiter = threading.BoundedSemaphore(max_size)
     self.idle_conns = []  # Atomic access only!!
 
@@ -45,22 +72,77 @@ class Pool(object):
     # NOTE: Once we acquire capacity from the semaphore, it is essential that we
     # return it eventually. On success, this responsibility is delegated to
     # _ConnectionProxy.
+    start_time = time.time()
     if not self.limiter.acquire(blocking=blocking):
       return None
-    c = None
-    # pop is atomic, but if we did a check first, it would not be atomic with
-    # the pop.
+    stats.STATS.RecordEvent("mysql_pool_wait_time", time.time() - start_time)
+
     try:
-      c = self.idle_conns.pop()
-    except IndexError:
-      # Create a connection, release the pool allocation if it fails.
-      try:
-        c = self.connect_func()
-      except Exception:
-        self.limiter.release()
-        raise
+      c = self._GetIdleConnection()
+      if c is None:
+        # Create a connection, release the pool allocation if it fails.
+        c = _PooledConnection(self.connect_func())
+        stats.STATS.IncrementCounter("mysql_pool_connections_created")
+    except Exception:
+      self.limiter.release()
+      raise
     return _ConnectionProxy(self, c)
 
+  def _GetIdleConnection(self):
+    """Returns a usable idle connection or None if there is none."""
+    while True:
+      # pop is atomic, but if we did a check first, it would not be atomic with
+      # the pop.
+      try:
+        c = self.idle_conns.pop()
+      except IndexError:
+        return None
+
+      now = time.time()
+      if self._Expired(c, now):
+        stats.STATS.IncrementCounter("mysql_pool_connections_recycled")
+        self._CloseQuietly(c.con)
+        continue
+
+      if (self.validation_interval is not None and
+          now - c.last_used > self.validation_interval):
+        try:
+          c.con.ping()
+        except MySQLdb.Error:
+          stats.STATS.IncrementCounter("mysql_pool_validation_failures")
+          self._CloseQuietly(c.con)
+          continue
+
+      return c
+
+  def _Expired(self, c, now):
+    return (self.max_lifetime is not None and
+            now - c.created > self.max_lifetime)
+
+  def _CloseQuietly(self, con):
+    try:
+      con.close()
+    except MySQLdb.Error:
+      pass
+
+  def put(self, c):
+    """Puts an idle connection back into the pool.
+
+    Only meant to be called by _ConnectionProxy, which also releases the pool
+    capacity taken by the connection.
+
+    Args:
+      c: The _PooledConnection to return.
+    """
+    now = time.time()
+    if self._Expired(c, now):
+      stats.STATS.IncrementCounter("mysql_pool_connections_recycled")
+      self._CloseQuietly(c.con)
+      return
+    c.last_used = now
+    # append is atomic.
+    self.idle_conns.append(c)
+
 
 class _ConnectionProxy(object):
   """A proxy/wrapper of the underlying database connection object.
@@ -70,8 +152,9 @@ class _ConnectionProxy(object):
   connection when it may be in an errored state.
   """
 
-  def __init__(self, pool, con):
-    self.con = con
+  def __init__(self, pool, pooled_con):
+    self.pooled_con = pooled_con
+    self.con = pooled_con.con
     self.pool = pool
     self.errored = False
 
@@ -86,8 +169,7 @@ class _ConnectionProxy(object):
         if not self.errored:
           try:
             self.con.rollback()
-            # append is atomic.
-            self.pool.idle_conns.append(self.con)
+            self.pool.put(self.pooled_con)
           except Exception:
             # rollback raised and the connection didn't make it into the idle
             # list, so close it.
@@ -97,6 +179,7 @@ class _ConnectionProxy(object):
           self.con.close()
       finally:
         self.con = None
+        self.pooled_con = None
         self.pool.limiter.release()
 
   def commit(self):
@@ -169,3 +252,16 @@ class _CursorProxy(object):
 
   def setoutputsize(self, size):
     self.cursor.setoutputsize(size)
+
+
+class MySQLPoolInit(registry.InitHook):
+  """Registers the connection pool metrics."""
+
+  def RunOnce(self):
+    stats.STATS.RegisterEventMetric(
+        "mysql_pool_wait_time",
+        bins=[0, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10],
+        units="SECONDS")
+    stats.STATS.RegisterCounterMetric("mysql_pool_connections_created")
+    stats.STATS.RegisterCounterMetric("mysql_pool_connections_recycled")
+    stats.STATS.RegisterCounterMetric("mysql_pool_validation_failures")
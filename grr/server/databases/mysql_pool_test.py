@@ -133,5 +133,52 @@ class TestPool(unittest.TestCase):
         self.assertEqual(1, len(pool.idle_conns))
 
 
+  def testConnectionsAreRecycledAfterMaxLifetime(self):
+    mocks = []
+
+    def gen_mock():
+      c = mock.MagicMock()
+      mocks.append(c)
+      return c
+
+    with mock.patch.object(mysql_pool.time, 'time', return_value=1000):
+      pool = mysql_pool.Pool(gen_mock, max_size=5, max_lifetime=60)
+      pool.get().close()
+      # Reused while still within its lifetime.
+      pool.get().close()
+      self.assertEqual(1, len(mocks))
+      mocks[0].close.assert_not_called()
+
+    with mock.patch.object(mysql_pool.time, 'time', return_value=1061):
+      con = pool.get()
+      self.assertEqual(2, len(mocks))
+      mocks[0].close.assert_called_once_with()
+      con.close()
+
+  def testConnectionsAreReplacedWhenValidationFails(self):
+    mocks = []
+
+    def gen_mock():
+      c = mock.MagicMock()
+      mocks.append(c)
+      return c
+
+    with mock.patch.object(mysql_pool.time, 'time', return_value=1000):
+      pool = mysql_pool.Pool(gen_mock, max_size=5, validation_interval=10)
+      pool.get().close()
+      # Not pinged when it was used recently.
+      pool.get().close()
+      mocks[0].ping.assert_not_called()
+
+    mocks[0].ping.side_effect = MySQLdb.OperationalError('Gone away')
+    with mock.patch.object(mysql_pool.time, 'time', return_value=1011):
+      con = pool.get()
+      mocks[0].ping.assert_called_once_with()
+      mocks[0].close.assert_called_once_with()
+      self.assertEqual(2, len(mocks))
+      con.close()
+      self.assertEqual(1, len(pool.idle_conns))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -181,33 +181,6 @@ class TestMysqlDB(db_test.DatabaseTestMixin, unittest.TestCase):
   def testRemoveClientKeyword(self):
     pass
 
-  def testWriteClientSnapshotHistory(self):
-    pass
-
-  def testWriteClientSnapshotHistoryDoesNotUpdateLastTimestampIfOlder(self):
-    pass
-
-  def testWriteClientSnapshotHistoryRaiseAttributeError(self):
-    pass
-
-  def testWriteClientSnapshotHistoryRaiseOnNonExistingClient(self):
-    pass
-
-  def testWriteClientSnapshotHistoryRaiseTypeError(self):
-    pass
-
-  def testWriteClientSnapshotHistoryRaiseValueErrorOnEmpty(self):
-    pass
-
-  def testWriteClientSnapshotHistoryRaiseValueErrorOnNonUniformIds(self):
-    pass
-
-  def testWriteClientSnapshotHistoryUpdatesLastTimestampIfNewer(self):
-    pass
-
-  def testWriteClientSnapshotHistoryUpdatesLastTimestampIfNotSet(self):
-    pass
-
   def testWriteClientSnapshotHistoryUpdatesOnlyLastClientTimestamp(self):
     pass
 
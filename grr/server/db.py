@@ -32,6 +32,35 @@ class UnknownApprovalRequestError(NotFoundError):
   pass
 
 
+def ValidateClientSnapshotHistory(clients):
+  """Checks the arguments of Database.WriteClientSnapshotHistory.
+
+  Args:
+    clients: The list of client snapshots to write.
+
+  Raises:
+    AttributeError: If some client does not have a `timestamp` attribute.
+    TypeError: If clients are not instances of `objects.ClientSnapshot`.
+    ValueError: If client list is empty or clients have non-uniform ids.
+  """
+  if not clients:
+    raise ValueError("Clients are empty")
+
+  client_id = None
+  for client in clients:
+    if not isinstance(client, objects.ClientSnapshot):
+      message = "Unexpected '%s' instead of client instance"
+      raise TypeError(message % client.__class__)
+
+    if client.timestamp is None:
+      raise AttributeError("Client without a `timestamp` attribute")
+
+    client_id = client_id or client.client_id
+    if client.client_id != client_id:
+      message = "Unexpected client id '%s' instead of '%s'"
+      raise ValueError(message % (client.client_id, client_id))
+
+
 class Database(object):
   """The GRR relational database abstraction."""
   __metaclass__ = abc.ABCMeta
@@ -199,22 +228,7 @@ class Database(object):
       TypeError: If clients are not instances of `objects.ClientSnapshot`.
       ValueError: If client list is empty or clients have non-uniform ids.
     """
-    if not clients:
-      raise ValueError("Clients are empty")
-
-    client_id = None
-    for client in clients:
-      if not isinstance(client, objects.ClientSnapshot):
-        message = "Unexpected '%s' instead of client instance"
-        raise TypeError(message % client.__class__)
-
-      if client.timestamp is None:
-        raise AttributeError("Client without a `timestamp` attribute")
-
-      client_id = client_id or client.client_id
-      if client.client_id != client_id:
-        message = "Unexpected client id '%s' instead of '%s'"
-        raise ValueError(message % (client.client_id, client_id))
+    ValidateClientSnapshotHistory(clients)
 
   @abc.abstractmethod
   def ReadClientSnapshotHistory(self, client_id, timerange=None):
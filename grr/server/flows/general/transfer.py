@@ -2,8 +2,8 @@
 """These flows are designed for high performance transfers."""
 
 import logging
-import zlib
 
+from grr.lib import compression
 from grr.lib import constants
 from grr.lib import rdfvalue
 from grr.lib.rdfvalues import client as rdf_client
@@ -846,14 +846,10 @@ class TransferStore(flow.WellKnownFlow):
       if not data:
         continue
 
-      if (read_buffer.compression ==
-          rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION):
-        data = zlib.decompress(data)
-      elif (read_buffer.compression ==
-            rdf_protodict.DataBlob.CompressionType.UNCOMPRESSED):
-        pass
-      else:
-        raise RuntimeError("Unsupported compression")
+      try:
+        data = compression.Decompress(read_buffer.compression, data)
+      except compression.Error as e:
+        raise RuntimeError("Unsupported compression: %s" % e)
 
       blobs.append(data)
 
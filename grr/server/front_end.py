@@ -3,6 +3,8 @@
 
 import logging
 import operator
+import struct
+import threading
 import time
 
 from grr import config
@@ -13,8 +15,10 @@ from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import access_control
+from grr.server import admission_control
 from grr.server import aff4
 from grr.server import client_index
 from grr.server import data_migration
@@ -24,10 +28,422 @@ from grr.server import events
 from grr.server import flow
 from grr.server import queue_manager
 from grr.server import rekall_profile_server
+from grr.server import shared_cache
 from grr.server import threadpool
 from grr.server.aff4_objects import aff4_grr
 
 
+class ClientPingWriter(object):
+  """Buffers client ping metadata and writes it to the data stores in bulk.
+
+  Every poll updates the last ping time, clock and IP address of the client.
+  Writing these synchronously on every poll makes up most of the write load of
+  large deployments, so only the latest values per client are kept in memory
+  and written out every Frontend.client_ping_flush_interval seconds, or as soon
+  as Frontend.client_ping_max_pending clients are waiting to be written. A
+  frontend crash thus loses at most one interval of ping metadata.
+
+  An interval of 0 disables buffering and writes every ping right away.
+  """
+
+  def __init__(self, write_aff4=True, flush_interval=None, max_pending=None):
+    """Constructor.
+
+    Args:
+      write_aff4: If True, the metadata is also written to the AFF4 client
+        objects. It is always written to the relational db if relational db
+        writes are enabled.
+      flush_interval: Seconds between two flushes, defaults to
+        Frontend.client_ping_flush_interval.
+      max_pending: Number of buffered clients that triggers an immediate
+        flush, defaults to Frontend.client_ping_max_pending.
+    """
+    if flush_interval is None:
+      flush_interval = config.CONFIG["Frontend.client_ping_flush_interval"]
+    if max_pending is None:
+      max_pending = config.CONFIG["Frontend.client_ping_max_pending"]
+
+    self.write_aff4 = write_aff4
+    self.flush_interval = flush_interval
+    self.max_pending = max_pending
+    self.pending = {}
+    self.lock = threading.Lock()
+    # Serializes flushes so an older state can never overwrite a newer one.
+    self.flush_lock = threading.Lock()
+    self.flusher_thread = None
+    # Set to stop the flusher thread.
+    self.flusher_stop = None
+
+  def Record(self,
+             client_id,
+             last_ping=None,
+             last_clock=None,
+             last_ip=None,
+             fleetspeak_enabled=None):
+    """Records the latest ping metadata of a client.
+
+    Args:
+      client_id: A GRR client id string, e.g. "C.ea3b2b71840d6fa7".
+      last_ping: An rdfvalue.RDFDatetime of the last contact with the client.
+      last_clock: An rdfvalue.RDFDatetime of the last client clock reading.
+      last_ip: The source IP address of the last client request as a string.
+      fleetspeak_enabled: A bool, indicating whether the client is connecting
+        through Fleetspeak.
+    """
+    update = dict(
+        last_ping=last_ping,
+        last_clock=last_clock,
+        last_ip=last_ip,
+        fleetspeak_enabled=fleetspeak_enabled)
+
+    with self.lock:
+      state = self.pending.setdefault(client_id, {})
+      for name, value in update.iteritems():
+        if value is not None:
+          state[name] = value
+      num_pending = len(self.pending)
+
+    if self.flush_interval <= 0 or num_pending >= self.max_pending:
+      self.Flush()
+    else:
+      self._StartFlusherThread()
+
+  def GetPendingClock(self, client_id):
+    """Returns the client clock that is still waiting to be written, if any."""
+    with self.lock:
+      return self.pending.get(client_id, {}).get("last_clock")
+
+  def _StartFlusherThread(self):
+    with self.lock:
+      if self.flusher_thread is not None:
+        return
+      self.flusher_stop = threading.Event()
+      self.flusher_thread = threading.Thread(
+          name="Client ping writer thread",
+          target=self._FlushInBackground,
+          args=(self.flusher_stop, self.flush_interval))
+      # Do not hold up program exit.
+      self.flusher_thread.daemon = True
+      self.flusher_thread.start()
+
+  def Stop(self):
+    """Stops the background flushes and writes what is still buffered.
+
+    Pings recorded afterwards are written right away.
+    """
+    with self.lock:
+      self.flush_interval = 0
+      flusher_thread, self.flusher_thread = self.flusher_thread, None
+
+    if flusher_thread is not None:
+      self.flusher_stop.set()
+      flusher_thread.join()
+    self.Flush()
+
+  def _FlushInBackground(self, stop, flush_interval):
+    # Pings are first written one interval after the first one was buffered.
+    while not stop.wait(flush_interval):
+      try:
+        self.Flush()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Failed to write client pings: %s", e)
+
+  def Flush(self):
+    """Writes all buffered ping metadata to the data stores."""
+    with self.flush_lock:
+      with self.lock:
+        pending, self.pending = self.pending, {}
+
+      if not pending:
+        return
+
+      if self.write_aff4:
+        self._WriteAFF4(pending)
+
+      if data_store.RelationalDBWriteEnabled():
+        self._WriteRelational(pending)
+
+  def _WriteAFF4(self, pending):
+    """Writes the ping metadata to the AFF4 client objects in one batch."""
+    schema = aff4_grr.VFSGRRClient.SchemaCls
+    with data_store.DB.GetMutationPool() as pool:
+      for client_id, state in pending.iteritems():
+        values = []
+        if "last_ping" in state:
+          values.append((schema.PING, state["last_ping"]))
+        if "last_clock" in state:
+          values.append((schema.CLOCK, state["last_clock"]))
+        if "last_ip" in state:
+          values.append((schema.CLIENT_IP,
+                         rdfvalue.RDFString(state["last_ip"])))
+        if not values:
+          continue
+
+        # These attributes are not versioned, so like AFF4Object.Set we
+        # replace all previous values and store the new one at timestamp 0.
+        attributes = {}
+        for attribute, value in values:
+          attributes[attribute] = [(value.SerializeToDataStore(), 0)]
+
+        aff4.FACTORY.SetAttributes(
+            rdf_client.ClientURN(client_id),
+            attributes,
+            set(attributes),
+            add_child_index=False,
+            mutation_pool=pool)
+
+  def _WriteRelational(self, pending):
+    """Writes the ping metadata to the relational db."""
+    for client_id, state in pending.iteritems():
+      kwargs = dict(state)
+      if kwargs.get("last_ip"):
+        kwargs["last_ip"] = rdf_client.NetworkAddress(
+            human_readable_address=kwargs["last_ip"])
+      else:
+        kwargs.pop("last_ip", None)
+
+      if not ("last_ping" in kwargs or "last_clock" in kwargs or
+              "last_ip" in kwargs):
+        continue
+
+      try:
+        data_store.REL_DB.WriteClientMetadata(client_id, **kwargs)
+      except db.UnknownClientError:
+        pass
+
+
+class _PendingItem(object):
+  """Work submitted to a BatchProcessor, waiting to be processed."""
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+    self.done = threading.Event()
+    # Set if this item was chosen to process the next batch.
+    self.leader = False
+    self.result = None
+    self.error = None
+
+
+class BatchProcessor(object):
+  """Processes work submitted on concurrent threads in batches.
+
+  While one thread processes a batch, work arriving on other threads is
+  collected and the first of these threads then processes it all at once.
+  Subclasses implement _ProcessBatch().
+  """
+
+  # Seconds the thread about to process a batch waits for more work to arrive.
+  batch_delay = 0
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # Items waiting for the next batch.
+    self.pending = []
+    # True while a batch is being processed.
+    self.processing = False
+
+  def _Submit(self, **kwargs):
+    """Processes an item as part of a batch, returns once it is done.
+
+    Args:
+      **kwargs: The attributes of the item.
+
+    Returns:
+      The result _ProcessBatch() set on the item.
+    """
+    item = _PendingItem(**kwargs)
+    with self.lock:
+      self.pending.append(item)
+      if not self.processing:
+        self.processing = True
+        item.leader = True
+
+    if not item.leader:
+      item.done.wait()
+      # We are either done or have to process the next batch now.
+      if not item.leader:
+        if item.error is not None:
+          raise item.error
+        return item.result
+
+    if self.batch_delay:
+      time.sleep(self.batch_delay)
+
+    with self.lock:
+      batch, self.pending = self.pending, []
+
+    try:
+      self._ProcessBatch(batch)
+    except Exception as e:  # pylint: disable=broad-except
+      for pending_item in batch:
+        pending_item.error = e
+    finally:
+      with self.lock:
+        if self.pending:
+          self.pending[0].leader = True
+          self.pending[0].done.set()
+        else:
+          self.processing = False
+
+      for pending_item in batch:
+        pending_item.done.set()
+
+    if item.error is not None:
+      raise item.error
+    return item.result
+
+  def _ProcessBatch(self, batch):
+    """Processes the items in batch, setting their results."""
+    raise NotImplementedError()
+
+
+class ReceivedMessageWriter(BatchProcessor):
+  """Writes the messages received from clients to the flow queues.
+
+  For every message a response is queued on its flow and, depending on the
+  message, the flow is notified and the request is removed from the client
+  queue. All of this is written with a single mutation pool flush per batch
+  of concurrently received messages. Notifications are coalesced per flow
+  across the whole batch.
+  """
+
+  def __init__(self, token=None):
+    super(ReceivedMessageWriter, self).__init__()
+    self.token = token
+
+  def Write(self, client_id, messages):
+    """Writes the messages, returns once they are stored.
+
+    Args:
+      client_id: The client which sent the messages.
+      messages: A list of GrrMessages, none of them for well known flows
+        processed on the frontend.
+    """
+    self._Submit(client_id=client_id, messages=messages)
+
+  def _ProcessBatch(self, batch):
+    stats.STATS.RecordEvent("grr_frontendserver_write_batch_size", len(batch))
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for write in batch:
+        self._QueueMessages(manager, write.client_id, write.messages)
+
+  def _QueueMessages(self, manager, client_id, messages):
+    for msgs in utils.GroupBy(messages,
+                              operator.attrgetter("session_id")).itervalues():
+      for msg in msgs:
+        manager.QueueResponse(msg)
+
+      for msg in msgs:
+        # Messages for well known flows should notify even though they don't
+        # have a status.
+        if msg.request_id == 0:
+          manager.QueueNotification(
+              session_id=msg.session_id, priority=msg.priority)
+          # Those messages are all the same, one notification is enough.
+          break
+        elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
+          # If we receive a status message from the client it means the client
+          # has finished processing this request. We therefore can de-queue it
+          # from the client queue. msg.task_id will raise if the task id is
+          # not set (message originated at the client, there was no request on
+          # the server), so we have to check .HasTaskID() first.
+          if msg.HasTaskID():
+            manager.DeQueueClientRequest(client_id, msg.task_id)
+
+          manager.QueueNotification(
+              session_id=msg.session_id,
+              priority=msg.priority,
+              last_status=msg.request_id)
+
+
+class ClientQueueDrainer(BatchProcessor):
+  """Drains the queues of clients polling concurrently in batches.
+
+  The tasks for all clients in a batch are leased with a single data store
+  query and retransmitted tasks are checked for a status in one go, see
+  FrontEndServer.DrainTaskSchedulerQueueForClients().
+  """
+
+  def __init__(self, server):
+    super(ClientQueueDrainer, self).__init__()
+    self.server = server
+    self.batch_delay = config.CONFIG["Frontend.drain_batch_delay"]
+
+  def Drain(self, client, max_count):
+    """Drains the client's queue, see DrainTaskSchedulerQueueForClient()."""
+    if max_count <= 0:
+      return []
+    return self._Submit(
+        client=rdf_client.ClientURN(client), max_count=max_count)
+
+  def _ProcessBatch(self, batch):
+    stats.STATS.RecordEvent("grr_frontendserver_drain_batch_size", len(batch))
+    # A client polling on several connections at once drains its queue once.
+    limits = {}
+    for drain in batch:
+      limits[drain.client] = max(limits.get(drain.client, 0), drain.max_count)
+
+    tasks = self.server.DrainTaskSchedulerQueueForClients(limits)
+    for drain in batch:
+      # Duplicate polls get nothing, the tasks are sent on the first one.
+      drain.result, tasks[drain.client] = tasks[drain.client], []
+
+
+def _SerializeCipher(cipher):
+  serialized_cipher = cipher.serialized_cipher
+  return (struct.pack("<I", len(serialized_cipher)) + serialized_cipher +
+          cipher.cipher_metadata.SerializeToString())
+
+
+def _ParseCipher(data):
+  (length,) = struct.unpack_from("<I", data)
+  return communicator.VerifiedCipher(
+      data[4:4 + length],
+      rdf_flows.CipherMetadata.FromSerializedString(data[4 + length:]))
+
+
+def _SerializeSessionCipher(cipher):
+  fields = [
+      cipher.cipher.SerializeToString(), cipher.encrypted_cipher,
+      cipher.encrypted_cipher_metadata, cipher.remote_key_fingerprint
+  ]
+  return struct.pack("<d", cipher.created) + "".join(
+      struct.pack("<I", len(field)) + field for field in fields)
+
+
+def _ParseSessionCipher(data):
+  (created,) = struct.unpack_from("<d", data)
+  pos = 8
+  fields = []
+  for _ in xrange(4):
+    (length,) = struct.unpack_from("<I", data, pos)
+    fields.append(data[pos + 4:pos + 4 + length])
+    pos += 4 + length
+  return communicator.RestoredCipher(*fields, created=created)
+
+
+def _SerializePublicKey(public_key):
+  return public_key.SerializeToString()
+
+
+def _CreateCache(name, serialize, parse):
+  """Creates a cache, backed by the shared cache of this name if there is one.
+
+  Args:
+    name: The name of the shared cache.
+    serialize: A function turning a cached value into a string.
+    parse: A function turning a string back into a value.
+
+  Returns:
+    An object with the Get/Put interface of utils.FastStore.
+  """
+  shared = shared_cache.GetCache(name)
+  if shared is None:
+    return utils.FastStore(max_size=50000)
+  return shared_cache.SharedCacheView(
+      name, shared, serialize, parse, max_size=50000)
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
@@ -36,7 +452,19 @@ class ServerCommunicator(communicator.Communicator):
     self.token = token
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
-    self.pub_key_cache = utils.FastStore(max_size=50000)
+    # Verified ciphers and client keys are shared with other frontend
+    # processes on this machine, if any.
+    self.encrypted_cipher_cache = _CreateCache("ciphers", _SerializeCipher,
+                                               _ParseCipher)
+    self.pub_key_cache = _CreateCache("public_keys", _SerializePublicKey,
+                                      rdf_crypto.RSAPublicKey)
+    self.session_ciphers = _CreateCache(
+        "session_ciphers", _SerializeSessionCipher, _ParseSessionCipher)
+    self.session_lifetime = config.CONFIG["Frontend.session_lifetime"]
+    # The latest clock accepted from each client. Clocks are written to the
+    # data store asynchronously, so this is what replay protection checks.
+    self.client_clocks = utils.FastStore(max_size=50000)
+    self.ping_writer = ClientPingWriter()
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
@@ -109,11 +537,11 @@ class ServerCommunicator(communicator.Communicator):
         stats.STATS.SetGaugeValue("grr_frontendserver_client_cache_size",
                                   len(self.client_cache))
 
-      ip = response_comms.orig_request.source_ip
-      client.Set(client.Schema.CLIENT_IP(ip))
-
       # The very first packet we see from the client we do not have its clock
-      remote_time = client.Get(client.Schema.CLOCK) or rdfvalue.RDFDatetime(0)
+      try:
+        remote_time = self.client_clocks.Get(client_id)
+      except KeyError:
+        remote_time = client.Get(client.Schema.CLOCK) or rdfvalue.RDFDatetime(0)
       client_time = packed_message_list.timestamp or rdfvalue.RDFDatetime(0)
 
       # This used to be a strict check here so absolutely no out of
@@ -137,11 +565,9 @@ class ServerCommunicator(communicator.Communicator):
       # Update the client and server timestamps only if the client
       # time moves forward.
       if client_time > long(remote_time):
-        client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
-        client.Set(client.Schema.PING, rdfvalue.RDFDatetime.Now())
-
-        clock = client_time
+        clock = rdfvalue.RDFDatetime(client_time)
         ping = rdfvalue.RDFDatetime.Now()
+        self.client_clocks.Put(client_id, clock)
 
         for label in client.Get(client.Schema.LABELS, []):
           stats.STATS.IncrementCounter(
@@ -152,25 +578,12 @@ class ServerCommunicator(communicator.Communicator):
         logging.warning("Out of order message for %s: %s >= %s", client_id,
                         long(remote_time), int(client_time))
 
-      client.Flush()
-      if data_store.RelationalDBWriteEnabled():
-        source_ip = response_comms.orig_request.source_ip
-        if source_ip:
-          last_ip = rdf_client.NetworkAddress(
-              human_readable_address=response_comms.orig_request.source_ip)
-        else:
-          last_ip = None
-
-        if ping or clock or last_ip:
-          try:
-            data_store.REL_DB.WriteClientMetadata(
-                client_id.Basename(),
-                last_ip=last_ip,
-                last_clock=clock,
-                last_ping=ping,
-                fleetspeak_enabled=False)
-          except db.UnknownClientError:
-            pass
+      self.ping_writer.Record(
+          client_id.Basename(),
+          last_ping=ping,
+          last_clock=clock,
+          last_ip=response_comms.orig_request.source_ip,
+          fleetspeak_enabled=False)
 
     except communicator.UnknownClientCert:
       pass
@@ -184,7 +597,14 @@ class RelationalServerCommunicator(communicator.Communicator):
   def __init__(self, certificate, private_key):
     super(RelationalServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
-    self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.encrypted_cipher_cache = _CreateCache("ciphers", _SerializeCipher,
+                                               _ParseCipher)
+    self.pub_key_cache = _CreateCache("public_keys", _SerializePublicKey,
+                                      rdf_crypto.RSAPublicKey)
+    self.session_ciphers = _CreateCache(
+        "session_ciphers", _SerializeSessionCipher, _ParseSessionCipher)
+    self.session_lifetime = config.CONFIG["Frontend.session_lifetime"]
+    self.ping_writer = ClientPingWriter(write_aff4=False)
     self.common_name = self.certificate.GetCN()
 
   def _GetRemotePublicKey(self, common_name):
@@ -208,7 +628,7 @@ class RelationalServerCommunicator(communicator.Communicator):
       raise communicator.UnknownClientCert("Stored cert mismatch")
 
     pub_key = cert.GetPublicKey()
-    self.pub_key_cache.Put(common_name, pub_key)
+    self.pub_key_cache.Put(remote_client_id, pub_key)
     return pub_key
 
   def VerifyMessageSignature(self, response_comms, packed_message_list, cipher,
@@ -248,9 +668,13 @@ class RelationalServerCommunicator(communicator.Communicator):
       # precaution. Given the behavior of those proxies, this seems
       # now excessive and we have changed the replay protection to
       # only trigger on messages that are more than one hour old.
-      if metadata and metadata.clock:
+      # Clocks still buffered by the ping writer are newer than the stored one.
+      stored_client_time = self.ping_writer.GetPendingClock(client_id)
+      if stored_client_time is None and metadata:
         stored_client_time = metadata.clock
 
+      if stored_client_time:
+
         if client_time < stored_client_time - rdfvalue.Duration("1h"):
           logging.warning("Message desynchronized for %s: %s >= %s", client_id,
                           long(stored_client_time), long(client_time))
@@ -272,18 +696,11 @@ class RelationalServerCommunicator(communicator.Communicator):
         stats.STATS.IncrementCounter(
             "client_pings_by_label", fields=[label.name])
 
-      source_ip = response_comms.orig_request.source_ip
-      if source_ip:
-        last_ip = rdf_client.NetworkAddress(
-            human_readable_address=response_comms.orig_request.source_ip)
-      else:
-        last_ip = None
-
-      data_store.REL_DB.WriteClientMetadata(
+      self.ping_writer.Record(
           client_id,
-          last_ip=last_ip,
-          last_clock=client_time,
           last_ping=rdfvalue.RDFDatetime.Now(),
+          last_clock=client_time,
+          last_ip=response_comms.orig_request.source_ip,
           fleetspeak_enabled=False)
 
     except communicator.UnknownClientCert:
@@ -325,16 +742,29 @@ class FrontEndServer(object):
       self._communicator = ServerCommunicator(
           certificate=certificate, private_key=private_key, token=self.token)
 
+    # Pings of Fleetspeak clients do not go through the communicator.
+    self.ping_writer = ClientPingWriter()
+
     self.receive_thread_pool = {}
     self.message_expiry_time = message_expiry_time
     self.max_retransmission_time = max_retransmission_time
     self.max_queue_size = max_queue_size
+    self.receive_batch_size = config.CONFIG["Frontend.receive_batch_size"]
     self.thread_pool = threadpool.ThreadPool.Factory(
         threadpool_prefix,
         min_threads=2,
         max_threads=config.CONFIG["Threadpool.size"])
     self.thread_pool.Start()
 
+    self.message_writer = ReceivedMessageWriter(token=self.token)
+    self.queue_drainer = ClientQueueDrainer(self)
+
+    # The number of bundles being handled right now, a measure of our load.
+    self.active_bundles = 0
+    self.active_bundles_lock = threading.Lock()
+
+    self.admission_controller = admission_control.AdmissionController()
+
     # Well known flows are run on the front end.
     self.well_known_flows = (
         flow.WellKnownFlow.GetAllWellKnownFlows(token=self.token))
@@ -365,14 +795,41 @@ class FrontEndServer(object):
     Returns:
        tuple of (source, message_count) where message_count is the number of
        messages received from the client with common name source.
+
+    Raises:
+       admission_control.Overloaded: If the frontend is too busy to handle
+       this bundle now.
     """
-    messages, source, timestamp = self._communicator.DecodeMessages(
-        request_comms)
+    # Polls are admitted per client. Clients can not be told apart before
+    # their cipher is read, which is cached for clients we saw recently. The
+    # payload is only decrypted once the poll was admitted.
+    session = self._communicator.ReadCipher(request_comms)
+    ticket = self.admission_controller.Admit(utils.SmartStr(session.source))
+    sent_messages = False
+    with self.active_bundles_lock:
+      self.active_bundles += 1
+    try:
+      message_stream = self._communicator.DecodeMessageStream(
+          request_comms, session=session)
+      message_count, sent_messages = self._HandleMessageBundles(
+          message_stream, request_comms, response_comms)
+      return message_stream.source, message_count
+    finally:
+      with self.active_bundles_lock:
+        self.active_bundles -= 1
+      ticket.Release(sent_messages=sent_messages)
+
+  def _HandleMessageBundles(self, message_stream, request_comms,
+                            response_comms):
+    source = message_stream.source
 
     now = time.time()
-    if messages:
-      # Receive messages in line.
+    # Receive messages in line. Large bundles are received in several batches
+    # as they are decoded, so they never have to be held in memory at once.
+    received_count = 0
+    for messages in message_stream.Batches(self.receive_batch_size):
       self.ReceiveMessages(source, messages)
+      received_count += len(messages)
 
     # We send the client a maximum of self.max_queue_size messages
     required_count = max(0, self.max_queue_size - request_comms.queue_size)
@@ -382,7 +839,7 @@ class FrontEndServer(object):
     # Only give the client messages if we are able to receive them in a
     # reasonable time.
     if time.time() - now < 10:
-      tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
+      tasks = self.queue_drainer.Drain(source, required_count)
       message_list.job = tasks
 
     # Encode the message_list in the response_comms using the same API version
@@ -392,16 +849,64 @@ class FrontEndServer(object):
           message_list,
           response_comms,
           destination=source,
-          timestamp=timestamp,
+          timestamp=message_stream.timestamp,
           api_version=request_comms.api_version)
     except communicator.UnknownClientCert:
       # We can not encode messages to the client yet because we do not have the
       # client certificate - return them to the queue so we can try again later.
-      with data_store.DB.GetMutationPool() as pool:
-        queue_manager.QueueManager(token=self.token).Schedule(tasks, pool)
+      manager = queue_manager.QueueManager(token=self.token)
+      with manager.data_store.GetMutationPool() as pool:
+        manager.Schedule(tasks, pool)
       raise
 
-    return source, len(messages)
+    # A drain which filled the client's queue may have left tasks behind.
+    # Otherwise the drain took every task that could be leased.
+    remaining_count = 0
+    if tasks and len(tasks) >= required_count:
+      remaining_count = queue_manager.QueueManager(
+          token=self.token).CountAvailableTasks(rdf_client.ClientURN(source))
+
+    poll_hint = self.PollHint(received_count, len(tasks), remaining_count)
+    if poll_hint:
+      response_comms.poll_hint = poll_hint
+
+    return received_count, bool(tasks)
+
+  # Hints which clients clamp to their shortest and longest poll interval.
+  POLL_NOW = 0.01
+  POLL_LATER = 24 * 60 * 60
+
+  def PollHint(self, received_count, sent_count, remaining_count):
+    """Returns how long a client should wait before polling again.
+
+    Args:
+      received_count: The number of messages the client just sent.
+      sent_count: The number of messages we just sent to the client.
+      remaining_count: The number of messages still queued for the client.
+
+    Returns:
+      A number of seconds or None if the client should decide by itself.
+    """
+    if remaining_count:
+      # More messages are waiting for the client.
+      stats.STATS.IncrementCounter("frontend_poll_hints", fields=["pending"])
+      return self.POLL_NOW
+
+    if received_count or sent_count:
+      # The client is busy and knows when it needs to poll fast.
+      return None
+
+    max_concurrent_bundles = config.CONFIG["Frontend.max_concurrent_bundles"]
+    if max_concurrent_bundles and self.active_bundles > max_concurrent_bundles:
+      stats.STATS.IncrementCounter("frontend_poll_hints", fields=["overloaded"])
+      return self.POLL_LATER
+
+    idle_poll_hint = config.CONFIG["Frontend.idle_poll_hint"]
+    if idle_poll_hint:
+      stats.STATS.IncrementCounter("frontend_poll_hints", fields=["idle"])
+      return idle_poll_hint
+
+    return None
 
   def DrainTaskSchedulerQueueForClient(self, client, max_count=None):
     """Drains the client's Task Scheduler queue.
@@ -425,44 +930,63 @@ class FrontEndServer(object):
     if max_count is None:
       max_count = self.max_queue_size
 
-    if max_count <= 0:
-      return []
-
     client = rdf_client.ClientURN(client)
+    return self.DrainTaskSchedulerQueueForClients({client: max_count})[client]
+
+  def DrainTaskSchedulerQueueForClients(self, max_counts):
+    """Drains the Task Scheduler queues of many clients at once.
+
+    This does the same as DrainTaskSchedulerQueueForClient() for every client,
+    but leases the tasks of all clients with a single data store query and
+    checks all retransmitted tasks for a status in one go.
+
+    Args:
+      max_counts: A dict mapping ClientURNs to the maximum number of messages
+        we will issue for them.
+
+    Returns:
+      A dict mapping each ClientURN to the tasks representing the messages
+      returned.
+    """
+    result = dict((client, []) for client in max_counts)
+    limits = dict((client.Queue(), max_count)
+                  for client, max_count in max_counts.iteritems()
+                  if max_count > 0)
+    if not limits:
+      return result
 
     start_time = time.time()
-    # Drain the queue for this client
-    new_tasks = queue_manager.QueueManager(token=self.token).QueryAndOwn(
-        queue=client.Queue(),
-        limit=max_count,
-        lease_seconds=self.message_expiry_time)
+    # Drain the queues of all clients.
+    new_tasks = queue_manager.QueueManager(token=self.token).MultiQueryAndOwn(
+        limits, lease_seconds=self.message_expiry_time)
 
     initial_ttl = rdf_flows.GrrMessage().task_ttl
     check_before_sending = []
-    result = []
-    for task in new_tasks:
-      if task.task_ttl < initial_ttl - 1:
-        # This message has been leased before.
-        check_before_sending.append(task)
-      else:
-        result.append(task)
+    for client in max_counts:
+      for task in new_tasks.get(client.Queue(), []):
+        if task.task_ttl < initial_ttl - 1:
+          # This message has been leased before.
+          check_before_sending.append((client, task))
+        else:
+          result[client].append(task)
 
     if check_before_sending:
       with queue_manager.QueueManager(token=self.token) as manager:
-        status_found = manager.MultiCheckStatus(check_before_sending)
+        status_found = manager.MultiCheckStatus(
+            [task for _, task in check_before_sending])
 
         # All messages that don't have a status yet should be sent again.
-        for task in check_before_sending:
+        for client, task in check_before_sending:
           if task not in status_found:
-            result.append(task)
+            result[client].append(task)
           else:
             manager.DeQueueClientRequest(client, task.task_id)
 
-    stats.STATS.IncrementCounter("grr_messages_sent", len(result))
-    if result:
-      logging.debug("Drained %d messages for %s in %s seconds.", len(result),
-                    client,
-                    time.time() - start_time)
+    sent_count = sum(len(tasks) for tasks in result.itervalues())
+    stats.STATS.IncrementCounter("grr_messages_sent", sent_count)
+    if sent_count:
+      logging.debug("Drained %d messages for %d clients in %s seconds.",
+                    sent_count, len(max_counts), time.time() - start_time)
 
     return result
 
@@ -519,17 +1043,15 @@ class FrontEndServer(object):
 
   def RecordFleetspeakClientPing(self, client_id):
     """Records the last client contact in the datastore."""
-    ping = rdfvalue.RDFDatetime.Now()
-    with aff4.FACTORY.Create(
-        rdf_client.ClientURN(client_id),
-        aff4_type=aff4_grr.VFSGRRClient,
-        mode="w",
-        token=self.token,
-        force_new_version=False) as client:
-      client.Set(client.Schema.PING, ping)
+    self.ping_writer.Record(client_id, last_ping=rdfvalue.RDFDatetime.Now())
 
-    if data_store.RelationalDBWriteEnabled():
-      data_store.REL_DB.WriteClientMetadata(client_id, last_ping=ping)
+  def Stop(self):
+    """Writes the client pings that are still buffered.
+
+    Called when the frontend shuts down.
+    """
+    self._communicator.ping_writer.Stop()
+    self.ping_writer.Stop()
 
   def ReceiveMessages(self, client_id, messages):
     """Receives and processes the messages from the source.
@@ -543,64 +1065,53 @@ class FrontEndServer(object):
       messages: A list of GrrMessage RDFValues.
     """
     now = time.time()
-    with queue_manager.QueueManager(token=self.token) as manager:
-      for session_id, msgs in utils.GroupBy(
-          messages, operator.attrgetter("session_id")).iteritems():
+    unprocessed_msgs = []
+    for msgs in utils.GroupBy(messages,
+                              operator.attrgetter("session_id")).itervalues():
+      # Remove and handle messages to WellKnownFlows
+      unprocessed_msgs.extend(self.HandleWellKnownFlows(msgs))
 
-        # Remove and handle messages to WellKnownFlows
-        unprocessed_msgs = self.HandleWellKnownFlows(msgs)
+    if unprocessed_msgs:
+      self.message_writer.Write(client_id, unprocessed_msgs)
 
-        if not unprocessed_msgs:
-          continue
+    for msg in unprocessed_msgs:
+      if msg.type != rdf_flows.GrrMessage.Type.STATUS:
+        continue
 
-        for msg in unprocessed_msgs:
-          manager.QueueResponse(msg)
-
-        for msg in unprocessed_msgs:
-          # Messages for well known flows should notify even though they don't
-          # have a status.
-          if msg.request_id == 0:
-            manager.QueueNotification(
-                session_id=msg.session_id, priority=msg.priority)
-            # Those messages are all the same, one notification is enough.
-            break
-          elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
-            # If we receive a status message from the client it means the client
-            # has finished processing this request. We therefore can de-queue it
-            # from the client queue. msg.task_id will raise if the task id is
-            # not set (message originated at the client, there was no request on
-            # the server), so we have to check .HasTaskID() first.
-            if msg.HasTaskID():
-              manager.DeQueueClientRequest(client_id, msg.task_id)
-
-            manager.QueueNotification(
-                session_id=msg.session_id,
-                priority=msg.priority,
-                last_status=msg.request_id)
-
-            stat = rdf_flows.GrrStatus(msg.payload)
-            if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
-              # A client crashed while performing an action, fire an event.
-              crash_details = rdf_client.ClientCrash(
-                  client_id=client_id,
-                  session_id=session_id,
-                  backtrace=stat.backtrace,
-                  crash_message=stat.error_message,
-                  nanny_status=stat.nanny_status,
-                  timestamp=rdfvalue.RDFDatetime.Now())
-              msg = rdf_flows.GrrMessage(
-                  source=client_id,
-                  payload=crash_details,
-                  auth_state=(
-                      rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED))
-              events.Events.PublishEvent("ClientCrash", msg, token=self.token)
+      stat = rdf_flows.GrrStatus(msg.payload)
+      if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
+        # A client crashed while performing an action, fire an event.
+        crash_details = rdf_client.ClientCrash(
+            client_id=client_id,
+            session_id=msg.session_id,
+            backtrace=stat.backtrace,
+            crash_message=stat.error_message,
+            nanny_status=stat.nanny_status,
+            timestamp=rdfvalue.RDFDatetime.Now())
+        msg = rdf_flows.GrrMessage(
+            source=client_id,
+            payload=crash_details,
+            auth_state=(rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED))
+        events.Events.PublishEvent("ClientCrash", msg, token=self.token)
 
     logging.debug("Received %s messages from %s in %s sec", len(messages),
                   client_id,
                   time.time() - now)
 
   def HandleWellKnownFlows(self, messages):
-    """Hands off messages to well known flows."""
+    """Hands off messages to well known flows.
+
+    Flows whitelisted in Frontend.well_known_flows are processed right here,
+    before the poll is answered, so their errors reach the caller. Messages
+    for all other well known flows are queued for the workers, which is the
+    way to take a flow off the request thread.
+
+    Args:
+      messages: The GrrMessages received from a client.
+
+    Returns:
+      The messages which have to be queued for the workers.
+    """
     msgs_by_wkf = {}
     result = []
     for msg in messages:
@@ -676,6 +1187,14 @@ class FrontendInit(registry.InitHook):
     stats.STATS.RegisterGaugeMetric(
         "frontend_active_count", int, fields=[("source", str)])
     stats.STATS.RegisterGaugeMetric("frontend_max_active_count", int)
+    stats.STATS.RegisterGaugeMetric("frontend_open_connections", int)
+    # Requests turned away because the frontend was saturated.
+    stats.STATS.RegisterCounterMetric("frontend_rejected_requests")
+    stats.STATS.RegisterCounterMetric(
+        "frontend_poll_hints", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric(
+        "frontend_admission", fields=[("decision", str)])
+    stats.STATS.RegisterGaugeMetric("frontend_concurrency_limit", int)
     stats.STATS.RegisterCounterMetric(
         "frontend_http_requests", fields=[("action", str), ("protocol", str)])
     stats.STATS.RegisterCounterMetric(
@@ -692,9 +1211,20 @@ class FrontendInit(registry.InitHook):
         "frontend_request_latency", fields=[("source", str)])
 
     stats.STATS.RegisterEventMetric("grr_frontendserver_handle_time")
+    # The number of client queues drained together by ClientQueueDrainer.
+    stats.STATS.RegisterEventMetric(
+        "grr_frontendserver_drain_batch_size",
+        bins=[1, 2, 4, 8, 16, 32, 64, 128])
+    # The number of client bundles written together by ReceivedMessageWriter.
+    stats.STATS.RegisterEventMetric(
+        "grr_frontendserver_write_batch_size",
+        bins=[1, 2, 4, 8, 16, 32, 64, 128])
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
 
     stats.STATS.RegisterCounterMetric(
         "grr_pub_key_cache", fields=[("type", str)])
+    # Lookups in caches shared by frontend processes, by cache and result.
+    stats.STATS.RegisterCounterMetric(
+        "grr_shared_cache", fields=[("cache", str), ("type", str)])
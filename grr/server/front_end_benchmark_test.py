@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Benchmarks for the frontend."""
+
+
+from grr import config
+from grr.lib import communicator
+from grr.lib import flags
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.server import data_store
+from grr.server import front_end
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import test_lib
+
+
+class QueueDrainBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
+  """Compares draining client queues one by one and in bulk."""
+
+  REPEATS = 5
+  units = "ms"
+
+  def setUp(self):
+    super(QueueDrainBenchmark, self).setUp()
+    self.server = front_end.FrontEndServer(
+        certificate=config.CONFIG["Frontend.certificate"],
+        private_key=config.CONFIG["PrivateKeys.server_key"],
+        threadpool_prefix="queue_drain_benchmark")
+
+  def _ScheduleTasks(self, clients):
+    tasks = [
+        rdf_flows.GrrMessage(
+            queue=client.Queue(),
+            session_id="aff4:/flows/W:Benchmark",
+            request_id=1,
+            generate_task_id=True) for client in clients
+    ]
+    with data_store.DB.GetMutationPool() as pool:
+      pool.QueueScheduleTasks(tasks, None)
+
+  def testDrainClientQueues(self):
+    """Times the polls of N clients which all have a message waiting."""
+    for client_count in [10, 100, 1000]:
+      clients = [
+          rdf_client.ClientURN("C.1%015X" % i) for i in xrange(client_count)
+      ]
+
+      def DrainOneByOne():
+        self._ScheduleTasks(clients)
+        for client in clients:
+          self.server.DrainTaskSchedulerQueueForClient(client, 10)
+
+      def DrainInBulk():
+        self._ScheduleTasks(clients)
+        self.server.DrainTaskSchedulerQueueForClients(
+            dict((client, 10) for client in clients))
+
+      self.TimeIt(DrainOneByOne, name="One by one (%d clients)" % client_count)
+      self.TimeIt(DrainInBulk, name="In bulk (%d clients)" % client_count)
+
+
+class SessionCipherBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
+  """Compares starting a new session with reusing one."""
+
+  REPEATS = 100
+  units = "ms"
+
+  def testCipherCreation(self):
+    """Times creating a cipher and encrypting a poll with an existing one."""
+    private_key = config.CONFIG["PrivateKeys.server_key"]
+    public_key = private_key.GetPublicKey()
+    data = "x" * 1024
+
+    def NewSession():
+      communicator.Cipher("aff4:/GRR Test Server", private_key, public_key)
+
+    cipher = communicator.Cipher("aff4:/GRR Test Server", private_key,
+                                 public_key)
+
+    def ReuseSession():
+      iv, encrypted = cipher.Encrypt(data)
+      cipher.HMAC(encrypted, cipher.encrypted_cipher,
+                  cipher.encrypted_cipher_metadata, iv.SerializeToString())
+
+    self.TimeIt(NewSession, name="New session")
+    self.TimeIt(ReuseSession, name="Reused session (1kb message)")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
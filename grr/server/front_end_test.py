@@ -4,6 +4,7 @@
 import array
 import logging
 import pdb
+import threading
 import time
 
 import requests
@@ -13,6 +14,7 @@ from grr_response_client import comms
 from grr_response_client.client_actions import admin
 from grr_response_client.client_actions import standard
 from grr.lib import communicator
+from grr.lib import compression
 from grr.lib import flags
 from grr.lib import queues
 from grr.lib import rdfvalue
@@ -22,12 +24,14 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.server import admission_control
 from grr.server import aff4
 from grr.server import data_store
 from grr.server import flow
 from grr.server import front_end
 from grr.server import maintenance_utils
 from grr.server import queue_manager
+from grr.server import shared_cache
 from grr.server.aff4_objects import aff4_grr
 from grr.server.flows.general import ca_enroller
 from grr.test_lib import client_test_lib
@@ -218,6 +222,42 @@ class GRRFEServerTest(GRRFEServerTestBase):
     self.assertEqual(flow_test_lib.WellKnownSessionTest.messages,
                      list(range(1, 10)))
 
+  def testWellKnownFlowErrorsAreRaised(self):
+    session_id = flow_test_lib.WellKnownSessionTest.well_known_session_id
+    messages = [
+        rdf_flows.GrrMessage(
+            request_id=0,
+            response_id=0,
+            session_id=session_id,
+            payload=rdfvalue.RDFInteger(1))
+    ]
+
+    def ProcessMessages(unused_msgs):
+      raise IOError("Well known flow failed.")
+
+    wkf = self.server.well_known_flows[session_id.FlowName()]
+    with utils.Stubber(wkf, "ProcessMessages", ProcessMessages):
+      self.assertRaises(IOError, self.server.ReceiveMessages,
+                        test_lib.TEST_CLIENT_ID, messages)
+
+  def testPollHints(self):
+    # More messages are waiting for the client.
+    self.assertEqual(
+        self.server.PollHint(0, 50, 1), front_end.FrontEndServer.POLL_NOW)
+    # The client is busy and polls by itself.
+    self.assertIsNone(self.server.PollHint(5, 10, 0))
+    self.assertIsNone(self.server.PollHint(0, 50, 0))
+    # An idle client decides by itself unless told otherwise.
+    self.assertIsNone(self.server.PollHint(0, 0, 0))
+    with test_lib.ConfigOverrider({"Frontend.idle_poll_hint": 300}):
+      self.assertEqual(self.server.PollHint(0, 0, 0), 300)
+
+    with test_lib.ConfigOverrider({"Frontend.max_concurrent_bundles": 10}):
+      self.server.active_bundles = 11
+      self.assertEqual(
+          self.server.PollHint(0, 0, 0), front_end.FrontEndServer.POLL_LATER)
+      self.server.active_bundles = 0
+
   def testWellKnownFlowsBlacklist(self):
     """Make sure that well known flows can run on the front end."""
     with test_lib.ConfigOverrider({
@@ -372,6 +412,83 @@ class GRRFEServerTest(GRRFEServerTestBase):
       self.assertEqual(response.job[i].session_id, session_id)
       self.assertEqual(response.job[i].name, "Test")
 
+  def testRejectedPollsAreNotDecrypted(self):
+    # The client communicator updates the config.
+    with test_lib.PreserveConfig():
+      client_communicator = comms.ClientCommunicator(
+          private_key=config.CONFIG["Client.private_key"])
+      client_communicator.LoadServerCertificate(
+          server_certificate=config.CONFIG["Frontend.certificate"],
+          ca_certificate=config.CONFIG["CA.certificate"])
+      request_comms = rdf_flows.ClientCommunication()
+      client_communicator.EncodeMessages(
+          rdf_flows.MessageList(job=[rdf_flows.GrrMessage(name="Test")]),
+          request_comms)
+
+    admitted = []
+    decrypted = []
+    decrypt = communicator.Cipher.Decrypt
+
+    def Admit(key):
+      admitted.append(key)
+      raise admission_control.Overloaded("Busy.", 10)
+
+    def Decrypt(cipher, data, iv):
+      decrypted.append(data)
+      return decrypt(cipher, data, iv)
+
+    with utils.MultiStubber(
+        (self.server.admission_controller, "Admit", Admit),
+        (communicator.Cipher, "Decrypt", Decrypt)):
+      self.assertRaises(admission_control.Overloaded,
+                        self.server.HandleMessageBundles, request_comms,
+                        rdf_flows.ClientCommunication())
+
+    self.assertEqual(admitted, [client_communicator.common_name])
+    self.assertNotIn(request_comms.encrypted, decrypted)
+
+  def _PollHintAfterDraining(self, client_id, message_count, max_count):
+    """Returns the poll hint of a poll allowed to drain max_count messages."""
+
+    class MockCommunicator(object):
+      """A fake that passes empty requests and drops the responses."""
+
+      def ReadCipher(self, *unused_args):
+        return communicator.ReceivedSession(client_id, None, False, None)
+
+      def DecodeMessageStream(self, *unused_args, **unused_kw):
+        return communicator.MessageStream(
+            rdf_flows.PackedMessageList(timestamp=100), None, client_id)
+
+      def EncodeMessages(self, *unused_args, **unused_kw):
+        pass
+
+    self.server._communicator = MockCommunicator()
+    flow.GRRFlow.StartFlow(
+        client_id=client_id,
+        flow_name=flow_test_lib.SendingFlow.__name__,
+        message_count=message_count,
+        token=self.token)
+
+    request_comms = rdf_flows.ClientCommunication(
+        queue_size=self.server.max_queue_size - max_count)
+    response_comms = rdf_flows.ClientCommunication()
+    self.server.HandleMessageBundles(request_comms, response_comms)
+    return response_comms.poll_hint
+
+  def testClientIsToldToPollNowIfMessagesAreLeft(self):
+    client_id = self.SetupClient(0)
+    self.assertEqual(
+        self._PollHintAfterDraining(client_id, 4, 3),
+        front_end.FrontEndServer.POLL_NOW)
+
+  def testClientIsNotToldToPollNowIfTheQueueIsDrained(self):
+    client_id = self.SetupClient(0)
+    # Exactly as many messages as the client can take are queued.
+    self.assertNotEqual(
+        self._PollHintAfterDraining(client_id, 3, 3),
+        front_end.FrontEndServer.POLL_NOW)
+
   def testHandleMessageBundle(self):
     """Check that HandleMessageBundles() requeues messages if it failed.
 
@@ -384,9 +501,13 @@ class GRRFEServerTest(GRRFEServerTestBase):
     class MockCommunicator(object):
       """A fake that simulates an unenrolled client."""
 
-      def DecodeMessages(self, *unused_args):
+      def ReadCipher(self, *unused_args):
+        return communicator.ReceivedSession(client_id, None, False, None)
+
+      def DecodeMessageStream(self, *unused_args, **unused_kw):
         """For simplicity client sends an empty request."""
-        return ([], client_id, 100)
+        return communicator.MessageStream(
+            rdf_flows.PackedMessageList(timestamp=100), None, client_id)
 
       def EncodeMessages(self, *unused_args, **unused_kw):
         """Raise because the server has no certificates for this client."""
@@ -509,6 +630,47 @@ class GRRFEServerTest(GRRFEServerTestBase):
         map(bool, msgs_recvd),
         [True] * 2 + [False] * (rdf_flows.GrrMessage().task_ttl - 2))
 
+  def testDrainTaskSchedulerQueueForClients(self):
+    client_ids = self.SetupClients(3)
+    for client_id in client_ids[:2]:
+      flow.GRRFlow.StartFlow(
+          client_id=client_id,
+          flow_name=flow_test_lib.SendingFlow.__name__,
+          message_count=3,
+          token=self.token)
+
+    tasks = self.server.DrainTaskSchedulerQueueForClients({
+        client_ids[0]: 2,
+        client_ids[1]: 100,
+        client_ids[2]: 100
+    })
+    self.assertEqual([len(tasks[client_id]) for client_id in client_ids],
+                     [2, 3, 0])
+
+    # Leased tasks are not handed out again.
+    tasks = self.server.DrainTaskSchedulerQueueForClients({
+        client_ids[0]: 100,
+        client_ids[1]: 100
+    })
+    self.assertEqual(len(tasks[client_ids[0]]), 1)
+    self.assertEqual(len(tasks[client_ids[1]]), 0)
+
+  def testQueueDrainerBatchesDuplicatePolls(self):
+    client_id = self.SetupClient(0)
+    flow.GRRFlow.StartFlow(
+        client_id=client_id,
+        flow_name=flow_test_lib.SendingFlow.__name__,
+        message_count=3,
+        token=self.token)
+
+    batch = [
+        front_end._PendingItem(client=client_id, max_count=2),
+        front_end._PendingItem(client=client_id, max_count=5)
+    ]
+    self.server.queue_drainer._ProcessBatch(batch)
+    self.assertEqual(len(batch[0].result), 3)
+    self.assertEqual(batch[1].result, [])
+
 
 def MakeHTTPException(code=500, msg="Error"):
   """A helper for creating a HTTPError exception."""
@@ -525,6 +687,145 @@ def MakeResponse(code=500, data=""):
   return response
 
 
+class ClientPingWriterTest(test_lib.GRRBaseTest):
+  """Tests the write-behind client ping writer."""
+
+  def _MakeWriter(self, **kwargs):
+    writer = front_end.ClientPingWriter(flush_interval=3600, **kwargs)
+    # Flushes are triggered explicitly by the tests.
+    writer._StartFlusherThread = lambda: None
+    return writer
+
+  def _ReadPing(self, client_id):
+    client_obj = aff4.FACTORY.Open(client_id, token=self.token)
+    return client_obj.Get(client_obj.Schema.PING)
+
+  def testPingsAreWrittenOnFlush(self):
+    client_id = self.SetupClient(0)
+    old_ping = self._ReadPing(client_id)
+    writer = self._MakeWriter()
+
+    ping = old_ping + rdfvalue.Duration("1m")
+    clock = rdfvalue.RDFDatetime.FromSecondsSinceEpoch(1000)
+    writer.Record(client_id.Basename(), last_ping=ping - 10)
+    writer.Record(
+        client_id.Basename(),
+        last_ping=ping,
+        last_clock=clock,
+        last_ip="192.168.0.1")
+
+    self.assertEqual(writer.GetPendingClock(client_id.Basename()), clock)
+    self.assertEqual(self._ReadPing(client_id), old_ping)
+
+    writer.Flush()
+
+    self.assertIsNone(writer.GetPendingClock(client_id.Basename()))
+    client_obj = aff4.FACTORY.Open(client_id, token=self.token)
+    self.assertEqual(client_obj.Get(client_obj.Schema.PING), ping)
+    self.assertEqual(client_obj.Get(client_obj.Schema.CLOCK), clock)
+    self.assertEqual(client_obj.Get(client_obj.Schema.CLIENT_IP), "192.168.0.1")
+
+  def testFlushesWhenTooManyClientsArePending(self):
+    client_ids = self.SetupClients(3)
+    writer = self._MakeWriter(max_pending=2)
+    ping = rdfvalue.RDFDatetime.Now() + rdfvalue.Duration("1h")
+
+    writer.Record(client_ids[0].Basename(), last_ping=ping)
+    self.assertNotEqual(self._ReadPing(client_ids[0]), ping)
+
+    writer.Record(client_ids[1].Basename(), last_ping=ping)
+    self.assertEqual(self._ReadPing(client_ids[0]), ping)
+    self.assertEqual(self._ReadPing(client_ids[1]), ping)
+
+    writer.Record(client_ids[2].Basename(), last_ping=ping)
+    self.assertNotEqual(self._ReadPing(client_ids[2]), ping)
+
+  def testStopWritesPendingPings(self):
+    client_ids = self.SetupClients(2)
+    writer = front_end.ClientPingWriter(flush_interval=3600)
+    ping = rdfvalue.RDFDatetime.Now() + rdfvalue.Duration("1h")
+
+    writer.Record(client_ids[0].Basename(), last_ping=ping)
+    self.assertIsNotNone(writer.flusher_thread)
+    self.assertNotEqual(self._ReadPing(client_ids[0]), ping)
+
+    writer.Stop()
+    self.assertIsNone(writer.flusher_thread)
+    self.assertEqual(self._ReadPing(client_ids[0]), ping)
+
+    # Pings recorded after the writer was stopped are not buffered anymore.
+    writer.Record(client_ids[1].Basename(), last_ping=ping)
+    self.assertEqual(self._ReadPing(client_ids[1]), ping)
+
+  def testFrontEndServerStopWritesPendingPings(self):
+    client_id = self.SetupClient(0)
+    with test_lib.ConfigOverrider({
+        "Frontend.client_ping_flush_interval": 3600
+    }):
+      server = front_end.FrontEndServer(
+          certificate=config.CONFIG["Frontend.certificate"],
+          private_key=config.CONFIG["PrivateKeys.server_key"])
+    # Well within the flush interval, so only Stop() writes the ping.
+    ping = rdfvalue.RDFDatetime.FromSecondsSinceEpoch(int(time.time()) + 60)
+
+    with test_lib.FakeTime(ping):
+      server.RecordFleetspeakClientPing(client_id.Basename())
+    self.assertNotEqual(self._ReadPing(client_id), ping)
+
+    server.Stop()
+    self.assertEqual(self._ReadPing(client_id), ping)
+
+
+class ReceivedMessageWriterTest(test_lib.GRRBaseTest):
+  """Tests the ReceivedMessageWriter."""
+
+  def testConcurrentWritesAreBatched(self):
+    writer = front_end.ReceivedMessageWriter(token=self.token)
+    batches = []
+    release = threading.Event()
+
+    def WriteBatch(batch):
+      batches.append([write.client_id for write in batch])
+      # Hold up the first batch until the other writes are pending.
+      release.wait()
+
+    def Write(client_id):
+      writer.Write(client_id, [])
+
+    with utils.Stubber(writer, "_ProcessBatch", WriteBatch):
+      threads = [threading.Thread(target=Write, args=("C.1",))]
+      threads[0].start()
+      while not batches:
+        time.sleep(0.01)
+
+      for client_id in ["C.2", "C.3"]:
+        thread = threading.Thread(target=Write, args=(client_id,))
+        thread.start()
+        threads.append(thread)
+      while len(writer.pending) < 2:
+        time.sleep(0.01)
+
+      release.set()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(batches[0], ["C.1"])
+    self.assertEqual(sorted(batches[1]), ["C.2", "C.3"])
+    self.assertFalse(writer.processing)
+
+  def testErrorsAreRaisedInAllWriters(self):
+    writer = front_end.ReceivedMessageWriter(token=self.token)
+
+    def WriteBatch(_):
+      raise IOError("Data store is down.")
+
+    with utils.Stubber(writer, "_ProcessBatch", WriteBatch):
+      with self.assertRaises(IOError):
+        writer.Write("C.1", [])
+
+    self.assertFalse(writer.processing)
+
+
 class ClientCommsTest(test_lib.GRRBaseTest):
   """Test the communicator."""
 
@@ -689,6 +990,102 @@ class ClientCommsTest(test_lib.GRRBaseTest):
     self.assertEqual(decoded_messages[0].auth_state,
                      rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
 
+  def testVerifiedCiphersAreShared(self):
+    """Ciphers verified by one frontend process are reused by the others."""
+    self._MakeClientRecord()
+
+    caches = dict((name,
+                   shared_cache.SharedMemoryCache(
+                       100, slot_size=shared_cache.CACHE_SLOT_SIZES[name]))
+                  for name in shared_cache.CACHE_NAMES)
+    with utils.Stubber(shared_cache, "_caches", caches):
+      self._SetupCommunicator()
+      self.ClientServerCommunicate()
+
+      # A new communicator stands in for another frontend process.
+      self._SetupCommunicator()
+
+      def ReceivedCipher(*unused_args):
+        raise AssertionError("Cipher was decrypted again.")
+
+      with utils.Stubber(communicator, "ReceivedCipher", ReceivedCipher):
+        decoded_messages = self.ClientServerCommunicate()
+
+    for message in decoded_messages:
+      self.assertEqual(message.auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+  def _EncodeForClient(self):
+    result = rdf_flows.ClientCommunication()
+    self.server_communicator.EncodeMessages(
+        rdf_flows.MessageList(),
+        result,
+        destination=rdf_client.ClientURN(self.client_id))
+    return result
+
+  def testSessionCiphersAreReused(self):
+    """The server only creates a new cipher once the session expires."""
+    self._MakeClientRecord()
+    self.ClientServerCommunicate()
+
+    first = self._EncodeForClient()
+    self.client_communicator.DecryptMessage(first.SerializeToString())
+
+    def ReceivedCipher(*unused_args):
+      raise AssertionError("Cipher was decrypted again.")
+
+    second = self._EncodeForClient()
+    with utils.Stubber(communicator, "ReceivedCipher", ReceivedCipher):
+      self.client_communicator.DecryptMessage(second.SerializeToString())
+
+    self.assertEqual(first.encrypted_cipher, second.encrypted_cipher)
+    self.assertNotEqual(first.packet_iv, second.packet_iv)
+
+    with test_lib.FakeTime(
+        time.time() + self.server_communicator.session_lifetime + 1):
+      third = self._EncodeForClient()
+    self.assertNotEqual(first.encrypted_cipher, third.encrypted_cipher)
+
+  def testSessionCiphersAreShared(self):
+    """Sessions created by one frontend process are used by the others."""
+    self._MakeClientRecord()
+
+    caches = dict((name,
+                   shared_cache.SharedMemoryCache(
+                       100, slot_size=shared_cache.CACHE_SLOT_SIZES[name]))
+                  for name in shared_cache.CACHE_NAMES)
+    with utils.Stubber(shared_cache, "_caches", caches):
+      self._SetupCommunicator()
+      first = self._EncodeForClient()
+
+      # A new communicator stands in for another frontend process.
+      self._SetupCommunicator()
+      second = self._EncodeForClient()
+
+    self.assertEqual(first.encrypted_cipher, second.encrypted_cipher)
+
+  def testEntriesForLargeKeysFitSharedCaches(self):
+    private_key = rdf_crypto.RSAPrivateKey.GenerateKey(bits=4096)
+    public_key = private_key.GetPublicKey()
+    cipher = communicator.Cipher("aff4:/C.0000000000000001", private_key,
+                                 public_key)
+    entries = {
+        "ciphers":
+            front_end._SerializeCipher(
+                communicator.VerifiedCipher(cipher.cipher.SerializeToString(),
+                                            cipher.cipher_metadata)),
+        "public_keys":
+            front_end._SerializePublicKey(public_key),
+        "session_ciphers":
+            front_end._SerializeSessionCipher(cipher),
+    }
+
+    for name, entry in entries.iteritems():
+      cache = shared_cache.SharedMemoryCache(
+          1, slot_size=shared_cache.CACHE_SLOT_SIZES[name])
+      self.assertTrue(cache.Put("key", entry), name)
+      cache.Close()
+
   def testX509Verify(self):
     """X509 Verify can have several failure paths."""
 
@@ -754,6 +1151,25 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       except communicator.DecodingError as e:
         logging.debug("Detected alteration at %s: %s", x, e)
 
+  def testClientOnlyUsesCodecsAllFrontendsAccept(self):
+    server_name = self.client_communicator.server_name
+    zlib_type = compression.ZCOMPRESSION
+    lz4_type = compression.LZ4COMPRESSION
+
+    with utils.Stubber(compression, "_server_compression", []):
+      self.client_communicator.SetPeerCompression(server_name,
+                                                  [zlib_type, lz4_type])
+      self.assertEqual(compression.ServerCompression(), [zlib_type, lz4_type])
+
+      # Another frontend of the same server does not support lz4.
+      self.client_communicator.SetPeerCompression(server_name, [zlib_type])
+      self.client_communicator.SetPeerCompression(server_name,
+                                                  [zlib_type, lz4_type])
+      self.assertEqual(
+          self.client_communicator.GetPeerCompression(server_name),
+          [zlib_type])
+      self.assertEqual(compression.ServerCompression(), [zlib_type])
+
   def testEnrollingCommunicator(self):
     """Test that the ClientCommunicator generates good keys."""
     self.client_communicator = comms.ClientCommunicator()
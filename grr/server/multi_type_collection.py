@@ -190,4 +190,4 @@ class MultiTypeCollection(object):
           self.collection_id, data_store.DataStore.COLLECTION_ATTRIBUTE):
         mutation_pool.DeleteSubject(rdfvalue.RDFURN(urn))
         if mutation_pool.Size() > 50000:
-          mutation_pool.Flush()
+          mutation_pool.Flush(wait=False)
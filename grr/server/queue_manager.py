@@ -14,6 +14,7 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import data_store
 from grr.server import fleetspeak_utils
+from grr.server import wakeup_channel
 
 
 class Error(Exception):
@@ -112,6 +113,10 @@ class QueueManager(object):
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
+    # Completed requests read in bulk for a number of flows. Keys are session
+    # ids, values are (end timestamp, list of (request, status) tuples).
+    self.prefetched_completed_requests = {}
+
     self.num_notification_shards = config.CONFIG["Worker.queue_shards"]
 
   def GetNotificationShard(self, queue):
@@ -190,10 +195,57 @@ class QueueManager(object):
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now())
 
+    prefetched = self.prefetched_completed_requests.get(session_id)
+    if prefetched is not None:
+      end, completed = prefetched
+      start, requested_end = timestamp
+      if not start and int(requested_end) == end:
+        for request, status in completed:
+          yield request, status
+        return
+
     for request, status in self.data_store.ReadCompletedRequests(
         session_id, timestamp=timestamp, limit=self.request_limit):
       yield request, status
 
+  def MultiFetchCompletedRequests(self, notifications):
+    """Reads the completed requests for a number of flows at once.
+
+    Every flow only gets the requests that were completed up to the timestamp
+    of its notification, exactly as FetchCompletedRequests would return them
+    when called with timestamp=(0, notification.timestamp).
+
+    Args:
+      notifications: A list of GrrNotification objects, one per flow.
+
+    Returns:
+      A dict mapping session ids to lists of (request, status) tuples.
+    """
+    end_timestamps = {}
+    for notification in notifications:
+      end_timestamps[notification.session_id] = int(
+          notification.timestamp or self.frozen_timestamp or
+          rdfvalue.RDFDatetime.Now())
+
+    return self.data_store.MultiReadCompletedRequests(
+        end_timestamps, limit=self.request_limit)
+
+  def PrefetchCompletedRequests(self, session_id, end, completed):
+    """Makes this manager serve completed requests from memory.
+
+    Args:
+      session_id: The flow the requests belong to.
+      end: The end of the time range the requests were read for.
+      completed: A list of (request, status) tuples as returned by
+                 MultiFetchCompletedRequests.
+    """
+    # Without a timestamp the flow reads everything up to now, which the
+    # prefetched requests may not cover.
+    if end is None:
+      return
+
+    self.prefetched_completed_requests[session_id] = (int(end), completed)
+
   def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000):
     """Fetch only completed requests and responses up to a limit."""
     if timestamp is None:
@@ -266,12 +318,13 @@ class QueueManager(object):
 
   def DeleteRequest(self, request):
     """Deletes the request and all its responses from the flow state queue."""
+    self.prefetched_completed_requests.pop(request.session_id, None)
     self.requests_to_delete.append(request)
 
     if request and request.HasField("request"):
       self.DeQueueClientRequest(request.client_id, request.request.task_id)
 
-    data_store.DB.DeleteRequest(request)
+    self.data_store.DeleteRequest(request)
 
   def DestroyFlowStates(self, session_id):
     """Deletes all states in this flow and dequeues all client messages."""
@@ -279,6 +332,9 @@ class QueueManager(object):
 
   def MultiDestroyFlowStates(self, session_ids):
     """Deletes all states in multiple flows and dequeues all client messages."""
+    for session_id in session_ids:
+      self.prefetched_completed_requests.pop(session_id, None)
+
     deleted_requests = self.data_store.MultiDestroyFlowStates(
         session_ids, request_limit=self.request_limit)
 
@@ -288,17 +344,19 @@ class QueueManager(object):
         self.DeQueueClientRequest(request.client_id, request.request.task_id)
 
   def Flush(self):
-    """Writes the changes in this object to the datastore."""
-
-    self.data_store.StoreRequestsAndResponses(
-        new_requests=self.request_queue,
-        new_responses=self.response_queue,
-        requests_to_delete=self.requests_to_delete)
+    """Writes the changes in this object to the datastore.
 
-    # We need to make sure that notifications are written after the requests so
-    # we flush after writing all requests and only notify afterwards.
+    Everything is written with a single mutation pool flush. Mutation pools
+    write notifications after all other mutations, so workers never see a
+    notification before the requests and responses it refers to.
+    """
     mutation_pool = self.data_store.GetMutationPool()
     with mutation_pool:
+      mutation_pool.StoreRequestsAndResponses(
+          new_requests=self.request_queue,
+          new_responses=self.response_queue,
+          requests_to_delete=self.requests_to_delete)
+
       for client_id, messages in self.client_messages_to_delete.iteritems():
         self.Delete(client_id.Queue(), messages, mutation_pool=mutation_pool)
 
@@ -311,11 +369,15 @@ class QueueManager(object):
               timestamp=timestamp,
               mutation_pool=mutation_pool)
 
-    if self.notifications:
       for notification in self.notifications.itervalues():
-        self.NotifyQueue(notification, mutation_pool=mutation_pool)
+        self._MultiNotifyQueue(
+            notification.session_id.Queue(), [notification],
+            mutation_pool=mutation_pool)
 
-      mutation_pool.Flush()
+    if self.notifications:
+      # Only wake up the workers once the notifications can be read.
+      self._WakeUpWorkers(
+          set(n.session_id.Queue() for n in self.notifications.itervalues()))
 
     self.request_queue = []
     self.response_queue = []
@@ -452,8 +514,22 @@ class QueueManager(object):
     Returns:
       dict of notifications objects keyed by priority.
     """
+    return self.GetNotificationsByPriorityForShards(
+        queue, self.GetAllNotificationShards(queue))
+
+  def GetNotificationsByPriorityForShards(self, queue, queue_shards):
+    """Same as GetNotificationsByPriority but for the given shards.
+
+    Used by workers that lease a subset of the notification shards.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      queue_shards: The shards of this queue to read notifications from.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
     output_dict = {}
-    for queue_shard in self.GetAllNotificationShards(queue):
+    for queue_shard in queue_shards:
       self._GetUnsortedNotifications(
           queue_shard, notifications_by_session_id=output_dict)
 
@@ -526,8 +602,7 @@ class QueueManager(object):
 
   def NotifyQueue(self, notification, **kwargs):
     """This signals that there are new messages available in a queue."""
-    self._MultiNotifyQueue(notification.session_id.Queue(), [notification],
-                           **kwargs)
+    self.MultiNotifyQueue([notification], **kwargs)
 
   def MultiNotifyQueue(self, notifications, mutation_pool=None):
     """This is the same as NotifyQueue but for several session_ids at once.
@@ -540,10 +615,24 @@ class QueueManager(object):
       RuntimeError: An invalid session_id was passed.
     """
     extract_queue = lambda notification: notification.session_id.Queue()
-    for queue, notifications in utils.GroupBy(notifications,
-                                              extract_queue).iteritems():
+    notifications_by_queue = utils.GroupBy(notifications, extract_queue)
+    for queue, notifications in notifications_by_queue.iteritems():
       self._MultiNotifyQueue(queue, notifications, mutation_pool=mutation_pool)
 
+    self._WakeUpWorkers(notifications_by_queue)
+
+  def _WakeUpWorkers(self, queues):
+    """Wakes up idle workers waiting for notifications on the given queues.
+
+    Workers woken up before a pending mutation pool is flushed find nothing to
+    do and pick the notifications up on their next poll.
+
+    Args:
+      queues: The queues that received new notifications.
+    """
+    if queues:
+      wakeup_channel.GetChannel().Publish(list(queues))
+
   def _MultiNotifyQueue(self, queue, notifications, mutation_pool=None):
     """Does the actual queuing."""
     notification_list = []
@@ -610,6 +699,27 @@ class QueueManager(object):
 
     return self.data_store.QueueQueryTasks(queue, limit=limit)
 
+  def CountAvailableTasks(self, queue):
+    """Counts the tasks in a queue which can be leased right now.
+
+    Tasks which are currently leased are not counted.
+
+    Args:
+       queue: The task queue to look at, usually client.Queue().
+
+    Returns:
+        The number of tasks QueryAndOwn() could return.
+    """
+    if isinstance(queue, rdf_client.ClientURN):
+      queue = queue.Queue()
+
+    timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now())
+    return len(
+        self.data_store.ResolvePrefix(
+            queue,
+            data_store.DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+            timestamp=timestamp))
+
   def QueryAndOwn(self, queue, lease_seconds=10, limit=1):
     """Returns a list of Tasks leased for a certain time.
 
@@ -624,6 +734,111 @@ class QueueManager(object):
       return mutation_pool.QueueQueryAndOwn(queue, lease_seconds, limit,
                                             self.frozen_timestamp)
 
+  def MultiQueryAndOwn(self, limits, lease_seconds=10):
+    """Leases tasks from several queues with a single data store query.
+
+    Args:
+      limits: A dict mapping queues to the number of tasks to lease from them.
+      lease_seconds: The tasks will be leased for this long.
+    Returns:
+        A dict mapping each queue to the list of GrrMessage() objects leased.
+    """
+    with self.data_store.GetMutationPool() as mutation_pool:
+      return mutation_pool.MultiQueueQueryAndOwn(limits, lease_seconds,
+                                                 self.frozen_timestamp)
+
+
+class NotificationShardLeases(object):
+  """The notification shards of a queue leased by a single worker.
+
+  Instead of round robining through all the shards of a queue, a worker can
+  lease some of them and only look for notifications there. This way
+  different workers don't compete for the same flows. Leases are data store
+  locks on the shard subjects. They are renewed on every Heartbeat() and
+  expire when the worker holding them dies, at which point another worker
+  picks the shard up.
+
+  Note that shards are only processed if enough shards are leased in total,
+  i.e. the number of workers times max_shards should be at least the number
+  of notification shards.
+  """
+
+  def __init__(self, queue, queue_shards, max_shards, lease_time, store=None):
+    """Constructor.
+
+    Args:
+      queue: The queue the shards belong to, usually rdfvalue.RDFURN("W").
+      queue_shards: All the notification shards of the queue.
+      max_shards: The maximum number of shards to hold at the same time.
+      lease_time: Duration of a shard lease in seconds.
+      store: The data store to take the leases in, defaults to data_store.DB.
+    """
+    if store is None:
+      store = data_store.DB
+
+    self.data_store = store
+    self.queue = queue
+    self.queue_shards = list(queue_shards)
+    self.max_shards = max_shards
+    self.lease_time = lease_time
+    # Keys are shard urns, values are the data store locks held on them.
+    self.leases = {}
+
+  def Heartbeat(self):
+    """Renews the leases we hold and leases free shards up to max_shards.
+
+    Returns:
+      The list of shards currently leased by us.
+    """
+    for queue_shard, lease in self.leases.items():
+      # If the lease has expired, somebody else might own the shard already.
+      if lease.CheckLease():
+        try:
+          lease.UpdateLease(self.lease_time)
+          continue
+        except data_store.DBSubjectLockError:
+          pass
+
+      logging.warning("Lost the lease on notification shard %s.", queue_shard)
+      # The lock might belong to another worker by now, releasing it (which
+      # also happens when the lock object is garbage collected) would break
+      # their lease.
+      lease.locked = False
+      stats.STATS.IncrementCounter(
+          "notification_shard_leases_lost", fields=[self.queue.Basename()])
+      del self.leases[queue_shard]
+
+    if len(self.leases) < self.max_shards:
+      # Try free shards in random order so concurrently starting workers don't
+      # all go for the same ones.
+      free_shards = [s for s in self.queue_shards if s not in self.leases]
+      random.shuffle(free_shards)
+      for queue_shard in free_shards:
+        try:
+          self.leases[queue_shard] = self.data_store.DBSubjectLock(
+              queue_shard, lease_time=self.lease_time)
+        except data_store.DBSubjectLockError:
+          continue
+
+        if len(self.leases) >= self.max_shards:
+          break
+
+    stats.STATS.SetGaugeValue(
+        "notification_shards_leased",
+        len(self.leases),
+        fields=[self.queue.Basename()])
+
+    return [s for s in self.queue_shards if s in self.leases]
+
+  def Release(self):
+    """Hands all the leased shards back."""
+    for lease in self.leases.itervalues():
+      lease.Release()
+
+    self.leases = {}
+    stats.STATS.SetGaugeValue(
+        "notification_shards_leased", 0, fields=[self.queue.Basename()])
+
 
 class WellKnownQueueManager(QueueManager):
   """A flow manager for well known flows."""
@@ -664,3 +879,7 @@ class QueueManagerInit(registry.InitHook):
         "notification_queue_count",
         int,
         fields=[("queue_name", str), ("priority", str)])
+    stats.STATS.RegisterGaugeMetric(
+        "notification_shards_leased", int, fields=[("queue_name", str)])
+    stats.STATS.RegisterCounterMetric(
+        "notification_shard_leases_lost", fields=[("queue_name", str)])
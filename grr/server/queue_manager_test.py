@@ -69,6 +69,116 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
       # Responses contain just the status message.
       self.assertEqual(len(responses), 1)
 
+  def _QueueCompletedRequest(self, manager, session_id, request_id):
+    manager.QueueRequest(
+        rdf_flows.RequestState(
+            id=request_id,
+            client_id=test_lib.TEST_CLIENT_ID,
+            next_state="TestState",
+            session_id=session_id))
+    manager.QueueResponse(
+        rdf_flows.GrrMessage(
+            session_id=session_id,
+            request_id=request_id,
+            response_id=1,
+            type=rdf_flows.GrrMessage.Type.STATUS))
+
+  def testMultiFetchCompletedRequests(self):
+    session_ids = [
+        rdfvalue.SessionID(flow_name="test%d" % i) for i in range(3)
+    ]
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for session_id in session_ids[:2]:
+        self._QueueCompletedRequest(manager, session_id, 1)
+      first_timestamp = manager.frozen_timestamp
+
+    self._current_mock_time += 10
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for session_id in session_ids[:2]:
+        self._QueueCompletedRequest(manager, session_id, 2)
+      second_timestamp = manager.frozen_timestamp
+
+    notifications = [
+        rdf_flows.GrrNotification(
+            session_id=session_ids[0], timestamp=first_timestamp),
+        rdf_flows.GrrNotification(
+            session_id=session_ids[1], timestamp=second_timestamp),
+        rdf_flows.GrrNotification(
+            session_id=session_ids[2], timestamp=second_timestamp),
+    ]
+
+    manager = queue_manager.QueueManager(token=self.token)
+    completed = manager.MultiFetchCompletedRequests(notifications)
+
+    # Every flow gets exactly what a single flow fetch would have returned.
+    for notification in notifications:
+      expected = list(
+          manager.FetchCompletedRequests(
+              notification.session_id,
+              timestamp=(0, notification.timestamp)))
+      self.assertEqual(completed[notification.session_id], expected)
+
+    self.assertEqual(
+        [request.id for request, _ in completed[session_ids[0]]], [1])
+    self.assertEqual(
+        [request.id for request, _ in completed[session_ids[1]]], [1, 2])
+    self.assertEqual(completed[session_ids[2]], [])
+
+  def testMultiFetchCompletedRequestsLimitsEachFlow(self):
+    busy, idle = [
+        rdfvalue.SessionID(flow_name=name) for name in ["busy", "idle"]
+    ]
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for request_id in range(1, 6):
+        self._QueueCompletedRequest(manager, busy, request_id)
+      self._QueueCompletedRequest(manager, idle, 1)
+      timestamp = manager.frozen_timestamp
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.request_limit = 4
+    notifications = [
+        rdf_flows.GrrNotification(session_id=session_id, timestamp=timestamp)
+        for session_id in [busy, idle]
+    ]
+    completed = manager.MultiFetchCompletedRequests(notifications)
+
+    # The busy flow does not use up the limit of the idle one.
+    self.assertEqual([request.id for request, _ in completed[idle]], [1])
+    self.assertEqual(completed[busy],
+                     list(manager.FetchCompletedRequests(busy, (0, timestamp))))
+
+  def testPrefetchWithoutTimestampIsIgnored(self):
+    session_id = rdfvalue.SessionID(flow_name="test")
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.PrefetchCompletedRequests(session_id, None, [])
+    self.assertNotIn(session_id, manager.prefetched_completed_requests)
+
+  def testPrefetchedCompletedRequestsAreDroppedOnDelete(self):
+    session_id = rdfvalue.SessionID(flow_name="test")
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      self._QueueCompletedRequest(manager, session_id, 1)
+      timestamp = manager.frozen_timestamp
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.PrefetchCompletedRequests(session_id, timestamp, [])
+
+    # Prefetched data is used for the matching time range only.
+    self.assertEqual(
+        list(manager.FetchCompletedRequests(session_id, (0, timestamp))), [])
+    later = (0, int(timestamp) + 1)
+    self.assertEqual(
+        len(list(manager.FetchCompletedRequests(session_id, later))), 1)
+
+    # Deleting a request invalidates what was prefetched for the flow.
+    manager.DeleteRequest(rdf_flows.RequestState(id=1, session_id=session_id))
+    self.assertEqual(
+        len(list(manager.FetchCompletedRequests(session_id, (0, timestamp)))),
+        1)
+
   def testDeleteRequest(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID(flow_name="test3")
@@ -143,6 +253,27 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
 
     self.assertEqual(data_store.DB.ResolveRow(session_id.Add("state")), [])
 
+  def testCountAvailableTasks(self):
+    test_queue = rdfvalue.RDFURN("fooCountAvailable")
+    tasks = [
+        rdf_flows.GrrMessage(
+            queue=test_queue,
+            session_id="aff4:/Test",
+            generate_task_id=True) for _ in range(3)
+    ]
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      manager.Schedule(tasks, pool)
+
+    self.assertEqual(manager.CountAvailableTasks(test_queue), 3)
+
+    # Leased tasks are not available.
+    manager.QueryAndOwn(test_queue, lease_seconds=100, limit=2)
+    self.assertEqual(manager.CountAvailableTasks(test_queue), 1)
+
+    self._current_mock_time += 110
+    self.assertEqual(manager.CountAvailableTasks(test_queue), 3)
+
   def testSchedule(self):
     """Test the ability to schedule a task."""
     test_queue = rdfvalue.RDFURN("fooSchedule")
@@ -467,8 +598,11 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
 
     self.config_overrider = test_lib.ConfigOverrider({"Worker.queue_shards": 2})
     self.config_overrider.Start()
+    self.shard_leases = []
 
   def tearDown(self):
+    for leases in self.shard_leases:
+      leases.Release()
     super(MultiShardedQueueManagerTest, self).tearDown()
     self.config_overrider.Stop()
 
@@ -545,6 +679,82 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     notifications = manager.GetNotificationsForAllShards(queues.HUNTS)
     self.assertEqual(len(notifications), 2)
 
+  def testGetNotificationsByPriorityForShards(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.QueueNotification(
+        session_id=rdfvalue.SessionID(
+            base="aff4:/hunts", queue=queues.HUNTS, flow_name="42"))
+    manager.Flush()
+    manager.QueueNotification(
+        session_id=rdfvalue.SessionID(
+            base="aff4:/hunts", queue=queues.HUNTS, flow_name="43"))
+    manager.Flush()
+
+    seen = set()
+    for queue_shard in manager.GetAllNotificationShards(queues.HUNTS):
+      by_priority = manager.GetNotificationsByPriorityForShards(
+          queues.HUNTS, [queue_shard])
+      notifications = sum(by_priority.values(), [])
+      self.assertEqual(len(notifications), 1)
+      seen.add(notifications[0].session_id.FlowName())
+
+    self.assertEqual(seen, set(["42", "43"]))
+
+  def _ShardLeases(self, max_shards, lease_time=100):
+    manager = queue_manager.QueueManager(token=self.token)
+    leases = queue_manager.NotificationShardLeases(
+        queues.HUNTS,
+        manager.GetAllNotificationShards(queues.HUNTS),
+        max_shards,
+        lease_time)
+    self.shard_leases.append(leases)
+    return leases
+
+  def testNotificationShardLeasesAreExclusive(self):
+    leases_1 = self._ShardLeases(1)
+    leases_2 = self._ShardLeases(1)
+    leases_3 = self._ShardLeases(1)
+
+    shards_1 = leases_1.Heartbeat()
+    shards_2 = leases_2.Heartbeat()
+    self.assertEqual(len(shards_1), 1)
+    self.assertEqual(len(shards_2), 1)
+    self.assertNotEqual(shards_1, shards_2)
+
+    # All the shards are taken.
+    self.assertEqual(leases_3.Heartbeat(), [])
+
+    # Renewing keeps the same shards.
+    self.assertEqual(leases_1.Heartbeat(), shards_1)
+
+    # Released shards can be leased by other workers.
+    leases_1.Release()
+    self.assertEqual(leases_3.Heartbeat(), shards_1)
+
+  def testNotificationShardLeaseIsLimitedToMaxShards(self):
+    leases = self._ShardLeases(5)
+    self.assertEqual(
+        leases.Heartbeat(),
+        queue_manager.QueueManager(
+            token=self.token).GetAllNotificationShards(queues.HUNTS))
+
+  def testExpiredNotificationShardLeasesAreTakenOver(self):
+    with test_lib.FakeTime(1000):
+      leases_1 = self._ShardLeases(2, lease_time=100)
+      self.assertEqual(len(leases_1.Heartbeat()), 2)
+
+    with test_lib.FakeTime(1050):
+      leases_2 = self._ShardLeases(2, lease_time=100)
+      self.assertEqual(leases_2.Heartbeat(), [])
+
+    # leases_1 died without releasing its shards.
+    with test_lib.FakeTime(1101):
+      self.assertEqual(len(leases_2.Heartbeat()), 2)
+
+    # The lease was lost in the meantime so the old owner doesn't renew it.
+    with test_lib.FakeTime(1102):
+      self.assertEqual(leases_1.Heartbeat(), [])
+
   def testNotificationRequeueing(self):
     with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
       session_id = rdfvalue.SessionID(
@@ -2,13 +2,16 @@
 """A collection of records stored sequentially.
 """
 
+import bisect
 import collections
 import random
 import threading
 import time
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
 
@@ -180,6 +183,9 @@ class BackgroundIndexUpdater(object):
 
   def __init__(self):
     self.to_process = collections.deque()
+    # Collections waiting in to_process. Busy collections ask for an update
+    # much more often than they need one, so they are only queued once.
+    self.queued = set()
     self.cv = threading.Condition()
 
   def ExitNow(self):
@@ -190,6 +196,10 @@ class BackgroundIndexUpdater(object):
 
   def AddIndexToUpdate(self, collection_cls, index_urn):
     with self.cv:
+      key = (collection_cls, utils.SmartUnicode(index_urn))
+      if key in self.queued:
+        return
+      self.queued.add(key)
       self.to_process.append((collection_cls, index_urn,
                               time.time() + self.INDEX_DELAY))
       self.cv.notify()
@@ -214,6 +224,8 @@ class BackgroundIndexUpdater(object):
         time.sleep(next_time - now)
         now = time.time()
 
+      with self.cv:
+        self.queued.discard((next_cls, utils.SmartUnicode(next_urn)))
       self.ProcessCollection(next_cls, next_urn)
 
 
@@ -231,6 +243,65 @@ class UpdaterStartHook(registry.InitHook):
     t.start()
 
 
+class CollectionIndex(object):
+  """The index points of an IndexedSequentialCollection.
+
+  Indexes are shared by all collection objects for the same collection in a
+  process through the index cache, see GetIndexCache().
+  """
+
+  def __init__(self):
+    # Maps record number i to the (timestamp, suffix) pair record i was stored
+    # at. Only contains points that are also written to the data store.
+    self.points = {0: (0, 0)}
+    # The keys of points, sorted.
+    self.numbers = [0]
+    # The record number and (timestamp, suffix) of the last record known to be
+    # older than INDEX_WRITE_DELAY. This is a running count that lets
+    # CalculateLength continue where it stopped last time instead of at the
+    # last index point.
+    self.tail = (0, (0, 0))
+    self.lock = threading.RLock()
+
+  @property
+  def max_indexed(self):
+    return self.numbers[-1]
+
+  def Add(self, i, ts):
+    with self.lock:
+      if i not in self.points:
+        bisect.insort(self.numbers, i)
+      self.points[i] = ts
+
+  def UpdateTail(self, i, ts):
+    with self.lock:
+      if i > self.tail[0]:
+        self.tail = (i, ts)
+
+  def Closest(self, i):
+    """Returns (record number, (timestamp, suffix)) of the best start for i."""
+    with self.lock:
+      n = self.numbers[bisect.bisect_right(self.numbers, i) - 1]
+      if n < self.tail[0] <= i:
+        return self.tail
+      return n, self.points[n]
+
+
+_INDEX_CACHE = None
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+def GetIndexCache():
+  """Returns the process wide cache of loaded collection indexes."""
+  global _INDEX_CACHE
+  with _INDEX_CACHE_LOCK:
+    if _INDEX_CACHE is None:
+      _INDEX_CACHE = utils.TimeBasedCache(
+          max_size=config.CONFIG["Datastore.collection_index_cache_size"],
+          max_age=600)
+    return _INDEX_CACHE
+
+
 class IndexedSequentialCollection(SequentialCollection):
   """An indexed sequential collection of RDFValues.
 
@@ -241,12 +312,13 @@ class IndexedSequentialCollection(SequentialCollection):
     INDEX_WRITE_DELAY.
   """
 
-  # How many records between index entries. Subclasses may change this.  The
-  # full index must fit comfortably in RAM, default is meant to be reasonable
-  # for collections of up to ~1b small records. (Assumes we can have ~1m index
-  # points in ram, and that reading 1k records is reasonably fast.)
+  # How many records between index entries. Subclasses may change this, if
+  # unset Datastore.collection_index_spacing is used. The full index must fit
+  # comfortably in RAM, 1024 is meant to be reasonable for collections of up to
+  # ~1b small records. (Assumes we can have ~1m index points in ram, and that
+  # reading 1k records is reasonably fast.)
 
-  INDEX_SPACING = 1024
+  INDEX_SPACING = None
 
   # An attribute name of the form "index:sc_<i>" at timestamp <t> indicates that
   # the item with record number i was stored at timestamp t. The timestamp
@@ -262,58 +334,65 @@ class IndexedSequentialCollection(SequentialCollection):
   def __init__(self, *args, **kwargs):
     super(IndexedSequentialCollection, self).__init__(*args, **kwargs)
     self._index = None
+    self._collection_index = None
+
+  @classmethod
+  def _IndexSpacing(cls):
+    return cls.INDEX_SPACING or config.CONFIG[
+        "Datastore.collection_index_spacing"]
+
+  @property
+  def _max_indexed(self):
+    return self._collection_index.max_indexed
 
   def _ReadIndex(self):
     if self._index:
       return
-    self._index = {0: (0, 0)}
-    self._max_indexed = 0
-    for (index, ts, suffix) in data_store.DB.CollectionReadIndex(
-        self.collection_id):
-      self._index[index] = (ts, suffix)
-      self._max_indexed = max(index, self._max_indexed)
+
+    cache = GetIndexCache()
+    try:
+      self._collection_index = cache.Get(self.collection_id)
+    except KeyError:
+      self._collection_index = CollectionIndex()
+      for (index, ts, suffix) in data_store.DB.CollectionReadIndex(
+          self.collection_id):
+        self._collection_index.Add(index, (ts, suffix))
+      cache.Put(self.collection_id, self._collection_index)
+
+    self._index = self._collection_index.points
 
   def _MaybeWriteIndex(self, i, ts, mutation_pool):
     """Write index marker i."""
-    if i > self._max_indexed and i % self.INDEX_SPACING == 0:
+    if i > self._max_indexed and i % self._IndexSpacing() == 0:
       # We only write the index if the timestamp is more than 5 minutes in the
       # past: hacky defense against a late write changing the count.
       if ts[0] < (rdfvalue.RDFDatetime.Now() -
                   self.INDEX_WRITE_DELAY).AsMicrosecondsSinceEpoch():
         mutation_pool.CollectionAddIndex(self.collection_id, i, ts[0], ts[1])
-        self._index[i] = ts
-        self._max_indexed = max(i, self._max_indexed)
+        self._collection_index.Add(i, ts)
 
   def _IndexedScan(self, i, max_records=None):
     """Scan records starting with index i."""
     self._ReadIndex()
 
-    # The record number that we will read next.
-    idx = 0
-    # The timestamp that we will start reading from.
-    start_ts = 0
-    if i >= self._max_indexed:
-      start_ts = max((0, 0), (self._index[self._max_indexed][0],
-                              self._index[self._max_indexed][1] - 1))
-      idx = self._max_indexed
-    else:
-      try:
-        possible_idx = i - i % self.INDEX_SPACING
-        start_ts = (max(0, self._index[possible_idx][0]),
-                    self._index[possible_idx][1] - 1)
-        idx = possible_idx
-      except KeyError:
-        pass
+    # The record number that we will read next and the timestamp that we will
+    # start reading from.
+    idx, (ts, suffix) = self._collection_index.Closest(i)
+    start_ts = max((0, 0), (ts, suffix - 1))
 
     if max_records is not None:
       max_records += i - idx
 
+    final_before = (rdfvalue.RDFDatetime.Now() -
+                    self.INDEX_WRITE_DELAY).AsMicrosecondsSinceEpoch()
     with data_store.DB.GetMutationPool() as mutation_pool:
       for (ts, value) in self.Scan(
           after_timestamp=start_ts,
           max_records=max_records,
           include_suffix=True):
         self._MaybeWriteIndex(idx, ts, mutation_pool)
+        if ts[0] < final_before:
+          self._collection_index.UpdateTail(idx, ts)
         if idx >= i:
           yield (idx, ts, value)
         idx += 1
@@ -333,7 +412,8 @@ class IndexedSequentialCollection(SequentialCollection):
   def CalculateLength(self):
     self._ReadIndex()
     highest_index = None
-    for (i, _, _) in self._IndexedScan(self._max_indexed):
+    start = max(self._max_indexed, self._collection_index.tail[0])
+    for (i, _, _) in self._IndexedScan(start):
       highest_index = i
     if highest_index is None:
       return 0
@@ -344,9 +424,23 @@ class IndexedSequentialCollection(SequentialCollection):
 
   def UpdateIndex(self):
     self._ReadIndex()
-    for _ in self._IndexedScan(self._max_indexed):
+    start = max(self._max_indexed, self._collection_index.tail[0])
+    for _ in self._IndexedScan(start):
       pass
 
+  def Delete(self):
+    GetIndexCache().ExpireObject(self.collection_id)
+    index_attributes = [
+        data_store.DataStore.COLLECTION_INDEX_ATTRIBUTE_PREFIX + "%08x" % index
+        for index, _, _ in data_store.DB.CollectionReadIndex(self.collection_id)
+    ]
+    super(IndexedSequentialCollection, self).Delete()
+    if index_attributes:
+      with data_store.DB.GetMutationPool() as pool:
+        pool.DeleteAttributes(self.collection_id, index_attributes)
+    self._index = None
+    self._collection_index = None
+
   @classmethod
   def StaticAdd(cls,
                 collection_urn,
@@ -360,7 +454,7 @@ class IndexedSequentialCollection(SequentialCollection):
         timestamp=timestamp,
         suffix=suffix,
         mutation_pool=mutation_pool)
-    if random.randint(0, cls.INDEX_SPACING) == 0:
+    if random.randint(0, cls._IndexSpacing()) == 0:
       BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(cls, collection_urn)
     return r
 
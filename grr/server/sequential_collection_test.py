@@ -225,6 +225,76 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
         for i in range(data_size - spacing + 5, data_size - spacing - 5, -1):
           self.assertEqual(collection[i], i)
 
+  def testIndexIsSharedBetweenCollectionObjects(self):
+    spacing = 10
+    with utils.Stubber(sequential_collection.IndexedSequentialCollection,
+                       "INDEX_SPACING", spacing):
+      urn = "aff4:/sequential_collection/testIndexIsShared"
+      collection = self._TestCollection(urn)
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(5 * spacing):
+          collection.StaticAdd(urn, rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("10m")):
+        self.assertEqual(collection.CalculateLength(), 5 * spacing)
+
+      with test_lib.Instrument(data_store.DB.__class__,
+                               "CollectionReadIndex") as read_index:
+        collection = self._TestCollection(urn)
+        self.assertEqual(collection[3 * spacing + 2], 3 * spacing + 2)
+        self.assertEqual(read_index.call_count, 0)
+
+      self.assertEqual(
+          sorted(collection._index.keys()), [i * spacing for i in xrange(5)])
+
+  def testLengthContinuesFromLastCountedRecord(self):
+    spacing = 10
+    with utils.Stubber(sequential_collection.IndexedSequentialCollection,
+                       "INDEX_SPACING", spacing):
+      urn = "aff4:/sequential_collection/testLengthContinues"
+      collection = self._TestCollection(urn)
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(2 * spacing + 5):
+          collection.StaticAdd(urn, rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("10m")):
+        self.assertEqual(collection.CalculateLength(), 2 * spacing + 5)
+        self.assertEqual(collection._collection_index.tail[0], 2 * spacing + 4)
+
+        with test_lib.Instrument(sequential_collection.SequentialCollection,
+                                 "Scan") as scan:
+          self.assertEqual(len(collection), 2 * spacing + 5)
+          self.assertEqual(scan.call_count, 1)
+          # The scan starts at the last counted record, not the last index
+          # point.
+          after_timestamp = scan.kwargs[0]["after_timestamp"]
+          self.assertEqual(after_timestamp[0],
+                           collection._collection_index.tail[1][0])
+
+  def testDeleteRemovesIndex(self):
+    spacing = 10
+    with utils.Stubber(sequential_collection.IndexedSequentialCollection,
+                       "INDEX_SPACING", spacing):
+      urn = "aff4:/sequential_collection/testDeleteRemovesIndex"
+      collection = self._TestCollection(urn)
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(3 * spacing):
+          collection.StaticAdd(urn, rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("10m")):
+        self.assertEqual(collection.CalculateLength(), 3 * spacing)
+
+      collection.Delete()
+      self.assertEqual(
+          list(data_store.DB.CollectionReadIndex(rdfvalue.RDFURN(urn))), [])
+
+      collection = self._TestCollection(urn)
+      self.assertEqual(collection.CalculateLength(), 0)
+      self.assertEqual(sorted(collection._index.keys()), [0])
+
   def testListing(self):
     test_urn = "aff4:/sequential_collection/testIndexedListing"
     collection = self._TestCollection(test_urn)
@@ -269,6 +339,14 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
       if not indexing_done.wait(timeout=10):
         self.fail("Indexing did not finish in time.")
 
+  def testIndexUpdatesAreQueuedOnce(self):
+    biu = sequential_collection.BackgroundIndexUpdater()
+    urn = rdfvalue.RDFURN("aff4:/sequential_collection/testQueuedOnce")
+    for _ in range(10):
+      biu.AddIndexToUpdate(TestIndexedSequentialCollection, urn)
+    biu.AddIndexToUpdate(TestIndexedSequentialCollection, urn.Add("other"))
+    self.assertEqual(len(biu.to_process), 2)
+
 
 class GeneralIndexedCollectionTest(aff4_test_lib.AFF4ObjectTest):
 
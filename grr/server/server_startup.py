@@ -33,12 +33,17 @@ def DropPrivileges():
 
 # Make sure we do not reinitialize multiple times.
 INIT_RAN = False
+CONFIG_INIT_RAN = False
 
 
-def Init():
-  """Run all required startup routines and initialization hooks."""
-  global INIT_RAN
-  if INIT_RAN:
+def InitConfig():
+  """Parses the configuration, the first step of Init.
+
+  Processes that fork before initializing can call this to read the
+  configuration without starting any of the services Init starts.
+  """
+  global CONFIG_INIT_RAN
+  if CONFIG_INIT_RAN:
     return
 
   # Set up a temporary syslog handler so we have somewhere to log problems
@@ -58,6 +63,17 @@ def Init():
     syslog_logger.exception("Died during config initialization")
     raise
 
+  CONFIG_INIT_RAN = True
+
+
+def Init():
+  """Run all required startup routines and initialization hooks."""
+  global INIT_RAN
+  if INIT_RAN:
+    return
+
+  InitConfig()
+
   if hasattr(registry_init, "stats"):
     logging.debug("Using local stats collector.")
     stats.STATS = registry_init.stats.StatsCollector()
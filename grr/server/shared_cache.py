@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""Caches shared by the processes of a multi-process frontend.
+
+Verifying a client's cipher and creating the cipher for messages to it cost
+RSA operations and looking up its public key costs a data store read. Frontend
+processes forked from the same parent share what they learned through fixed
+size caches in anonymous shared memory, so a process that was just (re)started
+does not have to redo this work.
+
+The caches hold session keys, so nothing is ever written to disk.
+"""
+
+import hashlib
+import logging
+import mmap
+import struct
+import threading
+import zlib
+
+from grr import config
+from grr.lib import stats
+from grr.lib import utils
+
+
+class SharedMemoryCache(object):
+  """A lossy key/value store of strings in memory shared with child processes.
+
+  The memory is divided into slots of equal size and every key is stored in a
+  slot determined by its hash, replacing whatever was there. Values too large
+  for a slot are not cached, Put() returns False for them.
+
+  Writes are not locked. Each slot carries a checksum, so entries that are
+  read while another process writes them are detected and treated as missing.
+  The checksum only protects against concurrent writes, all processes sharing
+  the memory are trusted.
+  """
+
+  # Checksum, key digest and value length.
+  _HEADER = struct.Struct("<I20sI")
+
+  def __init__(self, slots, slot_size=1024):
+    """Constructor.
+
+    Args:
+      slots: The number of slots, i.e. the maximum number of entries.
+      slot_size: The size of a slot in bytes.
+    """
+    self.slots = slots
+    self.slot_size = slot_size
+    self.max_value_size = slot_size - self._HEADER.size
+    # Anonymous mappings are shared with the processes forked after this.
+    self.memory = mmap.mmap(-1, slots * slot_size)
+
+  def _Locate(self, key):
+    digest = hashlib.sha1(key).digest()
+    index = struct.unpack_from("<Q", digest)[0] % self.slots
+    return digest, index * self.slot_size
+
+  def _Checksum(self, digest, value):
+    return zlib.crc32(value, zlib.crc32(digest)) & 0xffffffff
+
+  def Get(self, key):
+    """Returns the value stored for key.
+
+    Args:
+      key: A string.
+
+    Returns:
+      The value, a string.
+
+    Raises:
+      KeyError: If the key is not cached.
+    """
+    digest, offset = self._Locate(key)
+    checksum, stored_digest, length = self._HEADER.unpack_from(
+        self.memory, offset)
+    if stored_digest != digest or length > self.max_value_size:
+      raise KeyError(key)
+
+    start = offset + self._HEADER.size
+    value = self.memory[start:start + length]
+    if self._Checksum(digest, value) != checksum:
+      raise KeyError(key)
+
+    return value
+
+  def Put(self, key, value):
+    """Stores a value, evicting the entry that used its slot.
+
+    Args:
+      key: A string.
+      value: A string.
+
+    Returns:
+      False if the value is too large for a slot and was not stored, True
+      otherwise.
+    """
+    if len(value) > self.max_value_size:
+      return False
+
+    digest, offset = self._Locate(key)
+    entry = self._HEADER.pack(self._Checksum(digest, value), digest,
+                              len(value)) + value
+    self.memory[offset:offset + len(entry)] = entry
+    return True
+
+  def Close(self):
+    self.memory.close()
+
+
+class SharedCacheView(object):
+  """A per process cache in front of a SharedMemoryCache.
+
+  This has the Get/Put interface of utils.FastStore and keeps the objects
+  recently used by this process. Misses are looked up in the shared cache and
+  everything put in is written through to it.
+  """
+
+  def __init__(self, name, shared_cache, serialize, parse, max_size=50000):
+    """Constructor.
+
+    Args:
+      name: The name of the cache, used in metrics.
+      shared_cache: The SharedMemoryCache to use.
+      serialize: A function turning a value into a string.
+      parse: A function turning a string back into a value.
+      max_size: The number of entries kept in this process.
+    """
+    self.name = name
+    self.shared_cache = shared_cache
+    self.serialize = serialize
+    self.parse = parse
+    self.local_cache = utils.FastStore(max_size=max_size)
+    self.oversize_logged = False
+
+  def __len__(self):
+    return len(self.local_cache)
+
+  def Get(self, key):
+    try:
+      value = self.local_cache.Get(key)
+      stats.STATS.IncrementCounter(
+          "grr_shared_cache", fields=[self.name, "local_hits"])
+      return value
+    except KeyError:
+      pass
+
+    try:
+      value = self.parse(self.shared_cache.Get(utils.SmartStr(key)))
+    except KeyError:
+      stats.STATS.IncrementCounter(
+          "grr_shared_cache", fields=[self.name, "misses"])
+      raise
+
+    stats.STATS.IncrementCounter(
+        "grr_shared_cache", fields=[self.name, "shared_hits"])
+    self.local_cache.Put(key, value)
+    return value
+
+  def Put(self, key, value):
+    self.local_cache.Put(key, value)
+    serialized = self.serialize(value)
+    if self.shared_cache.Put(utils.SmartStr(key), serialized):
+      return
+
+    stats.STATS.IncrementCounter(
+        "grr_shared_cache", fields=[self.name, "oversize"])
+    if not self.oversize_logged:
+      self.oversize_logged = True
+      logging.warning(
+          "Value of %d bytes is too large for shared cache %s (at most %d "
+          "bytes), values this large are only cached per process.",
+          len(serialized), self.name, self.shared_cache.max_value_size)
+
+
+# Shared caches by name.
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Slot sizes in bytes by cache name. Entries grow with the RSA key sizes of
+# the server and clients, these fit keys of up to 4096 bits.
+CACHE_SLOT_SIZES = {
+    "ciphers": 1024,
+    "public_keys": 1024,
+    "session_ciphers": 2048,
+}
+
+CACHE_NAMES = sorted(CACHE_SLOT_SIZES)
+
+
+def CreateCaches():
+  """Creates the shared caches, has to be called before forking."""
+  with _caches_lock:
+    for name in CACHE_NAMES:
+      if name not in _caches:
+        _caches[name] = SharedMemoryCache(
+            config.CONFIG["Frontend.shared_cache_size"],
+            slot_size=CACHE_SLOT_SIZES[name])
+
+
+def GetCache(name):
+  """Returns the shared cache of this name or None if there is none."""
+  with _caches_lock:
+    return _caches.get(name)
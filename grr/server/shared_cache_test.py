@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Tests for the caches shared by frontend processes."""
+
+import os
+
+
+from grr.lib import flags
+from grr.lib import stats
+from grr.server import shared_cache
+from grr.test_lib import test_lib
+
+
+class SharedMemoryCacheTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(SharedMemoryCacheTest, self).setUp()
+    self.cache = shared_cache.SharedMemoryCache(16, slot_size=256)
+
+  def tearDown(self):
+    self.cache.Close()
+    super(SharedMemoryCacheTest, self).tearDown()
+
+  def testGetAndPut(self):
+    self.cache.Put("key", "value")
+    self.assertEqual(self.cache.Get("key"), "value")
+    self.assertRaises(KeyError, self.cache.Get, "other key")
+
+  def testPutReplacesValue(self):
+    self.cache.Put("key", "value")
+    self.cache.Put("key", "new value")
+    self.assertEqual(self.cache.Get("key"), "new value")
+
+  def testEntriesAreEvicted(self):
+    for i in range(100):
+      self.cache.Put("key%d" % i, "value%d" % i)
+
+    found = 0
+    for i in range(100):
+      try:
+        self.assertEqual(self.cache.Get("key%d" % i), "value%d" % i)
+        found += 1
+      except KeyError:
+        pass
+    self.assertLessEqual(found, 16)
+    self.assertEqual(self.cache.Get("key99"), "value99")
+
+  def testLargeValuesAreNotCached(self):
+    self.assertFalse(self.cache.Put("key", "x" * 1024))
+    self.assertRaises(KeyError, self.cache.Get, "key")
+
+  def testCorruptedEntriesAreMissing(self):
+    self.cache.Put("key", "value")
+    _, offset = self.cache._Locate("key")
+    # Simulate a concurrent write to the value.
+    value_offset = offset + self.cache._HEADER.size
+    self.cache.memory[value_offset:value_offset + 5] = "VALUE"
+    self.assertRaises(KeyError, self.cache.Get, "key")
+
+  def testEntriesAreSharedWithForkedProcesses(self):
+    pid = os.fork()
+    if pid == 0:
+      self.cache.Put("key", "written by child")
+      os._exit(0)  # pylint: disable=protected-access
+
+    os.waitpid(pid, 0)
+    self.assertEqual(self.cache.Get("key"), "written by child")
+
+
+class SharedCacheViewTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(SharedCacheViewTest, self).setUp()
+    self.shared = shared_cache.SharedMemoryCache(16)
+
+  def _CreateView(self):
+    return shared_cache.SharedCacheView("test", self.shared, str, int)
+
+  def testValuesAreReadFromTheSharedCache(self):
+    self._CreateView().Put("key", 42)
+
+    view = self._CreateView()
+    self.assertEqual(view.Get("key"), 42)
+    self.assertEqual(len(view), 1)
+
+  def testMissesRaise(self):
+    self.assertRaises(KeyError, self._CreateView().Get, "key")
+
+  def testLargeValuesAreCountedAndKeptLocally(self):
+    view = self._CreateView()
+    oversize = stats.STATS.GetMetricValue(
+        "grr_shared_cache", fields=["test", "oversize"])
+
+    view.Put("key", 10**2000)
+    self.assertEqual(view.Get("key"), 10**2000)
+    self.assertRaises(KeyError, self._CreateView().Get, "key")
+    self.assertEqual(
+        stats.STATS.GetMetricValue(
+            "grr_shared_cache", fields=["test", "oversize"]), oversize + 1)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
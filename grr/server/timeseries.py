@@ -2,16 +2,39 @@
 """Operations on a series of points, indexed by time.
 """
 
-import copy
+import array
+import bisect
+import itertools
+import operator
 
 from grr.lib import rdfvalue
 
 NORMALIZE_MODE_GAUGE = 1
 NORMALIZE_MODE_COUNTER = 2
 
+# Missing values are stored as NaN.
+_MISSING = float("nan")
+
+
+def _IsMissing(value):
+  return value != value  # pylint: disable=comparison-with-itself
+
+
+def _IsIntegral(value):
+  return value is None or isinstance(value, (int, long))
+
 
 class Timeseries(object):
-  """Timeseries contains a sequence of points, each with a timestamp."""
+  """Timeseries contains a sequence of points, each with a timestamp.
+
+  Timestamps are kept in a contiguous array of doubles, so that long series
+  take little memory and the operations below run as tight loops. Timestamps
+  are microseconds, which doubles represent exactly for any reasonable date.
+
+  Values go into an array of doubles as well once a non-integer value has been
+  added. Until then they stay a list of Python integers: counters can grow past
+  2**53, where doubles would silently round them.
+  """
 
   def __init__(self, initializer=None):
     """Create a timeseries with an optional initializer.
@@ -23,13 +46,59 @@ class Timeseries(object):
       RuntimeError: If initializer is not understood.
     """
     if initializer is None:
-      self.data = []
+      self._Reset()
       return
     if isinstance(initializer, Timeseries):
-      self.data = copy.deepcopy(initializer.data)
+      self._integral = initializer._integral
+      self._values = self._MakeValues(initializer._values)
+      self._timestamps = array.array("d", initializer._timestamps)
       return
     raise RuntimeError("Unrecognized initializer.")
 
+  @classmethod
+  def FromPairs(cls, value_timestamp_pairs):
+    """Builds a timeseries from (value, timestamp) pairs in one go.
+
+    Args:
+      value_timestamp_pairs: An iterable of (value, timestamp) tuples, ordered
+        by increasing timestamp, e.g. rows read from the data store.
+
+    Returns:
+      A new Timeseries.
+
+    Raises:
+      RuntimeError: If the timestamps are not increasing.
+    """
+    series = cls()
+    series.MultiAppend(value_timestamp_pairs)
+    return series
+
+  def _Reset(self):
+    self._integral = True
+    self._values = self._MakeValues()
+    self._timestamps = array.array("d")
+
+  def _MakeValues(self, values=()):
+    """Returns a new value container suitable for the current series type."""
+    if self._integral:
+      return list(values)
+    return array.array("d", values)
+
+  def _UpdateIntegral(self, integral):
+    """Switches to float storage when a non-integer value is added."""
+    if self._integral and not integral:
+      self._integral = False
+      self._values = self._MakeValues(self._values)
+
+  @property
+  def data(self):
+    """The points of this series as a list of [value, timestamp] lists."""
+    if self._integral:
+      values = [None if _IsMissing(v) else int(v) for v in self._values]
+    else:
+      values = [None if _IsMissing(v) else v for v in self._values]
+    return [[v, int(t)] for v, t in itertools.izip(values, self._timestamps)]
+
   def _NormalizeTime(self, time):
     """Normalize a time to be an int measured in microseconds."""
     if isinstance(time, rdfvalue.RDFDatetime):
@@ -52,18 +121,38 @@ class Timeseries(object):
     """
 
     timestamp = self._NormalizeTime(timestamp)
-    if self.data and timestamp < self.data[-1][1]:
+    if self._timestamps and timestamp < self._timestamps[-1]:
       raise RuntimeError("Next timestamp must be larger.")
-    self.data.append([value, timestamp])
+    self._UpdateIntegral(_IsIntegral(value))
+    self._timestamps.append(timestamp)
+    self._values.append(_MISSING if value is None else value)
 
   def MultiAppend(self, value_timestamp_pairs):
     """Adds multiple value<->timestamp pairs.
 
     Args:
       value_timestamp_pairs: Tuples of (value, timestamp).
+
+    Raises:
+      RuntimeError: If the timestamps are not increasing. Nothing is added in
+        this case.
     """
-    for value, timestamp in value_timestamp_pairs:
-      self.Append(value, timestamp)
+    pairs = list(value_timestamp_pairs)
+    values = [_MISSING if v is None else v for v, _ in pairs]
+    timestamps = array.array("d", [
+        t if isinstance(t, (int, long)) else self._NormalizeTime(t)
+        for _, t in pairs
+    ])
+
+    if timestamps:
+      if self._timestamps and timestamps[0] < self._timestamps[-1]:
+        raise RuntimeError("Next timestamp must be larger.")
+      if any(itertools.imap(operator.gt, timestamps, timestamps[1:])):
+        raise RuntimeError("Next timestamp must be larger.")
+
+    self._UpdateIntegral(all(_IsIntegral(v) for v, _ in pairs))
+    self._values.extend(values)
+    self._timestamps.extend(timestamps)
 
   def FilterRange(self, start_time=None, stop_time=None):
     """Filter the series to lie between start_time and stop_time.
@@ -74,14 +163,23 @@ class Timeseries(object):
       start_time: If set, timestamps before start_time will be dropped.
       stop_time: If set, timestamps at or past stop_time will be dropped.
     """
+    # Timestamps are sorted, so the range is found by bisection.
+    start = 0
+    if start_time is not None:
+      start = bisect.bisect_left(self._timestamps,
+                                 self._NormalizeTime(start_time))
+
+    stop = len(self._timestamps)
+    if stop_time is not None:
+      stop = bisect.bisect_left(self._timestamps,
+                                self._NormalizeTime(stop_time))
+
+    if start == 0 and stop == len(self._timestamps):
+      return
 
-    start_time = self._NormalizeTime(start_time)
-    stop_time = self._NormalizeTime(stop_time)
-    self.data = [
-        p for p in self.data
-        if (start_time is None or p[1] >= start_time) and
-        (stop_time is None or p[1] < stop_time)
-    ]
+    stop = max(start, stop)
+    self._values = self._values[start:stop]
+    self._timestamps = self._timestamps[start:stop]
 
   def Normalize(self, period, start_time, stop_time, mode=NORMALIZE_MODE_GAUGE):
     """Normalize the series to have a fixed period over a fixed time range.
@@ -119,33 +217,39 @@ class Timeseries(object):
     period = self._NormalizeTime(period)
     start_time = self._NormalizeTime(start_time)
     stop_time = self._NormalizeTime(stop_time)
-    if not self.data:
+    if not self._timestamps:
       return
 
     self.FilterRange(start_time, stop_time)
 
-    grouped = {}
-    for value, timestamp in self.data:
-      offset = timestamp - start_time
-      shifted_offset = offset - (offset % period)
-      grouped.setdefault(shifted_offset, []).append(value)
-
-    self.data = []
-    last_value = None
-    for offset in range(0, stop_time - start_time, period):
-      g = grouped.get(offset)
-      if mode == NORMALIZE_MODE_GAUGE:
-        v = None
-        if g:
-          v = float(sum(g)) / float(len(g))
-        self.data.append([v, offset + start_time])
-      else:
-        if g:
-          for v in g:
-            if v < last_value:
-              raise RuntimeError("Next value must not be smaller.")
-            last_value = v
-        self.data.append([last_value, offset + start_time])
+    bucket_starts = xrange(start_time, stop_time, period)
+    # Timestamps are sorted, so bisection finds the points of each bucket.
+    bounds = [bisect.bisect_left(self._timestamps, t) for t in bucket_starts]
+    bounds.append(len(self._timestamps))
+    old_values = self._values
+
+    if mode == NORMALIZE_MODE_GAUGE:
+      values = array.array("d")
+      for lo, hi in itertools.izip(bounds, bounds[1:]):
+        if hi > lo:
+          values.append(float(sum(old_values[lo:hi])) / (hi - lo))
+        else:
+          values.append(_MISSING)
+      self._integral = False
+    else:
+      values = self._MakeValues()
+      if any(itertools.imap(operator.gt, old_values, old_values[1:])):
+        raise RuntimeError("Next value must not be smaller.")
+
+      # Each bucket holds the last value seen during or before it.
+      current = _MISSING
+      for hi in bounds[1:]:
+        if hi:
+          current = old_values[hi - 1]
+        values.append(current)
+
+    self._values = values
+    self._timestamps = array.array("d", bucket_starts)
 
   def MakeIncreasing(self):
     """Makes the time series increasing.
@@ -159,15 +263,16 @@ class Timeseries(object):
     larger than the previous level.
 
     """
+    values = self._values
     offset = 0
     last_value = None
-    for p in self.data:
-      if last_value and last_value > p[0]:
+    for i, value in enumerate(values):
+      if last_value and last_value > value:
         # Assume that it was only reset once.
         offset += last_value
-      last_value = p[0]
+      last_value = value
       if offset:
-        p[0] += offset
+        values[i] = value + offset
 
   def ToDeltas(self):
     """Convert the sequence to the sequence of differences between points.
@@ -175,15 +280,16 @@ class Timeseries(object):
     The value of each point v[i] is replaced by v[i+1] - v[i], except for the
     last point which is dropped.
     """
-    if len(self.data) < 2:
-      self.data = []
+    if len(self._timestamps) < 2:
+      self._values = self._MakeValues()
+      self._timestamps = array.array("d")
       return
-    for i in range(0, len(self.data) - 1):
-      if self.data[i][0] is None or self.data[i + 1][0] is None:
-        self.data[i][0] = None
-      else:
-        self.data[i][0] = self.data[i + 1][0] - self.data[i][0]
-    del self.data[-1]
+
+    values = self._values
+    # Missing values stay missing as NaN propagates through the subtraction.
+    self._values = self._MakeValues(
+        b - a for a, b in itertools.izip(values, values[1:]))
+    self._timestamps = self._timestamps[:-1]
 
   def Add(self, other):
     """Add other to self pointwise.
@@ -198,24 +304,33 @@ class Timeseries(object):
     Raises:
       RuntimeError: other does not contain the same timestamps as self.
     """
-    if len(self.data) != len(other.data):
+    if len(self._timestamps) != len(other._timestamps):
       raise RuntimeError("Can only add series of identical lengths.")
-    for i in range(len(self.data)):
-      if self.data[i][1] != other.data[i][1]:
-        raise RuntimeError("Timestamp mismatch.")
-      if self.data[i][0] is None and other.data[i][0] is None:
-        continue
-      self.data[i][0] = (self.data[i][0] or 0) + (other.data[i][0] or 0)
+    if self._timestamps != other._timestamps:
+      raise RuntimeError("Timestamp mismatch.")
+
+    self._UpdateIntegral(other._integral)
+    values = self._MakeValues()
+    for a, b in itertools.izip(self._values, other._values):
+      if _IsMissing(a):
+        values.append(b)
+      elif _IsMissing(b):
+        values.append(a)
+      else:
+        values.append(a + b)
+    self._values = values
 
   def Rescale(self, multiplier):
     """Multiply pointwise by multiplier."""
-    for p in self.data:
-      if p[0] is not None:
-        p[0] *= multiplier
+    self._UpdateIntegral(_IsIntegral(multiplier))
+    # Missing values stay missing as NaN propagates through the product.
+    self._values = self._MakeValues(v * multiplier for v in self._values)
 
   def Mean(self):
     """Return the arithmatic mean of all values."""
-    values = [v for v, _ in self.data if v is not None]
+    values = [v for v in self._values if not _IsMissing(v)]
     if not values:
       return None
+    if self._integral:
+      return sum(values) // len(values)
     return sum(values) / len(values)
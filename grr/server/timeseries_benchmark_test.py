@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Benchmarks for the Timeseries class."""
+
+
+from grr.lib import flags
+from grr.server import timeseries
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import test_lib
+
+
+class TimeseriesBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
+  """Benchmarks the operations used to build stats graphs."""
+
+  REPEATS = 10
+  units = "ms"
+
+  # 30 days of samples taken every 10 seconds.
+  NUM_POINTS = 30 * 24 * 360
+  PERIOD = 10 * 1000000
+
+  def _MakePairs(self):
+    return [(i % 1000, i * self.PERIOD) for i in xrange(self.NUM_POINTS)]
+
+  def testTimeseriesOperations(self):
+    """Times the operations on a 30 day series of counter samples."""
+    pairs = self._MakePairs()
+    series = timeseries.Timeseries.FromPairs(pairs)
+    stop_time = self.NUM_POINTS * self.PERIOD
+
+    def Build():
+      timeseries.Timeseries.FromPairs(pairs)
+
+    def Normalize(mode):
+      s = timeseries.Timeseries(series)
+      s.Normalize(60 * self.PERIOD, 0, stop_time, mode=mode)
+
+    def MakeIncreasingRate():
+      s = timeseries.Timeseries(series)
+      s.MakeIncreasing()
+      s.Normalize(
+          60 * self.PERIOD,
+          0,
+          stop_time,
+          mode=timeseries.NORMALIZE_MODE_COUNTER)
+      s.ToDeltas()
+      s.Rescale(1.0 / 600)
+
+    def Add():
+      s = timeseries.Timeseries(series)
+      s.Add(series)
+
+    self.TimeIt(Build, name="FromPairs")
+    self.TimeIt(
+        Normalize, name="Normalize gauge", mode=timeseries.NORMALIZE_MODE_GAUGE)
+    self.TimeIt(MakeIncreasingRate, name="MakeIncreasing+Normalize+Rate")
+    self.TimeIt(Add, name="Add")
+    self.TimeIt(lambda: series.data, name="data")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
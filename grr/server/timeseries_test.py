@@ -109,6 +109,45 @@ class TimeseriesTest(test_lib.GRRBaseTest):
     for i in range(0, 5):
       self.assertEqual(i, s1.data[i][0])
 
+  def testFromPairs(self):
+    s = timeseries.Timeseries.FromPairs([(1, 1000), (None, 2000), (3, 3000)])
+    self.assertEqual([[1, 1000], [None, 2000], [3, 3000]], s.data)
+
+    with self.assertRaises(RuntimeError):
+      timeseries.Timeseries.FromPairs([(1, 2000), (2, 1000)])
+
+  def testAddKeepsMissingValuesIfMissingInBoth(self):
+    s1 = timeseries.Timeseries.FromPairs([(1, 1000), (None, 2000),
+                                          (None, 3000)])
+    s2 = timeseries.Timeseries.FromPairs([(None, 1000), (2, 2000),
+                                          (None, 3000)])
+    s1.Add(s2)
+    self.assertEqual([[1, 1000], [2, 2000], [None, 3000]], s1.data)
+
+    s3 = timeseries.Timeseries.FromPairs([(1, 1000), (1, 2000), (1, 4000)])
+    with self.assertRaises(RuntimeError):
+      s1.Add(s3)
+
+  def testLargeIntegersAreExact(self):
+    big = 2**53 + 1
+    s = timeseries.Timeseries.FromPairs([(big, 1000), (big + 2, 2000)])
+    s.Append(big + 4, 3000)
+    self.assertEqual([[big, 1000], [big + 2, 2000], [big + 4, 3000]], s.data)
+    self.assertEqual(big + 2, s.Mean())
+
+    s.Normalize(1000, 1000, 4000, mode=timeseries.NORMALIZE_MODE_COUNTER)
+    self.assertEqual([big, big + 2, big + 4], [v for v, _ in s.data])
+
+    s.Add(timeseries.Timeseries(s))
+    self.assertEqual([2 * big, 2 * big + 4, 2 * big + 8],
+                     [v for v, _ in s.data])
+
+    s.ToDeltas()
+    self.assertEqual([4, 4], [v for v, _ in s.data])
+
+    s.Append(0.5, 5000)
+    self.assertEqual([4, 4, 0.5], [v for v, _ in s.data])
+
   def testMean(self):
     s = timeseries.Timeseries()
     self.assertEqual(None, s.Mean())
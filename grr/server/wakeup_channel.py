@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Channels that wake up idle workers when notifications are queued.
+
+Workers poll their queues for notifications. Without a wakeup channel, every
+flow state transition can cost up to a polling interval. The queue manager
+publishes the queues it wrote notifications to on the channel and idle workers
+wait on it, falling back to polling if a wakeup gets lost.
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from grr import config
+from grr.lib import registry
+from grr.lib import utils
+
+
+class WakeupChannel(object):
+  """The wakeup channel base class.
+
+  This implementation does not deliver any wakeups, waiting workers simply
+  sleep for the polling interval.
+  """
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  def Publish(self, queues):
+    """Announces that new notifications were written to the given queues.
+
+    Args:
+      queues: A list of queue urns.
+    """
+
+  def Wait(self, queues, timeout, since=None):
+    """Waits for a publish to one of the queues.
+
+    Args:
+      queues: A list of queue urns.
+      timeout: The maximum number of seconds to wait.
+      since: If given, publishes made after this time (in seconds since the
+        epoch) return immediately, even if they happened before this call.
+
+    Returns:
+      The time of the publish that ended the wait or None on timeout.
+    """
+    del queues, since  # Unused.
+    time.sleep(timeout)
+    return None
+
+  def Close(self):
+    """Releases the resources held by this channel."""
+
+
+class InProcessWakeupChannel(WakeupChannel):
+  """Wakes up workers running in the same process as the publisher."""
+
+  def __init__(self):
+    super(InProcessWakeupChannel, self).__init__()
+    self.condition = threading.Condition()
+    # The time of the last publish, keyed by queue.
+    self.last_published = {}
+
+  def Publish(self, queues):
+    now = time.time()
+    with self.condition:
+      for queue in queues:
+        self.last_published[utils.SmartStr(queue)] = now
+      self.condition.notify_all()
+
+  def _LastPublished(self, queues, since):
+    last = None
+    for queue in queues:
+      published = self.last_published.get(utils.SmartStr(queue))
+      if published is not None and published > since:
+        last = max(last, published)
+    return last
+
+  def Wait(self, queues, timeout, since=None):
+    if since is None:
+      since = time.time()
+
+    deadline = time.time() + timeout
+    with self.condition:
+      while True:
+        published = self._LastPublished(queues, since)
+        if published is not None:
+          return published
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return None
+        self.condition.wait(remaining)
+
+
+class UnixSocketWakeupChannel(WakeupChannel):
+  """Wakes up workers running on the same machine as the publisher.
+
+  Every process waiting on the channel binds a unix datagram socket in
+  Worker.wakeup_socket_dir. Publishers send a datagram to each socket found
+  there.
+  """
+
+  # How long publishers reuse a listing of the socket directory.
+  LISTING_MAX_AGE = 1
+
+  def __init__(self, socket_dir=None):
+    super(UnixSocketWakeupChannel, self).__init__()
+    self.socket_dir = socket_dir or config.CONFIG["Worker.wakeup_socket_dir"]
+    self.lock = threading.Lock()
+    self.listing = []
+    self.listing_time = 0
+    self.send_socket = None
+    self.receive_socket = None
+    self.receive_path = None
+
+  def _ListSockets(self):
+    now = time.time()
+    with self.lock:
+      if now - self.listing_time > self.LISTING_MAX_AGE:
+        try:
+          self.listing = [
+              os.path.join(self.socket_dir, name)
+              for name in os.listdir(self.socket_dir)
+              if name.endswith(".sock")
+          ]
+        except OSError:
+          self.listing = []
+        self.listing_time = now
+      return self.listing
+
+  def Publish(self, queues):
+    paths = self._ListSockets()
+    if not paths:
+      return
+
+    now = time.time()
+    message = "\n".join("%f %s" % (now, utils.SmartStr(queue))
+                        for queue in queues)
+
+    with self.lock:
+      if self.send_socket is None:
+        self.send_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.send_socket.setblocking(False)
+
+      for path in paths:
+        try:
+          self.send_socket.sendto(message, path)
+        except socket.error as e:
+          if e.errno == errno.ECONNREFUSED:
+            # Nobody is listening anymore, the process owning the socket died.
+            try:
+              os.remove(path)
+            except OSError:
+              pass
+          elif e.errno not in (errno.EAGAIN, errno.ENOENT):
+            # A full receive buffer means the worker has pending wakeups
+            # anyway.
+            logging.warning("Unable to wake up worker at %s: %s", path, e)
+
+  def _GetReceiveSocket(self):
+    with self.lock:
+      if self.receive_socket is None:
+        utils.EnsureDirExists(self.socket_dir)
+        path = os.path.join(self.socket_dir, "%d-%d.sock" % (os.getpid(),
+                                                             id(self)))
+        if os.path.exists(path):
+          # Left behind by a crashed process that had the same pid.
+          os.remove(path)
+        receive_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receive_socket.bind(path)
+        receive_socket.setblocking(False)
+        self.receive_socket = receive_socket
+        self.receive_path = path
+      return self.receive_socket
+
+  def Wait(self, queues, timeout, since=None):
+    receive_socket = self._GetReceiveSocket()
+    queues = set(utils.SmartStr(queue) for queue in queues)
+    if since is None:
+      since = time.time()
+
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return None
+
+      readable, _, _ = select.select([receive_socket], [], [], remaining)
+      if not readable:
+        return None
+
+      published = None
+      # Drain all pending datagrams, skipping the ones published before since.
+      while True:
+        try:
+          message = receive_socket.recv(65536)
+        except socket.error as e:
+          if e.errno == errno.EAGAIN:
+            break
+          raise
+
+        for line in message.split("\n"):
+          timestamp, _, queue = line.partition(" ")
+          try:
+            timestamp = float(timestamp)
+          except ValueError:
+            continue
+          if queue in queues and timestamp > since:
+            published = max(published, timestamp)
+
+      if published is not None:
+        return published
+
+  def Close(self):
+    with self.lock:
+      for s in (self.send_socket, self.receive_socket):
+        if s is not None:
+          s.close()
+      self.send_socket = None
+      self.receive_socket = None
+
+      if self.receive_path:
+        try:
+          os.remove(self.receive_path)
+        except OSError:
+          pass
+        self.receive_path = None
+
+
+_channel = None
+_channel_lock = threading.Lock()
+
+
+def GetChannel():
+  """Returns the wakeup channel configured in Worker.wakeup_channel."""
+  global _channel
+
+  with _channel_lock:
+    if _channel is None:
+      channel_name = config.CONFIG["Worker.wakeup_channel"]
+      try:
+        cls = WakeupChannel.GetPlugin(channel_name)
+      except KeyError:
+        raise ValueError("No wakeup channel %s found." % channel_name)
+      _channel = cls()
+
+    return _channel
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Tests for the worker wakeup channels."""
+
+import os
+import threading
+import time
+
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.server import queue_manager
+from grr.server import wakeup_channel
+from grr.test_lib import test_lib
+
+QUEUE = rdfvalue.RDFURN("W")
+OTHER_QUEUE = rdfvalue.RDFURN("H")
+
+
+class WakeupChannelTestMixin(object):
+  """Tests every wakeup channel implementation has to pass."""
+
+  def CreateChannel(self):
+    raise NotImplementedError()
+
+  def setUp(self):
+    super(WakeupChannelTestMixin, self).setUp()
+    self.channel = self.CreateChannel()
+    # Waiting channels have to be set up before anything is published.
+    self.channel.Wait([QUEUE], 0)
+
+  def tearDown(self):
+    self.channel.Close()
+    super(WakeupChannelTestMixin, self).tearDown()
+
+  def testWaitTimesOut(self):
+    self.assertIsNone(self.channel.Wait([QUEUE], 0.1))
+
+  def testPublishBeforeWaitIsSeen(self):
+    since = time.time() - 1
+    self.channel.Publish([QUEUE])
+    published = self.channel.Wait([QUEUE], 5, since=since)
+    self.assertIsNotNone(published)
+    self.assertGreater(published, since)
+
+  def testOldPublishIsIgnored(self):
+    self.channel.Publish([QUEUE])
+    self.assertIsNone(self.channel.Wait([QUEUE], 0.1, since=time.time() + 1))
+
+  def testPublishToOtherQueueIsIgnored(self):
+    since = time.time() - 1
+    self.channel.Publish([OTHER_QUEUE])
+    self.assertIsNone(self.channel.Wait([QUEUE], 0.1, since=since))
+
+  def testPublishWakesUpWaitingThread(self):
+    results = []
+
+    def Waiter():
+      results.append(self.channel.Wait([QUEUE], 30))
+
+    waiter = threading.Thread(target=Waiter)
+    waiter.start()
+    # Give the thread a chance to start waiting.
+    time.sleep(0.1)
+
+    start = time.time()
+    self.channel.Publish([OTHER_QUEUE, QUEUE])
+    waiter.join()
+
+    self.assertLess(time.time() - start, 10)
+    self.assertIsNotNone(results[0])
+
+
+class InProcessWakeupChannelTest(WakeupChannelTestMixin, test_lib.GRRBaseTest):
+
+  def CreateChannel(self):
+    return wakeup_channel.InProcessWakeupChannel()
+
+
+class UnixSocketWakeupChannelTest(WakeupChannelTestMixin,
+                                  test_lib.GRRBaseTest):
+
+  def CreateChannel(self):
+    return wakeup_channel.UnixSocketWakeupChannel(
+        socket_dir=os.path.join(self.temp_dir, "wakeup"))
+
+  def testSocketIsRemovedOnClose(self):
+    socket_dir = os.path.join(self.temp_dir, "wakeup")
+    self.assertEqual(len(os.listdir(socket_dir)), 1)
+    self.channel.Close()
+    self.assertEqual(os.listdir(socket_dir), [])
+
+
+class QueueManagerWakeupTest(test_lib.GRRBaseTest):
+
+  def testNotifyingAQueuePublishesIt(self):
+    channel = wakeup_channel.InProcessWakeupChannel()
+    since = time.time() - 1
+    with utils.Stubber(wakeup_channel, "GetChannel", lambda: channel):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        manager.QueueNotification(
+            session_id=rdfvalue.SessionID(queue=QUEUE, flow_name="123"))
+
+        # Nothing is published before the notification is written.
+        self.assertIsNone(channel.Wait([QUEUE], 0, since=since))
+
+    self.assertIsNotNone(channel.Wait([QUEUE], 0, since=since))
+    self.assertIsNone(channel.Wait([OTHER_QUEUE], 0, since=since))
+
+  def testMultiNotifyQueuePublishes(self):
+    channel = wakeup_channel.InProcessWakeupChannel()
+    since = time.time() - 1
+    with utils.Stubber(wakeup_channel, "GetChannel", lambda: channel):
+      manager = queue_manager.QueueManager(token=self.token)
+      with manager.data_store.GetMutationPool() as pool:
+        manager.MultiNotifyQueue(
+            [
+                rdf_flows.GrrNotification(session_id=rdfvalue.SessionID(
+                    queue=OTHER_QUEUE, flow_name="123"))
+            ],
+            mutation_pool=pool)
+
+    self.assertIsNotNone(channel.Wait([OTHER_QUEUE], 0, since=since))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
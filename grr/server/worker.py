@@ -15,6 +15,7 @@ from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server import aff4
+from grr.server import data_store
 from grr.server import flow
 from grr.server import master
 from grr.server import queue_manager as queue_manager_lib
@@ -22,6 +23,7 @@ from grr.server import queue_manager as queue_manager_lib
 from grr.server import server_stubs
 # pylint: enable=unused-import
 from grr.server import threadpool
+from grr.server import wakeup_channel
 
 
 class Error(Exception):
@@ -56,6 +58,8 @@ class GRRWorker(object):
                queues=queues_config.WORKER_LIST,
                threadpool_prefix="grr_threadpool",
                threadpool_size=None,
+               batch_size=None,
+               shards_per_worker=None,
                token=None):
     """Constructor.
 
@@ -63,6 +67,13 @@ class GRRWorker(object):
       queues: The queues we use to fetch new messages from.
       threadpool_prefix: A name for the thread pool used by this worker.
       threadpool_size: The number of workers to start in this thread pool.
+      batch_size: The number of flows locked, read and processed together by
+                  a single thread pool task. If not given, uses
+                  Worker.flow_batch_size.
+      shards_per_worker: The number of notification shards of each queue this
+                         worker leases. 0 means no leasing, all shards are
+                         scanned. If not given, uses
+                         Worker.notification_shards_per_worker.
       token: The token to use for the worker.
 
     Raises:
@@ -89,6 +100,18 @@ class GRRWorker(object):
 
       self.__class__.thread_pool.Start()
 
+    if batch_size is None:
+      batch_size = config.CONFIG["Worker.flow_batch_size"]
+    self.batch_size = max(1, batch_size)
+
+    if shards_per_worker is None:
+      shards_per_worker = config.CONFIG["Worker.notification_shards_per_worker"]
+    self.shards_per_worker = shards_per_worker
+    # Notification shard leases held by this worker, keyed by queue.
+    self.shard_leases = {}
+
+    self.datastore_read_cache = config.CONFIG["Worker.datastore_read_cache"]
+
     self.token = token
     self.last_active = 0
 
@@ -97,8 +120,10 @@ class GRRWorker(object):
 
   def Run(self):
     """Event loop."""
+    channel = wakeup_channel.GetChannel()
     try:
       while 1:
+        run_start = time.time()
         if master.MASTER_WATCHER.IsMaster():
           processed = self.RunOnce()
         else:
@@ -114,13 +139,40 @@ class GRRWorker(object):
           else:
             interval = self.SHORT_POLLING_INTERVAL
 
-          time.sleep(interval)
+          # Wait for new notifications, polling again after the interval in
+          # case a wakeup got lost.
+          published = channel.Wait(self.queues, interval, since=run_start)
+          if published is not None:
+            stats.STATS.RecordEvent("worker_wakeup_latency",
+                                    time.time() - published)
         else:
           self.last_active = time.time()
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
       self.__class__.thread_pool.Join()
+      self.ReleaseShardLeases()
+      channel.Close()
+
+  def ReleaseShardLeases(self):
+    """Hands the leased notification shards back to the other workers."""
+    for leases in self.shard_leases.itervalues():
+      leases.Release()
+    self.shard_leases = {}
+
+  def _GetLeasedShards(self, queue, queue_manager):
+    """Renews this worker's shard leases for a queue and returns the shards."""
+    leases = self.shard_leases.get(queue)
+    if leases is None:
+      leases = queue_manager_lib.NotificationShardLeases(
+          queue,
+          queue_manager.GetAllNotificationShards(queue),
+          self.shards_per_worker,
+          config.CONFIG["Worker.notification_shard_lease_time"],
+          store=queue_manager.data_store)
+      self.shard_leases[queue] = leases
+
+    return leases.Heartbeat()
 
   def RunOnce(self):
     """Processes one set of messages from Task Scheduler.
@@ -141,8 +193,13 @@ class GRRWorker(object):
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      if self.shards_per_worker:
+        notifications_by_priority = (
+            queue_manager.GetNotificationsByPriorityForShards(
+                queue, self._GetLeasedShards(queue, queue_manager)))
+      else:
+        notifications_by_priority = queue_manager.GetNotificationsByPriority(
+            queue)
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -227,6 +284,7 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -234,13 +292,41 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+
+        # Well known flows are not locked for the whole time they are being
+        # processed so there is nothing to gain from batching them.
+        if (self.batch_size > 1 and
+            notification.session_id.FlowName() not in self.well_known_flows):
+          batch.append(notification)
+          if len(batch) >= self.batch_size:
+            self._AddBatchTask(batch, queue_manager)
+            batch = []
+          continue
+
         self.__class__.thread_pool.AddTask(
-            target=self._ProcessMessages,
-            args=(notification, queue_manager.Copy()),
+            target=self._RunWithReadCache,
+            args=(self._ProcessMessages, notification, queue_manager.Copy()),
             name=self.__class__.__name__)
 
+    if batch:
+      self._AddBatchTask(batch, queue_manager)
+
     return processed
 
+  def _AddBatchTask(self, notifications, queue_manager):
+    self.__class__.thread_pool.AddTask(
+        target=self._RunWithReadCache,
+        args=(self._ProcessMessagesBatch, notifications, queue_manager.Copy()),
+        name=self.__class__.__name__)
+
+  def _RunWithReadCache(self, target, *args):
+    """Runs target, caching data store reads if Worker.datastore_read_cache."""
+    if not self.datastore_read_cache:
+      return target(*args)
+
+    with data_store.DB.ReadCache():
+      return target(*args)
+
   def _ProcessRegularFlowMessages(self, flow_obj, notification):
     """Processes messages for a given flow."""
     session_id = notification.session_id
@@ -344,6 +430,97 @@ class GRRWorker(object):
           "worker_session_errors", fields=[str(type(e))])
       queue_manager.DeleteNotification(session_id)
 
+  def _ProcessMessagesBatch(self, notifications, queue_manager):
+    """Processes a number of regular flows together.
+
+    All the flows are locked and read from the data store with a single query,
+    their completed requests are fetched at once and their notifications are
+    deleted in bulk. The flows are then run one after the other in this thread.
+
+    Args:
+      notifications: A list of notifications for different regular flows.
+      queue_manager: QueueManager object used to manage notifications.
+    """
+    notifications_by_session_id = {}
+    for notification in notifications:
+      notifications_by_session_id[notification.session_id] = notification
+
+    start_time = time.time()
+    flow_objs = []
+    try:
+      flow_objs = aff4.FACTORY.MultiOpenWithLock(
+          notifications_by_session_id.keys(),
+          lease_time=self.flow_lease_time,
+          blocking=False,
+          token=self.token)
+
+      locked = [notifications_by_session_id[o.urn] for o in flow_objs]
+      stats.STATS.IncrementCounter("worker_batched_flows", len(locked))
+      stats.STATS.RecordEvent("worker_batch_lock_time",
+                              time.time() - start_time)
+
+      # If we get here, we own these flows. We can delete the notifications
+      # we just retrieved but we need to make sure we don't delete any that
+      # came in later.
+      for timestamp, batch in utils.GroupBy(
+          locked, lambda n: n.timestamp).iteritems():
+        queue_manager.DeleteNotifications(
+            [n.session_id for n in batch], end=timestamp)
+
+      completed_requests = queue_manager.MultiFetchCompletedRequests(locked)
+
+      while flow_objs:
+        flow_obj = flow_objs.pop(0)
+        notification = notifications_by_session_id.pop(flow_obj.urn)
+
+        if isinstance(flow_obj, flow.FlowBase):
+          flow_obj.GetRunner().queue_manager.PrefetchCompletedRequests(
+              notification.session_id, notification.timestamp,
+              completed_requests[notification.session_id])
+
+        self._ProcessLockedFlow(flow_obj, notification, queue_manager)
+
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error processing flow batch: %s", e)
+      stats.STATS.IncrementCounter(
+          "worker_session_errors", fields=[str(type(e))])
+      # Flows we did not get to yet are unlocked and retried one by one below.
+      for flow_obj in flow_objs:
+        flow_obj.transaction.Release()
+
+    # Flows we could not lock or open are handled one by one, this takes care
+    # of accounting lock failures and of removing notifications for broken
+    # objects.
+    for notification in notifications_by_session_id.itervalues():
+      self._ProcessMessages(notification, queue_manager)
+
+  def _ProcessLockedFlow(self, flow_obj, notification, queue_manager):
+    """Runs a regular flow that was locked as part of a batch."""
+    session_id = notification.session_id
+    try:
+      now = time.time()
+      with flow_obj:
+        self._ProcessRegularFlowMessages(flow_obj, notification)
+
+      elapsed = time.time() - now
+      logging.debug("Done processing %s: %s sec", session_id, elapsed)
+      stats.STATS.RecordEvent(
+          "worker_flow_processing_time", elapsed, fields=[flow_obj.Name()])
+
+      # Everything went well -> session can be run again.
+      self.queued_flows.ExpireObject(session_id)
+
+    except FlowProcessingError:
+      # Do nothing as we expect the error to be correctly logged and accounted
+      # already.
+      pass
+
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error processing session %s: %s", session_id, e)
+      stats.STATS.IncrementCounter(
+          "worker_session_errors", fields=[str(type(e))])
+      queue_manager.DeleteNotification(session_id)
+
 
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
@@ -363,3 +540,8 @@ class WorkerInit(registry.InitHook):
     stats.STATS.RegisterEventMetric(
         "worker_flow_processing_time", fields=[("flow", str)])
     stats.STATS.RegisterEventMetric("worker_time_to_retrieve_notifications")
+    # Time from a notification being published on the wakeup channel to the
+    # worker starting to process it.
+    stats.STATS.RegisterEventMetric("worker_wakeup_latency")
+    stats.STATS.RegisterCounterMetric("worker_batched_flows")
+    stats.STATS.RegisterEventMetric("worker_batch_lock_time")
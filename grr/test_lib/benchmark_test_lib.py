@@ -68,7 +68,7 @@ class AverageMicroBenchmarks(MicroBenchmarks):
   units = "s"
 
   def setUp(self):
-    super(AverageMicroBenchmarks, self).setUp(["Value"])
+    super(AverageMicroBenchmarks, self).setUp(["Value"], ["<20"])
 
   def TimeIt(self, callback, name=None, repetitions=None, pre=None, **kwargs):
     """Runs the callback repetitively and returns the average time."""
@@ -45,6 +45,7 @@ from grr.server import client_index
 from grr.server import data_store
 from grr.server import email_alerts
 from grr.server import flow
+from grr.server import sequential_collection
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore
 from grr.server.aff4_objects import users
@@ -130,6 +131,7 @@ class GRRBaseTest(unittest.TestCase):
     data_store.REL_DB.ClearTestDB()
 
     aff4.FACTORY.Flush()
+    sequential_collection.GetIndexCache().Flush()
 
     # Create a Foreman and Filestores, they are used in many tests.
     aff4_grr.GRRAFF4Init().Run()
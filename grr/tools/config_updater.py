@@ -3,6 +3,7 @@
 
 import argparse
 import getpass
+import logging
 import os
 
 import re
@@ -33,6 +34,7 @@ from grr.server import aff4
 from grr.server import artifact
 from grr.server import artifact_registry
 from grr.server import data_migration
+from grr.server import data_store
 from grr.server import key_utils
 from grr.server import maintenance_utils
 from grr.server import rekall_profile_server
@@ -298,6 +300,11 @@ parser_migrate_data = subparsers.add_parser(
     parents=[],
     help="Migrates data to the relational database.")
 
+parser_migrate_collections = subparsers.add_parser(
+    "migrate_collections",
+    parents=[],
+    help="Moves collection items to the MySQL collections table.")
+
 
 def ImportConfig(filename, config):
   """Reads an old config file and imports keys and user accounts."""
@@ -977,6 +984,13 @@ You are about to rotate the server key. Note that:
           cn=flags.FLAGS.common_name, keylength=keylength)
   elif flags.FLAGS.subparser_name == "migrate_data":
     data_migration.Migrate()
+  elif flags.FLAGS.subparser_name == "migrate_collections":
+    if not hasattr(data_store.DB, "MigrateCollections"):
+      logging.warning(
+          "The configured data store keeps no separate collections table.")
+    else:
+      logging.info("Migrated %d collection items.",
+                   data_store.DB.MigrateCollections())
 
 
 if __name__ == "__main__":
@@ -2,14 +2,23 @@
 """This is the GRR frontend HTTP Server."""
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
+import errno
 import logging
+import os
 import pdb
+import Queue
+import select
+import signal
 import socket
 import SocketServer
 import threading
+import time
 
 
 import ipaddr
@@ -27,11 +36,126 @@ from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.server import admission_control
 from grr.server import aff4
 from grr.server import front_end
 from grr.server import master
 from grr.server import server_logging
 from grr.server import server_startup
+from grr.server import shared_cache
+from grr.server import threadpool
+
+
+# An HTTP response: status code, body, content type and additional headers.
+Response = collections.namedtuple("Response",
+                                  ["status", "data", "ctype", "headers"])
+
+
+def _GetAPIVersion(path):
+  try:
+    return int(cgi.parse_qs(path.split("?")[1])["api"][0])
+  except (ValueError, KeyError, IndexError):
+    # The oldest api version we support if not specified.
+    return 3
+
+
+def ProcessControlRequest(frontend, path, raw_headers, post_data, client_ip):
+  """Runs a client poll through the frontend.
+
+  Args:
+    frontend: The FrontEndServer handling the messages.
+    path: The requested path, including the query string.
+    raw_headers: The request headers as a string.
+    post_data: The serialized ClientCommunication sent by the client.
+    client_ip: The ip address the request was received from.
+
+  Returns:
+    The Response to send to the client.
+  """
+  if not master.MASTER_WATCHER.IsMaster():
+    # We shouldn't be getting requests from the client unless we
+    # are the active instance.
+    stats.STATS.IncrementCounter(
+        "frontend_inactive_request_count", fields=["http"])
+    logging.info("Request sent to inactive frontend from %s", client_ip)
+
+  request_comms = rdf_flows.ClientCommunication.FromSerializedString(post_data)
+
+  # If the client did not supply the version in the protobuf we use the get
+  # parameter.
+  if not request_comms.api_version:
+    request_comms.api_version = _GetAPIVersion(path)
+
+  # Reply using the same version we were requested with.
+  responses_comms = rdf_flows.ClientCommunication(
+      api_version=request_comms.api_version)
+
+  source_ip = ipaddr.IPAddress(client_ip)
+
+  if source_ip.version == 6:
+    source_ip = source_ip.ipv4_mapped or source_ip
+
+  request_comms.orig_request = rdf_flows.HttpRequest(
+      timestamp=rdfvalue.RDFDatetime.Now().AsMicrosecondsSinceEpoch(),
+      raw_headers=raw_headers,
+      source_ip=utils.SmartStr(source_ip))
+
+  try:
+    source, nr_messages = frontend.HandleMessageBundles(request_comms,
+                                                        responses_comms)
+  except communicator.UnknownClientCert:
+    # "406 Not Acceptable: The server can only generate a response that is not
+    # accepted by the client". This is because we can not encrypt for the
+    # client appropriately.
+    return Response(406, "Enrollment required", "application/octet-stream",
+                    None)
+  except admission_control.Overloaded as e:
+    return Response(503, "Server busy.", "text/plain",
+                    {"Retry-After": e.retry_after})
+
+  server_logging.LOGGER.LogHttpFrontendAccess(
+      request_comms.orig_request, source=source, message_count=nr_messages)
+
+  return Response(200, responses_comms.SerializeToString(),
+                  "application/octet-stream", None)
+
+
+REKALL_PROFILE_PATH = "/rekall_profiles"
+
+
+def RekallProfileResponse(frontend, path):
+  """Looks up a rekall profile.
+
+  Args:
+    frontend: The FrontEndServer serving the profiles.
+    path: The requested path, /rekall_profiles/<version>/<profile_name>.
+
+  Returns:
+    The Response to send to the client.
+  """
+  remaining_path = path[len(REKALL_PROFILE_PATH):]
+  if not remaining_path.startswith("/"):
+    return Response(500, "Error serving profile.", "text/plain", None)
+
+  components = remaining_path[1:].split("/", 1)
+
+  if len(components) != 2:
+    return Response(500, "Error serving profile.", "text/plain", None)
+  version, name = components
+  profile = frontend.GetRekallProfile(name, version=version)
+  if not profile:
+    return Response(404, "Profile not found.", "text/plain", None)
+
+  json_data = json_format.MessageToJson(profile.AsPrimitiveProto())
+
+  sanitized_data = ")]}'\n" + json_data.replace("<", r"\u003c").replace(
+      ">", r"\u003e")
+
+  additional_headers = {
+      "Content-Disposition": "attachment; filename=response.json",
+      "X-Content-Type-Options": "nosniff"
+  }
+  return Response(200, sanitized_data, "application/json", additional_headers)
 
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -39,9 +163,11 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   statustext = {
       200: "200 OK",
+      400: "400 Bad Request",
       404: "404 Not Found",
       406: "406 Not Acceptable",
-      500: "500 Internal Server Error"
+      500: "500 Internal Server Error",
+      503: "503 Service Unavailable"
   }
 
   active_counter_lock = threading.Lock()
@@ -73,7 +199,7 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                      "".join(header_strings), data)
     self.wfile.write(data)
 
-  rekall_profile_path = "/rekall_profiles"
+  rekall_profile_path = REKALL_PROFILE_PATH
 
   static_content_path = "/static/"
 
@@ -103,36 +229,12 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """
     logging.debug("Rekall profile request from IP %s for %s",
                   self.client_address[0], path)
-    remaining_path = path[len(self.rekall_profile_path):]
-    if not remaining_path.startswith("/"):
-      self.Send("Error serving profile.", status=500, ctype="text/plain")
-      return
-
-    components = remaining_path[1:].split("/", 1)
-
-    if len(components) != 2:
-      self.Send("Error serving profile.", status=500, ctype="text/plain")
-      return
-    version, name = components
-    profile = self.server.frontend.GetRekallProfile(name, version=version)
-    if not profile:
-      self.Send("Profile not found.", status=404, ctype="text/plain")
-      return
-
-    json_data = json_format.MessageToJson(profile.AsPrimitiveProto())
-
-    sanitized_data = ")]}'\n" + json_data.replace("<", r"\u003c").replace(
-        ">", r"\u003e")
-
-    additional_headers = {
-        "Content-Disposition": "attachment; filename=response.json",
-        "X-Content-Type-Options": "nosniff"
-    }
+    response = RekallProfileResponse(self.server.frontend, path)
     self.Send(
-        sanitized_data,
-        status=200,
-        ctype="application/json",
-        additional_headers=additional_headers)
+        response.data,
+        status=response.status,
+        ctype=response.ctype,
+        additional_headers=response.headers)
 
   AFF4_READ_BLOCK_SIZE = 10 * 1024 * 1024
 
@@ -235,21 +337,6 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   @stats.Timed("frontend_request_latency", fields=["http"])
   def Control(self):
     """Handle POSTS."""
-    if not master.MASTER_WATCHER.IsMaster():
-      # We shouldn't be getting requests from the client unless we
-      # are the active instance.
-      stats.STATS.IncrementCounter(
-          "frontend_inactive_request_count", fields=["http"])
-      logging.info("Request sent to inactive frontend from %s",
-                   self.client_address[0])
-
-    # Get the api version
-    try:
-      api_version = int(cgi.parse_qs(self.path.split("?")[1])["api"][0])
-    except (ValueError, KeyError, IndexError):
-      # The oldest api version we support if not specified.
-      api_version = 3
-
     with GRRHTTPServerHandler.active_counter_lock:
       GRRHTTPServerHandler.active_counter += 1
       stats.STATS.SetGaugeValue(
@@ -262,41 +349,14 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
       length = int(content_length)
 
-      request_comms = rdf_flows.ClientCommunication.FromSerializedString(
-          self._GetPOSTData(length))
-
-      # If the client did not supply the version in the protobuf we use the get
-      # parameter.
-      if not request_comms.api_version:
-        request_comms.api_version = api_version
-
-      # Reply using the same version we were requested with.
-      responses_comms = rdf_flows.ClientCommunication(
-          api_version=request_comms.api_version)
-
-      source_ip = ipaddr.IPAddress(self.client_address[0])
-
-      if source_ip.version == 6:
-        source_ip = source_ip.ipv4_mapped or source_ip
-
-      request_comms.orig_request = rdf_flows.HttpRequest(
-          timestamp=rdfvalue.RDFDatetime.Now().AsMicrosecondsSinceEpoch(),
-          raw_headers=utils.SmartStr(self.headers),
-          source_ip=utils.SmartStr(source_ip))
-
-      source, nr_messages = self.server.frontend.HandleMessageBundles(
-          request_comms, responses_comms)
-
-      server_logging.LOGGER.LogHttpFrontendAccess(
-          request_comms.orig_request, source=source, message_count=nr_messages)
-
-      self.Send(responses_comms.SerializeToString())
-
-    except communicator.UnknownClientCert:
-      # "406 Not Acceptable: The server can only generate a response that is not
-      # accepted by the client". This is because we can not encrypt for the
-      # client appropriately.
-      self.Send("Enrollment required", status=406)
+      response = ProcessControlRequest(
+          self.server.frontend, self.path, utils.SmartStr(self.headers),
+          self._GetPOSTData(length), self.client_address[0])
+      self.Send(
+          response.data,
+          status=response.status,
+          ctype=response.ctype,
+          additional_headers=response.headers)
 
     finally:
       with GRRHTTPServerHandler.active_counter_lock:
@@ -305,6 +365,22 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             "frontend_active_count", self.active_counter, fields=["http"])
 
 
+def _CreateFrontEndServer():
+  return front_end.FrontEndServer(
+      certificate=config.CONFIG["Frontend.certificate"],
+      private_key=config.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config.CONFIG["Frontend.max_retransmission_time"])
+
+
+def _AddressFamily(server_address):
+  address = server_address[0]
+  if ipaddr.IPAddress(address).version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
+
+
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
   """The GRR HTTP frontend server."""
 
@@ -313,49 +389,622 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
 
   address_family = socket.AF_INET6
 
-  def __init__(self, server_address, handler, frontend=None, *args, **kwargs):
+  def __init__(self,
+               server_address,
+               handler,
+               frontend=None,
+               listening_socket=None,
+               *args,
+               **kwargs):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
-    if frontend:
-      self.frontend = frontend
+    self.frontend = frontend or _CreateFrontEndServer()
+    self.server_cert = config.CONFIG["Frontend.certificate"]
+    self.address_family = _AddressFamily(server_address)
+
+    if listening_socket is None:
+      logging.info("Will attempt to listen on %s", server_address)
+      BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
+                                         **kwargs)
+    else:
+      BaseHTTPServer.HTTPServer.__init__(
+          self, server_address, handler, bind_and_activate=False)
+      self.socket.close()
+      self.socket = listening_socket
+      self.server_address = listening_socket.getsockname()
+      self.server_name = socket.getfqdn(self.server_address[0])
+      self.server_port = self.server_address[1]
+
+
+class _HTTPRequest(object):
+  """A request read by the event loop frontend."""
+
+  def __init__(self, head):
+    """Parses the request line and headers.
+
+    Args:
+      head: The request head, up to but excluding the empty line ending it.
+
+    Raises:
+      ValueError: If the request can not be parsed.
+    """
+    self.received = time.time()
+    self.body = ""
+
+    request_line, _, self.raw_headers = head.lstrip("\r\n").partition("\r\n")
+    self.method, self.path, self.version = request_line.split()
+    if not self.version.startswith("HTTP/"):
+      raise ValueError("Invalid request line: %s" % request_line)
+
+    self.headers = {}
+    for line in self.raw_headers.split("\r\n"):
+      if line:
+        name, _, value = line.partition(":")
+        self.headers[name.strip().lower()] = value.strip()
+
+    self.content_length = int(self.headers.get("content-length", 0))
+    if self.content_length < 0:
+      raise ValueError("Invalid content length: %d" % self.content_length)
+
+    connection = self.headers.get("connection", "").lower()
+    if self.version == "HTTP/1.0":
+      self.keep_alive = connection == "keep-alive"
+    else:
+      self.keep_alive = connection != "close"
+
+
+class EventLoopConnection(asynchat.async_chat):
+  """A keep-alive client connection served by the GRREventLoopServer.
+
+  Requests on a connection are handled one at a time. While a request is
+  processed, nothing more is read from the connection.
+  """
+
+  ac_in_buffer_size = 64 * 1024
+  ac_out_buffer_size = 64 * 1024
+
+  MAX_HEADER_SIZE = 64 * 1024
+
+  def __init__(self, sock, client_address, server):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.server = server
+    self.client_address = client_address
+    self.incoming = []
+    self.incoming_size = 0
+    # The request whose body is currently read.
+    self.request = None
+    self.pending_requests = collections.deque()
+    self.in_flight = False
+    self.closing = False
+    self.last_activity = time.time()
+    self.set_terminator("\r\n\r\n")
+
+  def readable(self):
+    return not (self.closing or self.in_flight or self.pending_requests)
+
+  def handle_read(self):
+    self.last_activity = time.time()
+    asynchat.async_chat.handle_read(self)
+
+  def collect_incoming_data(self, data):
+    if self.closing:
+      return
+
+    self.incoming.append(data)
+    self.incoming_size += len(data)
+    if self.request is None and self.incoming_size > self.MAX_HEADER_SIZE:
+      self._RespondAndClose(Response(400, "Request header too large.",
+                                     "text/plain", None))
+
+  def found_terminator(self):
+    if self.closing:
+      return
+
+    data = "".join(self.incoming)
+    self.incoming = []
+    self.incoming_size = 0
+
+    if self.request is None:
+      try:
+        request = _HTTPRequest(data)
+      except ValueError:
+        self._RespondAndClose(Response(400, "Bad request.", "text/plain",
+                                       None))
+        return
+
+      if request.content_length:
+        self.request = request
+        self.set_terminator(request.content_length)
+        return
+    else:
+      request = self.request
+      request.body = data
+      self.request = None
+      self.set_terminator("\r\n\r\n")
+
+    self.pending_requests.append(request)
+    self._DispatchNext()
+
+  def _DispatchNext(self):
+    if self.in_flight or self.closing or not self.pending_requests:
+      return
+
+    self.in_flight = True
+    self.server.Dispatch(self, self.pending_requests.popleft())
+
+  def _RespondAndClose(self, response):
+    self.closing = True
+    self.push(_FormatResponse(response, keep_alive=False))
+    self.close_when_done()
+
+  def SendResponse(self, request, response):
+    """Sends the response to a request and continues with the next one."""
+    if not self.connected:
+      return
+
+    self.in_flight = False
+    self.last_activity = time.time()
+    keep_alive = request.keep_alive and self.server.running
+    self.push(_FormatResponse(response, keep_alive=keep_alive))
+
+    if keep_alive:
+      self._DispatchNext()
     else:
-      self.frontend = front_end.FrontEndServer(
-          certificate=config.CONFIG["Frontend.certificate"],
-          private_key=config.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config.CONFIG[
-              "Frontend.max_retransmission_time"])
+      self.closing = True
+      self.close_when_done()
+
+    self.server.reactor.Modified(self)
+
+  def handle_error(self):
+    logging.exception("Error serving %s.", self.client_address[0])
+    self.close()
+
+  def close(self):
+    self.server.reactor.Closed(self)
+    asynchat.async_chat.close(self)
+    self.server.connections.discard(self)
+
+
+def _FormatResponse(response, keep_alive=True):
+  """Formats an HTTP/1.1 response."""
+  headers = dict(response.headers or {})
+  headers["Connection"] = "keep-alive" if keep_alive else "close"
+  return ("HTTP/1.1 %s\r\n"
+          "Server: GRR Server\r\n"
+          "Content-type: %s\r\n"
+          "Content-Length: %d\r\n"
+          "%s"
+          "\r\n"
+          "%s") % (GRRHTTPServerHandler.statustext[response.status],
+                   response.ctype, len(response.data), "".join(
+                       "%s: %s\r\n" % (name, value)
+                       for name, value in headers.iteritems()), response.data)
+
+
+class _Waker(asyncore.dispatcher):
+  """Wakes up the event loop when the worker pool finished a request."""
+
+  def __init__(self, server):
+    receive_socket, self.send_socket = socket.socketpair()
+    asyncore.dispatcher.__init__(self, sock=receive_socket,
+                                 map=server.socket_map)
+    self.send_socket.setblocking(False)
+    self.server = server
+
+  def Wake(self):
+    try:
+      self.send_socket.send("x")
+    except socket.error:
+      # A full buffer means a wakeup is pending already, a closed socket that
+      # the server was shut down.
+      pass
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except socket.error:
+      pass
+    self.server.SendCompletedResponses()
+
+  def close(self):
+    asyncore.dispatcher.close(self)
+    self.send_socket.close()
+
+
+class _Reactor(object):
+  """Waits for events on the sockets of an event loop server.
+
+  Where available, epoll is used and only sockets that handled an event since
+  the last call are checked for changes in what they wait for, so idle
+  keep-alive connections cost nothing. Elsewhere, asyncore's poll loop is used.
+  """
+
+  def __init__(self, socket_map):
+    self.socket_map = socket_map
+    self.epoll = select.epoll() if hasattr(select, "epoll") else None
+    # Event masks of the registered file descriptors.
+    self.registered = {}
+    self.modified = set()
+
+  def Modified(self, dispatcher):
+    """Marks that what the dispatcher waits for might have changed."""
+    self.modified.add(dispatcher._fileno)  # pylint: disable=protected-access
+
+  def Closed(self, dispatcher):
+    """Stops waiting for events of a dispatcher about to close its socket.
+
+    The file descriptor can be reused by a new connection right away, which
+    then has to be registered again even if it waits for the same events.
+
+    Args:
+      dispatcher: The dispatcher being closed.
+    """
+    fd = dispatcher._fileno  # pylint: disable=protected-access
+    if fd is None:
+      return
+
+    self.modified.discard(fd)
+    if self.registered.pop(fd, None) is not None:
+      try:
+        self.epoll.unregister(fd)
+      except (IOError, ValueError):
+        pass
+
+  def _EventMask(self, dispatcher):
+    mask = 0
+    if dispatcher.readable():
+      mask |= select.EPOLLIN | select.EPOLLPRI
+    # Listening sockets are never written to.
+    if dispatcher.writable() and not dispatcher.accepting:
+      mask |= select.EPOLLOUT
+    return mask
+
+  def _UpdateRegistrations(self):
+    modified, self.modified = self.modified, set()
+    for fd in modified:
+      dispatcher = self.socket_map.get(fd)
+      if dispatcher is None:
+        # Closed file descriptors are removed from epoll automatically.
+        self.registered.pop(fd, None)
+        continue
+
+      mask = self._EventMask(dispatcher)
+      if self.registered.get(fd) == mask:
+        continue
+
+      try:
+        self.epoll.modify(fd, mask)
+      except IOError:
+        # The file descriptor was closed and reused since it was registered.
+        self.epoll.register(fd, mask)
+      self.registered[fd] = mask
+
+  def Poll(self, timeout):
+    if self.epoll is None:
+      asyncore.poll2(timeout, self.socket_map)
+      return
+
+    self._UpdateRegistrations()
+    try:
+      events = self.epoll.poll(timeout)
+    except IOError as e:
+      if e.errno == errno.EINTR:
+        return
+      raise
+
+    for fd, flags in events:
+      dispatcher = self.socket_map.get(fd)
+      if dispatcher is not None:
+        asyncore.readwrite(dispatcher, flags)
+        self.modified.add(fd)
+
+  def Close(self):
+    if self.epoll is not None:
+      self.epoll.close()
+
+
+class GRREventLoopServer(asyncore.dispatcher):
+  """The GRR frontend server using a single event loop for all connections.
+
+  Connections are kept open between requests and only cost a socket while
+  idle. Client polls and other requests that need the data store are handed to
+  a bounded worker pool. If the pool is saturated, clients are asked to retry
+  later.
+  """
+
+  request_queue_size = 500
+
+  # How often idle connections are checked for expiry.
+  IDLE_CHECK_INTERVAL = 1
+
+  # The Retry-After header sent with 503 responses.
+  RETRY_AFTER = 10
+
+  def __init__(self,
+               server_address,
+               frontend=None,
+               worker_threads=None,
+               keep_alive_timeout=None,
+               listening_socket=None):
+    """Constructor.
+
+    Args:
+      server_address: The (address, port) tuple to listen on.
+      frontend: The FrontEndServer to use, by default one is created.
+      worker_threads: The size of the worker pool, defaults to
+        Frontend.event_loop_worker_threads.
+      keep_alive_timeout: Seconds after which idle connections are closed,
+        defaults to Frontend.keep_alive_timeout.
+      listening_socket: If given, connections are accepted from this bound
+        socket instead of listening on server_address.
+    """
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    self.frontend = frontend or _CreateFrontEndServer()
     self.server_cert = config.CONFIG["Frontend.certificate"]
+    if worker_threads is None:
+      worker_threads = config.CONFIG["Frontend.event_loop_worker_threads"]
+    if keep_alive_timeout is None:
+      keep_alive_timeout = config.CONFIG["Frontend.keep_alive_timeout"]
+    self.keep_alive_timeout = keep_alive_timeout
+
+    if listening_socket is None:
+      logging.info("Will attempt to listen on %s", server_address)
+      self.create_socket(_AddressFamily(server_address), socket.SOCK_STREAM)
+      try:
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(self.request_queue_size)
+      except socket.error:
+        self.close()
+        raise
+    else:
+      listening_socket.setblocking(False)
+      self.set_socket(listening_socket)
+      self.accepting = True
+    self.server_address = self.socket.getsockname()
+
+    self.reactor = _Reactor(self.socket_map)
+    self.reactor.Modified(self)
+    self.waker = _Waker(self)
+    self.reactor.Modified(self.waker)
+
+    self.connections = set()
+    # Responses computed by the worker pool, as (connection, request, response)
+    # tuples.
+    self.completed = Queue.Queue()
+    # The number of requests handed to the worker pool. Only changed by the
+    # event loop thread.
+    self.active_count = 0
+    self.running = False
+    self.stopped = threading.Event()
+
+    # The pool queues as many requests as it has threads, so this is the number
+    # of requests handled concurrently before clients are asked to retry.
+    stats.STATS.SetGaugeValue("frontend_max_active_count", 2 * worker_threads)
+    stats.STATS.SetGaugeCallback("frontend_open_connections",
+                                 lambda: len(self.connections))
+    self.pool = threadpool.ThreadPool.Factory(
+        "grr_frontend_pool", min_threads=worker_threads,
+        max_threads=worker_threads)
+
+  def writable(self):
+    return False
+
+  def handle_accept(self):
+    try:
+      pair = self.accept()
+    except socket.error as e:
+      # E.g. running out of file descriptors, the client will retry.
+      logging.warning("Unable to accept connection: %s", e)
+      return
+
+    if pair is None:
+      return
+
+    sock, client_address = pair
+    connection = EventLoopConnection(sock, client_address, self)
+    self.connections.add(connection)
+    self.reactor.Modified(connection)
+
+  def Dispatch(self, connection, request):
+    """Serves a request received on a connection."""
+    path = request.path
+    if request.method == "POST":
+      if path.startswith("/upload"):
+        stats.STATS.IncrementCounter(
+            "frontend_http_requests", fields=["upload", "http"])
+        logging.error("Requested no longer supported file upload through HTTP.")
+        connection.SendResponse(request, Response(
+            404, "File upload though HTTP is no longer supported",
+            "application/octet-stream", None))
+      else:
+        stats.STATS.IncrementCounter(
+            "frontend_http_requests", fields=["control", "http"])
+        self._RunInPool(connection, request, self._Control)
+
+    elif request.method == "GET" and path.startswith("/server.pem"):
+      stats.STATS.IncrementCounter(
+          "frontend_http_requests", fields=["cert", "http"])
+      connection.SendResponse(request, Response(
+          200, self.server_cert.AsPEM(), "application/octet-stream", None))
+
+    elif request.method == "GET" and path.startswith(REKALL_PROFILE_PATH):
+      stats.STATS.IncrementCounter(
+          "frontend_http_requests", fields=["rekall", "http"])
+      self._RunInPool(connection, request, self._RekallProfile)
+
+    elif (request.method == "GET" and
+          path.startswith(GRRHTTPServerHandler.static_content_path)):
+      stats.STATS.IncrementCounter(
+          "frontend_http_requests", fields=["static", "http"])
+      self._RunInPool(connection, request, self._Static)
+
+    else:
+      connection.SendResponse(request, Response(404, "Not found.",
+                                                "text/plain", None))
+
+  def _RunInPool(self, connection, request, handler):
+    try:
+      self.pool.AddTask(
+          target=self._HandleRequest,
+          args=(connection, request, handler),
+          name="frontend request",
+          blocking=False,
+          inline=False)
+    except threadpool.Full:
+      # We can not use 406 here, clients would take it as a request to enroll.
+      stats.STATS.IncrementCounter("frontend_rejected_requests")
+      connection.SendResponse(request, Response(
+          503, "Server busy.", "text/plain",
+          {"Retry-After": self.RETRY_AFTER}))
+      return
+
+    self.active_count += 1
+    stats.STATS.SetGaugeValue(
+        "frontend_active_count", self.active_count, fields=["http"])
+
+  def _HandleRequest(self, connection, request, handler):
+    """Runs in the worker pool."""
+    try:
+      response = handler(connection, request)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error("Had to respond with status 500: %s.", e)
+      response = Response(500, "Error: %s" % e, "application/octet-stream",
+                          None)
+
+    self.completed.put((connection, request, response))
+    self.waker.Wake()
+
+  def _Control(self, connection, request):
+    stats.STATS.IncrementCounter("frontend_request_count", fields=["http"])
+    if "content-length" not in request.headers:
+      raise IOError("No content-length header provided.")
 
-    (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+    return ProcessControlRequest(self.frontend, request.path,
+                                 request.raw_headers, request.body,
+                                 connection.client_address[0])
 
-    logging.info("Will attempt to listen on %s", server_address)
-    BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
-                                       **kwargs)
+  def _RekallProfile(self, connection, request):
+    logging.debug("Rekall profile request from IP %s for %s",
+                  connection.client_address[0], request.path)
+    return RekallProfileResponse(self.frontend, request.path)
+
+  def _Static(self, unused_connection, request):
+    path = request.path[len(GRRHTTPServerHandler.static_content_path):]
+    aff4_path = aff4.FACTORY.GetStaticContentPath().Add(path)
+    try:
+      logging.info("Serving %s", aff4_path)
+      fd = aff4.FACTORY.Open(aff4_path, token=aff4.FACTORY.root_token)
+      return Response(200, fd.Read(fd.size), "application/octet-stream", None)
+    except (IOError, AttributeError):
+      return Response(404, "", "application/octet-stream", None)
+
+  def SendCompletedResponses(self):
+    """Sends the responses the worker pool finished, runs in the event loop."""
+    while True:
+      try:
+        connection, request, response = self.completed.get_nowait()
+      except Queue.Empty:
+        break
 
+      self.active_count -= 1
+      stats.STATS.SetGaugeValue(
+          "frontend_active_count", self.active_count, fields=["http"])
+      if request.method == "POST":
+        stats.STATS.RecordEvent(
+            "frontend_request_latency",
+            time.time() - request.received,
+            fields=["http"])
+      connection.SendResponse(request, response)
+
+  def _CloseIdleConnections(self):
+    deadline = time.time() - self.keep_alive_timeout
+    for connection in list(self.connections):
+      if (not connection.in_flight and not connection.pending_requests and
+          connection.last_activity < deadline):
+        connection.close()
+
+  def serve_forever(self):
+    """Runs the event loop until shutdown is called."""
+    self.running = True
+    self.stopped.clear()
+    self.pool.Start()
+
+    last_idle_check = time.time()
+    try:
+      while self.running:
+        self.reactor.Poll(self.IDLE_CHECK_INTERVAL)
 
-def CreateServer(frontend=None):
-  """Start frontend http server."""
+        now = time.time()
+        if now - last_idle_check >= self.IDLE_CHECK_INTERVAL:
+          self._CloseIdleConnections()
+          last_idle_check = now
+    finally:
+      for connection in list(self.connections):
+        connection.close()
+      self.waker.close()
+      self.close()
+      self.reactor.Close()
+      self.stopped.set()
+
+  def shutdown(self):
+    """Stops the event loop and waits for it to exit."""
+    self.running = False
+    self.waker.Wake()
+    self.stopped.wait()
+
+
+def _NewServer(server_address, frontend=None, listening_socket=None):
+  if config.CONFIG["Frontend.event_loop"]:
+    return GRREventLoopServer(
+        server_address, frontend=frontend, listening_socket=listening_socket)
+  return GRRHTTPServer(
+      server_address,
+      GRRHTTPServerHandler,
+      frontend=frontend,
+      listening_socket=listening_socket)
+
+
+def _FrontendAddresses():
+  """Yields the addresses to try binding to, in order."""
   max_port = config.CONFIG.Get("Frontend.port_max",
                                config.CONFIG["Frontend.bind_port"])
 
   for port in range(config.CONFIG["Frontend.bind_port"], max_port + 1):
+    yield (config.CONFIG["Frontend.bind_address"], port), port < max_port
+
+
+def CreateServer(frontend=None, listening_socket=None):
+  """Start frontend http server.
+
+  Args:
+    frontend: The FrontEndServer to use, by default one is created.
+    listening_socket: A bound socket to accept connections from. If not given,
+      the server binds the first free port in the configured range.
 
-    server_address = (config.CONFIG["Frontend.bind_address"], port)
+  Returns:
+    The server.
+  """
+  if listening_socket is not None:
+    return _NewServer(
+        listening_socket.getsockname(),
+        frontend=frontend,
+        listening_socket=listening_socket)
+
+  for server_address, more_ports in _FrontendAddresses():
     try:
-      httpd = GRRHTTPServer(
-          server_address, GRRHTTPServerHandler, frontend=frontend)
+      httpd = _NewServer(server_address, frontend=frontend)
       break
     except socket.error as e:
-      if e.errno == socket.errno.EADDRINUSE and port < max_port:
-        logging.info("Port %s in use, trying %s", port, port + 1)
+      if e.errno == socket.errno.EADDRINUSE and more_ports:
+        logging.info("Port %s in use, trying %s", server_address[1],
+                     server_address[1] + 1)
       else:
         raise
 
@@ -364,21 +1013,148 @@ def CreateServer(frontend=None):
   return httpd
 
 
+def _CreateListeningSocket():
+  """Binds the first free port in the configured range."""
+  for server_address, more_ports in _FrontendAddresses():
+    listening_socket = socket.socket(
+        _AddressFamily(server_address), socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+      listening_socket.bind(server_address)
+      break
+    except socket.error as e:
+      listening_socket.close()
+      if e.errno == socket.errno.EADDRINUSE and more_ports:
+        logging.info("Port %s in use, trying %s", server_address[1],
+                     server_address[1] + 1)
+      else:
+        raise
+
+  listening_socket.listen(GRRHTTPServer.request_queue_size)
+  # All processes wait for connections on this socket and only one of them
+  # gets to accept each, the others must not block.
+  listening_socket.setblocking(False)
+  sa = listening_socket.getsockname()
+  logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
+  return listening_socket
+
+
+def _StopOnSignal(unused_signum, unused_frame):
+  """Makes serve_forever return so the frontend can be stopped cleanly."""
+  raise KeyboardInterrupt()
+
+
+def _Serve(httpd):
+  """Serves requests until interrupted, then stops the frontend."""
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    logging.info("Caught keyboard interrupt, stopping")
+  finally:
+    httpd.frontend.Stop()
+
+
+def _RunFrontendProcess(index, listening_socket):
+  """Initializes and runs a process forked by ServeInProcesses."""
+  signal.signal(signal.SIGTERM, _StopOnSignal)
+  signal.signal(signal.SIGINT, _StopOnSignal)
+
+  # Every process runs its own monitoring server.
+  monitoring_port = config.CONFIG["Monitoring.http_port"]
+  if monitoring_port:
+    config.CONFIG.Set("Monitoring.http_port", monitoring_port + index)
+
+  server_startup.Init()
+  _Serve(CreateServer(listening_socket=listening_socket))
+
+
+def ServeInProcesses(processes):
+  """Runs the frontend in several processes sharing one port.
+
+  This process binds the port, sets up the caches the frontend processes share
+  and forks them. Processes that exit are restarted, so the shared caches
+  survive them.
+
+  Args:
+    processes: The number of frontend processes to run.
+  """
+  listening_socket = _CreateListeningSocket()
+  shared_cache.CreateCaches()
+  server_startup.DropPrivileges()
+
+  # The index of each running process, by pid.
+  children = {}
+  stopping = []
+
+  def Stop(unused_signum, unused_frame):
+    stopping.append(True)
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+  signal.signal(signal.SIGTERM, Stop)
+  signal.signal(signal.SIGINT, Stop)
+
+  while True:
+    if not stopping:
+      running = set(children.itervalues())
+      for index in xrange(processes):
+        if index in running:
+          continue
+
+        pid = os.fork()
+        if pid == 0:
+          try:
+            _RunFrontendProcess(index, listening_socket)
+          except Exception:  # pylint: disable=broad-except
+            logging.exception("Frontend process %d failed.", index)
+          finally:
+            os._exit(1)  # pylint: disable=protected-access
+
+        children[pid] = index
+        # Stop() may have run between the fork and the line above.
+        if stopping:
+          os.kill(pid, signal.SIGTERM)
+
+    if not children:
+      break
+
+    try:
+      pid, status = os.wait()
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+
+    children.pop(pid, None)
+    if not stopping:
+      logging.warning("Frontend process %d exited with status %d, restarting.",
+                      pid, status)
+      # Do not restart failing processes in a tight loop.
+      time.sleep(1)
+
+
 def main(argv):
   """Main."""
   del argv  # Unused.
   config.CONFIG.AddContext("HTTPServer Context")
 
+  server_startup.InitConfig()
+  processes = config.CONFIG["Frontend.processes"]
+  if processes > 1:
+    ServeInProcesses(processes)
+    return
+
   server_startup.Init()
 
   httpd = CreateServer()
 
   server_startup.DropPrivileges()
 
-  try:
-    httpd.serve_forever()
-  except KeyboardInterrupt:
-    print "Caught keyboard interrupt, stopping"
+  signal.signal(signal.SIGTERM, _StopOnSignal)
+  _Serve(httpd)
 
 
 if __name__ == "__main__":
@@ -3,8 +3,12 @@
 
 import hashlib
 import os
+import select
+import signal
 import socket
 import threading
+import time
+import unittest
 
 
 import ipaddr
@@ -21,6 +25,8 @@ from grr.lib.rdfvalues import rekall_types as rdf_rekall_types
 from grr.server import aff4
 from grr.server import flow
 from grr.server import front_end
+from grr.server import shared_cache
+from grr.server import threadpool
 from grr.server.aff4_objects import aff4_grr
 from grr.server.aff4_objects import filestore
 from grr.server.flows.general import file_finder
@@ -53,8 +59,7 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     # Bring up a local server for testing.
     port = portpicker.PickUnusedPort()
     ip = utils.ResolveHostnameToIP("localhost", port)
-    cls.httpd = frontend.GRRHTTPServer((ip, port),
-                                       frontend.GRRHTTPServerHandler)
+    cls.httpd = cls.CreateHTTPServer((ip, port))
 
     if ipaddr.IPAddress(ip).version == 6:
       cls.address_family = socket.AF_INET6
@@ -67,6 +72,10 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     cls.httpd_thread.daemon = True
     cls.httpd_thread.start()
 
+  @classmethod
+  def CreateHTTPServer(cls, server_address):
+    return frontend.GRRHTTPServer(server_address, frontend.GRRHTTPServerHandler)
+
   @classmethod
   def tearDownClass(cls):
     cls.httpd.shutdown()
@@ -281,6 +290,194 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
 
+class GRREventLoopServerTest(GRRHTTPServerTest):
+  """Runs the http server tests against the event loop server."""
+
+  @classmethod
+  def CreateHTTPServer(cls, server_address):
+    return frontend.GRREventLoopServer(server_address, worker_threads=4)
+
+  def _Connect(self):
+    ip, port = self.httpd.server_address[:2]
+    return socket.create_connection((ip, port))
+
+  def _ReadResponse(self, sock):
+    fd = sock.makefile("rb")
+    status_line = fd.readline()
+    headers = {}
+    while True:
+      line = fd.readline().strip()
+      if not line:
+        break
+      name, _, value = line.partition(":")
+      headers[name.lower()] = value.strip()
+    body = fd.read(int(headers["content-length"]))
+    return int(status_line.split()[1]), headers, body
+
+  def testKeepAlive(self):
+    sock = self._Connect()
+    try:
+      for _ in range(3):
+        sock.sendall("GET /server.pem HTTP/1.1\r\nHost: grr\r\n\r\n")
+        status, headers, body = self._ReadResponse(sock)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["connection"], "keep-alive")
+        self.assertTrue("BEGIN CERTIFICATE" in body)
+    finally:
+      sock.close()
+
+  def testConnectionClose(self):
+    sock = self._Connect()
+    try:
+      sock.sendall("GET /server.pem HTTP/1.1\r\nConnection: close\r\n\r\n")
+      status, headers, _ = self._ReadResponse(sock)
+      self.assertEqual(status, 200)
+      self.assertEqual(headers["connection"], "close")
+      self.assertEqual(sock.recv(1), "")
+    finally:
+      sock.close()
+
+  def testBadRequest(self):
+    sock = self._Connect()
+    try:
+      sock.sendall("NOT HTTP\r\n\r\n")
+      status, _, _ = self._ReadResponse(sock)
+      self.assertEqual(status, 400)
+    finally:
+      sock.close()
+
+  def testRetryWhenSaturated(self):
+
+    def Full(*unused_args, **unused_kwargs):
+      raise threadpool.Full()
+
+    with utils.Stubber(self.httpd.pool, "AddTask", Full):
+      req = requests.post(self.base_url + "control?api=3", data="")
+
+    self.assertEqual(req.status_code, 503)
+    self.assertEqual(req.headers["Retry-After"], "10")
+
+
+class _RecordingEventLoopServer(object):
+  """The parts of GRREventLoopServer a connection uses, recording requests."""
+
+  def __init__(self):
+    self.socket_map = {}
+    # pylint: disable=protected-access
+    self.reactor = frontend._Reactor(self.socket_map)
+    # pylint: enable=protected-access
+    self.connections = set()
+    self.requests = []
+
+  def Dispatch(self, connection, request):
+    self.requests.append((connection, request.path))
+
+
+@unittest.skipUnless(hasattr(select, "epoll"), "Requires epoll.")
+class ReactorTest(test_lib.GRRBaseTest):
+  """Tests the epoll based reactor of the event loop server."""
+
+  def _Serve(self, server, connection, path):
+    server.requests = []
+    deadline = time.time() + 5
+    while not server.requests and time.time() < deadline:
+      server.reactor.Poll(0.1)
+    self.assertEqual(server.requests, [(connection, path)])
+
+  def testReusedFileDescriptorIsRegisteredAgain(self):
+    server = _RecordingEventLoopServer()
+    self.addCleanup(server.reactor.Close)
+
+    sock, peer = socket.socketpair()
+    self.addCleanup(peer.close)
+    connection = frontend.EventLoopConnection(sock, ("127.0.0.1", 0), server)
+    server.reactor.Modified(connection)
+    peer.sendall("GET /first HTTP/1.1\r\n\r\n")
+    self._Serve(server, connection, "/first")
+
+    # Close the idle connection and reconnect in the same poll round. The new
+    # socket gets the same file descriptor and waits for the same events.
+    fd = sock.fileno()
+    connection.close()
+    sock, peer = socket.socketpair()
+    self.addCleanup(peer.close)
+    self.addCleanup(sock.close)
+    self.assertEqual(sock.fileno(), fd)
+    connection = frontend.EventLoopConnection(sock, ("127.0.0.1", 0), server)
+    server.reactor.Modified(connection)
+
+    peer.sendall("GET /second HTTP/1.1\r\n\r\n")
+    self._Serve(server, connection, "/second")
+
+
+class ServeInProcessesTest(test_lib.GRRBaseTest):
+  """Tests running the frontend in several processes."""
+
+  def setUp(self):
+    super(ServeInProcessesTest, self).setUp()
+    self.port = portpicker.PickUnusedPort()
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Frontend.bind_address": "127.0.0.1",
+        "Frontend.bind_port": self.port,
+        "Frontend.shared_cache_size": 10,
+    })
+    self.config_overrider.Start()
+    self.caches_stubber = utils.Stubber(shared_cache, "_caches", {})
+    self.caches_stubber.Start()
+
+    self.old_handlers = [(signum, signal.getsignal(signum))
+                         for signum in (signal.SIGTERM, signal.SIGINT)]
+
+  def tearDown(self):
+    for signum, handler in self.old_handlers:
+      signal.signal(signum, handler)
+    self.caches_stubber.Stop()
+    self.config_overrider.Stop()
+    super(ServeInProcessesTest, self).tearDown()
+
+  def testProcessesAreRestartedAndStopped(self):
+    read_fd, write_fd = os.pipe()
+
+    def Marker(name, index):
+      return os.path.join(self.temp_dir, "%s_%d" % (name, index))
+
+    def RunFrontendProcess(index, listening_socket):
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      restarted = os.path.exists(Marker("started", index))
+      open(Marker("started", index), "w").close()
+      os.write(write_fd, "%d %d %d %d\n" %
+               (index, restarted, listening_socket.getsockname()[1],
+                shared_cache.GetCache("ciphers") is not None))
+      if not restarted:
+        # The first run of each process fails.
+        return
+
+      # Once both processes were restarted, the parent is asked to stop.
+      open(Marker("restarted", index), "w").close()
+      if all(os.path.exists(Marker("restarted", i)) for i in (0, 1)):
+        os.kill(os.getppid(), signal.SIGTERM)
+      signal.pause()
+
+    def Timeout(unused_signum, unused_frame):
+      raise AssertionError("Frontend processes were not stopped.")
+
+    signal.signal(signal.SIGALRM, Timeout)
+    signal.alarm(60)
+    try:
+      with utils.Stubber(frontend, "_RunFrontendProcess", RunFrontendProcess):
+        frontend.ServeInProcesses(2)
+    finally:
+      signal.alarm(0)
+      signal.signal(signal.SIGALRM, signal.SIG_DFL)
+      os.close(write_fd)
+
+    # ServeInProcesses returns once all processes have exited.
+    with os.fdopen(read_fd) as pipe:
+      starts = [tuple(int(x) for x in line.split()) for line in pipe]
+    self.assertItemsEqual(starts, [(0, 0, self.port, 1), (1, 0, self.port, 1),
+                                   (0, 1, self.port, 1), (1, 1, self.port, 1)])
+
+
 def main(args):
   test_lib.main(args)
 
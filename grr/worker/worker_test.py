@@ -10,6 +10,7 @@ from grr import config
 from grr.lib import flags
 from grr.lib import queues
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
@@ -342,6 +343,103 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
         flow_obj.context.state == rdf_flows.FlowContext.State.TERMINATED)
     self.assertEqual(flow_obj.context.current_state, "End")
 
+  def testProcessMessagesInBatches(self):
+    """Test processing of several flows by a single batch task."""
+    session_ids = []
+    for flow_name in ["WorkerSendingTestFlow", "WorkerSendingTestFlow2"]:
+      flow_obj = self.FlowSetup(flow_name)
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id, data in zip(session_ids, ["Hello1", "Hello2"]):
+      self.SendResponse(session_id, data)
+
+    # One of the flows can not be locked.
+    locked_session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id,
+        flow_name="WorkerSendingTestFlow",
+        token=self.token)
+    self.SendResponse(locked_session_id, "Locked")
+
+    worker_obj = worker.GRRWorker(batch_size=10, token=self.token)
+    with aff4.FACTORY.OpenWithLock(locked_session_id, token=self.token):
+      worker_obj.RunOnce()
+      worker_obj.thread_pool.Join()
+
+    self.assertEqual(sorted(RESULTS), ["Hello1", "Hello2"])
+
+    # Processed requests are removed from the flow state.
+    self.assertEqual(
+        len(list(data_store.DB.ReadRequestsAndResponses(session_ids[0]))), 9)
+    flow_obj = aff4.FACTORY.Open(session_ids[1], token=self.token)
+    self.assertEqual(flow_obj.context.state,
+                     rdf_flows.FlowContext.State.TERMINATED)
+
+    # The notification for the flow we could not lock is still there.
+    manager = queue_manager.QueueManager(token=self.token)
+    notifications = manager.GetNotifications(queues.FLOWS)
+    self.assertEqual([n.session_id for n in notifications],
+                     [locked_session_id])
+
+  def testProcessMessagesWithReadCache(self):
+    """Test processing flows with the data store read cache enabled."""
+    session_ids = []
+    for flow_name in ["WorkerSendingTestFlow", "WorkerSendingTestFlow2"]:
+      flow_obj = self.FlowSetup(flow_name)
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id, data in zip(session_ids, ["Hello1", "Hello2"]):
+      self.SendResponse(session_id, data)
+
+    with test_lib.ConfigOverrider({"Worker.datastore_read_cache": True}):
+      worker_obj = worker.GRRWorker(token=self.token)
+
+    hits = stats.STATS.GetMetricValue("datastore_read_cache_hits")
+    worker_obj.RunOnce()
+    worker_obj.thread_pool.Join()
+
+    self.assertEqual(sorted(RESULTS), ["Hello1", "Hello2"])
+    self.assertGreater(
+        stats.STATS.GetMetricValue("datastore_read_cache_hits"), hits)
+
+    flow_obj = aff4.FACTORY.Open(session_ids[1], token=self.token)
+    self.assertEqual(flow_obj.context.state,
+                     rdf_flows.FlowContext.State.TERMINATED)
+
+  def testProcessMessagesFromLeasedShards(self):
+    """Test workers only processing the notification shards they lease."""
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 2}):
+      session_ids = []
+      for flow_name in ["WorkerSendingTestFlow", "WorkerSendingTestFlow2"]:
+        flow_obj = self.FlowSetup(flow_name)
+        session_ids.append(flow_obj.session_id)
+        flow_obj.Close()
+
+      for session_id, data in zip(session_ids, ["Hello1", "Hello2"]):
+        self.SendResponse(session_id, data)
+
+      worker_1 = worker.GRRWorker(shards_per_worker=1, token=self.token)
+      worker_2 = worker.GRRWorker(shards_per_worker=1, token=self.token)
+      try:
+        worker_1.RunOnce()
+        worker_1.thread_pool.Join()
+        worker_2.RunOnce()
+        worker_2.thread_pool.Join()
+
+        # Each worker owns one of the two shards of the flows queue.
+        shards_1 = worker_1.shard_leases[queues.FLOWS].leases.keys()
+        shards_2 = worker_2.shard_leases[queues.FLOWS].leases.keys()
+        self.assertEqual(len(shards_1), 1)
+        self.assertEqual(len(shards_2), 1)
+        self.assertNotEqual(shards_1, shards_2)
+      finally:
+        worker_1.ReleaseShardLeases()
+        worker_2.ReleaseShardLeases()
+
+      self.assertEqual(sorted(RESULTS), ["Hello1", "Hello2"])
+      self.assertFalse(worker_1.shard_leases)
+
   def testNoNotificationRescheduling(self):
     """Test that no notifications are rescheduled when a flow raises."""
 